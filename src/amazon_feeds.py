@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Работа с Amazon Feeds API: документ фида, загрузка содержимого,
+создание фида, ожидание обработки и скачивание отчета об обработке
+"""
+import gzip
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, List, Optional
+
+import requests
+from metrics import observe_http, observe_response, stage_timer
+from sp_api_router import get_router
+from structured_log import get_logger
+from tracing import current_span, http_span, span
+from test_integration import AmazonSandboxClient
+
+FEEDS_API_VERSION = "2021-06-30"
+
+# Лимит getFeedDocument: 0.0222 req/s (burst 10) - самый тесный в цикле фида
+GET_FEED_DOCUMENT_RATE = (0.0222, 10)
+
+log = get_logger('feeds')
+
+# Статусы фида, после которых ждать больше нечего
+FEED_FINAL_STATUSES = ('DONE', 'CANCELLED', 'FATAL')
+
+XML_CONTENT_TYPE = 'text/xml; charset=UTF-8'
+JSON_CONTENT_TYPE = 'application/json; charset=UTF-8'
+
+
+class FeedWaitCancelled(Exception):
+    """Ожидание фида прервано остановкой процесса - фид создан, отчет можно забрать позже по feed_id"""
+
+    def __init__(self, feed_id: str):
+        super().__init__(f"ожидание фида {feed_id} прервано")
+        self.feed_id = feed_id
+
+
+class AmazonFeedSubmitter:
+    """Отправляет фид Amazon и дожидается отчета об обработке"""
+
+    def __init__(self, client: AmazonSandboxClient = None, poll_interval: int = 30, timeout: int = 3600,
+                 stop_event: threading.Event = None):
+        self.client = client or AmazonSandboxClient()
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        # Установленный stop_event прерывает ожидание обработки (FeedWaitCancelled) - для SIGTERM демона
+        self.stop_event = stop_event or threading.Event()
+        # Общий на процесс bucket: несколько отправителей (потоки демона) делят один лимит
+        self.document_bucket = get_router().limiter(self.client.sandbox_url, 'getFeedDocument',
+                                                    *GET_FEED_DOCUMENT_RATE)
+
+    def upload_document(self, content: bytes, content_type: str = XML_CONTENT_TYPE) -> Optional[str]:
+        """Создает документ фида, загружает в него содержимое и возвращает feedDocumentId"""
+        document = self.client.make_api_request(
+            f"/feeds/{FEEDS_API_VERSION}/documents",
+            method='POST',
+            data={'contentType': content_type}
+        )
+        if not document or not document.get('url'):
+            log.error('feed.document_create_failed', content_type=content_type)
+            return None
+
+        started = time.perf_counter()
+        try:
+            with http_span('documents', 'PUT', document['url'], bytes=len(content)):
+                response = requests.put(document['url'], data=content, headers={'Content-Type': content_type})
+            observe_response('documents', response, time.perf_counter() - started)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if e.response is None:
+                observe_http('documents', 'PUT', document['url'], 'error', time.perf_counter() - started,
+                             len(content))
+            log.error('feed.upload_failed', document_id=document['feedDocumentId'], error=str(e))
+            return None
+
+        log.info('feed.uploaded', document_id=document['feedDocumentId'], bytes=len(content))
+        return document['feedDocumentId']
+
+    def create_feed(self, feed_type: str, marketplace_ids: List[str], document_id: str) -> Optional[str]:
+        """Создает фид из загруженного документа и возвращает feedId"""
+        response = self.client.make_api_request(
+            f"/feeds/{FEEDS_API_VERSION}/feeds",
+            method='POST',
+            data={'feedType': feed_type, 'marketplaceIds': marketplace_ids, 'inputFeedDocumentId': document_id}
+        )
+        if not response or not response.get('feedId'):
+            log.error('feed.create_failed', feed_type=feed_type, document_id=document_id)
+            return None
+        log.info('feed.created', feed_type=feed_type, feed_id=response['feedId'])
+        current_span().set(feed_id=response['feedId'])
+        return response['feedId']
+
+    def wait_for_feed(self, feed_id: str) -> Optional[str]:
+        """Ждет обработки фида и возвращает resultFeedDocumentId; stop_event - FeedWaitCancelled"""
+        deadline = time.monotonic() + self.timeout
+
+        with span('feed.wait', feed_id=feed_id) as wait_span:
+            polls = 0
+            while time.monotonic() < deadline:
+                if self.stop_event.is_set():
+                    log.info('feed.wait_cancelled', feed_id=feed_id, polls=polls)
+                    raise FeedWaitCancelled(feed_id)
+                feed = self.client.make_api_request(f"/feeds/{FEEDS_API_VERSION}/feeds/{feed_id}")
+                status = feed.get('processingStatus') if feed else None
+                polls += 1
+                wait_span.set(status=status, polls=polls)
+
+                if status == 'DONE':
+                    log.info('feed.done', feed_id=feed_id, result_document_id=feed.get('resultFeedDocumentId'))
+                    return feed.get('resultFeedDocumentId')
+                if status in FEED_FINAL_STATUSES:
+                    log.error('feed.failed', feed_id=feed_id, status=status)
+                    wait_span.fail(status)
+                    return None
+
+                log.info('feed.waiting', feed_id=feed_id, status=status, poll_interval=self.poll_interval)
+                self.stop_event.wait(self.poll_interval)
+
+            log.error('feed.timeout', feed_id=feed_id, timeout=self.timeout)
+            wait_span.fail('timeout')
+            return None
+
+    def download_result(self, document_id: str) -> Optional[str]:
+        """Скачивает отчет об обработке фида (с распаковкой GZIP)"""
+        self.document_bucket.acquire()
+        document = self.client.make_api_request(f"/feeds/{FEEDS_API_VERSION}/documents/{document_id}")
+        if not document or not document.get('url'):
+            log.error('feed.document_missing', document_id=document_id)
+            return None
+
+        started = time.perf_counter()
+        try:
+            with http_span('documents', 'GET', document['url']):
+                response = requests.get(document['url'])
+            observe_response('documents', response, time.perf_counter() - started)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if e.response is None:
+                observe_http('documents', 'GET', document['url'], 'error', time.perf_counter() - started)
+            log.error('feed.download_failed', document_id=document_id, error=str(e))
+            return None
+
+        content = response.content
+        if document.get('compressionAlgorithm') == 'GZIP':
+            content = gzip.decompress(content)
+        return content.decode('utf-8', errors='replace')
+
+    def submit(self, feed_type: str, marketplace_ids: List[str], content: bytes,
+               content_type: str = XML_CONTENT_TYPE,
+               on_progress: Callable[[str, str], None] = None) -> Optional[str]:
+        """
+        Полный цикл: загрузить документ, создать фид, дождаться и скачать отчет об обработке.
+
+        on_progress('uploaded', feedDocumentId) и on_progress('created', feedId) вызываются
+        сразу после шага - так журнал заданий знает, можно ли отправлять фид повторно.
+        """
+        with span('feed.submit', feed_type=feed_type, marketplace_id=','.join(marketplace_ids),
+                  bytes=len(content)):
+            return self._submit(feed_type, marketplace_ids, content, content_type, on_progress)
+
+    def _submit(self, feed_type: str, marketplace_ids: List[str], content: bytes, content_type: str,
+                on_progress: Callable[[str, str], None] = None) -> Optional[str]:
+        with stage_timer('upload'):
+            document_id = self.upload_document(content, content_type)
+            if not document_id:
+                return None
+            if on_progress:
+                on_progress('uploaded', document_id)
+
+            feed_id = self.create_feed(feed_type, marketplace_ids, document_id)
+            if not feed_id:
+                return None
+            if on_progress:
+                on_progress('created', feed_id)
+
+        return self.resume(feed_id)
+
+    def resume(self, feed_id: str) -> Optional[str]:
+        """Дожидается уже созданного фида и скачивает отчет (продолжение после перезапуска)"""
+        with stage_timer('poll'):
+            result_id = self.wait_for_feed(feed_id)
+        if not result_id:
+            return None
+
+        return self.download_result(result_id)
+
+
+def parse_processing_report(xml_text: str) -> Dict:
+    """Итоги XML-отчета об обработке: счетчики ProcessingSummary и ошибки по сообщениям"""
+    root = ET.fromstring(xml_text.encode('utf-8'))
+    summary = root.find('.//ProcessingSummary')
+    counts = {
+        child.tag: int(child.text or 0)
+        for child in (summary if summary is not None else [])
+    }
+
+    results = []
+    for result in root.iter('Result'):
+        results.append({
+            'message_id': result.findtext('MessageID'),
+            'code': result.findtext('ResultCode'),
+            'message_code': result.findtext('ResultMessageCode'),
+            'description': result.findtext('ResultDescription'),
+            'sku': result.findtext('AdditionalInfo/SKU'),
+        })
+
+    return {'status': root.findtext('.//StatusCode'), 'summary': counts, 'results': results}
+
+
+def report_errors(report: Dict, message_skus: List[str] = None) -> Dict[str, str]:
+    """
+    SKU → первая ошибка из разобранного отчета (parse_processing_report).
+
+    Если отчет не указал SKU, он находится по MessageID: message_skus[i] - SKU
+    сообщения с MessageID i + 1.
+    """
+    errors = {}
+    for result in report['results']:
+        if result['code'] != 'Error':
+            continue
+        sku = result['sku']
+        if not sku and message_skus and result['message_id']:
+            index = int(result['message_id']) - 1
+            sku = message_skus[index] if 0 <= index < len(message_skus) else None
+        if sku:
+            errors.setdefault(sku, f"{result['message_code']}: {result['description']}")
+    return errors
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Работа с Amazon Reports API: создание отчета, ожидание готовности,
+скачивание документа отчета и разбор плоских (TSV) отчетов
+
+    python src/amazon_reports.py --report-type GET_MERCHANT_LISTINGS_ALL_DATA --marketplaces UK --output listings.tsv
+"""
+import argparse
+import csv
+import gzip
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import requests
+from get_product_schema import AmazonProductSchemaClient
+from metrics import observe_http, observe_response, stage_timer
+from structured_log import get_logger
+from tracing import http_span, span
+from test_integration import AmazonSandboxClient
+
+REPORTS_API_VERSION = "2021-06-30"
+
+log = get_logger('reports')
+
+# Статусы отчета, после которых ждать больше нечего
+REPORT_FINAL_STATUSES = ('DONE', 'CANCELLED', 'FATAL')
+
+
+class AmazonReportFetcher:
+    """Создает отчет Amazon, дожидается его и скачивает документ"""
+
+    def __init__(self, client: AmazonSandboxClient = None, poll_interval: int = 30, timeout: int = 1800):
+        self.client = client or AmazonSandboxClient()
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def create_report(self, report_type: str, marketplace_ids: List[str]) -> Optional[str]:
+        """Создает отчет и возвращает его reportId"""
+        response = self.client.make_api_request(
+            f"/reports/{REPORTS_API_VERSION}/reports",
+            method='POST',
+            data={'reportType': report_type, 'marketplaceIds': marketplace_ids}
+        )
+        if not response or not response.get('reportId'):
+            log.error('report.create_failed', report_type=report_type)
+            return None
+        log.info('report.created', report_type=report_type, report_id=response['reportId'])
+        return response['reportId']
+
+    def wait_for_report(self, report_id: str) -> Optional[str]:
+        """Ждет готовности отчета и возвращает reportDocumentId"""
+        deadline = time.monotonic() + self.timeout
+
+        while time.monotonic() < deadline:
+            report = self.client.make_api_request(f"/reports/{REPORTS_API_VERSION}/reports/{report_id}")
+            status = report.get('processingStatus') if report else None
+
+            if status == 'DONE':
+                log.info('report.done', report_id=report_id, document_id=report.get('reportDocumentId'))
+                return report.get('reportDocumentId')
+            if status in REPORT_FINAL_STATUSES:
+                log.error('report.failed', report_id=report_id, status=status)
+                return None
+
+            log.info('report.waiting', report_id=report_id, status=status, poll_interval=self.poll_interval)
+            time.sleep(self.poll_interval)
+
+        log.error('report.timeout', report_id=report_id, timeout=self.timeout)
+        return None
+
+    def download_document(self, document_id: str) -> Optional[str]:
+        """Скачивает документ отчета (с распаковкой GZIP) и возвращает текст"""
+        document = self.client.make_api_request(f"/reports/{REPORTS_API_VERSION}/documents/{document_id}")
+        if not document or not document.get('url'):
+            log.error('report.document_missing', document_id=document_id)
+            return None
+
+        started = time.perf_counter()
+        try:
+            with http_span('documents', 'GET', document['url']):
+                response = requests.get(document['url'])
+            observe_response('documents', response, time.perf_counter() - started)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if e.response is None:
+                observe_http('documents', 'GET', document['url'], 'error', time.perf_counter() - started)
+            log.error('report.download_failed', document_id=document_id, error=str(e))
+            return None
+
+        content = response.content
+        if document.get('compressionAlgorithm') == 'GZIP':
+            content = gzip.decompress(content)
+
+        # Плоские отчеты в ряде маркетплейсов приходят в cp1252, а не в UTF-8
+        try:
+            return content.decode('utf-8')
+        except UnicodeDecodeError:
+            return content.decode(response.encoding or 'cp1252', errors='replace')
+
+    def fetch_report(self, report_type: str, marketplace_ids: List[str]) -> Optional[str]:
+        """Полный цикл: создать отчет, дождаться и скачать"""
+        with span('report.fetch', report_type=report_type, marketplace_id=','.join(marketplace_ids)):
+            return self._fetch_report(report_type, marketplace_ids)
+
+    def _fetch_report(self, report_type: str, marketplace_ids: List[str]) -> Optional[str]:
+        report_id = self.create_report(report_type, marketplace_ids)
+        if not report_id:
+            return None
+
+        with stage_timer('poll'):
+            document_id = self.wait_for_report(report_id)
+        if not document_id:
+            return None
+
+        return self.download_document(document_id)
+
+
+def iter_flat_report_rows(lines: Iterable[str]) -> Iterator[Dict[str, str]]:
+    """Построчно разбирает плоский TSV-отчет Amazon (первая строка - заголовок)"""
+    reader = csv.DictReader(lines, delimiter='\t', quoting=csv.QUOTE_NONE)
+    for row in reader:
+        yield row
+
+
+def main():
+    """Скачивание одного отчета Amazon в файл"""
+    parser = argparse.ArgumentParser(description='Создание и скачивание отчета Amazon Reports API')
+    parser.add_argument('--report-type', required=True,
+                        help='Тип отчета (GET_MERCHANT_LISTINGS_ALL_DATA, GET_FLAT_FILE_OPEN_LISTINGS_DATA, ...)')
+    parser.add_argument('--marketplaces', nargs='+', default=['USA'],
+                        help='Названия маркетплейсов (USA, UK, AUSTRALIA, ...), по умолчанию USA')
+    parser.add_argument('--output', help='Файл для отчета, по умолчанию <report-type>.tsv')
+    parser.add_argument('--poll-interval', type=int, default=30, help='Пауза между опросами статуса, сек')
+    args = parser.parse_args()
+
+    print("📄 REPORTS: скачивание отчета Amazon")
+    print("=" * 60)
+
+    schema_client = AmazonProductSchemaClient()
+    names = [name.upper() for name in args.marketplaces]
+    unknown = [name for name in names if name not in schema_client.marketplaces]
+    if unknown:
+        print(f"❌ Неизвестные маркетплейсы: {unknown}")
+        return
+    marketplace_ids = [schema_client.marketplaces[name] for name in names]
+
+    fetcher = AmazonReportFetcher(schema_client.base_client, poll_interval=args.poll_interval)
+    text = fetcher.fetch_report(args.report_type, marketplace_ids)
+    if text is None:
+        print(f"❌ Отчет {args.report_type} не получен")
+        return
+
+    output = args.output or f"{args.report_type}.tsv"
+    with open(output, 'w', encoding='utf-8') as f:
+        f.write(text)
+    print(f"✅ {args.report_type}: {len(text.splitlines())} строк → {output}")
+
+
+if __name__ == "__main__":
+    main()
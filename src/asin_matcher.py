@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Сопоставление товаров Shopify с существующими ASIN по штрихкодам
+
+- штрихкод нормализуется (пробелы, дефисы, потерянный ведущий ноль)
+  и проверяется по контрольной цифре: UPC-A, EAN-8/13, GTIN-14, ISBN-10/13
+- поиск идет пачками по searchCatalogItems (до 20 идентификаторов на запрос,
+  отдельно по каждому identifiersType, со всеми страницами ответа)
+- ответы, в том числе "не найдено", кэшируются в хранилище соответствий с TTL
+- найденные ASIN и productType записываются для SKU, чтобы не создавать
+  дубли листингов и не запрашивать каталог по одному ASIN
+"""
+import argparse
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from get_product_schema import AmazonProductSchemaClient
+from mapping_store import MappingStore
+from metrics import record_retry
+from settings import load_settings
+from sp_api_router import get_router
+from structured_log import get_logger
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+CATALOG_ITEMS_ENDPOINT = "/catalog/2022-04-01/items"
+
+log = get_logger('asin_matcher')
+
+# searchCatalogItems: до 20 идентификаторов в запросе, лимит 2 запроса/сек, burst 2
+MAX_IDENTIFIERS_PER_REQUEST = 20
+SEARCH_CATALOG_ITEMS_RATE = (2, 2)
+
+MAX_ATTEMPTS = 3
+
+# Найденный ASIN почти не меняется, а "не найдено" может устареть в любой момент
+POSITIVE_TTL = 30 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+
+
+def gs1_check_digit_ok(digits: str) -> bool:
+    """Контрольная цифра GS1 (UPC, EAN, GTIN-14, ISBN-13): веса 3 и 1 справа налево"""
+    total = 0
+    for position, digit in enumerate(reversed(digits[:-1])):
+        total += int(digit) * (3 if position % 2 == 0 else 1)
+    return (10 - total % 10) % 10 == int(digits[-1])
+
+
+def isbn10_check_digit_ok(value: str) -> bool:
+    total = 0
+    for position, char in enumerate(value):
+        digit = 10 if char == 'X' else int(char)
+        total += digit * (10 - position)
+    return total % 11 == 0
+
+
+def isbn10_to_isbn13(value: str) -> str:
+    body = '978' + value[:9]
+    for check in range(10):
+        if gs1_check_digit_ok(body + str(check)):
+            return body + str(check)
+    raise ValueError(value)
+
+
+def normalize_barcode(raw) -> Optional[Dict]:
+    """
+    Нормализует штрихкод: {'type': UPC|EAN|ISBN|GTIN, 'value': ..., 'gtin': GTIN-14}.
+
+    'type' и 'value' - то, что ждут StandardProductID и identifiersType,
+    'gtin' - единый ключ кэша для разных записей одного и того же кода.
+    None - пустой или невалидный штрихкод.
+    """
+    if raw is None:
+        return None
+    value = str(raw).strip().upper().replace('-', '').replace(' ', '')
+    if not value:
+        return None
+
+    # ISBN-10 может заканчиваться на X
+    if len(value) == 10 and value[:9].isdigit() and (value[9].isdigit() or value[9] == 'X'):
+        if not isbn10_check_digit_ok(value):
+            return None
+        return {'type': 'ISBN', 'value': value, 'gtin': isbn10_to_isbn13(value).zfill(14)}
+
+    if not value.isdigit():
+        return None
+
+    # Таблицы часто теряют ведущий ноль UPC-A
+    if len(value) == 11:
+        value = '0' + value
+    # GTIN-14 и EAN-13 с ведущими нулями - это более короткий код
+    while len(value) in (13, 14) and value.startswith('0'):
+        value = value[1:]
+
+    if len(value) not in (8, 12, 13, 14) or not gs1_check_digit_ok(value):
+        return None
+
+    if len(value) == 12:
+        barcode_type = 'UPC'
+    elif len(value) == 13:
+        barcode_type = 'ISBN' if value.startswith(('978', '979')) else 'EAN'
+    elif len(value) == 14:
+        barcode_type = 'GTIN'
+    else:
+        barcode_type = 'EAN'
+
+    return {'type': barcode_type, 'value': value, 'gtin': value.zfill(14)}
+
+
+class AsinMatcher:
+    """Находит ASIN по штрихкодам вариантов Shopify с кэшем в MappingStore"""
+
+    def __init__(self, store: MappingStore, marketplace_id: str,
+                 schema_client: AmazonProductSchemaClient = None,
+                 positive_ttl: float = POSITIVE_TTL, negative_ttl: float = NEGATIVE_TTL):
+        self.store = store
+        self.marketplace_id = marketplace_id
+        self.schema_client = schema_client or AmazonProductSchemaClient()
+        self.client = self.schema_client.base_client
+        self.base_url = self.schema_client.get_region_endpoint(marketplace_id)
+        self.bucket = get_router().limiter(self.base_url, 'searchCatalogItems', *SEARCH_CATALOG_ITEMS_RATE)
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+
+    def _search(self, identifiers_type: str, values: List[str]) -> Optional[List[Dict]]:
+        """
+        searchCatalogItems по пачке идентификаторов одного типа.
+
+        Один штрихкод может вернуть несколько ASIN, поэтому 20 идентификаторов
+        не всегда умещаются в страницу: идем по pagination.nextToken до конца.
+        None, если не удалась хоть одна страница - тогда отсутствие в ответе
+        ничего не значит и не должно попасть в отрицательный кэш.
+        """
+        params = {
+            'identifiers': ','.join(values),
+            'identifiersType': identifiers_type,
+            'marketplaceIds': self.marketplace_id,
+            'includedData': 'identifiers,productTypes,summaries',
+            'pageSize': MAX_IDENTIFIERS_PER_REQUEST
+        }
+        items = []
+        while True:
+            response = self._search_page(identifiers_type, len(values), params)
+            if response is None:
+                return None
+            items.extend(response.get('items', []))
+
+            next_token = (response.get('pagination') or {}).get('nextToken')
+            if not next_token:
+                return items
+            params = dict(params, pageToken=next_token)
+
+    def _search_page(self, identifiers_type: str, batch: int, params: Dict) -> Optional[Dict]:
+        """Одна страница searchCatalogItems с лимитом частоты и повторами"""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.bucket.acquire()
+            response = self.client.make_api_request(CATALOG_ITEMS_ENDPOINT, params=params, base_url=self.base_url)
+            if response is not None:
+                return response
+            log.warning('catalog.retry', operation='searchCatalogItems', attempt=attempt,
+                        identifiers_type=identifiers_type, batch=batch)
+            if attempt < MAX_ATTEMPTS:
+                record_retry('sp_api', CATALOG_ITEMS_ENDPOINT)
+                self.bucket.drain()
+                time.sleep(2 ** attempt)
+        return None
+
+    def _product_type(self, item: Dict) -> Optional[str]:
+        for entry in item.get('productTypes', []):
+            if entry.get('marketplaceId') == self.marketplace_id:
+                return entry.get('productType')
+        return None
+
+    def _index_items(self, items: List[Dict]) -> Dict[str, Dict]:
+        """GTIN-14 → {'asin', 'product_type'} по идентификаторам из ответа"""
+        found = {}
+        for item in items:
+            match = {'asin': item.get('asin'), 'product_type': self._product_type(item)}
+            for group in item.get('identifiers', []):
+                if group.get('marketplaceId') not in (None, self.marketplace_id):
+                    continue
+                for identifier in group.get('identifiers', []):
+                    barcode = normalize_barcode(identifier.get('identifier'))
+                    # Первый ASIN выигрывает: у Amazon бывают дубли одного штрихкода
+                    if barcode and barcode['gtin'] not in found:
+                        found[barcode['gtin']] = match
+        return found
+
+    def lookup(self, barcodes: List[Dict]) -> Dict[str, Dict]:
+        """
+        GTIN-14 → {'asin', 'product_type'} для нормализованных штрихкодов.
+
+        Сначала кэш, затем пачки по 20 на тип идентификатора. Отсутствие
+        в успешном ответе кэшируется как отрицательный результат; если запрос
+        не удался, штрихкод не попадет ни в результат, ни в кэш.
+        """
+        unique = {barcode['gtin']: barcode for barcode in barcodes}
+        result = self.store.get_gtin_lookups(list(unique), self.marketplace_id,
+                                             self.positive_ttl, self.negative_ttl)
+
+        by_type = defaultdict(list)
+        for gtin, barcode in unique.items():
+            if gtin not in result:
+                by_type[barcode['type']].append(barcode)
+
+        if by_type and not self.client.access_token and not self.client.get_access_token():
+            raise RuntimeError("Не удалось получить access token")
+
+        for identifiers_type, pending in by_type.items():
+            for start in range(0, len(pending), MAX_IDENTIFIERS_PER_REQUEST):
+                chunk = pending[start:start + MAX_IDENTIFIERS_PER_REQUEST]
+                items = self._search(identifiers_type, [barcode['value'] for barcode in chunk])
+                if items is None:
+                    continue
+
+                found = self._index_items(items)
+                lookups = {
+                    barcode['gtin']: found.get(barcode['gtin'], {'asin': None, 'product_type': None})
+                    for barcode in chunk
+                }
+                self.store.save_gtin_lookups(self.marketplace_id, lookups)
+                result.update(lookups)
+
+        return result
+
+    def match(self, sku_barcodes: Dict[str, str]) -> Dict:
+        """
+        Сопоставляет SKU → штрихкод с ASIN и записывает найденное в хранилище.
+
+        Возвращает {'matched': {sku: {...}}, 'unmatched': [sku], 'invalid': [sku], 'failed': [sku]}
+        """
+        report = {'matched': {}, 'unmatched': [], 'invalid': [], 'failed': []}
+        normalized = {}
+        for sku, raw in sku_barcodes.items():
+            barcode = normalize_barcode(raw)
+            if barcode is None:
+                report['invalid'].append(sku)
+            else:
+                normalized[sku] = barcode
+
+        lookups = self.lookup(list(normalized.values()))
+
+        for sku, barcode in normalized.items():
+            found = lookups.get(barcode['gtin'])
+            if found is None:
+                report['failed'].append(sku)
+            elif found['asin']:
+                report['matched'][sku] = {
+                    'sku': sku,
+                    'asin': found['asin'],
+                    'product_type': found['product_type'],
+                    'matched_by': barcode['type'],
+                    'matched_value': barcode['value']
+                }
+            else:
+                report['unmatched'].append(sku)
+
+        self.store.save_sku_asins(self.marketplace_id, report['matched'].values())
+        return report
+
+
+def main():
+    """Поиск ASIN по штрихкодам всего каталога Shopify"""
+    from reconcile_catalog import iter_jsonl
+
+    parser = argparse.ArgumentParser(description='Сопоставление SKU Shopify с ASIN по штрихкодам')
+    parser.add_argument('--shopify-snapshot', required=True, help='JSONL с товарами Shopify')
+    parser.add_argument('--marketplace', default='USA', help='Название маркетплейса (USA, UK, AUSTRALIA, ...)')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    args = parser.parse_args()
+
+    print("🔎 ПОИСК ASIN ПО ШТРИХКОДАМ")
+    print("=" * 60)
+
+    schema_client = AmazonProductSchemaClient()
+    marketplace_id = schema_client.marketplaces.get(args.marketplace.upper())
+    if not marketplace_id:
+        print(f"❌ Неизвестный маркетплейс: {args.marketplace}")
+        return
+
+    sku_barcodes = {}
+    for product in iter_jsonl(args.shopify_snapshot):
+        for variant in product.get('variants', []):
+            if variant.get('sku') and variant.get('barcode'):
+                sku_barcodes[variant['sku']] = variant['barcode']
+    print(f"🔢 SKU со штрихкодом: {len(sku_barcodes)}")
+
+    store = MappingStore(args.store)
+    matcher = AsinMatcher(store, marketplace_id, schema_client)
+
+    started = time.monotonic()
+    report = matcher.match(sku_barcodes)
+    elapsed = time.monotonic() - started
+
+    print(f"\n📊 ИТОГО ({elapsed:.1f} сек):")
+    print(f"   ✅ Найден ASIN: {len(report['matched'])}")
+    print(f"   ➖ Нет в каталоге: {len(report['unmatched'])}")
+    print(f"   ⚠️  Невалидный штрихкод: {len(report['invalid'])}")
+    print(f"   ❌ Ошибка запроса: {len(report['failed'])}")
+
+    for sku in report['invalid'][:20]:
+        print(f"      • {sku}: {sku_barcodes[sku]}")
+
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка результатов pipeline_benchmark против сохраненного baseline
+
+Для каждого размера каталога и этапа сравниваются медианы повторов.
+Порог учитывает шум: этап считается замедлившимся, если
+
+    медиана_сейчас > медиана_baseline * (1 + tolerance) + noise * max(IQR_baseline, IQR_сейчас)
+
+поэтому разброс между повторами (IQR) не дает ложных срабатываний, а
+устойчивое замедление в разы - ловится. При регрессии печатается таблица
+и процесс завершается с кодом 1 (для CI).
+
+Baseline имеет смысл только на той же машине/раннере, где он снят:
+
+    python src/benchmark_gate.py --run --update-baseline   # снять baseline
+    python src/benchmark_gate.py --run                     # прогнать и сравнить
+    python src/benchmark_gate.py --current pipeline_benchmark_<время>.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE_PATH = os.path.join(PROJECT_ROOT, 'benchmark_baseline.json')
+
+# Этапы, регрессия которых валит проверку; fetch/upload зависят от сети и stand-in сервера
+DEFAULT_GATED_STAGES = ['mapping', 'feed_xml', 'feed_json', 'report']
+
+DEFAULT_TOLERANCE = 0.25        # +25% к медиане baseline
+DEFAULT_NOISE_FACTOR = 1.5      # сколько IQR добавляется к порогу
+DEFAULT_MEMORY_TOLERANCE = 0.5  # +50% к приросту RSS этапа
+MEMORY_SLACK_MB = 16            # прирост RSS меньше этого не сравниваем - шум аллокатора
+MIN_SAMPLES = 3
+
+
+def iqr(samples: List[float]) -> float:
+    """Межквартильный размах; для одного замера - 0 (шум неизвестен)"""
+    if len(samples) < 2:
+        return 0.0
+    q1, _, q3 = statistics.quantiles(samples, n=4, method='inclusive')
+    return q3 - q1
+
+
+def _stage_samples(metrics: Dict) -> List[float]:
+    return metrics.get('samples') or [metrics['seconds']]
+
+
+def compare_stage(baseline: Dict, current: Dict, tolerance: float, noise_factor: float,
+                  memory_tolerance: float) -> Dict:
+    """Сравнение одного этапа: медианы, IQR, порог и вердикт"""
+    base_samples = _stage_samples(baseline)
+    current_samples = _stage_samples(current)
+    base_median = statistics.median(base_samples)
+    current_median = statistics.median(current_samples)
+    base_iqr = iqr(base_samples)
+    current_iqr = iqr(current_samples)
+
+    limit = base_median * (1 + tolerance) + noise_factor * max(base_iqr, current_iqr)
+    ratio = current_median / base_median if base_median else None
+
+    if current_median > limit:
+        status = 'regressed'
+    elif current_median < base_median * (1 - tolerance) - noise_factor * max(base_iqr, current_iqr):
+        status = 'improved'
+    else:
+        status = 'ok'
+
+    base_growth = baseline.get('rss_growth_mb') or 0.0
+    current_growth = current.get('rss_growth_mb') or 0.0
+    memory_limit = max(base_growth * (1 + memory_tolerance), base_growth + MEMORY_SLACK_MB)
+    memory_regressed = current_growth > memory_limit
+
+    return {
+        'baseline_median': base_median,
+        'baseline_iqr': base_iqr,
+        'current_median': current_median,
+        'current_iqr': current_iqr,
+        'limit': limit,
+        'ratio': ratio,
+        'status': status,
+        'baseline_rss_growth_mb': base_growth,
+        'current_rss_growth_mb': current_growth,
+        'memory_regressed': memory_regressed,
+        'samples': (len(base_samples), len(current_samples)),
+    }
+
+
+def compare_runs(baseline: Dict, current: Dict, stages: List[str], tolerance: float = DEFAULT_TOLERANCE,
+                 noise_factor: float = DEFAULT_NOISE_FACTOR,
+                 memory_tolerance: float = DEFAULT_MEMORY_TOLERANCE) -> List[Dict]:
+    """
+    Строки сравнения по (размер каталога, этап) текущего прогона.
+
+    Сравниваются только прогнанные размеры и запрошенные этапы: размеры baseline,
+    которых нет в прогоне (--sizes 1000 при baseline на 1000 и 10000), не
+    проверяются. Этап без данных с одной из сторон - статус missing,
+    в missing записано, где данных нет ('baseline' или 'current').
+    """
+    base_runs = {run['products']: run for run in baseline['runs']}
+    rows = []
+    for current_run in current['runs']:
+        size = current_run['products']
+        base_run = base_runs.get(size)
+        for stage in stages:
+            row = {'products': size, 'stage': stage}
+            base_metrics = base_run['stages'].get(stage) if base_run else None
+            current_metrics = current_run['stages'].get(stage)
+            if base_metrics is None or current_metrics is None:
+                row.update(status='missing', missing='baseline' if base_metrics is None else 'current')
+            else:
+                row.update(compare_stage(base_metrics, current_metrics, tolerance, noise_factor, memory_tolerance))
+            rows.append(row)
+    return rows
+
+
+def format_table(rows: List[Dict]) -> str:
+    """Таблица сравнения для терминала и логов CI"""
+    icons = {'ok': '✅', 'improved': '🚀', 'regressed': '❌', 'missing': '⚠️ '}
+    lines = [
+        f"   {'товаров':>8} {'этап':<10} {'baseline, с':>12} {'сейчас, с':>11} {'IQR':>7} "
+        f"{'порог, с':>9} {'x':>6} {'RSS +МБ':>13}  итог",
+        '   ' + '-' * 92,
+    ]
+    for row in rows:
+        icon = icons[row['status']]
+        if row['status'] == 'missing':
+            if row['missing'] == 'baseline':
+                values = f"{'нет данных':>12} {'':>11}"
+            else:
+                values = f"{'':>12} {'нет данных':>11}"
+            lines.append(f"   {row['products']:>8} {row['stage']:<10} {values}{'':>37}  {icon} missing")
+            continue
+        ratio = f"{row['ratio']:.2f}" if row['ratio'] is not None else '-'
+        memory = f"{row['baseline_rss_growth_mb']:.0f}→{row['current_rss_growth_mb']:.0f}"
+        verdict = row['status']
+        if row['memory_regressed']:
+            icon, verdict = icons['regressed'], 'память' if verdict == 'ok' else f"{verdict}, память"
+        lines.append(
+            f"   {row['products']:>8} {row['stage']:<10} {row['baseline_median']:>12.4f} "
+            f"{row['current_median']:>11.4f} {max(row['baseline_iqr'], row['current_iqr']):>7.4f} "
+            f"{row['limit']:>9.4f} {ratio:>6} {memory:>13}  {icon} {verdict}"
+        )
+    return '\n'.join(lines)
+
+
+def failed(rows: List[Dict], check_memory: bool = True) -> List[Dict]:
+    return [
+        row for row in rows
+        if row['status'] == 'regressed' or (check_memory and row.get('memory_regressed'))
+    ]
+
+
+def run_benchmark_like(baseline: Optional[Dict], sizes: List[int], stages: List[str], repeat: int) -> Dict:
+    """Прогон pipeline_benchmark с теми же параметрами, что у baseline"""
+    from pipeline_benchmark import run_size
+
+    config = (baseline or {}).get('config', {})
+    variants = config.get('variants', 3)
+    images = config.get('images', 4)
+    seed = config.get('seed', 42)
+    latency = config.get('latency')
+    transform_workers = config.get('transform_workers')
+
+    runs = []
+    for size in sizes:
+        print(f"⏱️  Прогон: {size} товаров, этапы {', '.join(stages)}, повторов {repeat}...")
+        runs.append(run_size(size, stages, repeat, seed, variants, images, latency, transform_workers))
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'config': {'stages': stages, 'repeat': repeat, 'variants': variants, 'images': images,
+                   'seed': seed, 'latency': latency, 'transform_workers': transform_workers},
+        'runs': runs,
+    }
+
+
+def main():
+    """Сравнение прогона бенчмарка с baseline"""
+    parser = argparse.ArgumentParser(description='Проверка производительности конвейера против baseline')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='JSON baseline (pipeline_benchmark)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--current', help='JSON текущего прогона pipeline_benchmark')
+    source.add_argument('--run', action='store_true', help='Прогнать бенчмарк с параметрами baseline')
+    parser.add_argument('--sizes', help='Размеры каталога для --run (по умолчанию как в baseline, иначе 1000)')
+    parser.add_argument('--stages', default=','.join(DEFAULT_GATED_STAGES), help='Проверяемые этапы')
+    parser.add_argument('--repeat', type=int, default=5, help='Повторов для --run (медиана/IQR)')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Допуск к медиане (0.25 = +25%%)')
+    parser.add_argument('--noise-factor', type=float, default=DEFAULT_NOISE_FACTOR, help='Множитель IQR в пороге')
+    parser.add_argument('--memory-tolerance', type=float, default=DEFAULT_MEMORY_TOLERANCE,
+                        help='Допуск к приросту RSS этапа')
+    parser.add_argument('--no-memory', action='store_true', help='Не проверять память')
+    parser.add_argument('--update-baseline', action='store_true', help='Записать текущий прогон как baseline')
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+
+    print("🚦 ПРОВЕРКА ПРОИЗВОДИТЕЛЬНОСТИ КОНВЕЙЕРА")
+    print("=" * 60)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    elif not args.update_baseline:
+        print(f"❌ Baseline не найден: {args.baseline}")
+        print("💡 Снимите его: python src/benchmark_gate.py --run --update-baseline")
+        sys.exit(2)
+
+    if args.run:
+        if args.sizes:
+            sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+        elif baseline and not args.update_baseline:
+            sizes = [run['products'] for run in baseline['runs']]
+        else:
+            sizes = [1000]
+        current = run_benchmark_like(baseline, sizes, stages, args.repeat)
+    else:
+        with open(args.current, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"💾 Baseline записан: {args.baseline}")
+        return
+
+    rows = compare_runs(baseline, current, stages, args.tolerance, args.noise_factor, args.memory_tolerance)
+    print(f"📏 Допуск: +{args.tolerance:.0%} к медиане + {args.noise_factor:g}×IQR")
+    print(format_table(rows))
+
+    missing = [row for row in rows if row['status'] == 'missing']
+    if missing:
+        print(f"\n⚠️  Нет данных для сравнения у {len(missing)} этапов - они не проверены, "
+              f"это не регрессия")
+    if len(missing) == len(rows):
+        print("❌ Нечего сравнивать: ни один прогнанный размер и этап не найден в baseline")
+        print("💡 Обновите baseline: python src/benchmark_gate.py --run --update-baseline")
+        sys.exit(2)
+
+    few_samples = [row for row in rows if 'samples' in row and min(row['samples']) < MIN_SAMPLES]
+    if few_samples:
+        print(f"\n⚠️  Меньше {MIN_SAMPLES} повторов у {len(few_samples)} этапов: шум не оценить, "
+              f"запускайте pipeline_benchmark с --repeat {MIN_SAMPLES} или больше")
+
+    failures = failed(rows, check_memory=not args.no_memory)
+    if failures:
+        print(f"\n❌ Регрессия производительности: {len(failures)} этапов хуже baseline")
+        sys.exit(1)
+    print("\n✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Единая точка входа для команд синхронизации
+
+    python src/cli.py sync
+    python src/cli.py prices --shopify-snapshot snapshot.json --marketplaces UK GERMANY
+    python src/cli.py --log-level INFO --cassette run.db orders --since-hours 24
+    python src/cli.py orders --help
+
+Модуль команды импортируется только при ее запуске: общая справка и разбор
+общих опций не тянут requests/numpy, а команда не платит за модули других
+команд. Импорт самой команды (вместе с ее --help) стоит столько же, сколько
+ее зависимости: requests, numpy, цепочка демона - это сотни миллисекунд
+(sync ~ 300 мс, prices ~ 170 мс против ~ 75 мс у голого sync --help).
+Настройки (.env) читаются один раз - settings.load_settings() здесь, остальные
+модули получают уже загруженное окружение.
+
+Общие опции пишутся до имени команды, все после имени уходит в main() команды.
+"""
+import argparse
+import importlib
+import os
+import sys
+
+# Команда → (модуль, функция точки входа, краткое описание)
+COMMANDS = {
+    'sync': ('create_sku_in_amazon', 'main', 'Создание товара Shopify в Amazon'),
+    'daemon': ('sync_daemon', 'main', 'Демон синхронизации с полосами приоритета'),
+    'journal': ('job_journal', 'main', 'Журнал заданий демона: этапы и последние переходы'),
+    'replay': ('sync_daemon', 'replay_main', 'Повтор только SKU из dead letters небольшими пачками'),
+    'schema': ('get_product_schema', 'main', 'Схема типа товара из Product Type Definitions'),
+    'reports': ('amazon_reports', 'main', 'Создание и скачивание отчета Amazon'),
+    'inventory': ('fba_inventory_crawler', 'main', 'Выгрузка FBA остатков по маркетплейсам'),
+    'orders': ('orders_ingester', 'main', 'Инкрементальная загрузка заказов Amazon'),
+    'reconcile': ('reconcile_catalog', 'main', 'Сверка каталога Shopify и Amazon по SKU'),
+    'bench': ('pipeline_benchmark', 'main', 'Бенчмарк конвейера на синтетических каталогах'),
+    'gate': ('benchmark_gate', 'main', 'Проверка производительности против baseline'),
+    'prices': ('price_engine', 'main', 'Пересчет цен для маркетплейсов'),
+    'allocate': ('inventory_allocator', 'main', 'Распределение остатков между маркетплейсами'),
+    'stock': ('shopify_stock_adjuster', 'main', 'Списание остатков Shopify по заказам Amazon'),
+    'match-asin': ('asin_matcher', 'main', 'Сопоставление SKU с ASIN по штрихкодам'),
+    'match-titles': ('title_matcher', 'main', 'Нечеткое сопоставление по названиям'),
+    'images': ('image_pipeline', 'main', 'Проверка изображений и Image feed'),
+    'feed': ('feed_template', 'main', 'Product feed из XML-шаблона'),
+    'describe': ('description_converter', 'main', 'Описания Shopify → текст для Amazon'),
+    'stand-in': ('stand_in_server', 'main', 'Локальная замена SP-API и Shopify'),
+    'check': ('test_integration', 'main', 'Проверка подключения к Amazon и Shopify'),
+}
+
+
+class CommandParser(argparse.ArgumentParser):
+    """Парсер имени команды: все аргументы после него как есть уходят в main() команды"""
+
+    def parse_known_args(self, args=None, namespace=None):
+        return argparse.Namespace(command_argv=list(args or [])), []
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='sync',
+        description='Синхронизация Shopify → Amazon: единая точка входа',
+        epilog="Справка по команде: sync <команда> --help",
+        allow_abbrev=False,
+    )
+    parser.add_argument('--env-file', help='Файл настроек вместо .env в корне проекта (SYNC_ENV_FILE)')
+    parser.add_argument('--log-level', help='Уровень логов: DEBUG, INFO, WARNING, ERROR (LOG_LEVEL)')
+    parser.add_argument('--log-format', choices=('text', 'json'), help='Формат логов (LOG_FORMAT)')
+    parser.add_argument('--trace', metavar='FILE', help='Файл трассировки (TRACE_FILE)')
+    parser.add_argument('--metrics-file', metavar='FILE', help='Файл метрик Prometheus (METRICS_FILE)')
+    parser.add_argument('--profile', action='store_true', help='Профилировать команду (SyncProfiler)')
+    parser.add_argument('--profile-dir', metavar='DIR', help='Каталог профиля (по умолчанию profile_<время>)')
+    parser.add_argument('--cassette', metavar='FILE', help='HTTP-кассета (HTTP_CASSETTE)')
+    parser.add_argument('--cassette-mode', choices=('record', 'replay', 'auto'),
+                        help='Режим кассеты, по умолчанию replay (HTTP_CASSETTE_MODE)')
+
+    subparsers = parser.add_subparsers(dest='command', metavar='<команда>', required=True,
+                                       parser_class=CommandParser)
+    for name, (_module, _function, help_text) in COMMANDS.items():
+        # Аргументы команды разбирает ее собственный main(), здесь только имя
+        subparsers.add_parser(name, help=help_text, add_help=False)
+    return parser
+
+
+def apply_global_options(args: argparse.Namespace) -> None:
+    """Переносит общие опции в окружение до импорта модуля команды"""
+    overrides = {
+        'SYNC_ENV_FILE': args.env_file,
+        'LOG_LEVEL': args.log_level,
+        'LOG_FORMAT': args.log_format,
+        'TRACE_FILE': args.trace,
+        'METRICS_FILE': args.metrics_file,
+        'HTTP_CASSETTE': args.cassette,
+        'HTTP_CASSETTE_MODE': args.cassette_mode,
+    }
+    for key, value in overrides.items():
+        if value is not None:
+            os.environ[key] = value
+
+
+def run_command(name: str, argv: list, profile: str = None):
+    """Импортирует модуль команды и вызывает ее main() с аргументами argv"""
+    module_name, function_name, _help = COMMANDS[name]
+    # argparse команды берет prog из sys.argv[0]: справка покажет "sync orders ..."
+    sys.argv = [f"sync {name}"] + list(argv)
+
+    from settings import load_settings
+    load_settings()
+
+    if os.getenv('HTTP_CASSETTE'):
+        from http_cassette import install_from_env
+        install_from_env()
+
+    entry = getattr(importlib.import_module(module_name), function_name)
+    if profile is None:
+        return entry()
+
+    from profiling import SyncProfiler
+    with SyncProfiler(profile or None, allocations=os.getenv('SYNC_PROFILE_ALLOCATIONS') != '0'):
+        return entry()
+
+
+def main(argv: list = None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Все после имени команды принадлежит команде, даже если совпадает с общей опцией
+    args = build_parser().parse_args(argv)
+    apply_global_options(args)
+    profile = (args.profile_dir or '') if args.profile or args.profile_dir else None
+    return run_command(args.command, args.command_argv, profile)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
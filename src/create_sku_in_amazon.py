@@ -7,20 +7,74 @@ import os
 import json
 import xml.etree.ElementTree as ET
 from test_integration import AmazonSandboxClient, ShopifyClient
-from dotenv import load_dotenv
+from get_product_schema import AmazonProductSchemaClient
+from price_engine import PriceEngine
+from asin_matcher import AsinMatcher, normalize_barcode
+from mapping_store import MappingStore
+from job_journal import JobJournal
+from metrics import stage_timer
+from tracing import current_span, traced
+from profiling import profile_main
+from image_pipeline import ImagePipeline, build_image_feed
+from description_converter import MAX_BULLETS, convert_description, description_byte_limit
+from settings import load_settings
 import base64
 import uuid
 from datetime import datetime
 
 # Загружаем .env из корневой директории проекта
-load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+load_settings()
+
+def shopify_product_data(product, marketplace):
+    """Товар Shopify → данные для листинга Amazon (без запросов к API, см. pipeline_benchmark)"""
+    # Описание и bullet points из <li> - за один проход по body_html
+    converted = convert_description(product.get('body_html'), description_byte_limit(marketplace))
+    
+    variant_details = [
+        {
+            'sku': variant.get('sku', ''),
+            'price': variant.get('price', '0.00'),
+            'weight': variant.get('weight', 0),
+            'inventory_quantity': variant.get('inventory_quantity', 0),
+            'barcode': variant.get('barcode', ''),
+            'title': variant.get('title', 'Default Title')
+        }
+        for variant in product.get('variants', [])
+    ]
+    
+    image_details = [
+        {
+            'src': image.get('src', ''),
+            'alt': image.get('alt', ''),
+            'position': image.get('position', i)
+        }
+        for i, image in enumerate(product.get('images', []), 1)
+    ]
+    
+    return {
+        'shopify_id': product.get('id'),
+        'title': product.get('title', ''),
+        'vendor': product.get('vendor', ''),
+        'product_type': product.get('product_type', ''),
+        'description': converted['description'],
+        'bullet_points': converted['bullets'],
+        'tags': product.get('tags', ''),
+        'variants': variant_details,
+        'images': image_details,
+        'handle': product.get('handle', ''),
+        'created_at': product.get('created_at', ''),
+        'updated_at': product.get('updated_at', '')
+    }
+
 
 class ShopifyToAmazonCreator:
     def __init__(self):
         self.shopify_client = ShopifyClient()
         self.amazon_client = AmazonSandboxClient()
         self.target_product_id = "9160927608983"  # Bosch Aerotwin A950S
+        self.target_marketplace = "USA"  # ключ в DEFAULT_MARKETPLACE_PRICING
     
+    @traced('shopify.get_product')
     def get_shopify_product_details(self):
         """Получаем полную информацию о товаре из Shopify"""
         print("🔍 ЭТАП 1: Получение товара из Shopify")
@@ -32,7 +86,8 @@ class ShopifyToAmazonCreator:
         endpoint = f"/products/{self.target_product_id}.json"
         print(f"📡 Запрос: GET {endpoint}")
         
-        response = self.shopify_client.make_api_request(endpoint)
+        with stage_timer('fetch'):
+            response = self.shopify_client.make_api_request(endpoint)
         
         if not response or 'product' not in response:
             print("❌ Товар не найден в Shopify")
@@ -44,81 +99,40 @@ class ShopifyToAmazonCreator:
         print("\n📦 ДЕТАЛИ ТОВАРА:")
         print("-" * 30)
         
-        # Основная информация
-        title = product.get('title', '')
-        vendor = product.get('vendor', '')
-        product_type = product.get('product_type', '')
-        description = product.get('body_html', '').replace('<p>', '').replace('</p>', '').replace('<br>', '\n')
-        tags = product.get('tags', '')
+        with stage_timer('map'):
+            product_data = shopify_product_data(product, self.target_marketplace)
+        # SKU известен только после ответа: спан загрузки помечается сам, корневой - в main
+        if product_data['variants']:
+            current_span().set(sku=product_data['variants'][0]['sku'])
         
-        print(f"📝 Название: {title}")
-        print(f"🏢 Бренд: {vendor}")
-        print(f"📂 Тип: {product_type}")
-        print(f"🏷️  Теги: {tags}")
-        print(f"📄 Описание: {description[:100]}...")
+        print(f"📝 Название: {product_data['title']}")
+        print(f"🏢 Бренд: {product_data['vendor']}")
+        print(f"📂 Тип: {product_data['product_type']}")
+        print(f"🏷️  Теги: {product_data['tags']}")
+        print(f"📄 Описание: {product_data['description'][:100]}...")
         
         # Варианты товара
-        variants = product.get('variants', [])
-        print(f"\n🔢 Вариантов товара: {len(variants)}")
-        
-        variant_details = []
-        for i, variant in enumerate(variants, 1):
-            sku = variant.get('sku', '')
-            price = variant.get('price', '0.00')
-            weight = variant.get('weight', 0)
-            inventory_qty = variant.get('inventory_quantity', 0)
-            barcode = variant.get('barcode', '')
-            
-            variant_info = {
-                'sku': sku,
-                'price': price,
-                'weight': weight,
-                'inventory_quantity': inventory_qty,
-                'barcode': barcode,
-                'title': variant.get('title', 'Default Title')
-            }
-            variant_details.append(variant_info)
-            
+        print(f"\n🔢 Вариантов товара: {len(product_data['variants'])}")
+        
+        for i, variant in enumerate(product_data['variants'], 1):
             print(f"   📦 Вариант {i}:")
-            print(f"      🏷️  SKU: {sku}")
-            print(f"      💰 Цена: ${price}")
-            print(f"      ⚖️  Вес: {weight}g")
-            print(f"      📊 Остаток: {inventory_qty} шт.")
-            if barcode:
-                print(f"      🔢 Штрихкод: {barcode}")
+            print(f"      🏷️  SKU: {variant['sku']}")
+            print(f"      💰 Цена: ${variant['price']}")
+            print(f"      ⚖️  Вес: {variant['weight']}g")
+            print(f"      📊 Остаток: {variant['inventory_quantity']} шт.")
+            if variant['barcode']:
+                print(f"      🔢 Штрихкод: {variant['barcode']}")
         
         # Изображения
-        images = product.get('images', [])
-        print(f"\n🖼️  Изображений: {len(images)}")
-        
-        image_details = []
-        for i, image in enumerate(images, 1):
-            image_info = {
-                'src': image.get('src', ''),
-                'alt': image.get('alt', ''),
-                'position': image.get('position', i)
-            }
-            image_details.append(image_info)
-            print(f"   📸 Изображение {i}: {image.get('src', '')[:60]}...")
-        
-        # Сохраняем все данные
-        product_data = {
-            'shopify_id': product.get('id'),
-            'title': title,
-            'vendor': vendor,
-            'product_type': product_type,
-            'description': description,
-            'tags': tags,
-            'variants': variant_details,
-            'images': image_details,
-            'handle': product.get('handle', ''),
-            'created_at': product.get('created_at', ''),
-            'updated_at': product.get('updated_at', '')
-        }
+        print(f"\n🖼️  Изображений: {len(product_data['images'])}")
+        
+        for i, image in enumerate(product_data['images'], 1):
+            print(f"   📸 Изображение {i}: {image['src'][:60]}...")
         
         print("\n✅ Данные товара успешно получены!")
         return product_data
     
+    @traced('build.listing_xml')
     def create_amazon_listing_xml(self, product_data):
         """Создаем XML для загрузки товара в Amazon через Feeds API"""
         print("\n🏗️  ЭТАП 2: Создание Amazon Listing XML")
@@ -164,11 +178,19 @@ class ShopifyToAmazonCreator:
         product = ET.SubElement(message, "Product")
         ET.SubElement(product, "SKU").text = sku
         
-        # Standard Product ID (если есть штрихкод)
-        if main_variant.get('barcode'):
+        # Standard Product ID: существующий ASIN, иначе штрихкод с его настоящим типом
+        barcode = normalize_barcode(main_variant.get('barcode'))
+        if main_variant.get('asin'):
             standard_id = ET.SubElement(product, "StandardProductID")
-            ET.SubElement(standard_id, "Type").text = "UPC"
-            ET.SubElement(standard_id, "Value").text = main_variant['barcode']
+            ET.SubElement(standard_id, "Type").text = "ASIN"
+            ET.SubElement(standard_id, "Value").text = main_variant['asin']
+            print(f"🔗 Привязка к существующему ASIN: {main_variant['asin']}")
+        elif barcode:
+            standard_id = ET.SubElement(product, "StandardProductID")
+            ET.SubElement(standard_id, "Type").text = barcode['type']
+            ET.SubElement(standard_id, "Value").text = barcode['value']
+        elif main_variant.get('barcode'):
+            print(f"⚠️  Штрихкод {main_variant['barcode']} не прошел проверку - StandardProductID не указан")
         
         # Product Tax Code (для автозапчастей)
         ET.SubElement(product, "ProductTaxCode").text = "A_GEN_NOTAX"
@@ -183,16 +205,16 @@ class ShopifyToAmazonCreator:
         ET.SubElement(desc_data, "Description").text = product_data.get('description', product_data['title'])
         ET.SubElement(desc_data, "Manufacturer").text = product_data.get('vendor', 'Generic')
         
-        # Bullet Points (из тегов и описания)
-        bullet_point = ET.SubElement(desc_data, "BulletPoint")
-        bullet_point.text = f"Compatible with various vehicle models"
-        
+        # Bullet Points: пункты списков из описания, остаток - из тегов (максимум 5)
+        bullets = list(product_data.get('bullet_points', []))[:MAX_BULLETS]
         if product_data.get('tags'):
-            tags_list = product_data['tags'].split(',')[:4]  # Максимум 5 bullet points
-            for i, tag in enumerate(tags_list, 2):
-                if i <= 5:
-                    bullet = ET.SubElement(desc_data, "BulletPoint")
-                    bullet.text = tag.strip().capitalize()
+            tags_list = [tag.strip().capitalize() for tag in product_data['tags'].split(',') if tag.strip()]
+            bullets += tags_list[:MAX_BULLETS - len(bullets)]
+        if not bullets:
+            bullets = ["Compatible with various vehicle models"]
+        
+        for text in bullets:
+            ET.SubElement(desc_data, "BulletPoint").text = text
         
         # Product Data для Automotive категории
         product_data_elem = ET.SubElement(product, "ProductData")
@@ -219,6 +241,7 @@ class ShopifyToAmazonCreator:
         
         return formatted_xml, sku
     
+    @traced('build.inventory_feed')
     def create_amazon_inventory_feed(self, sku, quantity):
         """Создаем XML для обновления остатков"""
         print(f"\n📦 Создание Inventory Feed для SKU: {sku}")
@@ -252,8 +275,9 @@ class ShopifyToAmazonCreator:
         print(f"✅ Inventory XML создан (остаток: {quantity})")
         return formatted_xml
     
-    def create_amazon_price_feed(self, sku, price):
-        """Создаем XML для обновления цены"""
+    @traced('build.price_feed')
+    def create_amazon_price_feed(self, sku, price, currency="USD", decimals=2):
+        """Создаем XML для обновления цены (price - уже в валюте маркетплейса, decimals - знаков в ней)"""
         print(f"\n💰 Создание Price Feed для SKU: {sku}")
         
         envelope = ET.Element("AmazonEnvelope")
@@ -276,14 +300,50 @@ class ShopifyToAmazonCreator:
         # Price
         price_elem = ET.SubElement(message, "Price")
         ET.SubElement(price_elem, "SKU").text = sku
-        ET.SubElement(price_elem, "StandardPrice", currency="USD").text = str(price)
+        ET.SubElement(price_elem, "StandardPrice", currency=currency).text = f"{price:.{decimals}f}"
         
         xml_str = ET.tostring(envelope, encoding='unicode')
         formatted_xml = self._format_xml(xml_str)
         
-        print(f"✅ Price XML создан (цена: ${price})")
+        print(f"✅ Price XML создан (цена: {price:.{decimals}f} {currency})")
         return formatted_xml
     
+    @traced('build.image_feed')
+    def create_amazon_image_feed(self, sku, images):
+        """Image feed только для слотов, изображение в которых изменилось с прошлой отправки"""
+        print("\n🖼️  Проверка изображений")
+        
+        store = MappingStore()
+        try:
+            pipeline = ImagePipeline(store)
+            result = pipeline.process({sku: images}, self.target_marketplace)
+            
+            for image in result['images']:
+                status = '⚠️ ' if image['issues'] else '✅'
+                print(f"   {status} {image['slot']}: {image.get('width')}x{image.get('height')} {image.get('format')}")
+                for issue in image['issues']:
+                    print(f"      • {issue}")
+            for image in result['failed']:
+                print(f"   ❌ {image['slot']}: {image['error']}")
+            
+            if not result['changed'] and not result['removed']:
+                print("   💤 Изображения не изменились - Image feed не нужен")
+                return None
+            
+            image_xml = self._format_xml(build_image_feed(result['changed'], result['removed']))
+            
+            xml_dir = os.path.join(os.path.dirname(__file__), "amazon_xml_feeds")
+            os.makedirs(xml_dir, exist_ok=True)
+            image_file = os.path.join(xml_dir, f"image_feed_{sku}.xml")
+            with open(image_file, 'w', encoding='utf-8') as f:
+                f.write(image_xml)
+            print(f"   🖼️  Image Feed: {image_file} (слотов: {len(result['changed'])})")
+            # Фид здесь не отправляется (загрузка - симуляция), поэтому слоты не отмечаются:
+            # sent_hash ставит тот, кто получил отчет Amazon (демон, image_pipeline)
+            return image_xml
+        finally:
+            store.close()
+    
     def _format_xml(self, xml_string):
         """Форматируем XML для читаемости"""
         try:
@@ -293,6 +353,7 @@ class ShopifyToAmazonCreator:
         except:
             return xml_string
     
+    @traced('upload.feeds')
     def simulate_amazon_upload(self, product_xml, inventory_xml, price_xml, sku):
         """Симуляция загрузки в Amazon (поскольку Feeds API не работает в sandbox)"""
         print("\n🚀 ЭТАП 3: Симуляция загрузки в Amazon")
@@ -402,6 +463,8 @@ class ShopifyToAmazonCreator:
         print("   4. Дождаться обработки Amazon (обычно 15-30 минут)")
         print("   5. Товар появится в вашем Seller Central")
 
+@profile_main
+@traced('sync.product')
 def main():
     """Главная функция"""
     print("🚀 SHOPIFY → AMAZON: Создание товара")
@@ -415,27 +478,64 @@ def main():
         print("❌ Не удалось авторизоваться в Amazon")
         return
     
+    schema_client = AmazonProductSchemaClient()
+    schema_client.base_client = creator.amazon_client
+    marketplace_id = schema_client.marketplaces[creator.target_marketplace]
+    # Ключи корреляции (tracing.CORRELATION_KEYS) наследуют только спаны, открытые после set
+    current_span().set(marketplace_id=marketplace_id, shopify_product_id=creator.target_product_id)
+    
     # Этап 1: Получаем товар из Shopify
     product_data = creator.get_shopify_product_details()
     if not product_data:
         print("❌ Не удалось получить товар из Shopify")
+        # Товар не теряется: повтор - sync replay --kinds fetch
+        journal = JobJournal()
+        journal.record_dead_letter('fetch', creator.target_marketplace, f"shopify:{creator.target_product_id}",
+                                   {'product_id': creator.target_product_id},
+                                   creator.shopify_client.last_error or 'товар не найден в Shopify')
+        journal.close()
+        print("📮 Товар записан в dead letters: python src/cli.py replay --kinds fetch")
         return
     
-    # Этап 2: Создаем XML для Amazon
-    product_xml, sku = creator.create_amazon_listing_xml(product_data)
-    
+    # Сначала ищем товар в каталоге Amazon по штрихкоду, чтобы не создать дубль
     main_variant = product_data['variants'][0] if product_data['variants'] else {}
-    inventory_xml = creator.create_amazon_inventory_feed(
-        sku, 
-        main_variant.get('inventory_quantity', 0)
-    )
-    price_xml = creator.create_amazon_price_feed(
-        sku,
-        float(main_variant.get('price', '0.00'))
-    )
+    # SKU становится атрибутом корневого спана - по нему ищется весь путь товара
+    current_span().set(sku=main_variant.get('sku'))
+    if main_variant.get('sku') and main_variant.get('barcode'):
+        store = MappingStore()
+        try:
+            report = AsinMatcher(store, marketplace_id, schema_client).match(
+                {main_variant['sku']: main_variant['barcode']}
+            )
+        finally:
+            store.close()
+        found = report['matched'].get(main_variant['sku'])
+        if found:
+            main_variant['asin'] = found['asin']
+            print(f"🔗 Найден ASIN {found['asin']} ({found['product_type']}) по {found['matched_by']}")
+    
+    # Этап 2: Создаем XML для Amazon
+    with stage_timer('build'):
+        product_xml, sku = creator.create_amazon_listing_xml(product_data)
+        
+        inventory_xml = creator.create_amazon_inventory_feed(
+            sku, 
+            main_variant.get('inventory_quantity', 0)
+        )
+        # Цена маркетплейса: валюта, наценка, налог и окончание - по правилам price_engine
+        price_engine = PriceEngine([creator.target_marketplace])
+        price_xml = creator.create_amazon_price_feed(
+            sku,
+            price_engine.price_one(float(main_variant.get('price', '0.00')), creator.target_marketplace),
+            price_engine.currency(creator.target_marketplace),
+            price_engine.decimals(creator.target_marketplace)
+        )
+        
+        creator.create_amazon_image_feed(sku, product_data['images'])
     
     # Этап 3: Симулируем загрузку
-    creator.simulate_amazon_upload(product_xml, inventory_xml, price_xml, sku)
+    with stage_timer('upload'):
+        creator.simulate_amazon_upload(product_xml, inventory_xml, price_xml, sku)
     
     # Итоговый отчет
     creator.create_product_summary(product_data, sku)
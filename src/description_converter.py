@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Преобразование body_html из Shopify в описание для Amazon за один проход
+
+- из разметки остаются только разрешенные Amazon теги (без атрибутов),
+  остальные теги снимаются, script/style и подобные - вместе с содержимым
+- сущности декодируются, пробелы схлопываются на лету
+- лимит описания считается в байтах UTF-8 прямо во время разбора:
+  обрезка не рвет ни символ, ни тег, открытые теги закрываются
+- текст элементов <li> дополнительно собирается в bullet points
+"""
+import argparse
+import html
+import json
+import re
+import time
+from typing import Dict, List, Optional
+
+# Теги, которые Amazon оставляет в описании
+AMAZON_ALLOWED_TAGS = frozenset({'p', 'br', 'b'})
+TAG_ALIASES = {'strong': 'b'}
+
+# Содержимое не выводится
+SKIP_TAGS = frozenset({'script', 'style', 'noscript', 'template', 'iframe', 'svg', 'head', 'title', 'object'})
+# Начало и конец - перенос строки, если сам тег не разрешен
+BLOCK_TAGS = frozenset({
+    'p', 'div', 'br', 'li', 'ul', 'ol', 'dl', 'dt', 'dd', 'tr', 'table', 'section', 'article',
+    'blockquote', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'header', 'footer'
+})
+VOID_TAGS = frozenset({'br', 'hr', 'img', 'input', 'meta', 'link', 'wbr', 'source', 'area', 'col'})
+
+# Лимиты Amazon в байтах UTF-8 (ключи как в DEFAULT_MARKETPLACE_PRICING)
+DESCRIPTION_MAX_BYTES = 2000
+DESCRIPTION_BYTE_LIMITS = {
+    'JAPAN': 2000,
+}
+BULLET_MAX_BYTES = 500
+MAX_BULLETS = 5
+
+
+def description_byte_limit(marketplace: str) -> int:
+    return DESCRIPTION_BYTE_LIMITS.get(marketplace, DESCRIPTION_MAX_BYTES)
+
+
+def truncate_utf8(text: str, max_bytes: int) -> str:
+    """Обрезает текст до max_bytes байт UTF-8, не разрывая символ (и по возможности слово)"""
+    if len(text) <= max_bytes and (text.isascii() or len(text.encode('utf-8')) <= max_bytes):
+        return text
+    cut = text.encode('utf-8')[:max_bytes].decode('utf-8', 'ignore')
+    # Не оставляем половину слова, если пробел недалеко
+    space = cut.rfind(' ')
+    if space > len(cut) * 0.8:
+        cut = cut[:space]
+    return cut.rstrip()
+
+
+def _byte_len(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+# Один токен за шаг: тег (атрибуты в кавычках могут содержать '>'), комментарий,
+# doctype/инструкция, текст или одиночный '<'
+TOKEN_RE = re.compile(
+    r'<(/?)([a-zA-Z][a-zA-Z0-9]*)(?:"[^"]*"|\'[^\']*\'|[^\'">])*>'
+    r'|<!--.*?(?:-->|$)|<[!?][^>]*>?|[^<]+|<',
+    re.S
+)
+
+
+class DescriptionConverter:
+    """
+    Однопроходный конвертер: токены разбираются одним регулярным выражением,
+    текст копится в список кусков с учетом бюджета байт.
+    """
+
+    def __init__(self, max_bytes: int = DESCRIPTION_MAX_BYTES, allowed_tags=AMAZON_ALLOWED_TAGS):
+        self.max_bytes = max_bytes
+        self.allowed_tags = allowed_tags
+        self.line_break = '<br>' if 'br' in allowed_tags else '\n'
+        # С разрешенными тегами '<' и '&' в тексте должны остаться текстом
+        self.escape_text = bool(allowed_tags)
+
+        self.parts: List[str] = []
+        self.used = 0
+        self.full = False
+        self.open_tags: List[str] = []   # разрешенные теги, открытые в выводе
+        self.closing_bytes = 0           # байты, зарезервированные под их закрытие
+        self.pending_space = False
+        self.at_line_start = True
+
+        self.bullets: List[Optional[str]] = []
+        self.list_depth = 0
+        self.bullet_stack: List[tuple] = []  # (глубина списка, индекс в bullets, слова) открытых <li>
+
+    # --- вывод ---
+
+    def _emit(self, piece: str) -> bool:
+        size = len(piece) if piece.isascii() else len(piece.encode('utf-8'))
+        if self.used + size + self.closing_bytes > self.max_bytes:
+            return False
+        self.parts.append(piece)
+        self.used += size
+        return True
+
+    def _emit_text(self, text: str) -> None:
+        if self.full:
+            return
+        if self.pending_space and not self.at_line_start:
+            text = ' ' + text
+        self.pending_space = False
+
+        if not self._emit(text):
+            remaining = self.max_bytes - self.used - self.closing_bytes
+            tail = truncate_utf8(text, remaining) if remaining > 0 else ''
+            if tail and not text[len(tail)].isspace():
+                # Обрезка пришлась на середину слова - слово целиком не выводим
+                tail = tail[:tail.rfind(' ') + 1].rstrip() if ' ' in tail else ''
+            if self.escape_text and '&' in tail:
+                # Не оставляем обрезанную сущность вроде '&am'
+                amp = tail.rfind('&')
+                if ';' not in tail[amp:]:
+                    tail = tail[:amp].rstrip()
+            if tail.strip():
+                self.parts.append(tail)
+                self.used += _byte_len(tail)
+            self.full = True
+            return
+        self.at_line_start = False
+
+    def _emit_break(self) -> None:
+        self.pending_space = False
+        if self.full or self.at_line_start:
+            return
+        if self._emit(self.line_break):
+            self.at_line_start = True
+
+    def _open(self, tag: str) -> None:
+        if self.full:
+            return
+        if tag == 'p':
+            # Абзац сам начинается с новой строки
+            if self.parts and self.parts[-1] == self.line_break:
+                self.used -= _byte_len(self.parts.pop())
+            self.pending_space = False
+        elif self.pending_space and not self.at_line_start:
+            self._emit(' ')
+            self.pending_space = False
+
+        if self._emit(f'<{tag}>'):
+            self.open_tags.append(tag)
+            self.closing_bytes += len(tag) + 3
+            if tag == 'p':
+                self.at_line_start = True
+        else:
+            if self.parts and self.parts[-1] == ' ':
+                self.used -= 1
+                self.parts.pop()
+            self.full = True
+
+    def _close(self, tag: str) -> None:
+        if tag not in self.open_tags:
+            return
+        # Закрываем и все, что открыто внутри (некорректная вложенность в исходнике)
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.closing_bytes -= len(open_tag) + 3
+            if self.parts and self.parts[-1] == f'<{open_tag}>':
+                # Пустой элемент (например, после обрезки) не выводим
+                self.used -= len(open_tag) + 2
+                self.parts.pop()
+                if self.parts and self.parts[-1] == ' ':
+                    self.used -= 1
+                    self.parts.pop()
+            else:
+                self.parts.append(f'</{open_tag}>')
+                self.used += len(open_tag) + 3
+            if open_tag == tag:
+                break
+        if tag == 'p':
+            self.at_line_start = True
+            self.pending_space = False
+
+    # --- bullet points ---
+
+    def _finish_bullet(self) -> None:
+        _, index, words = self.bullet_stack.pop()
+        if words:
+            self.bullets[index] = truncate_utf8(' '.join(words), BULLET_MAX_BYTES)
+
+    # --- токены ---
+
+    def start_tag(self, tag: str) -> None:
+        if tag in ('ul', 'ol'):
+            self.list_depth += 1
+        elif tag == 'li':
+            # <li> без </li> закрывается следующим <li> того же списка
+            if self.bullet_stack and self.bullet_stack[-1][0] == self.list_depth:
+                self._finish_bullet()
+            # Место в списке резервируется сразу, чтобы вложенные пункты не меняли порядок
+            self.bullet_stack.append((self.list_depth, len(self.bullets), []))
+            self.bullets.append(None)
+
+        tag = TAG_ALIASES.get(tag, tag)
+        if tag in self.allowed_tags:
+            if tag == 'br':
+                self._emit_break()
+            else:
+                if tag == 'p':
+                    self._close('p')
+                self._open(tag)
+        elif tag in BLOCK_TAGS:
+            self._emit_break()
+        elif tag == 'img':
+            self.pending_space = True
+
+    def end_tag(self, tag: str) -> None:
+        if tag == 'li':
+            if self.bullet_stack and self.bullet_stack[-1][0] == self.list_depth:
+                self._finish_bullet()
+        elif tag in ('ul', 'ol') and self.list_depth:
+            while self.bullet_stack and self.bullet_stack[-1][0] == self.list_depth:
+                self._finish_bullet()
+            self.list_depth -= 1
+
+        tag = TAG_ALIASES.get(tag, tag)
+        if tag in self.allowed_tags:
+            self._close(tag)
+        elif tag in BLOCK_TAGS:
+            self._emit_break()
+
+    def data(self, text: str) -> None:
+        if '&' in text:
+            text = html.unescape(text)
+        words = text.split()
+        if not words:
+            self.pending_space = True
+            return
+
+        if self.bullet_stack:
+            self.bullet_stack[-1][2].extend(words)
+        if self.full:
+            return
+
+        if text[0].isspace():
+            self.pending_space = True
+        joined = ' '.join(words)
+        if self.escape_text:
+            joined = html.escape(joined, quote=False)
+        self._emit_text(joined)
+        if text[-1].isspace():
+            self.pending_space = True
+
+    def feed(self, body_html: str) -> None:
+        skip_until = None
+        for token in TOKEN_RE.finditer(body_html):
+            closing, tag = token.group(1, 2)
+            if skip_until is not None:
+                # Содержимое script/style и т.п. пропускаем до закрывающего тега
+                if closing and tag.lower() == skip_until:
+                    skip_until = None
+                continue
+
+            if tag is None:
+                value = token.group()
+                if value[0] != '<' or len(value) == 1:
+                    self.data(value)
+                continue
+
+            tag = tag.lower()
+            if closing:
+                self.end_tag(tag)
+            elif tag in SKIP_TAGS:
+                skip_until = tag
+            else:
+                self.start_tag(tag)
+                if tag not in VOID_TAGS and token.group().endswith('/>'):
+                    self.end_tag(tag)
+
+    def result(self) -> Dict:
+        while self.bullet_stack:
+            self._finish_bullet()
+        while self.open_tags:
+            self._close(self.open_tags[-1])
+
+        # Висящие переносы в конце не нужны
+        while self.parts and self.parts[-1] == self.line_break:
+            self.parts.pop()
+        return {
+            'description': ''.join(self.parts),
+            'bullets': [bullet for bullet in self.bullets if bullet],
+            'truncated': self.full
+        }
+
+
+def convert_description(body_html: Optional[str], max_bytes: int = DESCRIPTION_MAX_BYTES,
+                        allowed_tags=AMAZON_ALLOWED_TAGS) -> Dict:
+    """
+    body_html → {'description': ..., 'bullets': [...], 'truncated': bool}.
+
+    allowed_tags=() дает чистый текст с переносами строк.
+    """
+    converter = DescriptionConverter(max_bytes, allowed_tags)
+    if body_html:
+        converter.feed(body_html)
+    return converter.result()
+
+
+def main():
+    """Преобразование описаний из JSONL-выгрузки Shopify"""
+    from reconcile_catalog import iter_jsonl
+
+    parser = argparse.ArgumentParser(description='Описания Shopify → текст для Amazon')
+    parser.add_argument('--shopify-snapshot', required=True, help='JSONL с товарами Shopify (с body_html)')
+    parser.add_argument('--max-bytes', type=int, default=DESCRIPTION_MAX_BYTES, help='Лимит описания в байтах UTF-8')
+    parser.add_argument('--plain', action='store_true', help='Без HTML-тегов')
+    parser.add_argument('--output', help='JSONL с результатом (sku, description, bullets)')
+    args = parser.parse_args()
+
+    print("📝 ОПИСАНИЯ ДЛЯ AMAZON")
+    print("=" * 60)
+
+    allowed_tags = () if args.plain else AMAZON_ALLOWED_TAGS
+    products = list(iter_jsonl(args.shopify_snapshot))
+
+    started = time.perf_counter()
+    converted = [convert_description(p.get('body_html'), args.max_bytes, allowed_tags) for p in products]
+    elapsed = time.perf_counter() - started
+
+    truncated = sum(1 for item in converted if item['truncated'])
+    rate = len(products) / elapsed if elapsed else 0
+    print(f"✅ Описаний: {len(products)} за {elapsed:.2f} сек ({rate:.0f}/сек)")
+    print(f"✂️  Обрезано по лимиту: {truncated}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for product, item in zip(products, converted):
+                variants = product.get('variants') or [{}]
+                record = {'product_id': product.get('id'), 'sku': variants[0].get('sku'), **item}
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        print(f"💾 Результат: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
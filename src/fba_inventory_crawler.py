@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Краулер FBA Inventory Summaries по всем маркетплейсам
+
+- проходит все страницы /fba/inventory/v1/summaries по nextToken
+- обходит маркетплейсы параллельно (по цепочке страниц на маркетплейс),
+  каждый через свой региональный эндпоинт
+- поддерживает startDateTime для выгрузки только изменившихся остатков
+- пишет страницы в хранилище соответствий по мере получения
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from get_product_schema import AmazonProductSchemaClient
+from mapping_store import MappingStore, utc_now
+from settings import load_settings
+from sp_api_router import get_router
+from structured_log import get_logger
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('fba_inventory')
+
+FBA_SUMMARIES_ENDPOINT = "/fba/inventory/v1/summaries"
+
+# Лимит getInventorySummaries: 2 запроса/сек, burst 2
+GET_INVENTORY_SUMMARIES_RATE = (2, 2)
+
+
+def watermark_key(marketplace_id: str) -> str:
+    return f"fba_inventory:{marketplace_id}:last_crawl"
+
+
+class FbaInventoryCrawler:
+    """Выгружает FBA остатки по всем маркетплейсам в MappingStore"""
+
+    def __init__(self, store: MappingStore, schema_client: AmazonProductSchemaClient = None,
+                 max_workers: int = None):
+        self.store = store
+        self.schema_client = schema_client or AmazonProductSchemaClient()
+        self.client = self.schema_client.base_client
+        self.router = get_router()
+        self.max_workers = max_workers
+
+    def crawl_marketplace(self, marketplace_id: str, start_datetime: Optional[str] = None) -> Dict:
+        """Проходит всю цепочку страниц одного маркетплейса"""
+        base_url = self.schema_client.get_region_endpoint(marketplace_id)
+        limiter = self.router.limiter(base_url, 'getInventorySummaries', *GET_INVENTORY_SUMMARIES_RATE)
+        crawl_started = utc_now()
+
+        params = {
+            'details': 'true',
+            'granularityType': 'Marketplace',
+            'granularityId': marketplace_id,
+            'marketplaceIds': marketplace_id
+        }
+        if start_datetime:
+            params['startDateTime'] = start_datetime
+
+        pages = 0
+        summaries_count = 0
+
+        while True:
+            # Лимит частоты общий для региона
+            limiter.acquire()
+            response = self.client.make_api_request(FBA_SUMMARIES_ENDPOINT, params=params, base_url=base_url)
+            if response is None:
+                log.error('fba.page_failed', marketplace_id=marketplace_id, pages=pages)
+                return {
+                    'marketplace_id': marketplace_id,
+                    'pages': pages,
+                    'summaries': summaries_count,
+                    'complete': False
+                }
+
+            summaries = response.get('payload', {}).get('inventorySummaries', [])
+            summaries_count += self.store.upsert_fba_summaries(marketplace_id, summaries)
+            pages += 1
+            log.debug('fba.page', marketplace_id=marketplace_id, page=pages, summaries=len(summaries))
+
+            next_token = (response.get('pagination') or {}).get('nextToken')
+            if not next_token:
+                break
+            params['nextToken'] = next_token
+
+        # Watermark сдвигаем только после полной цепочки, иначе следующий
+        # инкрементальный запуск пропустит изменения с недокачанных страниц
+        self.store.set_state(watermark_key(marketplace_id), crawl_started)
+
+        return {
+            'marketplace_id': marketplace_id,
+            'pages': pages,
+            'summaries': summaries_count,
+            'complete': True
+        }
+
+    def crawl(self, marketplace_ids: List[str], changed_only: bool = False,
+              start_datetime: Optional[str] = None) -> List[Dict]:
+        """Параллельно обходит маркетплейсы: одна цепочка страниц на маркетплейс"""
+        # Токен получаем заранее, чтобы потоки не запрашивали его наперегонки
+        if not self.client.access_token and not self.client.get_access_token():
+            log.error('fba.token_unavailable')
+            return []
+
+        starts = {}
+        for marketplace_id in marketplace_ids:
+            since = start_datetime
+            if changed_only and not since:
+                since = self.store.get_state(watermark_key(marketplace_id))
+            starts[marketplace_id] = since
+
+        results = []
+        fanned_out = self.router.fan_out(
+            marketplace_ids,
+            lambda marketplace_id: self.crawl_marketplace(marketplace_id, starts[marketplace_id]),
+            max_workers=self.max_workers
+        )
+        for marketplace_id, result, error in fanned_out:
+            if error is not None:
+                log.error('fba.crawl_failed', marketplace_id=marketplace_id, error=repr(error))
+                result = {'marketplace_id': marketplace_id, 'pages': 0, 'summaries': 0, 'complete': False}
+            results.append(result)
+        return results
+
+
+def main():
+    """Выгрузка FBA остатков по всем маркетплейсам"""
+    parser = argparse.ArgumentParser(description='Выгрузка FBA inventory summaries по всем маркетплейсам')
+    parser.add_argument('--marketplaces', nargs='*',
+                        help='Названия маркетплейсов (USA, UK, AUSTRALIA, ...), по умолчанию все')
+    parser.add_argument('--changed-only', action='store_true',
+                        help='Только изменения с прошлого полного обхода (startDateTime из watermark)')
+    parser.add_argument('--since-hours', type=int,
+                        help='Только изменения за последние N часов (startDateTime)')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    args = parser.parse_args()
+
+    print("📦 FBA INVENTORY: выгрузка остатков по маркетплейсам")
+    print("=" * 60)
+
+    schema_client = AmazonProductSchemaClient()
+    names = [name.upper() for name in args.marketplaces] if args.marketplaces else list(schema_client.marketplaces)
+    unknown = [name for name in names if name not in schema_client.marketplaces]
+    if unknown:
+        print(f"❌ Неизвестные маркетплейсы: {unknown}")
+        return
+    marketplace_ids = [schema_client.marketplaces[name] for name in names]
+
+    start_datetime = None
+    if args.since_hours:
+        since = datetime.now(timezone.utc) - timedelta(hours=args.since_hours)
+        start_datetime = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    store = MappingStore(args.store)
+    crawler = FbaInventoryCrawler(store, schema_client)
+
+    started = time.monotonic()
+    results = crawler.crawl(marketplace_ids, changed_only=args.changed_only, start_datetime=start_datetime)
+    elapsed = time.monotonic() - started
+
+    print(f"\n📊 ИТОГО ({elapsed:.1f} сек):")
+    print("-" * 40)
+    for result in sorted(results, key=lambda r: r['marketplace_id']):
+        status = '✅' if result['complete'] else '❌'
+        print(f"   {status} {result['marketplace_id']}: страниц {result['pages']}, записей {result['summaries']}")
+
+    print(f"\n💾 Хранилище: {store.path}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Компилируемые XML-шаблоны фидов (wiper_blade_xml_template_*.xml)
+
+Синтаксис совместим с прежними шаблонами под str.format:
+    {name}              - значение, экранируется для XML (None → пусто)
+    {name:.2f}          - значение с форматом
+    {?name}...{/name}   - блок, если значение истинно
+    {^name}...{/name}   - блок, если значение ложно/отсутствует
+    {*name}...{/name}   - блок для каждого элемента списка; внутри {.} - сам
+                          элемент, {field} - поле элемента-словаря (или внешнего контекста)
+    {{ и }}             - литеральные скобки
+
+Шаблон один раз компилируется в Python-функцию: статические куски становятся
+строковыми константами, слоты - вызовами экранирования. Строка, на которой
+стоит только тег блока, из вывода удаляется целиком.
+"""
+import argparse
+import os
+import re
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List
+
+TOKEN_RE = re.compile(r'\{\{|\}\}|\{([?^*/]?)([A-Za-z_][A-Za-z0-9_]*|\.)(?::([^{}]*))?\}')
+# Строка, на которой только тег блока: отступ и перевод строки не выводим
+STANDALONE_BLOCK_RE = re.compile(r'^[ \t]*(\{[?^*/][A-Za-z_][A-Za-z0-9_]*\})[ \t]*\r?\n', re.M)
+
+# Символы, запрещенные в XML 1.0 (кроме \t \n \r)
+INVALID_XML_CHARS_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+class TemplateError(ValueError):
+    """Ошибка синтаксиса шаблона"""
+
+
+def escape_xml(value) -> str:
+    """Экранирование для текста и атрибутов XML"""
+    if value is None:
+        return ''
+    text = value if isinstance(value, str) else str(value)
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if not text.isprintable():
+        text = INVALID_XML_CHARS_RE.sub('', text)
+    return text
+
+
+def _items(value) -> Iterable:
+    if value is None:
+        return ()
+    if isinstance(value, (str, bytes, dict)):
+        return (value,)
+    return value
+
+
+class FeedTemplate:
+    """Шаблон, скомпилированный в функцию render(context) -> str"""
+
+    def __init__(self, source: str, name: str = '<template>'):
+        self.name = name
+        self.slots: List[str] = []
+        self.blocks: List[str] = []
+        self.code = self._generate(source)
+        namespace = {'_e': escape_xml, '_items': _items, '_format': format}
+        exec(compile(self.code, name, 'exec'), namespace)
+        self._render: Callable[[Dict], str] = namespace['render']
+
+    def _generate(self, source: str) -> str:
+        source = STANDALONE_BLOCK_RE.sub(r'\1', source)
+
+        lines = ['def render(_c0):', '    _out = []', '    _a = _out.append']
+        indent = '    '
+        # Стек открытых блоков: (вид, имя, переменная элемента или None)
+        stack = []
+        static: List[str] = []
+
+        def flush_static():
+            if static:
+                lines.append(f'{indent}_a({"".join(static)!r})')
+                static.clear()
+
+        def lookup(name: str) -> str:
+            """Выражение для значения: ближайший элемент-словарь цикла, затем контекст"""
+            if name == '.':
+                loops = [var for kind, _, var in stack if kind == '*']
+                if not loops:
+                    raise TemplateError(f"{self.name}: {{.}} вне блока {{*...}}")
+                return loops[-1]
+            expression = f'_c0[{name!r}]'
+            for kind, _, var in stack:
+                if kind == '*':
+                    expression = (f'({var}[{name!r}] if {var}.__class__ is dict and {name!r} in {var} '
+                                  f'else {expression})')
+            return expression
+
+        def soft_lookup(name: str) -> str:
+            """То же, но отсутствие значения - None (для условий и циклов)"""
+            if name == '.':
+                return lookup(name)
+            expression = f'_c0.get({name!r})'
+            for kind, _, var in stack:
+                if kind == '*':
+                    expression = (f'({var}[{name!r}] if {var}.__class__ is dict and {name!r} in {var} '
+                                  f'else {expression})')
+            return expression
+
+        pos = 0
+        for token in TOKEN_RE.finditer(source):
+            static.append(source[pos:token.start()])
+            pos = token.end()
+
+            text = token.group()
+            if text == '{{':
+                static.append('{')
+                continue
+            if text == '}}':
+                static.append('}')
+                continue
+
+            kind, name, spec = token.group(1), token.group(2), token.group(3)
+            flush_static()
+
+            if kind == '':
+                self.slots.append(name)
+                value = lookup(name)
+                if spec:
+                    lines.append(f'{indent}_a(_e(_format({value}, {spec!r})))')
+                else:
+                    lines.append(f'{indent}_a(_e({value}))')
+            elif kind == '/':
+                if not stack or stack[-1][1] != name:
+                    raise TemplateError(f"{self.name}: лишний {{/{name}}}")
+                stack.pop()
+                indent = indent[:-4]
+            else:
+                if spec:
+                    raise TemplateError(f"{self.name}: формат у блока {{{kind}{name}}}")
+                if name == '.' and kind == '*':
+                    raise TemplateError(f"{self.name}: {{*.}} не поддерживается")
+                self.blocks.append(name)
+                value = soft_lookup(name)
+                if kind == '?':
+                    lines.append(f'{indent}if {value}:')
+                    stack.append((kind, name, None))
+                elif kind == '^':
+                    lines.append(f'{indent}if not {value}:')
+                    stack.append((kind, name, None))
+                else:
+                    var = f'_i{len(stack) + 1}'
+                    lines.append(f'{indent}for {var} in _items({value}):')
+                    stack.append((kind, name, var))
+                indent += '    '
+                # Пустое тело блока - все равно валидный Python
+                lines.append(f'{indent}pass')
+
+        if stack:
+            raise TemplateError(f"{self.name}: не закрыт блок {{{stack[-1][0]}{stack[-1][1]}}}")
+
+        static.append(source[pos:])
+        flush_static()
+        lines.append("    return ''.join(_out)")
+        return '\n'.join(lines) + '\n'
+
+    def render(self, context: Dict) -> str:
+        """Отсутствующий обязательный слот - KeyError, как у str.format"""
+        return self._render(context)
+
+
+_template_cache: Dict[str, tuple] = {}
+
+
+def load_template(path: str) -> FeedTemplate:
+    """Шаблон из файла; компилируется один раз, пока файл не изменится"""
+    mtime = os.path.getmtime(path)
+    cached = _template_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'r', encoding='utf-8') as f:
+        template = FeedTemplate(f.read(), os.path.basename(path))
+    _template_cache[path] = (mtime, template)
+    return template
+
+
+def product_context(product: Dict, message_id: int = 1, marketplace: str = 'USA') -> Dict:
+    """Контекст шаблона товара дворников из товара Shopify"""
+    from description_converter import MAX_BULLETS, convert_description, description_byte_limit
+
+    variant = (product.get('variants') or [{}])[0]
+    converted = convert_description(product.get('body_html'), description_byte_limit(marketplace))
+    bullets = converted['bullets'][:MAX_BULLETS]
+    tags = [tag.strip() for tag in (product.get('tags') or '').split(',') if tag.strip()]
+
+    context = {
+        'message_id': message_id,
+        'sku': variant.get('sku') or f"SHOPIFY_{product.get('id')}",
+        'launch_date': (product.get('created_at') or datetime.now().isoformat())[:10],
+        'product_name': product.get('title') or '',
+        'brand': product.get('vendor') or 'Generic',
+        'product_description': converted['description'] or product.get('title') or '',
+        'manufacturer': product.get('vendor') or 'Generic',
+        'bullet_points': bullets,
+        'search_terms': ' '.join(tags),
+        'item_type': 'windshield-wiper-blades',
+        'target_audience': 'unisex-adult',
+        'part_number': variant.get('sku') or '',
+        'fitting_position': 'Front'
+    }
+    # Старые шаблоны с фиксированными {bullet_point1..3}
+    for i in range(1, 4):
+        context[f'bullet_point{i}'] = bullets[i - 1] if i <= len(bullets) else ''
+    return context
+
+
+def _etree_product_feed(context: Dict) -> str:
+    """Эквивалент шаблона через ElementTree - для сравнения скорости"""
+    import xml.etree.ElementTree as ET
+
+    envelope = ET.Element("AmazonEnvelope")
+    envelope.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
+    envelope.set("xsi:noNamespaceSchemaLocation", "amzn-envelope.xsd")
+    header = ET.SubElement(envelope, "Header")
+    ET.SubElement(header, "DocumentVersion").text = "1.01"
+    ET.SubElement(header, "MerchantIdentifier").text = "MERCHANT_ID"
+    ET.SubElement(envelope, "MessageType").text = "Product"
+    ET.SubElement(envelope, "PurgeAndReplace").text = "false"
+    message = ET.SubElement(envelope, "Message")
+    ET.SubElement(message, "MessageID").text = str(context['message_id'])
+    ET.SubElement(message, "OperationType").text = "Update"
+    product = ET.SubElement(message, "Product")
+    ET.SubElement(product, "SKU").text = context['sku']
+    ET.SubElement(product, "ProductTaxCode").text = "A_GEN_NOTAX"
+    ET.SubElement(product, "LaunchDate").text = context['launch_date']
+    descriptive = ET.SubElement(product, "DescriptiveData")
+    ET.SubElement(descriptive, "Title").text = context['product_name']
+    ET.SubElement(descriptive, "Brand").text = context['brand']
+    ET.SubElement(descriptive, "Description").text = context['product_description']
+    ET.SubElement(descriptive, "Manufacturer").text = context['manufacturer']
+    for bullet in context['bullet_points']:
+        ET.SubElement(descriptive, "BulletPoint").text = bullet
+    ET.SubElement(descriptive, "SearchTerms").text = context['search_terms']
+    ET.SubElement(descriptive, "ItemType").text = context['item_type']
+    ET.SubElement(descriptive, "TargetAudience").text = context['target_audience']
+    misc = ET.SubElement(ET.SubElement(ET.SubElement(product, "ProductData"), "AutoAccessory"), "AutoAccessoryMisc")
+    ET.SubElement(misc, "PartNumber").text = context['part_number']
+    ET.SubElement(misc, "FittingPosition").text = context['fitting_position']
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(envelope, encoding='unicode')
+
+
+def main():
+    """Product feed по шаблону для всей выгрузки Shopify"""
+    from reconcile_catalog import iter_jsonl
+
+    parser = argparse.ArgumentParser(description='Product feed из XML-шаблона')
+    parser.add_argument('--template', required=True, help='Файл шаблона (wiper_blade_xml_template_*.xml)')
+    parser.add_argument('--shopify-snapshot', required=True, help='JSONL с товарами Shopify')
+    parser.add_argument('--marketplace', default='USA', help='Маркетплейс (лимит описания)')
+    parser.add_argument('--compare-etree', action='store_true', help='Сравнить скорость с ElementTree')
+    parser.add_argument('--output', help='Файл фида для шаблона с {*messages} (по умолчанию amazon_xml_feeds/product_feed_<время>.xml)')
+    args = parser.parse_args()
+
+    print("🧩 PRODUCT FEED ПО ШАБЛОНУ")
+    print("=" * 60)
+
+    template = load_template(args.template)
+    contexts = [
+        product_context(product, i, args.marketplace)
+        for i, product in enumerate(iter_jsonl(args.shopify_snapshot), 1)
+    ]
+    print(f"📦 Товаров: {len(contexts)}, слотов в шаблоне: {len(set(template.slots))}")
+
+    started = time.perf_counter()
+    if 'messages' in template.blocks:
+        # Шаблон с {*messages}: один фид на все товары
+        documents = [template.render({'messages': contexts})]
+    else:
+        documents = [template.render(context) for context in contexts]
+    elapsed = time.perf_counter() - started
+    rate = len(contexts) / elapsed if elapsed else 0
+    print(f"⚡ Шаблон: {elapsed * 1000:.1f} мс ({rate:.0f} товаров/сек)")
+
+    if args.compare_etree:
+        started = time.perf_counter()
+        for context in contexts:
+            _etree_product_feed(context)
+        etree_elapsed = time.perf_counter() - started
+        print(f"🐢 ElementTree: {etree_elapsed * 1000:.1f} мс "
+              f"(в {etree_elapsed / elapsed if elapsed else 0:.1f} раза медленнее)")
+
+    xml_dir = os.path.join(os.path.dirname(__file__), "amazon_xml_feeds")
+    os.makedirs(xml_dir, exist_ok=True)
+    if len(documents) == 1:
+        output = args.output or os.path.join(xml_dir, f"product_feed_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xml")
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(documents[0])
+        print(f"💾 Фид: {output}")
+    else:
+        # Шаблон на один товар: отдельный фид на SKU
+        for context, document in zip(contexts, documents):
+            with open(os.path.join(xml_dir, f"product_feed_{context['sku']}.xml"), 'w', encoding='utf-8') as f:
+                f.write(document)
+        print(f"💾 Фидов: {len(documents)} в {xml_dir}")
+
+
+if __name__ == "__main__":
+    main()
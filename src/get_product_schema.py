@@ -3,16 +3,15 @@
 Получение полной схемы полей для товара "автомобильные дворники" 
 на маркетплейсе Amazon Австралия
 """
-import os
 import json
-import requests
 from datetime import datetime
-from pathlib import Path
-from dotenv import load_dotenv
+from settings import load_settings
+from profiling import profile_main
+from sp_api_router import endpoint_for
 from test_integration import AmazonSandboxClient
 
 # Загружаем переменные окружения
-load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+load_settings()
 
 class AmazonProductSchemaClient:
     """Клиент для получения схем товаров Amazon"""
@@ -45,151 +44,103 @@ class AmazonProductSchemaClient:
             'AUTO_ACCESSORY'
         ]
         
-        # Эндпоинты по регионам
-        self.endpoints = {
-            'NA': 'https://sellingpartnerapi-na.amazon.com',  # США, Канада, Мексика
-            'EU': 'https://sellingpartnerapi-eu.amazon.com',  # Европа
-            'FE': 'https://sellingpartnerapi-fe.amazon.com'   # Дальний Восток (включая Австралию)
-        }
-    
     def get_region_endpoint(self, marketplace_id):
         """Определяет нужный эндпоинт по ID маркетплейса"""
-        if marketplace_id in ['ATVPDKIKX0DER', 'A2EUQ1WTGCTBG2', 'A1AM78C64UM0Y8']:
-            return self.endpoints['NA']
-        elif marketplace_id in ['A39IBJ37TRP1C6', 'A1VC38T7YXB528']:  # Австралия, Япония
-            return self.endpoints['FE']
-        else:
-            return self.endpoints['EU']  # Европа по умолчанию
+        return endpoint_for(marketplace_id)
     
     def search_product_types(self, marketplace_id, keywords='wiper'):
         """Ищет доступные типы товаров по ключевым словам"""
         print(f"🔍 Поиск типов товаров по ключевому слову: {keywords}")
         print(f"📍 Маркетплейс: {marketplace_id}")
         
-        try:
-            # Получаем токен доступа
-            access_token = self.base_client.get_access_token()
-            if not access_token:
-                print("❌ Не удалось получить токен доступа")
-                return None
-            
-            # Определяем эндпоинт
-            base_url = self.get_region_endpoint(marketplace_id)
-            
-            headers = {
-                'x-amz-access-token': access_token,
-                'Content-Type': 'application/json'
-            }
-            
-            api_version = "2020-09-01"
-            url = f"{base_url}/definitions/{api_version}/productTypes"
-            
-            params = {
-                'marketplaceIds': marketplace_id
-            }
-            
-            print(f"🌐 Запрос к: {url}")
-            
-            response = requests.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            
-            data = response.json()
-            product_types = data.get('productTypes', [])
-            
-            print(f"✅ Найдено {len(product_types)} типов товаров")
-            
-            # Фильтруем по ключевым словам
-            matching_types = []
-            for ptype in product_types:
-                name = ptype.get('name', '').upper()
-                display_name = ptype.get('displayName', '').upper()
-                
-                if any(keyword.upper() in name or keyword.upper() in display_name 
-                      for keyword in keywords.split()):
-                    matching_types.append(ptype)
-            
-            print(f"🎯 Найдено {len(matching_types)} подходящих типов:")
-            for ptype in matching_types:
-                print(f"   • {ptype.get('name')} - {ptype.get('displayName')}")
-            
-            # Сохраняем полный список
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"product_types_{marketplace_id}_{timestamp}.json"
-            
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump({
-                    'marketplace_id': marketplace_id,
-                    'total_types': len(product_types),
-                    'matching_types': matching_types,
-                    'all_types': product_types
-                }, f, indent=2, ensure_ascii=False)
-            
-            print(f"💾 Результаты сохранены в: {filename}")
-            return matching_types
-            
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка при поиске типов товаров: {e}")
-            if hasattr(e, 'response') and e.response:
-                print(f"   Код ответа: {e.response.status_code}")
-                print(f"   Тело ответа: {e.response.text}")
+        # Определяем эндпоинт
+        base_url = self.get_region_endpoint(marketplace_id)
+        
+        api_version = "2020-09-01"
+        endpoint = f"/definitions/{api_version}/productTypes"
+        
+        params = {
+            'marketplaceIds': marketplace_id
+        }
+        
+        print(f"🌐 Запрос к: {base_url}{endpoint}")
+        
+        data = self.base_client.make_api_request(endpoint, params=params, base_url=base_url)
+        if data is None:
+            print("❌ Ошибка при поиске типов товаров")
             return None
+        
+        product_types = data.get('productTypes', [])
+        
+        print(f"✅ Найдено {len(product_types)} типов товаров")
+        
+        # Фильтруем по ключевым словам
+        matching_types = []
+        for ptype in product_types:
+            name = ptype.get('name', '').upper()
+            display_name = ptype.get('displayName', '').upper()
+            
+            if any(keyword.upper() in name or keyword.upper() in display_name 
+                  for keyword in keywords.split()):
+                matching_types.append(ptype)
+        
+        print(f"🎯 Найдено {len(matching_types)} подходящих типов:")
+        for ptype in matching_types:
+            print(f"   • {ptype.get('name')} - {ptype.get('displayName')}")
+        
+        # Сохраняем полный список
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"product_types_{marketplace_id}_{timestamp}.json"
+        
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({
+                'marketplace_id': marketplace_id,
+                'total_types': len(product_types),
+                'matching_types': matching_types,
+                'all_types': product_types
+            }, f, indent=2, ensure_ascii=False)
+        
+        print(f"💾 Результаты сохранены в: {filename}")
+        return matching_types
     
     def get_product_type_definition(self, product_type, marketplace_id):
         """Получает полную схему определения типа товара"""
         print(f"⚙️  Запрашиваем схему для типа '{product_type}'...")
         print(f"📍 Маркетплейс: {marketplace_id}")
         
-        try:
-            # Получаем токен доступа
-            access_token = self.base_client.get_access_token()
-            if not access_token:
-                print("❌ Не удалось получить токен доступа")
-                return None
-            
-            # Определяем эндпоинт
-            base_url = self.get_region_endpoint(marketplace_id)
-            
-            headers = {
-                'x-amz-access-token': access_token,
-                'Content-Type': 'application/json'
-            }
-            
-            api_version = "2020-09-01"
-            url = f"{base_url}/definitions/{api_version}/productTypes/{product_type}"
-            
-            params = {
-                'marketplaceIds': marketplace_id,
-                'requirements': 'LISTING',  # Требования для создания листинга
-                'requirementsEnforced': 'ENFORCED'  # Только обязательные поля
-            }
-            
-            print(f"🌐 Запрос к: {url}")
-            
-            response = requests.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            
-            schema = response.json()
-            print("✅ Схема успешно получена!")
-            
-            # Анализируем схему
-            self.analyze_schema(schema, product_type)
-            
-            # Сохраняем результат
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"schema_{product_type}_{marketplace_id}_{timestamp}.json"
-            
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(schema, f, indent=2, ensure_ascii=False)
-            
-            print(f"💾 Схема сохранена в: {filename}")
-            return schema
-            
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка при запросе схемы: {e}")
-            if hasattr(e, 'response') and e.response:
-                print(f"   Код ответа: {e.response.status_code}")
-                print(f"   Тело ответа: {e.response.text}")
+        # Определяем эндпоинт
+        base_url = self.get_region_endpoint(marketplace_id)
+        
+        api_version = "2020-09-01"
+        endpoint = f"/definitions/{api_version}/productTypes/{product_type}"
+        
+        params = {
+            'marketplaceIds': marketplace_id,
+            'requirements': 'LISTING',  # Требования для создания листинга
+            'requirementsEnforced': 'ENFORCED'  # Только обязательные поля
+        }
+        
+        print(f"🌐 Запрос к: {base_url}{endpoint}")
+        
+        schema = self.base_client.make_api_request(endpoint, params=params, base_url=base_url)
+        if schema is None:
+            print("❌ Ошибка при запросе схемы")
             return None
+        
+        print("✅ Схема успешно получена!")
+        
+        # Анализируем схему
+        self.analyze_schema(schema, product_type)
+        
+        # Сохраняем результат
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"schema_{product_type}_{marketplace_id}_{timestamp}.json"
+        
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(schema, f, indent=2, ensure_ascii=False)
+        
+        print(f"💾 Схема сохранена в: {filename}")
+        return schema
     
     def analyze_schema(self, schema, product_type):
         """Анализирует и выводит информацию о схеме"""
@@ -264,6 +215,7 @@ class AmazonProductSchemaClient:
         
         return successful_types
 
+@profile_main
 def main():
     """Основная функция"""
     print("🚀 ПОЛУЧЕНИЕ СХЕМЫ ТОВАРА 'АВТОМОБИЛЬНЫЕ ДВОРНИКИ'")
@@ -270,7 +270,12 @@ def analyze_shopify_to_amazon_mapping():
     return mapping
 
 def create_sample_xml_feed():
-    """Создает пример XML фида на основе схемы"""
+    """
+    Создает пример XML фида на основе схемы.
+
+    Шаблон для feed_template: {*messages} - сообщение на товар,
+    {*bullet_points} - повторяемый блок, {?search_terms} - необязательный.
+    """
     
     xml_template = '''<?xml version="1.0" encoding="UTF-8"?>
 <AmazonEnvelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
@@ -281,8 +286,9 @@ def create_sample_xml_feed():
     </Header>
     <MessageType>Product</MessageType>
     <PurgeAndReplace>false</PurgeAndReplace>
+    {*messages}
     <Message>
-        <MessageID>1</MessageID>
+        <MessageID>{message_id}</MessageID>
         <OperationType>Update</OperationType>
         <Product>
             <SKU>{sku}</SKU>
@@ -293,10 +299,12 @@ def create_sample_xml_feed():
                 <Brand>{brand}</Brand>
                 <Description>{product_description}</Description>
                 <Manufacturer>{manufacturer}</Manufacturer>
-                <BulletPoint>{bullet_point1}</BulletPoint>
-                <BulletPoint>{bullet_point2}</BulletPoint>
-                <BulletPoint>{bullet_point3}</BulletPoint>
+                {*bullet_points}
+                <BulletPoint>{.}</BulletPoint>
+                {/bullet_points}
+                {?search_terms}
                 <SearchTerms>{search_terms}</SearchTerms>
+                {/search_terms}
                 <ItemType>{item_type}</ItemType>
                 <TargetAudience>{target_audience}</TargetAudience>
             </DescriptiveData>
@@ -310,6 +318,7 @@ def create_sample_xml_feed():
             </ProductData>
         </Product>
     </Message>
+    {/messages}
 </AmazonEnvelope>'''
     
     return xml_template
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Запись и воспроизведение HTTP-обменов (кассета) для офлайн-прогонов и бенчмарков
+
+Перехватывается requests.Session.send, поэтому кассета работает для всех
+запросов процесса: AmazonSandboxClient, ShopifyClient, загрузка документов
+и отдельные скрипты с голым requests.get/post.
+
+    # записать реальные ответы
+    python src/http_cassette.py record --cassette runs/schema.sqlite3 src/get_product_schema.py
+    # воспроизвести без сети: как можно быстрее или в исходном темпе (--speed 1)
+    python src/http_cassette.py replay --cassette runs/schema.sqlite3 --speed 1 src/get_product_schema.py
+    python src/http_cassette.py info --cassette runs/schema.sqlite3
+
+Клиенты из test_integration подключают кассету и сами по окружению:
+HTTP_CASSETTE=<файл>, HTTP_CASSETTE_MODE=record|replay|auto, HTTP_CASSETTE_SPEED=0|1|2...
+
+Кассета - SQLite-файл: тела ответов сжаты zlib, секреты вычищены
+(токены LWA/Shopify в телах, заголовки авторизации и cookie не пишутся).
+Ключ поиска - хэш метода, пути и нормализованных параметров (порядок не важен,
+подписи X-Amz-* и временные фильтры отброшены) плюс хэш тела запроса; если
+запрос с таким телом не записан, берется ответ на тот же метод+путь+параметры.
+При воспроизведении все записи загружаются в память, поиск - один словарь.
+Повторяющиеся запросы (опрос статуса фида) получают ответы в порядке записи,
+последний ответ повторяется.
+"""
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import runpy
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from structured_log import get_logger, redact, redact_text
+
+log = get_logger('cassette')
+
+MODES = ('record', 'replay', 'auto')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS interactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    match_key TEXT NOT NULL,
+    route_key TEXT NOT NULL,
+    method TEXT NOT NULL,
+    route TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    reason TEXT,
+    headers TEXT NOT NULL,
+    body BLOB,
+    elapsed REAL NOT NULL,
+    recorded_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_interactions_match_key ON interactions(match_key, id);
+"""
+
+# Параметры, которые меняются от запуска к запуску и не должны влиять на поиск
+VOLATILE_PARAMS = {'CreatedAfter', 'CreatedBefore', 'LastUpdatedAfter', 'LastUpdatedBefore', 'startDateTime'}
+
+# Заголовки ответа, которые в кассету не пишутся (content-length относится к телу до очистки -
+# при воспроизведении он считается заново)
+DROPPED_RESPONSE_HEADERS = {'set-cookie', 'authorization', 'x-amz-access-token', 'x-shopify-access-token',
+                            'content-encoding', 'transfer-encoding', 'connection', 'keep-alive',
+                            'content-length'}
+
+TEXT_CONTENT_TYPES = ('json', 'xml', 'text', 'html', 'x-www-form-urlencoded')
+
+_original_send = requests.Session.send
+_active: Optional['Cassette'] = None
+_install_lock = threading.Lock()
+
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=12).hexdigest()
+
+
+def _body_text(body) -> str:
+    """Тело запроса в каноническом виде (JSON - с отсортированными ключами)"""
+    if body is None:
+        return ''
+    if isinstance(body, bytes):
+        try:
+            body = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return hashlib.blake2b(body, digest_size=12).hexdigest()
+    if not isinstance(body, str):
+        # Потоковые тела (файлы, генераторы) в ключ не попадают
+        return ''
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        return body
+
+
+def request_route(method: str, url: str) -> str:
+    """GET /catalog/2022-04-01/items?identifiers=...&marketplaceIds=... - без хоста, в каноническом порядке"""
+    parts = urlsplit(url)
+    params = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in VOLATILE_PARAMS and not key.lower().startswith('x-amz-')
+    )
+    query = urlencode(params)
+    return f"{method.upper()} {parts.path or '/'}" + (f"?{query}" if query else '')
+
+
+def request_keys(method: str, url: str, body=None) -> Tuple[str, str, str]:
+    """(ключ с телом, ключ без тела, маршрут для отчетов)"""
+    route = request_route(method, url)
+    return _digest(f"{route}\n{_body_text(body)}"), _digest(route), route
+
+
+def _scrub_body(content: bytes, content_type: str) -> bytes:
+    if not content or not any(kind in content_type for kind in TEXT_CONTENT_TYPES):
+        return content
+    try:
+        return redact_text(content.decode('utf-8')).encode('utf-8')
+    except UnicodeDecodeError:
+        return content
+
+
+def _scrub_headers(headers) -> Dict[str, str]:
+    kept = {key: value for key, value in headers.items() if key.lower() not in DROPPED_RESPONSE_HEADERS}
+    return redact(kept)
+
+
+class Cassette:
+    """Кассета в SQLite: запись обменов и воспроизведение из памяти"""
+
+    def __init__(self, path: str, mode: str = 'replay', speed: float = 0.0):
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим кассеты: {mode} ({', '.join(MODES)})")
+        if mode == 'replay' and not os.path.exists(path):
+            raise FileNotFoundError(f"Кассета не найдена: {path}")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._pending = 0
+        # ключ → записи по порядку и позиция следующей
+        self._entries: Dict[str, List[tuple]] = {}
+        self._cursors: Dict[str, int] = {}
+        self.stats = {'hits': 0, 'fallback_hits': 0, 'misses': 0, 'recorded': 0}
+        if mode != 'record':
+            self._load()
+
+    def _load(self) -> None:
+        rows = self._conn.execute(
+            "SELECT match_key, route_key, status, reason, headers, body, elapsed FROM interactions ORDER BY id"
+        )
+        for match_key, route_key, status, reason, headers, body, elapsed in rows:
+            entry = (status, reason, headers, body, elapsed)
+            self._entries.setdefault(match_key, []).append(entry)
+            self._entries.setdefault('route:' + route_key, []).append(entry)
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM interactions").fetchone()[0]
+
+    def _next(self, key: str) -> Optional[tuple]:
+        entries = self._entries.get(key)
+        if not entries:
+            return None
+        with self._lock:
+            position = self._cursors.get(key, 0)
+            self._cursors[key] = position + 1
+        return entries[min(position, len(entries) - 1)]
+
+    def lookup(self, method: str, url: str, body=None) -> Optional[tuple]:
+        match_key, route_key, _ = request_keys(method, url, body)
+        entry = self._next(match_key)
+        if entry is not None:
+            self.stats['hits'] += 1
+            return entry
+        entry = self._next('route:' + route_key)
+        if entry is not None:
+            self.stats['fallback_hits'] += 1
+        return entry
+
+    def replay(self, request: requests.PreparedRequest, entry: tuple) -> requests.Response:
+        status, reason, headers, body, elapsed = entry
+        if self.speed > 0:
+            time.sleep(elapsed / self.speed)
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response._content = zlib.decompress(body) if body else b''
+        response.headers['Content-Length'] = str(len(response._content))
+        response._content_consumed = True
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=elapsed)
+        return response
+
+    def record(self, request: requests.PreparedRequest, response: requests.Response, elapsed: float) -> None:
+        match_key, route_key, route = request_keys(request.method, request.url, request.body)
+        content = _scrub_body(response.content, response.headers.get('Content-Type', ''))
+        row = (
+            match_key, route_key, request.method, route, response.status_code, response.reason,
+            json.dumps(_scrub_headers(response.headers), ensure_ascii=False),
+            zlib.compress(content, 6) if content else None, elapsed,
+            datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        )
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO interactions (match_key, route_key, method, route, status, reason, headers, body, "
+                "elapsed, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row
+            )
+            self.stats['recorded'] += 1
+            self._pending += 1
+            if self._pending >= 100:
+                self._conn.commit()
+                self._pending = 0
+
+    def send(self, session: requests.Session, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if self.mode != 'record':
+            entry = self.lookup(request.method, request.url, request.body)
+            if entry is not None:
+                return self.replay(request, entry)
+            self.stats['misses'] += 1
+            if self.mode == 'replay':
+                route = request_route(request.method, request.url)
+                log.warning('cassette.miss', route=route)
+                raise requests.exceptions.ConnectionError(f"В кассете нет ответа на {route}", request=request)
+
+        started = time.perf_counter()
+        response = _original_send(session, request, **kwargs)
+        # Тело читается целиком и для stream=True: iter_content потом отдаст его из памяти
+        response.content
+        self.record(request, response, time.perf_counter() - started)
+        return response
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def info(self) -> Dict:
+        total, size, elapsed = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0), COALESCE(SUM(elapsed), 0) FROM interactions"
+        ).fetchone()
+        routes = Counter(route.split('?', 1)[0] for route, in self._conn.execute("SELECT route FROM interactions"))
+        return {'interactions': total, 'compressed_bytes': size, 'recorded_seconds': elapsed,
+                'routes': routes.most_common()}
+
+
+def _patched_send(session, request, **kwargs):
+    cassette = _active
+    if cassette is None:
+        return _original_send(session, request, **kwargs)
+    return cassette.send(session, request, **kwargs)
+
+
+def install_cassette(path: str, mode: str = 'replay', speed: float = 0.0) -> Cassette:
+    """Подключает кассету ко всем запросам requests в процессе"""
+    global _active
+    with _install_lock:
+        if _active is not None:
+            _active.close()
+        _active = Cassette(path, mode, speed)
+        requests.Session.send = _patched_send
+    atexit.register(uninstall_cassette)
+    log.info('cassette.installed', path=path, mode=mode, speed=speed,
+             interactions=lambda: len(_active) if _active else 0)
+    return _active
+
+
+def uninstall_cassette() -> None:
+    global _active
+    with _install_lock:
+        if _active is not None:
+            log.info('cassette.closed', path=_active.path, **_active.stats)
+            _active.close()
+            _active = None
+        requests.Session.send = _original_send
+
+
+def install_from_env() -> Optional[Cassette]:
+    """HTTP_CASSETTE / HTTP_CASSETTE_MODE / HTTP_CASSETTE_SPEED; без HTTP_CASSETTE ничего не делает"""
+    path = os.getenv('HTTP_CASSETTE')
+    if not path or _active is not None:
+        return _active
+    return install_cassette(path, os.getenv('HTTP_CASSETTE_MODE') or 'replay',
+                            float(os.getenv('HTTP_CASSETTE_SPEED') or 0))
+
+
+def main():
+    """Запуск скрипта проекта с записью или воспроизведением HTTP"""
+    parser = argparse.ArgumentParser(description='HTTP-кассета: запись и воспроизведение запросов скрипта')
+    commands = parser.add_subparsers(dest='mode', required=True)
+    help_texts = {
+        'record': 'Записать запросы скрипта',
+        'replay': 'Воспроизвести без сети (промах - ошибка соединения)',
+        'auto': 'Воспроизвести, промахи - выполнить и дописать',
+        'info': 'Содержимое кассеты',
+    }
+    for mode, help_text in help_texts.items():
+        command = commands.add_parser(mode, help=help_text)
+        command.add_argument('--cassette', required=True, help='Файл кассеты (SQLite)')
+        if mode == 'info':
+            continue
+        if mode != 'record':
+            command.add_argument('--speed', type=float, default=0.0,
+                                 help='Темп: 0 - без задержек, 1 - как при записи, 2 - вдвое быстрее')
+        command.add_argument('script', help='Путь к скрипту')
+        command.add_argument('args', nargs=argparse.REMAINDER, help='Аргументы скрипта')
+    args = parser.parse_args()
+
+    if args.mode == 'info':
+        cassette = Cassette(args.cassette, 'replay')
+        info = cassette.info()
+        cassette.close()
+        print(f"📼 {args.cassette}: {info['interactions']} обменов, "
+              f"{info['compressed_bytes'] / 2 ** 20:.1f} МБ тел (zlib), {info['recorded_seconds']:.1f} с при записи")
+        for route, count in info['routes'][:30]:
+            print(f"   {count:>6}  {route}")
+        return
+
+    cassette = install_cassette(args.cassette, args.mode, getattr(args, 'speed', 0.0))
+    sys.argv = [args.script] + args.args
+    sys.path[0] = os.path.dirname(os.path.abspath(args.script))
+    try:
+        runpy.run_path(args.script, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            print(f"⚠️  Скрипт завершился с кодом {e.code}")
+    finally:
+        stats = dict(cassette.stats)
+        uninstall_cassette()
+        print(f"\n📼 Кассета {args.cassette} ({args.mode}): записано {stats['recorded']}, "
+              f"найдено {stats['hits']} (+{stats['fallback_hits']} без учета тела), промахов {stats['misses']}")
+
+
+if __name__ == "__main__":
+    main()
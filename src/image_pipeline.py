@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Изображения листингов: загрузка из Shopify, проверка и Image feed
+
+- изображения скачиваются параллельно и хранятся в кэше на диске
+  по хэшу содержимого (одинаковые файлы у разных SKU - один файл)
+- если src не изменился и файл есть в кэше, повторной загрузки нет
+- формат и размеры читаются из заголовка без декодирования; фон главного
+  изображения проверяется по рамке уменьшенной копии (JPEG декодируется
+  сразу в 1/8 масштаба)
+- в Image feed попадают только слоты, хэш которых отличается от отправленного
+  на этот маркетплейс (Delete - тоже по маркетплейсу)
+"""
+import argparse
+import hashlib
+import io
+import os
+import sys
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import requests
+from mapping_store import MappingStore
+from settings import load_settings
+from structured_log import get_logger
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('images')
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'image_cache')
+
+# Требования Amazon к изображениям товара
+ALLOWED_FORMATS = {'JPEG', 'PNG', 'GIF', 'TIFF'}
+MIN_LONGEST_SIDE = 500     # меньше - изображение отклоняется
+ZOOM_LONGEST_SIDE = 1000   # меньше - не будет зума на странице товара
+WHITE_LEVEL = 245          # JPEG-шум не дает ровно 255
+MIN_WHITE_BORDER_RATIO = 0.9
+
+# Позиция изображения в Shopify → слот Amazon (Main + до 8 дополнительных)
+IMAGE_SLOTS = ['Main'] + [f'PT{i}' for i in range(1, 9)]
+
+DOWNLOAD_TIMEOUT = 30
+
+
+def slot_for_position(position: int) -> Optional[str]:
+    return IMAGE_SLOTS[position - 1] if 1 <= position <= len(IMAGE_SLOTS) else None
+
+
+def white_border_ratio(image: Image.Image) -> float:
+    """Доля почти белых пикселей по рамке изображения (прозрачность считается белой)"""
+    width, height = image.size
+    # draft работает только для JPEG: декодер сразу отдает уменьшенную копию
+    image.draft('RGB', (max(width // 8, 1), max(height // 8, 1)))
+    if image.mode in ('RGBA', 'LA', 'P'):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGBA', rgba.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, rgba)
+    image = image.convert('RGB')
+    image.thumbnail((256, 256))
+
+    pixels = np.asarray(image)
+    border = np.concatenate([pixels[0], pixels[-1], pixels[1:-1, 0], pixels[1:-1, -1]])
+    return float((border >= WHITE_LEVEL).all(axis=1).mean())
+
+
+def inspect_image(data: bytes, is_main: bool) -> Dict:
+    """Формат, размеры и нарушения требований Amazon"""
+    try:
+        # Image.open читает только заголовок
+        image = Image.open(io.BytesIO(data))
+    except Exception as e:
+        return {'format': None, 'width': None, 'height': None, 'issues': [f'не читается: {e}']}
+
+    width, height = image.size
+    result = {'format': image.format, 'width': width, 'height': height, 'issues': []}
+
+    if image.format not in ALLOWED_FORMATS:
+        result['issues'].append(f'формат {image.format} не поддерживается')
+        return result
+
+    longest = max(width, height)
+    if longest < MIN_LONGEST_SIDE:
+        result['issues'].append(f'слишком маленькое: {width}x{height}, нужно от {MIN_LONGEST_SIDE}px')
+        return result
+    if longest < ZOOM_LONGEST_SIDE:
+        result['warning'] = f'без зума: {width}x{height}, рекомендуется от {ZOOM_LONGEST_SIDE}px'
+
+    if is_main:
+        ratio = white_border_ratio(image)
+        if ratio < MIN_WHITE_BORDER_RATIO:
+            result['issues'].append(f'фон главного изображения не белый ({ratio:.0%} белой рамки)')
+
+    return result
+
+
+class ImageCache:
+    """Файлы изображений по хэшу содержимого: <dir>/ab/abcdef..."""
+
+    def __init__(self, root: str = None):
+        self.root = root or os.getenv('IMAGE_CACHE_DIR') or DEFAULT_CACHE_DIR
+
+    def path(self, content_hash: str) -> str:
+        return os.path.join(self.root, content_hash[:2], content_hash)
+
+    def has(self, content_hash: str) -> bool:
+        return os.path.exists(self.path(content_hash))
+
+    def put(self, data: bytes) -> str:
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return content_hash
+
+
+class ImagePipeline:
+    """Скачивает, проверяет и сравнивает изображения листингов с отправленными"""
+
+    def __init__(self, store: MappingStore, cache: ImageCache = None, max_workers: int = 8):
+        self.store = store
+        self.cache = cache or ImageCache()
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _download(self, src: str, tasks: List[Dict]) -> List[Dict]:
+        """Одна загрузка на src, проверка для каждого слота, где он используется"""
+        try:
+            response = self.session.get(src, timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            log.warning('image.download_failed', src=src, slots=len(tasks), error=str(e))
+            return [dict(task, error=str(e)) for task in tasks]
+
+        content_hash = self.cache.put(response.content)
+        inspections = {}
+        results = []
+        for task in tasks:
+            is_main = task['slot'] == 'Main'
+            if is_main not in inspections:
+                inspections[is_main] = inspect_image(response.content, is_main)
+            results.append(dict(task, content_hash=content_hash, **inspections[is_main]))
+        return results
+
+    def process(self, sku_images: Dict[str, List[Dict]], marketplace: str) -> Dict:
+        """
+        sku → изображения Shopify ({'src', 'position'}).
+
+        Возвращает {'images': [...], 'changed': [...], 'removed': [(sku, слот)], 'failed': [...]}:
+        changed - прошедшие проверку слоты, хэш которых отличается от подтвержденного
+        на marketplace, removed - подтвержденные там слоты, которых больше нет.
+        """
+        previous = self.store.get_listing_images(list(sku_images))
+        sent = self.store.get_sent_images(marketplace, list(sku_images))
+
+        tasks, reused, current_slots = defaultdict(list), [], set()
+        for sku, images in sku_images.items():
+            for i, image in enumerate(sorted(images, key=lambda img: img.get('position') or 0), 1):
+                slot = slot_for_position(i)
+                if not slot or not image.get('src'):
+                    continue
+                current_slots.add((sku, slot))
+                task = {'sku': sku, 'slot': slot, 'src': image['src']}
+
+                known = previous.get((sku, slot))
+                # Shopify меняет ?v= в src при замене файла, так что тот же src - тот же файл
+                if known and known['src'] == image['src'] and self.cache.has(known['content_hash']):
+                    reused.append(known)
+                else:
+                    tasks[image['src']].append(task)
+
+        # Одно и то же изображение у нескольких SKU скачивается один раз
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            downloaded = [
+                image
+                for images in executor.map(self._download, tasks.keys(), tasks.values())
+                for image in images
+            ]
+
+        failed = [image for image in downloaded if 'error' in image]
+        fresh = [image for image in downloaded if 'error' not in image]
+        self.store.save_listing_images(fresh)
+
+        images = reused + fresh
+        changed = [
+            image for image in images
+            if not image['issues'] and image['content_hash'] != sent.get((image['sku'], image['slot']))
+        ]
+        removed = [key for key in sent if key not in current_slots]
+        # Проверка слота, которого нет в Shopify, больше не нужна; Delete считается от отправленного
+        self.store.delete_listing_images([key for key in previous if key not in current_slots])
+
+        return {
+            'images': images,
+            'downloaded': len(fresh),
+            'changed': changed,
+            'removed': removed,
+            'failed': failed
+        }
+
+    def mark_sent(self, result: Dict, marketplace: str, rejected_skus=()) -> None:
+        """Отмечает слоты отправленными на маркетплейс - только после отчета Amazon, без SKU с ошибками"""
+        self.store.mark_images_sent(
+            marketplace,
+            [(image['sku'], image['slot'], image['content_hash']) for image in result['changed']
+             if image['sku'] not in rejected_skus],
+            [(sku, slot) for sku, slot in result['removed'] if sku not in rejected_skus]
+        )
+
+
+def build_image_feed(changed: List[Dict], removed: List[tuple] = (), merchant_id: str = "MERCHANT_ID") -> str:
+    """ProductImage feed: Update для изменившихся слотов, Delete для удаленных"""
+    envelope = ET.Element("AmazonEnvelope")
+    envelope.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
+    envelope.set("xsi:noNamespaceSchemaLocation", "amzn-envelope.xsd")
+
+    header = ET.SubElement(envelope, "Header")
+    ET.SubElement(header, "DocumentVersion").text = "1.01"
+    ET.SubElement(header, "MerchantIdentifier").text = merchant_id
+
+    ET.SubElement(envelope, "MessageType").text = "ProductImage"
+
+    messages = [('Update', image['sku'], image['slot'], image['src']) for image in changed]
+    messages += [('Delete', sku, slot, None) for sku, slot in removed]
+
+    for message_id, (operation, sku, slot, location) in enumerate(messages, 1):
+        message = ET.SubElement(envelope, "Message")
+        ET.SubElement(message, "MessageID").text = str(message_id)
+        ET.SubElement(message, "OperationType").text = operation
+
+        product_image = ET.SubElement(message, "ProductImage")
+        ET.SubElement(product_image, "SKU").text = sku
+        ET.SubElement(product_image, "ImageType").text = slot
+        if location:
+            ET.SubElement(product_image, "ImageLocation").text = location
+
+    return '<?xml version="1.0" encoding="utf-8"?>\n' + ET.tostring(envelope, encoding='unicode')
+
+
+def image_locator_attributes(changed: List[Dict], marketplace_id: str) -> Dict[str, Dict]:
+    """Атрибуты Listings API (main/other_product_image_locator_N) для изменившихся слотов по SKU"""
+    attributes: Dict[str, Dict] = {}
+    for image in changed:
+        if image['slot'] == 'Main':
+            name = 'main_product_image_locator'
+        else:
+            name = f"other_product_image_locator_{image['slot'][2:]}"
+        attributes.setdefault(image['sku'], {})[name] = [
+            {'media_location': image['src'], 'marketplace_id': marketplace_id}
+        ]
+    return attributes
+
+
+def main():
+    """Проверка изображений каталога и Image feed по изменившимся слотам"""
+    from amazon_feeds import AmazonFeedSubmitter, parse_processing_report, report_errors
+    from get_product_schema import AmazonProductSchemaClient
+    from reconcile_catalog import iter_jsonl
+
+    parser = argparse.ArgumentParser(description='Изображения листингов: проверка и Image feed')
+    parser.add_argument('--shopify-snapshot', required=True, help='JSONL с товарами Shopify (с images)')
+    parser.add_argument('--workers', type=int, default=8, help='Параллельных загрузок')
+    parser.add_argument('--cache-dir', help='Каталог кэша изображений')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    parser.add_argument('--marketplace', default='USA', help='Маркетплейс, в который отправляется Image feed')
+    parser.add_argument('--feed-poll-interval', type=float, default=30, help='Секунд между опросами статуса фида')
+    parser.add_argument('--dry-run', action='store_true', help='Только записать Image feed, без отправки в Amazon')
+    args = parser.parse_args()
+
+    print("🖼️  ИЗОБРАЖЕНИЯ ЛИСТИНГОВ")
+    print("=" * 60)
+
+    marketplace = args.marketplace.upper()
+    marketplace_id = AmazonProductSchemaClient().marketplaces.get(marketplace)
+    if marketplace_id is None:
+        print(f"❌ Неизвестный маркетплейс: {args.marketplace}")
+        return 1
+
+    # Изображения товара относятся к его основному (первому) SKU
+    sku_images = {}
+    for product in iter_jsonl(args.shopify_snapshot):
+        variants = [v for v in product.get('variants', []) if v.get('sku')]
+        if variants:
+            sku_images[variants[0]['sku']] = product.get('images', [])
+
+    store = MappingStore(args.store)
+    pipeline = ImagePipeline(store, ImageCache(args.cache_dir), max_workers=args.workers)
+
+    started = datetime.now()
+    result = pipeline.process(sku_images, marketplace)
+    elapsed = (datetime.now() - started).total_seconds()
+
+    rejected = [image for image in result['images'] if image['issues']]
+    print(f"\n📊 ИТОГО ({elapsed:.1f} сек):")
+    print(f"   📥 Проверено заново: {result['downloaded']}, из кэша: {len(result['images']) - result['downloaded']}")
+    print(f"   🔄 К отправке: {len(result['changed'])}, к удалению: {len(result['removed'])}")
+    print(f"   ⚠️  Не прошли проверку: {len(rejected)}")
+    print(f"   ❌ Ошибки загрузки: {len(result['failed'])}")
+    for image in rejected[:20]:
+        print(f"      • {image['sku']} {image['slot']}: {'; '.join(image['issues'])}")
+
+    if result['changed'] or result['removed']:
+        feed_xml = build_image_feed(result['changed'], result['removed'])
+        xml_dir = os.path.join(os.path.dirname(__file__), "amazon_xml_feeds")
+        os.makedirs(xml_dir, exist_ok=True)
+        feed_file = os.path.join(xml_dir, f"image_feed_{started.strftime('%Y%m%d_%H%M%S')}.xml")
+        with open(feed_file, 'w', encoding='utf-8') as f:
+            f.write(feed_xml)
+        print(f"\n📄 Image feed: {feed_file}")
+
+        if not args.dry_run:
+            # Хэши отмечаются только по отчету Amazon: файл на диске еще не отправка
+            feeds = AmazonFeedSubmitter(poll_interval=args.feed_poll_interval)
+            print(f"📤 Отправка Image feed в {marketplace}...")
+            report = feeds.submit('POST_PRODUCT_IMAGE_DATA', [marketplace_id], feed_xml.encode('utf-8'))
+            if report is None:
+                print("❌ Фид не обработан - изображения не отмечены, повторите запуск")
+                store.close()
+                return 1
+
+            # Сообщения фида: сначала Update по changed, затем Delete по removed
+            message_skus = [image['sku'] for image in result['changed']] + [sku for sku, _slot in result['removed']]
+            errors = report_errors(parse_processing_report(report), message_skus)
+            pipeline.mark_sent(result, marketplace, errors)
+            print(f"✅ Принято Amazon: {len(set(message_skus) - set(errors))} SKU, с ошибками: {len(errors)}")
+            for sku, error in list(errors.items())[:20]:
+                print(f"      • {sku}: {error}")
+
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Распределение складских остатков Shopify между маркетплейсами Amazon
+
+Вход: остатки по локациям Shopify (inventory_levels) и резервы под
+MFN-заказы Amazon, еще не списанные в Shopify. Для каждого маркетплейса
+считается продаваемое количество:
+
+    пул       = сумма по разрешенным локациям - резервы - общий страховой запас
+    маркетплейс = min(cap, floor(пул * share) - buffer), не меньше нуля
+
+Все считается матрицами numpy по всему каталогу, а в Inventory feed
+попадают только SKU, у которых остаток изменился с прошлой отправки.
+"""
+import argparse
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from mapping_store import MappingStore
+from settings import load_settings
+from structured_log import get_logger
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('allocator')
+
+# Правила по маркетплейсам (названия как в AmazonProductSchemaClient.marketplaces)
+#   share  - доля общего пула (сумма долей > 1 означает пересекающиеся пулы - риск оверселла)
+#   buffer - сколько единиц придержать на этом маркетплейсе
+#   cap    - максимум к отправке (None - без ограничения)
+DEFAULT_ALLOCATION_RULES = {
+    'USA': {'share': 1.0, 'buffer': 2, 'cap': None},
+}
+
+FULFILLMENT_LATENCY_DAYS = 2
+
+# Сколько location_ids передавать в один запрос inventory_levels.json (ограничение Shopify)
+LOCATIONS_LOOKUP_BATCH = 50
+
+
+class InventoryLevels:
+    """Остатки каталога по локациям: матрица (SKU × локации)"""
+
+    def __init__(self, skus: List[str], location_ids: List[str], levels: np.ndarray):
+        self.skus = skus
+        self.location_ids = location_ids
+        self.levels = levels
+        self.index = {sku: i for i, sku in enumerate(skus)}
+
+    @classmethod
+    def from_levels(cls, levels: Iterable[Dict], item_to_sku: Dict[str, str]) -> 'InventoryLevels':
+        """Собирает матрицу из записей Shopify inventory_levels (inventory_item_id, location_id, available)"""
+        sku_rows: Dict[str, int] = {}
+        location_cols: Dict[str, int] = {}
+        rows, cols, values = [], [], []
+
+        for level in levels:
+            sku = item_to_sku.get(str(level.get('inventory_item_id')))
+            if not sku:
+                continue
+            location = str(level.get('location_id'))
+            rows.append(sku_rows.setdefault(sku, len(sku_rows)))
+            cols.append(location_cols.setdefault(location, len(location_cols)))
+            values.append(level.get('available') or 0)
+
+        matrix = np.zeros((len(sku_rows), len(location_cols)), dtype=np.int64)
+        # np.add.at: одна и та же пара (SKU, локация) может встретиться дважды у дублей SKU
+        np.add.at(matrix, (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)),
+                  np.array(values, dtype=np.int64))
+        return cls(list(sku_rows), list(location_cols), matrix)
+
+
+class InventoryAllocator:
+    """Векторно распределяет пул остатков между маркетплейсами"""
+
+    def __init__(self, rules: Dict[str, Dict] = None, safety_buffer: int = 0,
+                 location_ids: Optional[Sequence[str]] = None):
+        self.rules = rules or DEFAULT_ALLOCATION_RULES
+        self.marketplaces = list(self.rules)
+        self.safety_buffer = safety_buffer
+        self.location_ids = [str(location_id) for location_id in location_ids] if location_ids else None
+
+        self.shares = np.array([self.rules[m].get('share', 1.0) for m in self.marketplaces], dtype=np.float64)
+        self.buffers = np.array([self.rules[m].get('buffer', 0) for m in self.marketplaces], dtype=np.int64)
+        caps = [self.rules[m].get('cap') for m in self.marketplaces]
+        self.caps = np.array([np.iinfo(np.int64).max if cap is None else cap for cap in caps], dtype=np.int64)
+
+        if self.shares.sum() > 1.0 + 1e-9:
+            log.warning('allocation.oversell_risk', shares_total=round(float(self.shares.sum()), 2))
+
+    def pool(self, inventory: InventoryLevels, reservations: Dict[str, int]) -> np.ndarray:
+        """Продаваемый пул по SKU: разрешенные локации - резервы - страховой запас"""
+        if self.location_ids is None:
+            mask = np.ones(len(inventory.location_ids), dtype=bool)
+        else:
+            allowed = set(self.location_ids)
+            mask = np.array([location in allowed for location in inventory.location_ids], dtype=bool)
+
+        # Отрицательный остаток локации (перепродажа в Shopify) не должен съедать остаток соседней
+        on_hand = np.maximum(inventory.levels[:, mask], 0).sum(axis=1)
+        reserved = np.fromiter((reservations.get(sku, 0) for sku in inventory.skus),
+                               dtype=np.int64, count=len(inventory.skus))
+        return np.maximum(on_hand - reserved - self.safety_buffer, 0)
+
+    def allocate(self, pool: np.ndarray) -> np.ndarray:
+        """Матрица (маркетплейсы × SKU) с количеством к отправке"""
+        shared = np.floor(pool[np.newaxis, :] * self.shares[:, np.newaxis]).astype(np.int64)
+        allocated = shared - self.buffers[:, np.newaxis]
+        return np.clip(allocated, 0, self.caps[:, np.newaxis])
+
+    @staticmethod
+    def changed(skus: List[str], allocated: np.ndarray, previous: Dict[str, int]) -> List[Tuple[str, int]]:
+        """Пары (SKU, количество), отличающиеся от последней отправки"""
+        sent = np.fromiter((previous.get(sku, -1) for sku in skus), dtype=np.int64, count=len(skus))
+        rows = np.flatnonzero(allocated != sent)
+        return [(skus[i], int(allocated[i])) for i in rows.tolist()]
+
+
+def build_inventory_feed(changes: Sequence[Tuple[str, int]], merchant_id: str = "MERCHANT_ID") -> str:
+    """Inventory feed с одним сообщением на SKU"""
+    envelope = ET.Element("AmazonEnvelope")
+    envelope.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
+    envelope.set("xsi:noNamespaceSchemaLocation", "amzn-envelope.xsd")
+
+    header = ET.SubElement(envelope, "Header")
+    ET.SubElement(header, "DocumentVersion").text = "1.01"
+    ET.SubElement(header, "MerchantIdentifier").text = merchant_id
+
+    ET.SubElement(envelope, "MessageType").text = "Inventory"
+
+    for message_id, (sku, quantity) in enumerate(changes, 1):
+        message = ET.SubElement(envelope, "Message")
+        ET.SubElement(message, "MessageID").text = str(message_id)
+        ET.SubElement(message, "OperationType").text = "Update"
+
+        inventory = ET.SubElement(message, "Inventory")
+        ET.SubElement(inventory, "SKU").text = sku
+        ET.SubElement(inventory, "Quantity").text = str(quantity)
+        ET.SubElement(inventory, "FulfillmentLatency").text = str(FULFILLMENT_LATENCY_DAYS)
+
+    return '<?xml version="1.0" encoding="utf-8"?>\n' + ET.tostring(envelope, encoding='unicode')
+
+
+def _item_to_sku_from_snapshot(path: str) -> Dict[str, str]:
+    from reconcile_catalog import iter_jsonl
+
+    mapping = {}
+    for product in iter_jsonl(path):
+        for variant in product.get('variants', []):
+            if variant.get('sku') and variant.get('inventory_item_id'):
+                mapping[str(variant['inventory_item_id'])] = variant['sku']
+    return mapping
+
+
+def _iter_shopify_levels(location_ids: Optional[Sequence[str]]) -> Iterator[Dict]:
+    """
+    inventory_levels из Shopify по локациям.
+
+    Без location_ids/inventory_item_ids Shopify отвечает 422, поэтому без --locations
+    локации берутся из /locations.json. Обрыв выгрузки - RuntimeError: по неполным
+    остаткам SKU с непрочитанных страниц ушли бы в Amazon с нулем.
+    """
+    from test_integration import ShopifyClient
+
+    client = ShopifyClient()
+    if not location_ids:
+        response = client.make_api_request('/locations.json')
+        if response is None:
+            raise RuntimeError(f"Не удалось получить локации Shopify: {client.last_error}")
+        location_ids = [str(location['id']) for location in response.get('locations', [])]
+
+    for start in range(0, len(location_ids), LOCATIONS_LOOKUP_BATCH):
+        endpoint = (f"/inventory_levels.json?limit=250"
+                    f"&location_ids={','.join(location_ids[start:start + LOCATIONS_LOOKUP_BATCH])}")
+        yield from client.iter_pages(endpoint, 'inventory_levels')
+        if client.last_error:
+            raise RuntimeError(f"Выгрузка остатков Shopify прервана: {client.last_error}")
+
+
+def main():
+    """Распределение остатков и Inventory feed только по изменившимся SKU"""
+    from amazon_feeds import AmazonFeedSubmitter, parse_processing_report, report_errors
+    from get_product_schema import AmazonProductSchemaClient
+    from reconcile_catalog import iter_jsonl
+
+    parser = argparse.ArgumentParser(description='Распределение остатков Shopify между маркетплейсами Amazon')
+    parser.add_argument('--shopify-snapshot', required=True,
+                        help='JSONL с товарами Shopify (нужен inventory_item_id → SKU)')
+    parser.add_argument('--levels', help='JSONL с inventory_levels (по умолчанию - выгрузка из Shopify)')
+    parser.add_argument('--locations', nargs='*', help='Локации Shopify, участвующие в пуле (по умолчанию все)')
+    parser.add_argument('--rules', help='JSON с правилами распределения по маркетплейсам')
+    parser.add_argument('--safety-buffer', type=int, default=0, help='Общий страховой запас на SKU')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    parser.add_argument('--feed-poll-interval', type=float, default=30, help='Секунд между опросами статуса фида')
+    parser.add_argument('--dry-run', action='store_true', help='Только записать Inventory feed, без отправки в Amazon')
+    args = parser.parse_args()
+
+    rules = None
+    if args.rules:
+        with open(args.rules, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+
+    print("📦 РАСПРЕДЕЛЕНИЕ ОСТАТКОВ ПО МАРКЕТПЛЕЙСАМ")
+    print("=" * 60)
+
+    item_to_sku = _item_to_sku_from_snapshot(args.shopify_snapshot)
+    levels = iter_jsonl(args.levels) if args.levels else _iter_shopify_levels(args.locations)
+    try:
+        inventory = InventoryLevels.from_levels(levels, item_to_sku)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        print("💡 Остатки не отправлены - повторите запуск позже")
+        return 1
+    print(f"🏬 SKU: {len(inventory.skus)}, локаций: {len(inventory.location_ids)}")
+
+    store = MappingStore(args.store)
+    allocator = InventoryAllocator(rules, args.safety_buffer, args.locations)
+    allocations = allocator.allocate(allocator.pool(inventory, store.pending_reservations()))
+
+    xml_dir = os.path.join(os.path.dirname(__file__), "amazon_xml_feeds")
+    os.makedirs(xml_dir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    marketplace_ids = AmazonProductSchemaClient().marketplaces
+    feeds = None if args.dry_run else AmazonFeedSubmitter(poll_interval=args.feed_poll_interval)
+    failed = 0
+
+    for i, marketplace in enumerate(allocator.marketplaces):
+        changes = allocator.changed(inventory.skus, allocations[i], store.get_allocations(marketplace))
+        print(f"   • {marketplace}: изменилось {len(changes)} из {len(inventory.skus)}")
+        if not changes:
+            continue
+
+        feed_xml = build_inventory_feed(changes)
+        feed_file = os.path.join(xml_dir, f"inventory_feed_{marketplace}_{timestamp}.xml")
+        with open(feed_file, 'w', encoding='utf-8') as f:
+            f.write(feed_xml)
+        print(f"     📄 {feed_file}")
+
+        if args.dry_run:
+            continue
+
+        # Отправленным остаток считается только по отчету Amazon: иначе следующий запуск
+        # не увидит разницы и количество так и не дойдет до маркетплейса
+        report = feeds.submit('POST_INVENTORY_AVAILABILITY_DATA', [marketplace_ids[marketplace]],
+                              feed_xml.encode('utf-8'))
+        if report is None:
+            print("     ❌ Фид не обработан - остатки будут отправлены при следующем запуске")
+            failed += 1
+            continue
+
+        errors = report_errors(parse_processing_report(report), [sku for sku, _quantity in changes])
+        store.save_allocations(marketplace, [(sku, quantity) for sku, quantity in changes if sku not in errors])
+        print(f"     ✅ Принято Amazon: {len(changes) - len(errors)}, с ошибками: {len(errors)}")
+        for sku, error in list(errors.items())[:20]:
+            print(f"        • {sku}: {error}")
+
+    store.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+Журнал заданий синхронизации (write-ahead, SQLite)
+
+Каждый переход задания и фида записывается до следующего шага:
+
+    задание: queued → built (в пачке batch_id) → done / rejected / dropped / replaced
+    пачка:   built → uploaded (document_id) → created (feed_id) → done / failed / abandoned
+
+Перезапущенный демон (sync_daemon) продолжает с того же места:
+- задания queued снова встают в очередь со своими данными и счетчиком попыток
+- пачки created (фид уже создан в Amazon) не отправляются повторно - демон
+  дожидается их отчета по feed_id
+- пачки built / uploaded (фида в Amazon еще нет) помечаются abandoned, их задания
+  возвращаются в очередь
+
+Завершенные задания из journal_jobs удаляются (итог - в listing_snapshots
+MappingStore), история переходов остается в journal_events на
+JOURNAL_RETENTION_DAYS дней.
+
+Задания, которые не дошли до Amazon, не пропадают - они попадают в dead_letters
+(одна строка на kind/marketplace/SKU) с ошибкой, хэшем данных и числом попыток:
+- rejected - Amazon отклонил сообщение фида
+- dropped - фид не обработан за MAX_ATTEMPTS попыток
+- fetch - товар не удалось получить из Shopify или разобрать
+Успешная отправка того же kind/marketplace/SKU убирает запись; повторить только
+эти SKU - sync replay (sync_daemon.replay_main).
+
+    python src/job_journal.py                    # сводка: задания и пачки по этапам
+    python src/job_journal.py --events 20        # последние переходы
+    python src/job_journal.py --dead-letters 50  # задания, не дошедшие до Amazon
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mapping_store import utc_now
+
+DEFAULT_JOURNAL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    'sync_journal.sqlite3')
+
+JOURNAL_RETENTION_DAYS = 7
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal_runs (
+    run_id TEXT PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    params TEXT NOT NULL DEFAULT '{}',
+    stats TEXT
+);
+
+CREATE TABLE IF NOT EXISTS journal_jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    batch_id TEXT,
+    position INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    payload_hash TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS journal_jobs_batch ON journal_jobs (batch_id);
+
+CREATE TABLE IF NOT EXISTS journal_batches (
+    batch_id TEXT PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    feed_type TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    jobs INTEGER NOT NULL,
+    document_id TEXT,
+    feed_id TEXT,
+    context TEXT,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS dead_letters (
+    kind TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    job_id TEXT,
+    reason TEXT NOT NULL,
+    error TEXT,
+    payload TEXT NOT NULL,
+    payload_hash TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    first_failed_at TEXT NOT NULL,
+    last_failed_at TEXT NOT NULL,
+    PRIMARY KEY (kind, marketplace, sku)
+);
+
+CREATE TABLE IF NOT EXISTS journal_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    entity_id TEXT NOT NULL,
+    sku TEXT,
+    stage TEXT NOT NULL,
+    detail TEXT,
+    recorded_at TEXT NOT NULL
+);
+"""
+
+
+# Задание без очереди (record_dead_letter) - те же атрибуты, что у sync_daemon.SyncJob
+_Job = namedtuple('_Job', 'job_id kind marketplace sku payload attempts', defaults=(0,))
+
+
+def payload_hash(payload: Dict) -> str:
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+                        .encode('utf-8')).hexdigest()
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex
+
+
+class JobJournal:
+    """
+    Журнал поверх SQLite: одно соединение, запись под блокировкой.
+
+    Задания передаются объектами с атрибутами job_id, kind, marketplace, sku,
+    payload, attempts (sync_daemon.SyncJob). Каждый вызов record_* - одна
+    транзакция, поэтому пачка в 10 000 заданий - одна запись на диск.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv('SYNC_JOURNAL_PATH', DEFAULT_JOURNAL_PATH)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: подтвержденная запись переживает и падение ОС, а не только процесса
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self.run_id: Optional[str] = None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _events(self, entity: str, rows: Iterable[tuple]) -> None:
+        """rows: (entity_id, sku, stage, detail); вызывается под блокировкой"""
+        recorded_at = utc_now()
+        self._conn.executemany(
+            "INSERT INTO journal_events (run_id, entity, entity_id, sku, stage, detail, recorded_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(self.run_id or '', entity, entity_id, sku, stage, detail, recorded_at)
+             for entity_id, sku, stage, detail in rows]
+        )
+
+    # --- запуски ---
+
+    def start_run(self, params: Dict = None) -> str:
+        """Новый запуск; заодно чистит историю старше JOURNAL_RETENTION_DAYS"""
+        self.run_id = new_id()
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=JOURNAL_RETENTION_DAYS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self._lock:
+            self._conn.execute("INSERT INTO journal_runs (run_id, started_at, params) VALUES (?, ?, ?)",
+                               (self.run_id, utc_now(), json.dumps(params or {})))
+            self._conn.execute("DELETE FROM journal_events WHERE recorded_at < ?", (cutoff,))
+            self._conn.execute("DELETE FROM journal_batches WHERE updated_at < ? AND stage IN "
+                               "('done', 'failed', 'abandoned')", (cutoff,))
+            self._conn.commit()
+        return self.run_id
+
+    def finish_run(self, stats: Dict) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE journal_runs SET finished_at = ?, stats = ? WHERE run_id = ?",
+                               (utc_now(), json.dumps(stats), self.run_id))
+            self._conn.commit()
+
+    # --- задания ---
+
+    def record_queued(self, jobs: List, replaced: Iterable[str] = ()) -> None:
+        """Задания встали в очередь; replaced - job_id заданий, которые они заменили"""
+        replaced = list(replaced)
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO journal_jobs (job_id, kind, marketplace, sku, stage, attempts, payload, payload_hash, "
+                "updated_at) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET stage = 'queued', batch_id = NULL, attempts = excluded.attempts, "
+                "updated_at = excluded.updated_at",
+                [(job.job_id, job.kind, job.marketplace, job.sku, job.attempts,
+                  json.dumps(job.payload, ensure_ascii=False, default=str), payload_hash(job.payload), updated_at)
+                 for job in jobs]
+            )
+            self._conn.executemany("DELETE FROM journal_jobs WHERE job_id = ?", [(job_id,) for job_id in replaced])
+            self._events('job', [(job.job_id, job.sku, 'queued', f"{job.kind}:{job.marketplace}") for job in jobs])
+            self._events('job', [(job_id, None, 'replaced', None) for job_id in replaced])
+            self._conn.commit()
+
+    def queued_jobs(self) -> List[Dict]:
+        """Задания, ожидающие отправки, в порядке постановки"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM journal_jobs WHERE stage = 'queued' ORDER BY rowid"
+            ).fetchall()
+        return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+    # --- пачки ---
+
+    def record_built(self, batch_id: str, kind: str, marketplace: str, feed_type: str, jobs: List,
+                     context: Dict = None) -> None:
+        """Фид пачки собран - до загрузки в Amazon"""
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO journal_batches (batch_id, run_id, kind, marketplace, feed_type, stage, jobs, context, "
+                "updated_at) VALUES (?, ?, ?, ?, ?, 'built', ?, ?, ?)",
+                (batch_id, self.run_id or '', kind, marketplace, feed_type, len(jobs),
+                 json.dumps(context, default=str) if context else None, updated_at)
+            )
+            self._conn.executemany(
+                # position - номер сообщения в фиде: по нему отчет сопоставляется с заданиями
+                "UPDATE journal_jobs SET stage = 'built', batch_id = ?, position = ?, updated_at = ? WHERE job_id = ?",
+                [(batch_id, position, updated_at, job.job_id) for position, job in enumerate(jobs, 1)]
+            )
+            self._events('batch', [(batch_id, None, 'built', f"{kind}:{marketplace} jobs={len(jobs)}")])
+            self._events('job', [(job.job_id, job.sku, 'built', batch_id) for job in jobs])
+            self._conn.commit()
+
+    def record_progress(self, batch_id: str, stage: str, value: str) -> None:
+        """uploaded (value - feedDocumentId) или created (value - feedId)"""
+        column = {'uploaded': 'document_id', 'created': 'feed_id'}[stage]
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE journal_batches SET stage = ?, {column} = ?, updated_at = ? WHERE batch_id = ?",
+                (stage, value, utc_now(), batch_id)
+            )
+            self._events('batch', [(batch_id, None, stage, value)])
+            self._conn.commit()
+
+    def record_finished(self, batch_id: Optional[str], done: List, rejected: List[Tuple] = ()) -> None:
+        """
+        Отчет об обработке разобран: done - подтвержденные задания,
+        rejected - пары (задание, ошибка Amazon по сообщению).
+        """
+        rejected = list(rejected)
+        finished = list(done) + [job for job, _error in rejected]
+        with self._lock:
+            if batch_id:
+                self._conn.execute("UPDATE journal_batches SET stage = 'done', updated_at = ? WHERE batch_id = ?",
+                                   (utc_now(), batch_id))
+                self._events('batch', [(batch_id, None, 'done', f"done={len(done)} rejected={len(rejected)}")])
+            self._conn.executemany("DELETE FROM journal_jobs WHERE job_id = ?", [(job.job_id,) for job in finished])
+            self._resolve([(job.kind, job.marketplace, job.sku) for job in done])
+            self._dead_letter('rejected', rejected)
+            self._events('job', [(job.job_id, job.sku, 'done', batch_id) for job in done])
+            self._events('job', [(job.job_id, job.sku, 'rejected', error) for job, error in rejected])
+            self._conn.commit()
+
+    def record_failed(self, batch_id: str, requeued: List, dropped: List[Tuple] = (), error: str = None) -> None:
+        """Пачка не обработана целиком: requeued вернулись в очередь, dropped - (задание, причина)"""
+        dropped = list(dropped)
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.execute("UPDATE journal_batches SET stage = 'failed', updated_at = ? WHERE batch_id = ?",
+                               (updated_at, batch_id))
+            self._conn.executemany(
+                "UPDATE journal_jobs SET stage = 'queued', batch_id = NULL, attempts = ?, updated_at = ? "
+                "WHERE job_id = ?",
+                [(job.attempts, updated_at, job.job_id) for job in requeued]
+            )
+            self._conn.executemany("DELETE FROM journal_jobs WHERE job_id = ?",
+                                   [(job.job_id,) for job, _reason in dropped])
+            self._dead_letter('dropped', dropped)
+            self._events('batch', [(batch_id, None, 'failed', error)])
+            self._events('job', [(job.job_id, job.sku, 'queued', f"retry {job.attempts}") for job in requeued])
+            self._events('job', [(job.job_id, job.sku, 'dropped', reason) for job, reason in dropped])
+            self._conn.commit()
+
+    def recover(self) -> Dict[str, List[Dict]]:
+        """
+        Состояние после перезапуска: {'queued': задания в очередь, 'created': пачки с feed_id и их задания}.
+
+        Пачки без feed_id помечаются abandoned, их задания возвращаются в queued.
+        """
+        updated_at = utc_now()
+        with self._lock:
+            abandoned = [row['batch_id'] for row in self._conn.execute(
+                "SELECT batch_id FROM journal_batches WHERE stage IN ('built', 'uploaded')"
+            )]
+            self._conn.executemany(
+                "UPDATE journal_batches SET stage = 'abandoned', updated_at = ? WHERE batch_id = ?",
+                [(updated_at, batch_id) for batch_id in abandoned]
+            )
+            self._conn.executemany(
+                "UPDATE journal_jobs SET stage = 'queued', batch_id = NULL, updated_at = ? WHERE batch_id = ?",
+                [(updated_at, batch_id) for batch_id in abandoned]
+            )
+            self._events('batch', [(batch_id, None, 'abandoned', 'restart') for batch_id in abandoned])
+            self._conn.commit()
+
+            batches = [dict(row) for row in self._conn.execute(
+                "SELECT * FROM journal_batches WHERE stage = 'created' ORDER BY updated_at"
+            )]
+            for batch in batches:
+                batch['context'] = json.loads(batch['context']) if batch['context'] else {}
+                batch['jobs'] = [dict(row, payload=json.loads(row['payload'])) for row in self._conn.execute(
+                    "SELECT * FROM journal_jobs WHERE batch_id = ? ORDER BY position", (batch['batch_id'],)
+                )]
+
+        return {'queued': self.queued_jobs(), 'created': batches}
+
+    # --- dead letters ---
+
+    def _dead_letter(self, reason: str, failed: List[Tuple]) -> None:
+        """failed: пары (задание, ошибка); вызывается под блокировкой"""
+        failed_at = utc_now()
+        # attempts копится: повторный провал того же SKU (в том числе с новыми данными) - еще одна попытка
+        self._conn.executemany(
+            "INSERT INTO dead_letters (kind, marketplace, sku, job_id, reason, error, payload, payload_hash, attempts, "
+            "first_failed_at, last_failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(kind, marketplace, sku) DO UPDATE SET job_id = excluded.job_id, reason = excluded.reason, "
+            "error = excluded.error, payload = excluded.payload, payload_hash = excluded.payload_hash, "
+            "attempts = MAX(excluded.attempts, dead_letters.attempts + 1), last_failed_at = excluded.last_failed_at",
+            [(job.kind, job.marketplace, job.sku, job.job_id, reason, error,
+              json.dumps(job.payload, ensure_ascii=False, default=str), payload_hash(job.payload), job.attempts + 1,
+              failed_at, failed_at)
+             for job, error in failed]
+        )
+
+    def _resolve(self, keys: List[Tuple[str, str, str]]) -> None:
+        """Убирает dead letters по (kind, marketplace, sku); вызывается под блокировкой"""
+        self._conn.executemany("DELETE FROM dead_letters WHERE kind = ? AND marketplace = ? AND sku = ?", keys)
+
+    def record_dead_letter(self, kind: str, marketplace: str, sku: str, payload: Dict, error: str,
+                           reason: str = 'fetch') -> None:
+        """Отдельное задание, которое не удалось даже поставить в очередь (например, товар не получен из Shopify)"""
+        job = _Job(new_id(), kind, marketplace, sku, payload)
+        with self._lock:
+            self._dead_letter(reason, [(job, error)])
+            self._events('job', [(job.job_id, sku, reason, error)])
+            self._conn.commit()
+
+    def resolve_dead_letters(self, keys: List[Tuple[str, str, str]]) -> None:
+        with self._lock:
+            self._resolve(keys)
+            self._conn.commit()
+
+    def dead_letters(self, kinds: List[str] = None, marketplaces: List[str] = None, skus: List[str] = None,
+                     limit: int = None) -> List[Dict]:
+        """Dead letters, самые старые первыми; фильтры - списки допустимых значений"""
+        query, params = "SELECT * FROM dead_letters WHERE 1 = 1", []
+        for column, values in (('kind', kinds), ('marketplace', marketplaces), ('sku', skus)):
+            if values:
+                query += f" AND {column} IN ({', '.join('?' * len(values))})"
+                params += list(values)
+        query += " ORDER BY first_failed_at, rowid"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+    # --- сводка ---
+
+    def summary(self) -> Dict:
+        with self._lock:
+            jobs = {row['stage']: row['n'] for row in self._conn.execute(
+                "SELECT stage, COUNT(*) AS n FROM journal_jobs GROUP BY stage")}
+            batches = {row['stage']: row['n'] for row in self._conn.execute(
+                "SELECT stage, COUNT(*) AS n FROM journal_batches GROUP BY stage")}
+            dead_letters = {row['kind']: row['n'] for row in self._conn.execute(
+                "SELECT kind, COUNT(*) AS n FROM dead_letters GROUP BY kind")}
+            last_run = self._conn.execute(
+                "SELECT * FROM journal_runs ORDER BY started_at DESC LIMIT 1").fetchone()
+        return {'jobs': jobs, 'batches': batches, 'dead_letters': dead_letters,
+                'last_run': dict(last_run) if last_run else None}
+
+    def recent_events(self, limit: int) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM journal_events ORDER BY seq DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+
+def main():
+    """Сводка журнала заданий"""
+    parser = argparse.ArgumentParser(description='Журнал заданий демона синхронизации')
+    parser.add_argument('--journal', help='Путь к SQLite журналу (SYNC_JOURNAL_PATH)')
+    parser.add_argument('--events', type=int, default=0, help='Показать N последних переходов')
+    parser.add_argument('--dead-letters', type=int, default=0, help='Показать N самых старых dead letters')
+    args = parser.parse_args()
+
+    print("📓 JOB JOURNAL: состояние заданий синхронизации")
+    print("=" * 60)
+
+    journal = JobJournal(args.journal)
+    summary = journal.summary()
+    last_run = summary['last_run']
+    if last_run:
+        state = f"завершен {last_run['finished_at']}" if last_run['finished_at'] else "не завершен"
+        print(f"🕒 Последний запуск {last_run['run_id'][:8]}: начат {last_run['started_at']}, {state}")
+    print(f"📋 Задания в работе: {summary['jobs'] or 'нет'}")
+    print(f"📦 Пачки: {summary['batches'] or 'нет'}")
+    print(f"📮 Dead letters: {summary['dead_letters'] or 'нет'}")
+
+    for event in journal.recent_events(args.events):
+        sku = f" {event['sku']}" if event['sku'] else ''
+        print(f"   {event['recorded_at']} {event['entity']} {event['entity_id'][:8]}{sku}: {event['stage']}"
+              f"{' (' + event['detail'] + ')' if event['detail'] else ''}")
+
+    letters = journal.dead_letters(limit=args.dead_letters) if args.dead_letters else []
+    if letters:
+        print(f"\n📮 DEAD LETTERS ({len(letters)}):")
+        print("-" * 40)
+    for letter in letters:
+        print(f"   ❌ {letter['kind']}/{letter['marketplace']} {letter['sku']}: {letter['reason']}, "
+              f"попыток {letter['attempts']}, {letter['last_failed_at']}")
+        print(f"      {(letter['error'] or '')[:200]}")
+    if letters:
+        print("💡 Повторить только эти SKU: python src/cli.py replay")
+
+    print(f"\n💾 Журнал: {journal.path}")
+    journal.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,664 @@
+# -*- coding: utf-8 -*-
+"""
+Локальное хранилище соответствий Shopify ↔ Amazon (SQLite)
+
+Хранит то, что интеграция узнает об Amazon между запусками:
+остатки FBA по маркетплейсам, заказы Amazon с позициями, соответствие
+SKU → inventory item Shopify, журнал и незавершенные пачки списаний остатков в Shopify,
+последние отправленные в Amazon остатки по маркетплейсам, найденные ASIN
+(и кэш поиска по штрихкодам), хэши изображений листингов, последнее
+отправленное состояние листингов (для демона синхронизации) и служебные
+отметки (watermark) синхронизаций.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_STORE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mapping_store.sqlite3')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS fba_inventory (
+    marketplace_id TEXT NOT NULL,
+    seller_sku TEXT NOT NULL,
+    asin TEXT,
+    fn_sku TEXT,
+    product_name TEXT,
+    condition TEXT,
+    fulfillable_quantity INTEGER,
+    total_quantity INTEGER,
+    last_updated_time TEXT,
+    fetched_at TEXT NOT NULL,
+    PRIMARY KEY (marketplace_id, seller_sku)
+);
+
+CREATE TABLE IF NOT EXISTS amazon_orders (
+    amazon_order_id TEXT PRIMARY KEY,
+    marketplace_id TEXT,
+    order_status TEXT,
+    fulfillment_channel TEXT,
+    purchase_date TEXT,
+    last_update_date TEXT,
+    order_total_amount TEXT,
+    order_total_currency TEXT,
+    fetched_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS amazon_order_items (
+    amazon_order_id TEXT NOT NULL,
+    order_item_id TEXT NOT NULL,
+    seller_sku TEXT,
+    asin TEXT,
+    title TEXT,
+    quantity_ordered INTEGER,
+    quantity_shipped INTEGER,
+    item_price_amount TEXT,
+    item_price_currency TEXT,
+    PRIMARY KEY (amazon_order_id, order_item_id)
+);
+
+CREATE TABLE IF NOT EXISTS shopify_variants (
+    sku TEXT PRIMARY KEY,
+    variant_id TEXT NOT NULL,
+    inventory_item_id TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS shopify_stock_ledger (
+    line_key TEXT PRIMARY KEY,
+    inventory_item_id TEXT NOT NULL,
+    location_id TEXT NOT NULL,
+    delta INTEGER NOT NULL,
+    batch_key TEXT NOT NULL,
+    applied_at TEXT NOT NULL
+);
+
+-- Пачка списания записывается до мутации и удаляется только после того, как
+-- известно, применена ли она в Shopify: повтор идет той же пачкой с тем же ключом
+CREATE TABLE IF NOT EXISTS shopify_stock_batches (
+    batch_key TEXT PRIMARY KEY,
+    changes TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS shopify_stock_batch_lines (
+    line_key TEXT PRIMARY KEY,
+    batch_key TEXT NOT NULL,
+    inventory_item_id TEXT NOT NULL,
+    location_id TEXT NOT NULL,
+    quantity INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS inventory_allocations (
+    marketplace TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (marketplace, sku)
+);
+
+CREATE TABLE IF NOT EXISTS gtin_lookups (
+    gtin TEXT NOT NULL,
+    marketplace_id TEXT NOT NULL,
+    asin TEXT,
+    product_type TEXT,
+    checked_at REAL NOT NULL,
+    PRIMARY KEY (gtin, marketplace_id)
+);
+
+CREATE TABLE IF NOT EXISTS sku_asins (
+    sku TEXT NOT NULL,
+    marketplace_id TEXT NOT NULL,
+    asin TEXT NOT NULL,
+    product_type TEXT,
+    matched_by TEXT NOT NULL,
+    matched_value TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (sku, marketplace_id)
+);
+
+CREATE TABLE IF NOT EXISTS listing_images (
+    sku TEXT NOT NULL,
+    slot TEXT NOT NULL,
+    src TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    issues TEXT NOT NULL DEFAULT '[]',
+    sent_hash TEXT,  -- устарело: отправленное состояние перенесено в listing_images_sent
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (sku, slot)
+);
+
+-- Что подтвердил Amazon на каждом маркетплейсе: Delete считается от этого списка,
+-- поэтому слот, удаленный на одном маркетплейсе, остается к удалению на остальных
+CREATE TABLE IF NOT EXISTS listing_images_sent (
+    marketplace TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    slot TEXT NOT NULL,
+    sent_hash TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (marketplace, sku, slot)
+);
+
+CREATE TABLE IF NOT EXISTS listing_snapshots (
+    marketplace TEXT NOT NULL,
+    sku TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (marketplace, sku)
+);
+"""
+
+
+def utc_now() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class MappingStore:
+    """
+    Тонкая обертка над SQLite.
+
+    Одно соединение на процесс, запись под блокировкой - так в хранилище
+    можно писать из нескольких потоков (например, из краулера по маркетплейсам).
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv('MAPPING_STORE_PATH', DEFAULT_STORE_PATH)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate_sent_images()
+        self._conn.commit()
+
+    def _migrate_sent_images(self) -> None:
+        """
+        Общий sent_hash из listing_images → listing_images_sent для каждого маркетплейса,
+        где у SKU есть снимок листинга (раньше изображения отправлялись всем сразу)
+        """
+        self._conn.execute(
+            "INSERT OR IGNORE INTO listing_images_sent (marketplace, sku, slot, sent_hash, updated_at) "
+            "SELECT s.marketplace, i.sku, i.slot, i.sent_hash, i.updated_at FROM listing_images i "
+            "JOIN listing_snapshots s ON s.sku = i.sku WHERE i.sent_hash IS NOT NULL"
+        )
+        self._conn.execute("UPDATE listing_images SET sent_hash = NULL WHERE sent_hash IS NOT NULL")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # --- служебные отметки ---
+
+    def get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+
+    def set_state(self, key: str, value: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sync_state (key, value, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                (key, value, utc_now())
+            )
+            self._conn.commit()
+
+    # --- FBA остатки ---
+
+    def upsert_fba_summaries(self, marketplace_id: str, summaries: Iterable[Dict]) -> int:
+        """Записывает страницу FBA inventory summaries, возвращает число строк"""
+        fetched_at = utc_now()
+        rows = []
+        for summary in summaries:
+            sku = summary.get('sellerSku')
+            if not sku:
+                continue
+            details = summary.get('inventoryDetails') or {}
+            rows.append((
+                marketplace_id,
+                sku,
+                summary.get('asin'),
+                summary.get('fnSku'),
+                summary.get('productName'),
+                summary.get('condition'),
+                details.get('fulfillableQuantity'),
+                summary.get('totalQuantity'),
+                summary.get('lastUpdatedTime'),
+                fetched_at
+            ))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO fba_inventory (marketplace_id, seller_sku, asin, fn_sku, product_name, condition, "
+                "fulfillable_quantity, total_quantity, last_updated_time, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(marketplace_id, seller_sku) DO UPDATE SET "
+                "asin = excluded.asin, fn_sku = excluded.fn_sku, product_name = excluded.product_name, "
+                "condition = excluded.condition, fulfillable_quantity = excluded.fulfillable_quantity, "
+                "total_quantity = excluded.total_quantity, last_updated_time = excluded.last_updated_time, "
+                "fetched_at = excluded.fetched_at",
+                rows
+            )
+            self._conn.commit()
+        return len(rows)
+
+    def iter_fba_inventory(self, marketplace_id: str):
+        """Отдает сохраненные остатки FBA маркетплейса в формате inventorySummaries"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM fba_inventory WHERE marketplace_id = ? ORDER BY seller_sku",
+                (marketplace_id,)
+            ).fetchall()
+        for row in rows:
+            yield {
+                'sellerSku': row['seller_sku'],
+                'asin': row['asin'],
+                'fnSku': row['fn_sku'],
+                'productName': row['product_name'],
+                'condition': row['condition'],
+                'totalQuantity': row['total_quantity'],
+                'lastUpdatedTime': row['last_updated_time'],
+                'inventoryDetails': {'fulfillableQuantity': row['fulfillable_quantity']}
+            }
+
+    # --- заказы Amazon ---
+
+    def upsert_order(self, order: Dict, items: Iterable[Dict]) -> bool:
+        """
+        Идемпотентно записывает заказ с позициями.
+
+        Более старая версия заказа (по LastUpdateDate) не перетирает
+        уже сохраненную; возвращает True, если запись изменилась.
+        """
+        order_id = order['AmazonOrderId']
+        last_update = order.get('LastUpdateDate') or ''
+        total = order.get('OrderTotal') or {}
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_update_date FROM amazon_orders WHERE amazon_order_id = ?", (order_id,)
+            ).fetchone()
+            if row and (row['last_update_date'] or '') > last_update:
+                return False
+
+            self._conn.execute(
+                "INSERT INTO amazon_orders (amazon_order_id, marketplace_id, order_status, fulfillment_channel, "
+                "purchase_date, last_update_date, order_total_amount, order_total_currency, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(amazon_order_id) DO UPDATE SET "
+                "marketplace_id = excluded.marketplace_id, order_status = excluded.order_status, "
+                "fulfillment_channel = excluded.fulfillment_channel, purchase_date = excluded.purchase_date, "
+                "last_update_date = excluded.last_update_date, order_total_amount = excluded.order_total_amount, "
+                "order_total_currency = excluded.order_total_currency, fetched_at = excluded.fetched_at",
+                (
+                    order_id,
+                    order.get('MarketplaceId'),
+                    order.get('OrderStatus'),
+                    order.get('FulfillmentChannel'),
+                    order.get('PurchaseDate'),
+                    last_update,
+                    total.get('Amount'),
+                    total.get('CurrencyCode'),
+                    utc_now()
+                )
+            )
+            self._conn.executemany(
+                "INSERT INTO amazon_order_items (amazon_order_id, order_item_id, seller_sku, asin, title, "
+                "quantity_ordered, quantity_shipped, item_price_amount, item_price_currency) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(amazon_order_id, order_item_id) DO UPDATE SET "
+                "seller_sku = excluded.seller_sku, asin = excluded.asin, title = excluded.title, "
+                "quantity_ordered = excluded.quantity_ordered, quantity_shipped = excluded.quantity_shipped, "
+                "item_price_amount = excluded.item_price_amount, item_price_currency = excluded.item_price_currency",
+                [
+                    (
+                        order_id,
+                        item.get('OrderItemId'),
+                        item.get('SellerSKU'),
+                        item.get('ASIN'),
+                        item.get('Title'),
+                        item.get('QuantityOrdered'),
+                        item.get('QuantityShipped'),
+                        (item.get('ItemPrice') or {}).get('Amount'),
+                        (item.get('ItemPrice') or {}).get('CurrencyCode')
+                    )
+                    for item in items
+                ]
+            )
+            self._conn.commit()
+        return True
+
+    def iter_pending_stock_lines(self):
+        """
+        Позиции MFN-заказов, которые еще не списаны со склада Shopify.
+
+        FBA-заказы (AFN) отгружаются со склада Amazon и остаток Shopify не трогают,
+        отмененные заказы не списываются.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT i.amazon_order_id, i.order_item_id, i.seller_sku, i.quantity_ordered "
+                "FROM amazon_order_items i JOIN amazon_orders o USING (amazon_order_id) "
+                "WHERE o.fulfillment_channel = 'MFN' AND o.order_status != 'Canceled' "
+                "AND i.quantity_ordered > 0 "
+                "AND NOT EXISTS (SELECT 1 FROM shopify_stock_ledger l "
+                "WHERE l.line_key = i.amazon_order_id || ':' || i.order_item_id) "
+                "AND NOT EXISTS (SELECT 1 FROM shopify_stock_batch_lines b "
+                "WHERE b.line_key = i.amazon_order_id || ':' || i.order_item_id) "
+                "ORDER BY o.purchase_date"
+            ).fetchall()
+        for row in rows:
+            yield {
+                'line_key': f"{row['amazon_order_id']}:{row['order_item_id']}",
+                'seller_sku': row['seller_sku'],
+                'quantity': row['quantity_ordered']
+            }
+
+    def begin_stock_batch(self, batch_key: str, changes: List[Dict], lines: List[Dict]) -> None:
+        """Пачка списания до мутации: изменения (с остатками до нее) и ее позиции - одной транзакцией"""
+        now = utc_now()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO shopify_stock_batches (batch_key, changes, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (batch_key, json.dumps(changes), now, now)
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO shopify_stock_batch_lines "
+                "(line_key, batch_key, inventory_item_id, location_id, quantity) VALUES (?, ?, ?, ?, ?)",
+                [(line['line_key'], batch_key, line['inventory_item_id'], line['location_id'], line['quantity'])
+                 for line in lines]
+            )
+            self._conn.commit()
+
+    def get_stock_batches(self) -> List[Dict]:
+        """Пачки, про которые еще не известно, применены ли они в Shopify"""
+        with self._lock:
+            batches = [dict(row) for row in self._conn.execute(
+                "SELECT * FROM shopify_stock_batches ORDER BY created_at")]
+            for batch in batches:
+                batch['changes'] = json.loads(batch['changes'])
+                batch['lines'] = [dict(row) for row in self._conn.execute(
+                    "SELECT * FROM shopify_stock_batch_lines WHERE batch_key = ?", (batch['batch_key'],))]
+        return batches
+
+    def count_stock_attempt(self, batch_key: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE shopify_stock_batches SET attempts = attempts + 1, updated_at = ? WHERE batch_key = ?",
+                (utc_now(), batch_key)
+            )
+            self._conn.commit()
+
+    def finish_stock_batch(self, batch_key: str, applied: bool) -> None:
+        """
+        Закрывает пачку: applied - позиции переходят в журнал списаний,
+        иначе (Shopify пачку отклонил) позиции снова ждут списания.
+        """
+        with self._lock:
+            if applied:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO shopify_stock_ledger "
+                    "(line_key, inventory_item_id, location_id, delta, batch_key, applied_at) "
+                    "SELECT line_key, inventory_item_id, location_id, -quantity, batch_key, ? "
+                    "FROM shopify_stock_batch_lines WHERE batch_key = ?",
+                    (utc_now(), batch_key)
+                )
+            self._conn.execute("DELETE FROM shopify_stock_batch_lines WHERE batch_key = ?", (batch_key,))
+            self._conn.execute("DELETE FROM shopify_stock_batches WHERE batch_key = ?", (batch_key,))
+            self._conn.commit()
+
+    # --- варианты Shopify ---
+
+    def get_inventory_items(self, skus: Iterable[str]) -> Dict[str, str]:
+        """SKU → inventory_item_id из кэша"""
+        skus = list(skus)
+        result = {}
+        with self._lock:
+            # SQLite ограничивает число параметров в запросе, идем пачками
+            for start in range(0, len(skus), 500):
+                chunk = skus[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in self._conn.execute(
+                    f"SELECT sku, inventory_item_id FROM shopify_variants WHERE sku IN ({placeholders})", chunk
+                ):
+                    result[row['sku']] = row['inventory_item_id']
+        return result
+
+    def upsert_variants(self, variants: Iterable[Dict]) -> None:
+        """Кэширует соответствие SKU → variant / inventory item"""
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO shopify_variants (sku, variant_id, inventory_item_id, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(sku) DO UPDATE SET variant_id = excluded.variant_id, "
+                "inventory_item_id = excluded.inventory_item_id, updated_at = excluded.updated_at",
+                [(v['sku'], v['variant_id'], v['inventory_item_id'], updated_at) for v in variants]
+            )
+            self._conn.commit()
+
+    def pending_reservations(self) -> Dict[str, int]:
+        """SKU → количество в MFN-заказах Amazon, еще не списанное в Shopify"""
+        reserved: Dict[str, int] = {}
+        for line in self.iter_pending_stock_lines():
+            sku = line['seller_sku']
+            reserved[sku] = reserved.get(sku, 0) + line['quantity']
+        return reserved
+
+    # --- отправленные остатки ---
+
+    def get_allocations(self, marketplace: str) -> Dict[str, int]:
+        """SKU → последний отправленный в маркетплейс остаток"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sku, quantity FROM inventory_allocations WHERE marketplace = ?", (marketplace,)
+            ).fetchall()
+        return {row['sku']: row['quantity'] for row in rows}
+
+    def save_allocations(self, marketplace: str, allocations: Iterable) -> None:
+        """Запоминает отправленные остатки: пары (sku, quantity)"""
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO inventory_allocations (marketplace, sku, quantity, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(marketplace, sku) DO UPDATE SET quantity = excluded.quantity, "
+                "updated_at = excluded.updated_at",
+                [(marketplace, sku, quantity, updated_at) for sku, quantity in allocations]
+            )
+            self._conn.commit()
+
+    # --- ASIN ---
+
+    def get_gtin_lookups(self, gtins: List[str], marketplace_id: str,
+                         positive_ttl: float, negative_ttl: float) -> Dict[str, Dict]:
+        """
+        Кэш поиска по GTIN: gtin → {'asin', 'product_type'}.
+
+        Найденные ASIN живут positive_ttl секунд, отрицательные ответы
+        (asin = NULL) - negative_ttl: товар могут создать в каталоге в любой момент.
+        """
+        now = time.time()
+        result = {}
+        with self._lock:
+            for start in range(0, len(gtins), 500):
+                chunk = gtins[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in self._conn.execute(
+                    f"SELECT gtin, asin, product_type, checked_at FROM gtin_lookups "
+                    f"WHERE marketplace_id = ? AND gtin IN ({placeholders})",
+                    [marketplace_id, *chunk]
+                ):
+                    ttl = positive_ttl if row['asin'] else negative_ttl
+                    if now - row['checked_at'] < ttl:
+                        result[row['gtin']] = {'asin': row['asin'], 'product_type': row['product_type']}
+        return result
+
+    def save_gtin_lookups(self, marketplace_id: str, lookups: Dict[str, Dict]) -> None:
+        """Сохраняет результаты поиска по GTIN (в том числе отрицательные)"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO gtin_lookups (gtin, marketplace_id, asin, product_type, checked_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(gtin, marketplace_id) DO UPDATE SET asin = excluded.asin, "
+                "product_type = excluded.product_type, checked_at = excluded.checked_at",
+                [
+                    (gtin, marketplace_id, found.get('asin'), found.get('product_type'), now)
+                    for gtin, found in lookups.items()
+                ]
+            )
+            self._conn.commit()
+
+    def save_sku_asins(self, marketplace_id: str, matches: Iterable[Dict]) -> None:
+        """Запоминает ASIN для SKU: {'sku', 'asin', 'product_type', 'matched_by', 'matched_value'}"""
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO sku_asins (sku, marketplace_id, asin, product_type, matched_by, matched_value, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(sku, marketplace_id) DO UPDATE SET asin = excluded.asin, "
+                "product_type = excluded.product_type, matched_by = excluded.matched_by, "
+                "matched_value = excluded.matched_value, updated_at = excluded.updated_at",
+                [
+                    (m['sku'], marketplace_id, m['asin'], m.get('product_type'), m['matched_by'],
+                     m.get('matched_value'), updated_at)
+                    for m in matches
+                ]
+            )
+            self._conn.commit()
+
+    def get_sku_asin(self, sku: str, marketplace_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT asin, product_type, matched_by FROM sku_asins WHERE sku = ? AND marketplace_id = ?",
+                (sku, marketplace_id)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def matched_skus(self, marketplace_id: str) -> set:
+        """SKU, для которых ASIN на маркетплейсе уже известен"""
+        with self._lock:
+            return {
+                row['sku'] for row in self._conn.execute(
+                    "SELECT sku FROM sku_asins WHERE marketplace_id = ?", (marketplace_id,)
+                )
+            }
+
+    # --- Изображения листингов ---
+
+    def get_listing_images(self, skus: List[str]) -> Dict[tuple, Dict]:
+        """(sku, слот) → последнее проверенное изображение"""
+        result = {}
+        with self._lock:
+            for start in range(0, len(skus), 500):
+                chunk = skus[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in self._conn.execute(
+                    f"SELECT * FROM listing_images WHERE sku IN ({placeholders})", chunk
+                ):
+                    image = dict(row)
+                    image['issues'] = json.loads(image['issues'])
+                    result[(row['sku'], row['slot'])] = image
+        return result
+
+    def save_listing_images(self, images: Iterable[Dict]) -> None:
+        """Сохраняет результат проверки; sent_hash не трогает"""
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO listing_images (sku, slot, src, content_hash, width, height, format, issues, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(sku, slot) DO UPDATE SET src = excluded.src, content_hash = excluded.content_hash, "
+                "width = excluded.width, height = excluded.height, format = excluded.format, "
+                "issues = excluded.issues, updated_at = excluded.updated_at",
+                [
+                    (image['sku'], image['slot'], image['src'], image['content_hash'], image.get('width'),
+                     image.get('height'), image.get('format'), json.dumps(image.get('issues', [])), updated_at)
+                    for image in images
+                ]
+            )
+            self._conn.commit()
+
+    def delete_listing_images(self, keys: Iterable[tuple]) -> None:
+        """Результаты проверки слотов (sku, слот), которых больше нет в Shopify"""
+        with self._lock:
+            self._conn.executemany("DELETE FROM listing_images WHERE sku = ? AND slot = ?", list(keys))
+            self._conn.commit()
+
+    def get_sent_images(self, marketplace: str, skus: List[str]) -> Dict[tuple, str]:
+        """(sku, слот) → хэш, подтвержденный Amazon на маркетплейсе"""
+        result = {}
+        with self._lock:
+            for start in range(0, len(skus), 500):
+                chunk = skus[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in self._conn.execute(
+                    f"SELECT sku, slot, sent_hash FROM listing_images_sent "
+                    f"WHERE marketplace = ? AND sku IN ({placeholders})", [marketplace] + chunk
+                ):
+                    result[(row['sku'], row['slot'])] = row['sent_hash']
+        return result
+
+    def mark_images_sent(self, marketplace: str, sent: Iterable[tuple], removed: Iterable[tuple] = ()) -> None:
+        """
+        Отмечает отправку Image feed на маркетплейс: sent - (sku, слот, хэш),
+        removed - (sku, слот), удаленные из листинга.
+        """
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO listing_images_sent (marketplace, sku, slot, sent_hash, updated_at) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(marketplace, sku, slot) DO UPDATE SET "
+                "sent_hash = excluded.sent_hash, updated_at = excluded.updated_at",
+                [(marketplace, sku, slot, content_hash, updated_at) for sku, slot, content_hash in sent]
+            )
+            self._conn.executemany(
+                "DELETE FROM listing_images_sent WHERE marketplace = ? AND sku = ? AND slot = ?",
+                [(marketplace, sku, slot) for sku, slot in removed]
+            )
+            self._conn.commit()
+
+    # --- Отправленное состояние листингов ---
+
+    def get_listing_snapshots(self, marketplace: str, skus: List[str]) -> Dict[str, Dict]:
+        """SKU → последнее подтвержденное Amazon состояние листинга (цена, остаток, хэши)"""
+        result = {}
+        with self._lock:
+            for start in range(0, len(skus), 500):
+                chunk = skus[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in self._conn.execute(
+                    f"SELECT sku, state FROM listing_snapshots WHERE marketplace = ? AND sku IN ({placeholders})",
+                    [marketplace] + chunk
+                ):
+                    result[row['sku']] = json.loads(row['state'])
+        return result
+
+    def save_listing_snapshots(self, marketplace: str, updates: Dict[str, Dict]) -> None:
+        """Дописывает поля состояния: SKU → {поле: значение}; остальные поля не трогает"""
+        skus = list(updates)
+        current = self.get_listing_snapshots(marketplace, skus)
+        updated_at = utc_now()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO listing_snapshots (marketplace, sku, state, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(marketplace, sku) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                [(marketplace, sku, json.dumps({**current.get(sku, {}), **updates[sku]}), updated_at)
+                 for sku in skus]
+            )
+            self._conn.commit()
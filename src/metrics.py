@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики клиентов API и этапов конвейера в формате Prometheus
+
+Что считается:
+- запросы SP-API, Shopify и загрузки документов: число по операции/методу/статусу,
+  гистограмма задержек, байты запроса и ответа, ответы 429
+- повторы запросов (_request в asin_matcher / title_matcher / orders_ingester)
+- получение LWA-токена: длительность и результат
+- этапы конвейера fetch / map / build / upload / poll (stage_timer)
+- задания демона синхронизации по полосам: отправлено, отклонено, повторено (sync_daemon)
+
+Операция - путь запроса без идентификаторов: /orders/v0/orders/{id}/orderItems,
+/products/{id}.json, поэтому число рядов не растет с числом заказов и товаров.
+
+Экспорт (стандартный text exposition format 0.0.4):
+- METRICS_FILE=<путь> - файл перезаписывается при выходе из процесса
+  (подходит для textfile collector node_exporter и для разовых прогонов)
+- METRICS_PORT=<порт> - HTTP-эндпоинт /metrics в фоновом потоке
+- из кода: render(), write_textfile(path), serve_metrics(port)
+"""
+import atexit
+import bisect
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы гистограмм задержек, секунды: от быстрых ответов stand-in до долгого опроса фидов
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+
+# Сегменты пути, которые остаются как есть: версии API (v0, 2021-06-30)
+_VERSION_SEGMENT = re.compile(r'^(v\d+|\d{4}-\d{2}(-\d{2})?)$')
+# Префикс Shopify Admin API - одинаков для всех запросов и ничего не говорит об операции
+_SHOPIFY_PREFIX = re.compile(r'^/admin/api/[^/]+')
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram:
+    """Гистограмма с кумулятивными корзинами le, _sum и _count"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # метки → [счетчики по корзинам (последняя - +Inf), сумма]
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет блок кода (и при исключении тоже)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return sum(entry[0]) if entry else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса и их вывод в text exposition format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Метрика {metric.name} уже зарегистрирована с другим типом или метками")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write_textfile(self, path: str) -> None:
+        """Атомарная запись: textfile collector никогда не увидит файл наполовину"""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'sync_http_requests_total', 'HTTP-запросы к внешним API по операции, методу и статусу (error - сетевая ошибка)',
+    ('service', 'operation', 'method', 'status'))
+HTTP_DURATION = REGISTRY.histogram(
+    'sync_http_request_duration_seconds', 'Длительность HTTP-запроса, включая чтение тела ответа',
+    ('service', 'operation', 'method'))
+HTTP_REQUEST_BYTES = REGISTRY.counter(
+    'sync_http_request_bytes_total', 'Отправлено байт в телах запросов', ('service', 'operation', 'method'))
+HTTP_RESPONSE_BYTES = REGISTRY.counter(
+    'sync_http_response_bytes_total', 'Получено байт в телах ответов', ('service', 'operation', 'method'))
+HTTP_THROTTLED = REGISTRY.counter(
+    'sync_http_throttled_total', 'Ответы 429 Too Many Requests', ('service', 'operation'))
+HTTP_RETRIES = REGISTRY.counter(
+    'sync_http_retries_total', 'Повторы запроса после ошибки или 429', ('service', 'operation'))
+TOKEN_REFRESH_DURATION = REGISTRY.histogram(
+    'sync_token_refresh_duration_seconds', 'Получение access token LWA по refresh token', ('result',))
+STAGE_DURATION = REGISTRY.histogram(
+    'sync_stage_duration_seconds', 'Длительность этапа конвейера', ('stage', 'result'), STAGE_BUCKETS)
+DAEMON_JOBS = REGISTRY.counter(
+    'sync_daemon_jobs_total', 'Задания демона синхронизации по полосе, типу и итогу', ('lane', 'kind', 'result'))
+
+# Подписчики на начало/конец этапов (profiling.SyncProfiler): пары (started, finished)
+_stage_hooks: List[Tuple] = []
+
+_exporters_lock = threading.Lock()
+_exporters_started = False
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def operation_name(url: str) -> str:
+    """Путь запроса без хоста, query и идентификаторов: /feeds/2021-06-30/feeds/{id}"""
+    path = urlsplit(url).path or '/'
+    path = _SHOPIFY_PREFIX.sub('', path) or '/'
+    segments = []
+    for segment in path.split('/'):
+        stem, dot, extension = segment.partition('.')
+        if extension != 'json':
+            stem, dot, extension = segment, '', ''
+        if stem and not _VERSION_SEGMENT.match(stem) and (any(c.isdigit() for c in stem) or len(stem) > 40):
+            stem = '{id}'
+        segments.append(stem + dot + extension)
+    return '/'.join(segments)
+
+
+def _ensure_exporters() -> None:
+    """METRICS_FILE / METRICS_PORT подключаются при первом замере, а не при импорте"""
+    global _exporters_started
+    if _exporters_started:
+        return
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+        path = os.getenv('METRICS_FILE')
+        if path:
+            atexit.register(REGISTRY.write_textfile, path)
+        port = os.getenv('METRICS_PORT')
+        if port:
+            serve_metrics(int(port), os.getenv('METRICS_HOST', '127.0.0.1'))
+
+
+def observe_http(service: str, method: str, url: str, status, seconds: float,
+                 request_bytes: int = 0, response_bytes: int = 0) -> None:
+    """Один выполненный запрос; status - код ответа или 'error' при сетевой ошибке"""
+    _ensure_exporters()
+    operation = operation_name(url)
+    method = method.upper()
+    HTTP_REQUESTS.inc(service=service, operation=operation, method=method, status=status)
+    HTTP_DURATION.observe(seconds, service=service, operation=operation, method=method)
+    if request_bytes:
+        HTTP_REQUEST_BYTES.inc(request_bytes, service=service, operation=operation, method=method)
+    if response_bytes:
+        HTTP_RESPONSE_BYTES.inc(response_bytes, service=service, operation=operation, method=method)
+    if status == 429:
+        HTTP_THROTTLED.inc(service=service, operation=operation)
+
+
+def observe_response(service: str, response, seconds: float) -> None:
+    """observe_http по объекту requests.Response"""
+    body = response.request.body if response.request is not None else None
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    observe_http(service, response.request.method if response.request is not None else 'GET', response.url,
+                 response.status_code, seconds, len(body or b''), len(response.content or b''))
+
+
+def record_retry(service: str, url: str) -> None:
+    _ensure_exporters()
+    HTTP_RETRIES.inc(service=service, operation=operation_name(url))
+
+
+def record_token_refresh(result: str, seconds: float) -> None:
+    _ensure_exporters()
+    TOKEN_REFRESH_DURATION.observe(seconds, result=result)
+
+
+def record_daemon_jobs(lane: str, kind: str, result: str, count: int = 1) -> None:
+    _ensure_exporters()
+    DAEMON_JOBS.inc(count, lane=lane, kind=kind, result=result)
+
+
+def add_stage_hook(started, finished) -> None:
+    """started(stage) и finished(stage) вызываются на границах каждого stage_timer"""
+    _stage_hooks.append((started, finished))
+
+
+def remove_stage_hook(started, finished) -> None:
+    if (started, finished) in _stage_hooks:
+        _stage_hooks.remove((started, finished))
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """with stage_timer('upload'): ... - длительность этапа с результатом ok/error"""
+    _ensure_exporters()
+    hooks = list(_stage_hooks)
+    for started_hook, _ in hooks:
+        started_hook(stage)
+    started = time.perf_counter()
+    result = 'error'
+    try:
+        yield
+        result = 'ok'
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - started, stage=stage, result=result)
+        for _, finished_hook in reversed(hooks):
+            finished_hook(stage)
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def write_textfile(path: str) -> None:
+    REGISTRY.write_textfile(path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Поднимает /metrics в фоновом потоке (один сервер на процесс)"""
+    global _server
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+    return _server
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Инкрементальная загрузка заказов Amazon в локальное хранилище
+
+- один проход по /orders/v0/orders начиная с watermark LastUpdatedAfter,
+  с переходом по NextToken
+- позиции заказов (/orderItems) запрашиваются параллельно, но в рамках
+  лимита getOrderItems (token bucket на весь пул потоков)
+- заказы записываются постранично, как только готовы позиции страницы
+  (запись идемпотентна); watermark сдвигается только после успешной записи
+  всей выборки - ошибка на поздней странице не теряет уже полученные заказы
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+
+from get_product_schema import AmazonProductSchemaClient
+from mapping_store import MappingStore
+from metrics import record_retry
+from rate_limiter import TokenBucket
+from settings import load_settings
+from sp_api_router import get_router
+from structured_log import get_logger
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('orders')
+
+ORDERS_ENDPOINT = "/orders/v0/orders"
+
+# Лимиты Orders API: getOrders 0.0167 req/s (burst 20), getOrderItems 0.5 req/s (burst 30)
+GET_ORDERS_RATE = (0.0167, 20)
+GET_ORDER_ITEMS_RATE = (0.5, 30)
+
+MAX_ATTEMPTS = 3
+
+
+def watermark_key(marketplace_id: str) -> str:
+    return f"orders:{marketplace_id}:last_updated_after"
+
+
+class OrdersIngester:
+    """Загружает изменившиеся заказы маркетплейса вместе с позициями"""
+
+    def __init__(self, store: MappingStore, marketplace_id: str,
+                 schema_client: AmazonProductSchemaClient = None, max_workers: int = 8):
+        self.store = store
+        self.marketplace_id = marketplace_id
+        self.schema_client = schema_client or AmazonProductSchemaClient()
+        self.client = self.schema_client.base_client
+        self.base_url = self.schema_client.get_region_endpoint(marketplace_id)
+        self.max_workers = max_workers
+        # Лимиты общие для всех клиентов этого региона в процессе
+        router = get_router()
+        self.orders_bucket = router.limiter(self.base_url, 'getOrders', *GET_ORDERS_RATE)
+        self.items_bucket = router.limiter(self.base_url, 'getOrderItems', *GET_ORDER_ITEMS_RATE)
+
+    def _request(self, bucket: TokenBucket, endpoint: str, params: Dict = None) -> Optional[Dict]:
+        """Запрос с лимитом частоты и повторами (make_api_request возвращает None на 429/5xx)"""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            bucket.acquire()
+            response = self.client.make_api_request(endpoint, params=params, base_url=self.base_url)
+            if response is not None:
+                return response
+            log.warning('orders.retry', endpoint=endpoint, attempt=attempt)
+            if attempt < MAX_ATTEMPTS:
+                record_retry('sp_api', endpoint)
+                bucket.drain()
+                time.sleep(2 ** attempt)
+        return None
+
+    def iter_order_pages(self, last_updated_after: str) -> Iterator[List[Dict]]:
+        """Страницы заказов, изменившихся после last_updated_after (переход по NextToken)"""
+        params = {
+            'MarketplaceIds': self.marketplace_id,
+            'LastUpdatedAfter': last_updated_after
+        }
+
+        while True:
+            response = self._request(self.orders_bucket, ORDERS_ENDPOINT, params)
+            if response is None:
+                raise RuntimeError("Не удалось получить страницу заказов")
+
+            payload = response.get('payload', {})
+            yield payload.get('Orders', [])
+
+            next_token = payload.get('NextToken')
+            if not next_token:
+                return
+            # С NextToken остальные фильтры передавать не нужно
+            params = {'MarketplaceIds': self.marketplace_id, 'NextToken': next_token}
+
+    def fetch_order_items(self, order_id: str) -> Optional[List[Dict]]:
+        """Все позиции заказа (ответ тоже может быть постраничным)"""
+        endpoint = f"{ORDERS_ENDPOINT}/{order_id}/orderItems"
+        items = []
+        params = None
+
+        while True:
+            response = self._request(self.items_bucket, endpoint, params)
+            if response is None:
+                return None
+
+            payload = response.get('payload', {})
+            items.extend(payload.get('OrderItems', []))
+
+            next_token = payload.get('NextToken')
+            if not next_token:
+                return items
+            params = {'NextToken': next_token}
+
+    def ingest(self, initial_days: int = 7) -> Dict:
+        """Загружает заказы с последнего watermark и сдвигает его"""
+        since = self.store.get_state(watermark_key(self.marketplace_id))
+        if not since:
+            start = datetime.now(timezone.utc) - timedelta(days=initial_days)
+            since = start.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        log.info('orders.ingest.start', marketplace_id=self.marketplace_id, since=since)
+
+        if not self.client.access_token and not self.client.get_access_token():
+            raise RuntimeError("Не удалось получить access token")
+
+        stats = {'orders': 0, 'written': 0, 'failed': 0, 'error': None}
+        new_watermark = since
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Позиции страницы запрашиваются, пока листается следующая страница;
+            # предыдущая страница записывается, как только готовы ее позиции
+            pages = self.iter_order_pages(since)
+            previous = []
+            while True:
+                try:
+                    orders = next(pages, None)
+                except RuntimeError as e:
+                    stats['error'] = str(e)
+                    log.error('orders.page_failed', marketplace_id=self.marketplace_id, error=str(e))
+                    orders = None
+
+                current = [(order, executor.submit(self.fetch_order_items, order['AmazonOrderId']))
+                           for order in orders or []]
+                stats['orders'] += len(current)
+                new_watermark = self._write_page(previous, stats, new_watermark)
+                previous = current
+                if orders is None:
+                    break
+
+        # Если хоть один заказ не записан или выборка оборвалась, watermark не двигаем -
+        # следующий запуск заберет их повторно (запись идемпотентна)
+        if stats['failed'] == 0 and stats['error'] is None:
+            self.store.set_state(watermark_key(self.marketplace_id), new_watermark)
+            stats['watermark'] = new_watermark
+        else:
+            stats['watermark'] = since
+
+        log.info('orders.ingest.done', marketplace_id=self.marketplace_id, **stats)
+        return stats
+
+    def _write_page(self, page: List, stats: Dict, watermark: str) -> str:
+        """Записывает заказы страницы с готовыми позициями; возвращает новый кандидат в watermark"""
+        for order, future in page:
+            items = future.result()
+            if items is None:
+                stats['failed'] += 1
+                log.error('orders.items_failed', marketplace_id=self.marketplace_id,
+                          order_id=order['AmazonOrderId'])
+                continue
+            if self.store.upsert_order(order, items):
+                stats['written'] += 1
+            watermark = max(watermark, order.get('LastUpdateDate') or watermark)
+        return watermark
+
+
+def main():
+    """Инкрементальная загрузка заказов Amazon"""
+    parser = argparse.ArgumentParser(description='Инкрементальная загрузка заказов Amazon')
+    parser.add_argument('--marketplace', default='USA', help='Название маркетплейса (USA, UK, AUSTRALIA, ...)')
+    parser.add_argument('--initial-days', type=int, default=7,
+                        help='Глубина первой загрузки, если watermark еще нет')
+    parser.add_argument('--workers', type=int, default=8, help='Потоков для загрузки позиций заказов')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    args = parser.parse_args()
+
+    print("📊 AMAZON ORDERS: инкрементальная загрузка")
+    print("=" * 60)
+
+    schema_client = AmazonProductSchemaClient()
+    marketplace_id = schema_client.marketplaces.get(args.marketplace.upper())
+    if not marketplace_id:
+        print(f"❌ Неизвестный маркетплейс: {args.marketplace}")
+        return
+
+    store = MappingStore(args.store)
+    ingester = OrdersIngester(store, marketplace_id, schema_client, max_workers=args.workers)
+
+    started = time.monotonic()
+    stats = ingester.ingest(initial_days=args.initial_days)
+    elapsed = time.monotonic() - started
+
+    print(f"\n📊 ИТОГО ({elapsed:.1f} сек):")
+    print(f"   📋 Заказов получено: {stats['orders']}")
+    print(f"   💾 Записано/обновлено: {stats['written']}")
+    print(f"   ❌ Ошибок позиций: {stats['failed']}")
+    print(f"   📅 Watermark: {stats['watermark']}")
+    if stats['error']:
+        print(f"   ⚠️  Выборка прервана: {stats['error']} - watermark не сдвинут, записанные заказы сохранены")
+
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк конвейера Shopify → Amazon на синтетических каталогах
+
+Каталог из N товаров по образцу Bosch Aerotwin (варианты, изображения, теги,
+HTML-описание) раздается локальным stand_in_server в отдельном процессе,
+после чего по этапам замеряются время, пропускная способность и пиковая
+память (RSS процесса):
+
+- fetch       - постраничная выгрузка товаров из Shopify
+- mapping     - товар Shopify → данные листинга, штрихкоды, цены
+- feed_xml    - Product feed тем же рендером, что у демона (TransformPool →
+                create_amazon_listing_xml), и Inventory feed
+- feed_json   - JSON_LISTINGS_FEED с атрибутами Listings API
+- upload      - документ фида, загрузка, createFeed, ожидание, отчет об обработке
+- report      - отчет листингов Amazon: скачивание и разбор TSV в снимок
+
+Дополнительные этапы (только по --stages):
+
+- feed_template - Product feed по шаблону FeedTemplate (в рабочих путях не используется)
+
+Результаты пишутся в JSON, чтобы прогоны можно было сравнивать между собой.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from profiling import RssSampler
+
+DEFAULT_SIZES = [1000, 10000]
+STAGES = ['fetch', 'mapping', 'feed_xml', 'feed_json', 'upload', 'report']
+# Не входят в прогон по умолчанию; выполняются после основных этапов
+EXTRA_STAGES = ['feed_template']
+
+MARKETPLACE = 'USA'
+MARKETPLACE_ID = 'ATVPDKIKX0DER'
+SHOPIFY_PAGE_LIMIT = 250
+
+
+def measure(func: Callable[[], Dict]) -> Dict:
+    """
+    Запускает этап и возвращает его метрики.
+
+    func возвращает {'items': ..., 'bytes': ..., 'result': ...}; вывод этапа
+    (print'ы клиентов API) подавляется, чтобы не мешать замеру и отчету.
+    """
+    with RssSampler() as rss, contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        outcome = func()
+        seconds = time.perf_counter() - started
+
+    items = outcome.get('items', 0)
+    return {
+        'seconds': seconds,
+        'items': items,
+        'items_per_second': items / seconds if seconds else None,
+        'bytes': outcome.get('bytes'),
+        'peak_rss_mb': rss.peak / 2 ** 20,
+        'rss_growth_mb': (rss.peak - rss.start) / 2 ** 20,
+        'result': outcome.get('result'),
+    }
+
+
+def _serve_stand_in(queue, products: int, seed: int, variants: int, images: int, latency: Optional[str]) -> None:
+    """Тело процесса stand-in сервера"""
+    from stand_in_server import StandInConfig, StandInData, StandInServer
+
+    data = StandInData(products, orders=0, seed=seed, variants=variants, images=images)
+    config = StandInConfig(latency={'default': latency} if latency else None,
+                           throttle=False, processing_seconds=0)
+    server = StandInServer(data, config)
+    queue.put(server.environment())
+    server.httpd.serve_forever()
+
+
+def start_stand_in(products: int, seed: int, variants: int, images: int,
+                   latency: Optional[str] = None):
+    """
+    Stand-in сервер в отдельном процессе: его данные и потоки не попадают
+    в RSS и GIL измеряемого процесса
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_serve_stand_in, args=(queue, products, seed, variants, images, latency), daemon=True
+    )
+    process.start()
+    environment = queue.get(timeout=600)
+    return process, environment
+
+
+def json_listings_feed(contexts: List[Dict], seller_id: str, marketplace_id: str) -> str:
+    """JSON_LISTINGS_FEED: сообщение UPDATE с атрибутами Listings API на каждый товар"""
+    def attribute(value):
+        return [{'value': value, 'marketplace_id': marketplace_id}]
+
+    messages = []
+    for context in contexts:
+        attributes = {
+            'item_name': attribute(context['product_name']),
+            'brand': attribute(context['brand']),
+            'manufacturer': attribute(context['manufacturer']),
+            'product_description': attribute(context['product_description']),
+            'bullet_point': [{'value': bullet, 'marketplace_id': marketplace_id}
+                             for bullet in context['bullet_points']],
+            'part_number': attribute(context['part_number']),
+        }
+        if context['search_terms']:
+            attributes['generic_keyword'] = attribute(context['search_terms'])
+        messages.append({
+            'messageId': context['message_id'],
+            'sku': context['sku'],
+            'operationType': 'UPDATE',
+            'productType': 'WINDSHIELD_WIPER_BLADE',
+            'attributes': attributes,
+        })
+
+    feed = {'header': {'sellerId': seller_id, 'version': '2.0', 'issueLocale': 'en_US'}, 'messages': messages}
+    return json.dumps(feed, ensure_ascii=False)
+
+
+class PipelineBenchmark:
+    """Прогон всех этапов для одного каталога, поднятого в stand-in сервере"""
+
+    def __init__(self, transform_workers: Optional[int] = None):
+        from amazon_feeds import AmazonFeedSubmitter
+        from amazon_reports import AmazonReportFetcher
+        from test_integration import AmazonSandboxClient, ShopifyClient
+        from transform_pool import TransformPool
+
+        self.shopify_client = ShopifyClient()
+        self.amazon_client = AmazonSandboxClient()
+        self.feeds = AmazonFeedSubmitter(self.amazon_client, poll_interval=0.05)
+        self.reports = AmazonReportFetcher(self.amazon_client, poll_interval=0.05)
+        self.transform = TransformPool(transform_workers)
+
+        self.products: List[Dict] = []
+        self.mapped: List[Dict] = []
+        self.contexts: List[Dict] = []
+        self.product_xml = ''
+        self.json_feed = ''
+
+    def fetch(self) -> Dict:
+        self.products = list(self.shopify_client.iter_pages(f'/products.json?limit={SHOPIFY_PAGE_LIMIT}', 'products'))
+        return {'items': len(self.products)}
+
+    def mapping(self) -> Dict:
+        from asin_matcher import normalize_barcode
+        from create_sku_in_amazon import shopify_product_data
+        from price_engine import PriceEngine
+
+        self.mapped = [shopify_product_data(product, MARKETPLACE) for product in self.products]
+        variants = [variant for data in self.mapped for variant in data['variants']]
+        barcodes = [normalize_barcode(variant['barcode']) for variant in variants]
+
+        engine = PriceEngine([MARKETPLACE])
+        base_prices = np.array([float(variant['price'] or 0) for variant in variants])
+        prices = engine.price_pairs(base_prices, np.zeros(len(base_prices), dtype=int))
+        return {'items': len(self.mapped),
+                'result': {'variants': len(variants), 'invalid_barcodes': barcodes.count(None),
+                           'priced': int(np.count_nonzero(~np.isnan(prices)))}}
+
+    def feed_xml(self) -> Dict:
+        from inventory_allocator import build_inventory_feed
+
+        self.product_xml = self.transform.render_listing_feed(self.mapped)
+        inventory_xml = build_inventory_feed([
+            (variant['sku'], variant['inventory_quantity'])
+            for data in self.mapped for variant in data['variants']
+        ])
+        return {'items': len(self.mapped),
+                'bytes': len(self.product_xml.encode('utf-8')) + len(inventory_xml.encode('utf-8')),
+                'result': {'workers': self.transform.workers}}
+
+    def feed_json(self) -> Dict:
+        from feed_template import product_context
+
+        self.contexts = [product_context(product, i, MARKETPLACE) for i, product in enumerate(self.products, 1)]
+        self.json_feed = json_listings_feed(self.contexts, 'MERCHANT_ID', MARKETPLACE_ID)
+        return {'items': len(self.contexts), 'bytes': len(self.json_feed.encode('utf-8'))}
+
+    def feed_template(self) -> Dict:
+        from feed_template import FeedTemplate, product_context
+        from get_usa_product_schema import create_sample_xml_feed
+
+        template = FeedTemplate(create_sample_xml_feed(), 'product_feed')
+        contexts = [product_context(product, i, MARKETPLACE) for i, product in enumerate(self.products, 1)]
+        xml = template.render({'messages': contexts})
+        return {'items': len(contexts), 'bytes': len(xml.encode('utf-8'))}
+
+    def warm_up_transform(self) -> None:
+        """Демон держит пул процессов весь срок жизни: запуск процессов не входит в замер"""
+        from transform_pool import MIN_PARALLEL_RECORDS
+
+        if self.transform.parallel(len(self.mapped)):
+            self.transform.render_listing_feed(self.mapped[:MIN_PARALLEL_RECORDS])
+
+    def upload(self) -> Dict:
+        from amazon_feeds import JSON_CONTENT_TYPE, parse_processing_report
+
+        content = self.product_xml.encode('utf-8')
+        report = self.feeds.submit('POST_PRODUCT_DATA', [MARKETPLACE_ID], content)
+        json_content = self.json_feed.encode('utf-8')
+        json_report = self.feeds.submit('JSON_LISTINGS_FEED', [MARKETPLACE_ID], json_content, JSON_CONTENT_TYPE)
+        if report is None or json_report is None:
+            raise RuntimeError('Фид не принят stand-in сервером')
+        summary = parse_processing_report(report)['summary']
+        return {'items': len(self.mapped), 'bytes': len(content) + len(json_content),
+                'result': {'messages_processed': summary.get('MessagesProcessed')}}
+
+    def report(self) -> Dict:
+        from amazon_reports import iter_flat_report_rows
+        from reconcile_catalog import load_amazon_snapshot
+
+        text = self.reports.fetch_report('GET_MERCHANT_LISTINGS_ALL_DATA', [MARKETPLACE_ID])
+        if text is None:
+            raise RuntimeError('Отчет листингов не получен от stand-in сервера')
+        snapshot = load_amazon_snapshot(iter_flat_report_rows(io.StringIO(text)))
+        return {'items': len(snapshot), 'bytes': len(text.encode('utf-8'))}
+
+    def run(self, stages: List[str]) -> Dict[str, Dict]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            authorized = self.amazon_client.get_access_token()
+        if not authorized:
+            raise RuntimeError('Stand-in сервер не выдал access token')
+
+        results = {}
+        try:
+            for stage in stages:
+                if stage == 'feed_xml':
+                    self.warm_up_transform()
+                results[stage] = measure(getattr(self, stage))
+        finally:
+            self.transform.close()
+        return results
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(samples: List[Dict]) -> Dict:
+    """Медиана по повторам этапа; все замеры времени сохраняются в samples"""
+    seconds = [sample['seconds'] for sample in samples]
+    median = statistics.median(seconds)
+    items = samples[0]['items']
+    return {
+        'seconds': median,
+        'samples': seconds,
+        'items': items,
+        'items_per_second': items / median if median else None,
+        'bytes': samples[0]['bytes'],
+        'peak_rss_mb': max(sample['peak_rss_mb'] for sample in samples),
+        'rss_growth_mb': max(sample['rss_growth_mb'] for sample in samples),
+        'result': samples[-1]['result'],
+    }
+
+
+def run_size(products: int, stages: List[str], repeat: int, seed: int, variants: int, images: int,
+             latency: Optional[str], transform_workers: Optional[int] = None) -> Dict:
+    """Все этапы для каталога одного размера, repeat раз"""
+    process, environment = start_stand_in(products, seed, variants, images, latency)
+    os.environ.update(environment)
+    # Локальные учетные данные: stand-in принимает любые
+    for key in ('AMAZON_CLIENT_ID', 'AMAZON_CLIENT_SECRET', 'AMAZON_REFRESH_TOKEN', 'SHOPIFY_ACCESS_TOKEN'):
+        os.environ[key] = 'stand-in'
+
+    try:
+        samples: Dict[str, List[Dict]] = {stage: [] for stage in stages}
+        for _ in range(repeat):
+            benchmark = PipelineBenchmark(transform_workers)
+            # Этапы зависят от результатов предыдущих: fetch и mapping выполняются всегда
+            last = max((STAGES.index(s) for s in stages if s in STAGES), default=STAGES.index('mapping'))
+            needed = [stage for stage in STAGES if stage in stages or STAGES.index(stage) < last]
+            needed += [stage for stage in EXTRA_STAGES if stage in stages]
+            for stage, result in benchmark.run(needed).items():
+                if stage in samples:
+                    samples[stage].append(result)
+            del benchmark
+    finally:
+        process.terminate()
+        process.join()
+
+    return {
+        'products': products,
+        'variants_per_product': variants,
+        'images_per_product': images,
+        'stages': {stage: summarize(stage_samples) for stage, stage_samples in samples.items()},
+    }
+
+
+def print_run(run: Dict) -> None:
+    print(f"\n📦 Товаров: {run['products']} (вариантов на товар: {run['variants_per_product']})")
+    print(f"   {'этап':<13} {'время, с':>9} {'шт/сек':>11} {'МБ':>8} {'пик RSS':>9} {'прирост':>8}")
+    for stage, metrics in run['stages'].items():
+        rate = f"{metrics['items_per_second']:.0f}" if metrics['items_per_second'] else '-'
+        size = f"{metrics['bytes'] / 2 ** 20:.1f}" if metrics['bytes'] else '-'
+        print(f"   {stage:<13} {metrics['seconds']:>9.3f} {rate:>11} {size:>8} "
+              f"{metrics['peak_rss_mb']:>9.1f} {metrics['rss_growth_mb']:>8.1f}")
+
+
+def main():
+    """Запуск бенчмарка конвейера"""
+    parser = argparse.ArgumentParser(description='Бенчмарк конвейера Shopify → Amazon на синтетических каталогах')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Размеры каталога через запятую (например 1000,10000,100000)')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help=f"Этапы через запятую: {', '.join(STAGES)}; дополнительно: {', '.join(EXTRA_STAGES)}")
+    parser.add_argument('--repeat', type=int, default=1, help='Повторов каждого этапа (в отчете - медиана)')
+    parser.add_argument('--variants', type=int, default=3, help='Вариантов на товар')
+    parser.add_argument('--images', type=int, default=4, help='Изображений на товар')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--transform-workers', type=int,
+                        help='Процессов рендера Product feed (по умолчанию TRANSFORM_WORKERS или ядра - 1)')
+    parser.add_argument('--latency', help='Задержка stand-in сервера, например lognormal:40,0.5 (по умолчанию нет)')
+    parser.add_argument('--output', help='Файл результатов (по умолчанию pipeline_benchmark_<время>.json)')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = set(stages) - set(STAGES) - set(EXTRA_STAGES)
+    if unknown:
+        parser.error(f"Неизвестные этапы: {', '.join(sorted(unknown))}")
+
+    print("⏱️  БЕНЧМАРК КОНВЕЙЕРА SHOPIFY → AMAZON")
+    print("=" * 60)
+    print(f"📐 Размеры: {sizes}, этапы: {', '.join(stages)}, повторов: {args.repeat}")
+
+    runs = []
+    for size in sizes:
+        run = run_size(size, stages, args.repeat, args.seed, args.variants, args.images, args.latency,
+                       args.transform_workers)
+        print_run(run)
+        runs.append(run)
+
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {'stages': stages, 'repeat': args.repeat, 'variants': args.variants,
+                   'images': args.images, 'seed': args.seed, 'latency': args.latency,
+                   'transform_workers': args.transform_workers},
+        'runs': runs,
+    }
+
+    output = args.output or f"pipeline_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Векторный расчет цен для маркетплейсов Amazon
+
+Цена Shopify (в валюте магазина) → цена маркетплейса за один проход по
+numpy-массивам: конвертация по кэшированной таблице курсов, наценка
+маркетплейса, VAT/GST (для площадок, где цена показывается с налогом),
+"красивые" окончания (.95 / .99), границы min/max.
+
+Курсы берутся из FX_RATES_URL и кэшируются в файл с отметкой времени;
+если все нужные валюты совпадают с валютой магазина, сеть не трогаем.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from settings import load_settings
+from structured_log import get_logger
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('pricing')
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FX_CACHE_PATH = os.path.join(PROJECT_ROOT, 'fx_rates_cache.json')
+DEFAULT_FX_RATES_URL = 'https://open.er-api.com/v6/latest/{base}'
+DEFAULT_FX_TTL_HOURS = 12
+# Как часто долгоживущий PriceEngine проверяет возраст курсов (неудачный запрос не повторяется чаще)
+FX_RECHECK_SECONDS = 300
+
+# Правила ценообразования по маркетплейсам (названия как в AmazonProductSchemaClient.marketplaces).
+# США - домашний рынок магазина: цена уходит как есть.
+#   markup        - наценка к сконвертированной цене (0.15 = +15%)
+#   tax_rate      - VAT/GST, включаемый в цену на площадках с tax_inclusive
+#   ending        - окончание цены (0.95 → 24.95), None - обычное округление
+#   decimals      - знаков после запятой у валюты
+#   min_price / max_price - границы в валюте маркетплейса (None - без границы)
+DEFAULT_MARKETPLACE_PRICING = {
+    'USA':       {'currency': 'USD', 'markup': 0.00, 'tax_rate': 0.00, 'tax_inclusive': False, 'ending': None, 'decimals': 2, 'min_price': None, 'max_price': None},
+    'CANADA':    {'currency': 'CAD', 'markup': 0.15, 'tax_rate': 0.00, 'tax_inclusive': False, 'ending': 0.99, 'decimals': 2, 'min_price': 5.0, 'max_price': None},
+    'MEXICO':    {'currency': 'MXN', 'markup': 0.20, 'tax_rate': 0.16, 'tax_inclusive': True,  'ending': None, 'decimals': 2, 'min_price': 100.0, 'max_price': None},
+    'AUSTRALIA': {'currency': 'AUD', 'markup': 0.20, 'tax_rate': 0.10, 'tax_inclusive': True,  'ending': 0.95, 'decimals': 2, 'min_price': 9.95, 'max_price': None},
+    'UK':        {'currency': 'GBP', 'markup': 0.20, 'tax_rate': 0.20, 'tax_inclusive': True,  'ending': 0.99, 'decimals': 2, 'min_price': 4.99, 'max_price': None},
+    'GERMANY':   {'currency': 'EUR', 'markup': 0.20, 'tax_rate': 0.19, 'tax_inclusive': True,  'ending': 0.95, 'decimals': 2, 'min_price': 4.95, 'max_price': None},
+    'FRANCE':    {'currency': 'EUR', 'markup': 0.20, 'tax_rate': 0.20, 'tax_inclusive': True,  'ending': 0.95, 'decimals': 2, 'min_price': 4.95, 'max_price': None},
+    'ITALY':     {'currency': 'EUR', 'markup': 0.20, 'tax_rate': 0.22, 'tax_inclusive': True,  'ending': 0.95, 'decimals': 2, 'min_price': 4.95, 'max_price': None},
+    'SPAIN':     {'currency': 'EUR', 'markup': 0.20, 'tax_rate': 0.21, 'tax_inclusive': True,  'ending': 0.95, 'decimals': 2, 'min_price': 4.95, 'max_price': None},
+    'JAPAN':     {'currency': 'JPY', 'markup': 0.20, 'tax_rate': 0.10, 'tax_inclusive': True,  'ending': None, 'decimals': 0, 'min_price': 500.0, 'max_price': None},
+}
+
+
+class FxRateTable:
+    """Таблица курсов относительно валюты магазина с файловым кэшем и TTL"""
+
+    def __init__(self, base_currency: str = None, cache_path: str = None,
+                 ttl_hours: float = None, rates_url: str = None):
+        self.base_currency = (base_currency or os.getenv('SHOPIFY_CURRENCY', 'USD')).upper()
+        self.cache_path = cache_path or os.getenv('FX_CACHE_PATH', DEFAULT_FX_CACHE_PATH)
+        self.ttl_seconds = 3600 * (ttl_hours if ttl_hours is not None
+                                   else float(os.getenv('FX_TTL_HOURS', DEFAULT_FX_TTL_HOURS)))
+        self.rates_url = rates_url or os.getenv('FX_RATES_URL', DEFAULT_FX_RATES_URL)
+        self.rates: Optional[Dict[str, float]] = None
+        self.fetched_at: Optional[float] = None
+
+    def _load_cache(self) -> bool:
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if cached.get('base') != self.base_currency:
+            return False
+        self.rates = {code: float(rate) for code, rate in cached['rates'].items()}
+        self.fetched_at = float(cached['fetched_at_unix'])
+        return True
+
+    def _fetch(self) -> bool:
+        # requests нужен только при промахе кэша: короткие cron-запуски его не импортируют
+        import requests
+
+        url = self.rates_url.format(base=self.base_currency)
+        try:
+            response = requests.get(url, timeout=15)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.warning('fx.fetch_failed', url=url, error=str(e))
+            return False
+
+        rates = data.get('rates')
+        if not rates:
+            log.warning('fx.no_rates', url=url)
+            return False
+
+        self.rates = {code.upper(): float(rate) for code, rate in rates.items()}
+        self.rates[self.base_currency] = 1.0
+        self.fetched_at = time.time()
+
+        # Атомарная запись: параллельный процесс не прочитает кэш наполовину
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'base': self.base_currency,
+                'fetched_at': datetime.fromtimestamp(self.fetched_at, timezone.utc).isoformat(),
+                'fetched_at_unix': self.fetched_at,
+                'source': url,
+                'rates': self.rates
+            }, f, indent=2)
+        os.replace(tmp_path, self.cache_path)
+        return True
+
+    def ensure_fresh(self) -> None:
+        """Обновляет курсы, если кэша нет или он старше TTL (устаревший кэш лучше, чем ничего)"""
+        if self.rates is None:
+            self._load_cache()
+
+        if self.fetched_at is not None and time.time() - self.fetched_at < self.ttl_seconds:
+            return
+
+        if not self._fetch() and self.rates is None:
+            raise RuntimeError(f"Нет курсов валют для {self.base_currency}: ни кэша, ни ответа {self.rates_url}")
+        if self.rates is not None and time.time() - self.fetched_at >= self.ttl_seconds:
+            age_hours = (time.time() - self.fetched_at) / 3600
+            log.warning('fx.stale_rates', base=self.base_currency, age_hours=round(age_hours, 1))
+
+    def rate(self, currency: str) -> float:
+        """Сколько единиц currency за единицу валюты магазина"""
+        currency = currency.upper()
+        if currency == self.base_currency:
+            return 1.0
+        self.ensure_fresh()
+        if currency not in self.rates:
+            raise KeyError(f"Нет курса {self.base_currency} → {currency}")
+        return self.rates[currency]
+
+
+class PriceEngine:
+    """
+    Переводит цены Shopify в цены маркетплейсов.
+
+    Правила маркетплейсов заранее раскладываются в массивы по индексу
+    маркетплейса, поэтому расчет любой пачки пар (SKU, маркетплейс) -
+    несколько векторных операций без Python-цикла по товарам.
+    Долгоживущий движок (демон) пересобирает множители, когда курсы
+    старше FX_TTL_HOURS и таблица подтянула свежие.
+    """
+
+    def __init__(self, marketplaces: Sequence[str] = None, rules: Dict[str, Dict] = None,
+                 fx: FxRateTable = None):
+        self.rules = rules or DEFAULT_MARKETPLACE_PRICING
+        self.marketplaces: List[str] = list(marketplaces or self.rules)
+        self.fx = fx or FxRateTable()
+        self.index = {name: i for i, name in enumerate(self.marketplaces)}
+
+        rules_list = [self.rules[name] for name in self.marketplaces]
+        self.currencies = [rule['currency'] for rule in rules_list]
+        self.needs_fx = any(currency.upper() != self.fx.base_currency for currency in self.currencies)
+
+        # Множитель цены до округления: курс * (1 + наценка) * (1 + налог, если цена с налогом)
+        tax = np.array([rule['tax_rate'] if rule['tax_inclusive'] else 0.0 for rule in rules_list])
+        markup = np.array([rule['markup'] for rule in rules_list])
+        self.rule_factors = (1.0 + markup) * (1.0 + tax)
+        self._apply_rates()
+
+        self.endings = np.array([np.nan if rule['ending'] is None else rule['ending'] for rule in rules_list])
+        self.decimals_list = [rule['decimals'] for rule in rules_list]
+        self.scales = np.array([10.0 ** decimals for decimals in self.decimals_list])
+        self.min_prices = np.array([-np.inf if rule['min_price'] is None else rule['min_price'] for rule in rules_list])
+        self.max_prices = np.array([np.inf if rule['max_price'] is None else rule['max_price'] for rule in rules_list])
+
+    def _apply_rates(self) -> None:
+        self.fx_rates = np.array([self.fx.rate(currency) for currency in self.currencies])
+        self.multipliers = self.fx_rates * self.rule_factors
+        self.rates_fetched_at = self.fx.fetched_at
+        self.rates_checked_at = time.time()
+
+    def refresh_rates(self) -> None:
+        """Пересобирает множители, если курсы устарели и удалось получить новые"""
+        if not self.needs_fx or time.time() - self.rates_checked_at < min(FX_RECHECK_SECONDS, self.fx.ttl_seconds):
+            return
+        self.rates_checked_at = time.time()
+        try:
+            self.fx.ensure_fresh()
+        except RuntimeError as e:
+            log.warning('fx.refresh_failed', error=str(e))
+            return
+        if self.fx.fetched_at != self.rates_fetched_at:
+            self._apply_rates()
+            log.info('fx.rates_refreshed', base=self.fx.base_currency,
+                     fetched_at=lambda: datetime.fromtimestamp(self.fx.fetched_at, timezone.utc).isoformat())
+
+    def price_pairs(self, base_prices: np.ndarray, marketplace_idx: np.ndarray) -> np.ndarray:
+        """
+        Цены для пар (SKU, маркетплейс).
+
+        base_prices[i] - цена Shopify пары i, marketplace_idx[i] - индекс
+        маркетплейса в self.marketplaces. NaN во входе остается NaN.
+        """
+        self.refresh_rates()
+        prices = base_prices * self.multipliers[marketplace_idx]
+
+        # Окончание: поднимаем до ближайшего X.ending сверху (24.10 → 24.95, 24.96 → 25.95)
+        endings = self.endings[marketplace_idx]
+        has_ending = ~np.isnan(endings)
+        charm = np.ceil(prices - endings - 1e-9) + endings
+        prices = np.where(has_ending, charm, prices)
+
+        scales = self.scales[marketplace_idx]
+        prices = np.round(prices * scales) / scales
+
+        # Границы применяются последними: это страховка, а не часть формулы
+        return np.clip(prices, self.min_prices[marketplace_idx], self.max_prices[marketplace_idx])
+
+    def price_matrix(self, base_prices: np.ndarray) -> np.ndarray:
+        """Цены всех SKU на всех маркетплейсах: массив (маркетплейсы × SKU)"""
+        n_markets = len(self.marketplaces)
+        n_skus = len(base_prices)
+        prices = self.price_pairs(
+            np.tile(base_prices, n_markets),
+            np.repeat(np.arange(n_markets), n_skus)
+        )
+        return prices.reshape(n_markets, n_skus)
+
+    def price_one(self, base_price: float, marketplace: str) -> float:
+        """Цена одного SKU (для построения одиночного Price feed)"""
+        return float(self.price_pairs(np.array([base_price]), np.array([self.index[marketplace]]))[0])
+
+    def currency(self, marketplace: str) -> str:
+        return self.currencies[self.index[marketplace]]
+
+    def decimals(self, marketplace: str) -> int:
+        """Знаков после запятой в цене маркетплейса (JPY - 0)"""
+        return self.decimals_list[self.index[marketplace]]
+
+
+def main():
+    """Пересчет цен каталога Shopify для маркетплейсов Amazon"""
+    from reconcile_catalog import iter_jsonl, load_shopify_snapshot
+
+    parser = argparse.ArgumentParser(description='Векторный пересчет цен для маркетплейсов Amazon')
+    parser.add_argument('--shopify-snapshot', required=True, help='JSONL с товарами Shopify')
+    parser.add_argument('--marketplaces', nargs='*', help='Маркетплейсы (по умолчанию все из правил)')
+    parser.add_argument('--rules', help='JSON с правилами ценообразования вместо встроенных')
+    parser.add_argument('--output', help='Файл результата (по умолчанию prices_<timestamp>.json)')
+    args = parser.parse_args()
+
+    rules = None
+    if args.rules:
+        with open(args.rules, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+
+    print("💰 ПЕРЕСЧЕТ ЦЕН ДЛЯ МАРКЕТПЛЕЙСОВ AMAZON")
+    print("=" * 60)
+
+    snapshot = load_shopify_snapshot(iter_jsonl(args.shopify_snapshot))
+    engine = PriceEngine([m.upper() for m in args.marketplaces] if args.marketplaces else None, rules)
+
+    started = time.perf_counter()
+    matrix = engine.price_matrix(snapshot.prices)
+    elapsed = time.perf_counter() - started
+
+    print(f"📦 SKU: {len(snapshot)}, маркетплейсов: {len(engine.marketplaces)}")
+    print(f"⚡ Пересчитано {matrix.size} пар за {elapsed * 1000:.1f} мс")
+
+    output = args.output or f"prices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'base_currency': engine.fx.base_currency,
+            'fx_fetched_at': engine.fx.fetched_at,
+            'marketplaces': {
+                name: {
+                    'currency': engine.currencies[i],
+                    'prices': dict(zip(snapshot.skus, [None if np.isnan(p) else p for p in matrix[i].tolist()]))
+                }
+                for i, name in enumerate(engine.marketplaces)
+            }
+        }, f, indent=2, ensure_ascii=False)
+
+    print(f"💾 Цены сохранены в: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Режим профилирования для команд синхронизации
+
+Включается без правки скриптов:
+
+    python src/create_sku_in_amazon.py --profile              # точки входа с @profile_main
+    python src/get_product_schema.py --profile=/tmp/prof
+    SYNC_PROFILE=/tmp/prof python src/test_integration.py
+    python src/profiling.py src/test_sandbox.py [аргументы]   # любой скрипт
+
+Что пишется в каталог профиля:
+- cpu_total.prof и cpu_<этап>.prof - cProfile (pstats, snakeviz) целиком и по этапам
+  fetch / map / build / upload / poll (границы этапов - metrics.stage_timer);
+  у функций, внутри которых начинается этап, cumtime в cpu_total.prof занижен -
+  полные стеки в stacks.collapsed
+- stacks.collapsed - сэмплы стеков в формате collapsed stacks
+  (flamegraph.pl, inferno, speedscope); корень стека - этап или имя потока
+- summary.json - по этапам: время, CPU, пик RSS, top-N функций и top-N мест
+  аллокаций (tracemalloc включается на время этапа: в снимке только то, что этап
+  выделил и не освободил)
+
+Время этапов меряется без снимка tracemalloc; --no-allocations
+(SYNC_PROFILE_ALLOCATIONS=0) отключает tracemalloc совсем.
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import runpy
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+from typing import Dict, List, Optional
+
+from metrics import add_stage_hook, remove_stage_hook
+
+DEFAULT_TOP = 15
+SAMPLE_INTERVAL = 0.005     # период сэмплирования стеков, секунды
+TRACEMALLOC_FRAMES = 1      # глубина стека аллокаций: 1 - группировка по строке
+
+
+class RssSampler:
+    """Пиковый RSS процесса за время этапа: фоновый поток опрашивает /proc/self/statm"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.page_size = resource.getpagesize()
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def current(self) -> int:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:
+            # Не Linux: только пик за всю жизнь процесса (ru_maxrss - КБ на Linux, байты на macOS)
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self) -> 'RssSampler':
+        self.start = self.peak = self.current()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.end = self.current()
+        self.peak = max(self.peak, self.end)
+
+
+class StackSampler:
+    """Сэмплирует стеки всех потоков процесса и копит их в формате collapsed stacks"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.stage_by_thread: Dict[int, str] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label.replace(';', ':')
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self._frame_label(frame))
+                frame = frame.f_back
+            root = self.stage_by_thread.get(thread_id) or names.get(thread_id, 'thread')
+            labels.append(root)
+            self.stacks[';'.join(reversed(labels))] += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def write(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def top_functions(stats: pstats.Stats, limit: int, key: str = 'cumtime') -> List[Dict]:
+    """Самые дорогие функции по cumtime (с вызываемыми) или tottime (собственное время)"""
+    index = 3 if key == 'cumtime' else 2
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][index], reverse=True)[:limit]
+    return [
+        {
+            'function': f"{func} ({os.path.basename(filename)}:{line})",
+            'calls': calls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6),
+        }
+        for (filename, line, func), (_, calls, tottime, cumtime, _) in rows
+    ]
+
+
+def top_allocations(snapshot: tracemalloc.Snapshot, limit: int) -> List[Dict]:
+    """Строки кода, удерживающие больше всего памяти (без самого профилировщика)"""
+    skip = (tracemalloc.__file__, __file__)
+    stats = [stat for stat in snapshot.statistics('lineno') if stat.traceback[0].filename not in skip]
+    return [
+        {
+            'location': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count,
+        }
+        for stat in stats[:limit]
+    ]
+
+
+class _StageRecord:
+    def __init__(self, stage: str, top: int, profile: cProfile.Profile, allocations: bool):
+        self.stage = stage
+        self.top = top
+        self.profile = profile
+        self.rss = RssSampler()
+        # Вложенный этап пользуется tracemalloc внешнего и не останавливает его
+        self.owns_tracing = allocations and not tracemalloc.is_tracing()
+        if self.owns_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.rss.__enter__()
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+
+    def finish(self) -> Dict:
+        wall = time.perf_counter() - self.started
+        cpu = time.process_time() - self.cpu_started
+        self.rss.__exit__(None, None, None)
+        report = {
+            'stage': self.stage,
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(cpu, 6),
+            'peak_rss_mb': round(self.rss.peak / 2 ** 20, 1),
+            'rss_growth_mb': round((self.rss.peak - self.rss.start) / 2 ** 20, 1),
+        }
+        if self.owns_tracing:
+            report['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            report['allocations'] = top_allocations(tracemalloc.take_snapshot(), self.top)
+            tracemalloc.stop()
+        return report
+
+
+class SyncProfiler:
+    """
+    Профиль всего запуска и его этапов.
+
+    cProfile работает в потоке, который запустил профилирование; на время этапа
+    общий профиль переключается на профиль этапа, а в cpu_total.prof они сливаются.
+    Этапы из других потоков (fan_out) попадают только в сэмплы стеков.
+    """
+
+    def __init__(self, output_dir: str = None, top: int = DEFAULT_TOP, interval: float = SAMPLE_INTERVAL,
+                 allocations: bool = True):
+        self.output_dir = output_dir or f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.top = top
+        self.allocations = allocations
+        self.thread_id = threading.get_ident()
+        self.total = cProfile.Profile()
+        self.sampler = StackSampler(interval)
+        self.rss = RssSampler()
+        self.stage_profiles: Dict[str, cProfile.Profile] = {}
+        self.stage_reports: Dict[str, List[Dict]] = {}
+        self._stack: List[_StageRecord] = []
+
+    def _active_profile(self) -> cProfile.Profile:
+        return self._stack[-1].profile if self._stack else self.total
+
+    def stage_started(self, stage: str) -> None:
+        if threading.get_ident() != self.thread_id:
+            return
+        self._active_profile().disable()
+        profile = self.stage_profiles.setdefault(stage, cProfile.Profile())
+        record = _StageRecord(stage, self.top, profile, self.allocations)
+        self._stack.append(record)
+        self.sampler.stage_by_thread[self.thread_id] = stage
+        record.profile.enable()
+
+    def stage_finished(self, stage: str) -> None:
+        if threading.get_ident() != self.thread_id or not self._stack or self._stack[-1].stage != stage:
+            return
+        record = self._stack.pop()
+        record.profile.disable()
+        self.stage_reports.setdefault(stage, []).append(record.finish())
+        if self._stack:
+            self.sampler.stage_by_thread[self.thread_id] = self._stack[-1].stage
+        else:
+            self.sampler.stage_by_thread.pop(self.thread_id, None)
+        self._active_profile().enable()
+
+    def __enter__(self) -> 'SyncProfiler':
+        os.makedirs(self.output_dir, exist_ok=True)
+        add_stage_hook(self.stage_started, self.stage_finished)
+        self.rss.__enter__()
+        self.sampler.start()
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.total.enable()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._active_profile().disable()
+        while self._stack:
+            self.stage_finished(self._stack[-1].stage)
+            self._active_profile().disable()
+        wall = time.perf_counter() - self.started
+        cpu = time.process_time() - self.cpu_started
+        remove_stage_hook(self.stage_started, self.stage_finished)
+        self.sampler.stop()
+        self.rss.__exit__(None, None, None)
+        self.write(wall, cpu)
+
+    def _stats(self, profile: cProfile.Profile) -> Optional[pstats.Stats]:
+        try:
+            return pstats.Stats(profile, stream=io.StringIO())
+        except TypeError:
+            # Профиль без единого вызова
+            return None
+
+    def write(self, wall: float, cpu: float) -> None:
+        stages = {}
+        for stage, profile in self.stage_profiles.items():
+            stats = self._stats(profile)
+            if stats:
+                stats.dump_stats(os.path.join(self.output_dir, f"cpu_{stage}.prof"))
+            runs = self.stage_reports.get(stage, [])
+            stages[stage] = {
+                'runs': len(runs),
+                'wall_seconds': round(sum(run['wall_seconds'] for run in runs), 6),
+                'cpu_seconds': round(sum(run['cpu_seconds'] for run in runs), 6),
+                'peak_rss_mb': max((run['peak_rss_mb'] for run in runs), default=None),
+                'functions': top_functions(stats, self.top) if stats else [],
+                'samples': runs,
+            }
+
+        total_stats = self._stats(self.total)
+        for profile in self.stage_profiles.values():
+            stats = self._stats(profile)
+            if stats is None:
+                continue
+            if total_stats is None:
+                total_stats = stats
+            else:
+                total_stats.add(stats)
+        if total_stats:
+            total_stats.dump_stats(os.path.join(self.output_dir, 'cpu_total.prof'))
+
+        self.sampler.write(os.path.join(self.output_dir, 'stacks.collapsed'))
+
+        self.summary = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'command': sys.argv,
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(cpu, 6),
+            'peak_rss_mb': round(self.rss.peak / 2 ** 20, 1),
+            'stack_samples': sum(self.sampler.stacks.values()),
+            'functions': top_functions(total_stats, self.top, 'tottime') if total_stats else [],
+            'stages': stages,
+        }
+        with open(os.path.join(self.output_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.summary, f, ensure_ascii=False, indent=2)
+        print_summary(self.summary, self.output_dir)
+
+
+def print_summary(summary: Dict, output_dir: str) -> None:
+    print("\n🔬 ПРОФИЛЬ ЗАПУСКА")
+    print("=" * 60)
+    print(f"   время {summary['wall_seconds']:.3f} с, CPU {summary['cpu_seconds']:.3f} с, "
+          f"пик RSS {summary['peak_rss_mb']:.1f} МБ, сэмплов стеков {summary['stack_samples']}")
+    if summary['stages']:
+        print(f"   {'этап':<10} {'запусков':>8} {'время, с':>10} {'CPU, с':>9} {'пик RSS':>9}")
+        for stage, metrics in summary['stages'].items():
+            peak = f"{metrics['peak_rss_mb']:.1f}" if metrics['peak_rss_mb'] is not None else '-'
+            print(f"   {stage:<10} {metrics['runs']:>8} {metrics['wall_seconds']:>10.3f} "
+                  f"{metrics['cpu_seconds']:>9.3f} {peak:>9}")
+    for row in summary['functions'][:5]:
+        print(f"   ⏱️  {row['tottime']:>8.3f} с собственного времени  {row['function']}")
+    print(f"💾 Профиль: {output_dir} (cpu_*.prof, stacks.collapsed, summary.json)")
+
+
+def _take_profile_flag() -> Optional[str]:
+    """
+    Забирает --profile / --profile=<каталог> из sys.argv (чтобы argparse скрипта его не видел).
+
+    Возвращает каталог профиля, '' для каталога по умолчанию или None, если профиль не нужен.
+    """
+    output = None
+    for arg in list(sys.argv[1:]):
+        if arg == '--profile' or arg.startswith('--profile='):
+            sys.argv.remove(arg)
+            output = arg.partition('=')[2]
+    if output is None and os.getenv('SYNC_PROFILE'):
+        value = os.getenv('SYNC_PROFILE')
+        output = '' if value.lower() in ('1', 'true', 'yes') else value
+    return output
+
+
+def profile_main(func):
+    """Декоратор точки входа: --profile или SYNC_PROFILE включают SyncProfiler на весь запуск"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        output = _take_profile_flag()
+        if output is None:
+            return func(*args, **kwargs)
+        with SyncProfiler(output or None, allocations=os.getenv('SYNC_PROFILE_ALLOCATIONS') != '0'):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def main():
+    """Профилирование любого скрипта проекта без его правки"""
+    parser = argparse.ArgumentParser(description='Профилирование скрипта синхронизации')
+    parser.add_argument('--output', help='Каталог профиля (по умолчанию profile_<время>)')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help='Сколько функций и мест аллокаций в отчете')
+    parser.add_argument('--interval', type=float, default=SAMPLE_INTERVAL, help='Период сэмплирования стеков, с')
+    parser.add_argument('--no-allocations', action='store_true', help='Без снимков tracemalloc')
+    parser.add_argument('script', help='Путь к скрипту')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Аргументы скрипта')
+    args = parser.parse_args()
+
+    sys.argv = [args.script] + args.args
+    sys.path[0] = os.path.dirname(os.path.abspath(args.script))
+    with SyncProfiler(args.output, args.top, args.interval, not args.no_allocations):
+        try:
+            runpy.run_path(args.script, run_name='__main__')
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                print(f"⚠️  Скрипт завершился с кодом {e.code}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Token bucket для соблюдения лимитов SP-API (rate + burst) из нескольких потоков
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Классический token bucket: `rate` токенов в секунду, не больше `burst` в запасе.
+
+    acquire() блокирует поток, пока не появится токен, поэтому одним
+    экземпляром можно ограничить сразу весь пул потоков.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self) -> None:
+        """Обнуляет запас - после 429 от сервера ждем полного интервала"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0.0)
+
+    def try_acquire(self) -> bool:
+        """Берет токен без ожидания; False - лимит исчерпан"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def available(self) -> float:
+        """Текущий запас токенов"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
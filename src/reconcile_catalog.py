@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+Сверка каталога Shopify с Amazon по SKU
+
+Источники:
+- снимок вариантов Shopify (JSONL с товарами или постраничная выгрузка через API)
+- отчет Amazon GET_MERCHANT_LISTINGS_ALL_DATA (TSV)
+- FBA inventory summaries (JSON / JSONL)
+
+Данные хранятся колонками (numpy-массивы + список SKU), соединение - hash join
+по SKU, сравнение цен/остатков/названий - векторными операциями.
+"""
+import argparse
+import json
+import sys
+from array import array
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+from settings import load_settings
+from structured_log import get_logger
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('reconcile')
+
+# Маркер "название отсутствует" в колонке title_hashes
+EMPTY_TITLE_HASH = 0
+
+MISMATCH_CATEGORIES = (
+    'missing_on_amazon',
+    'orphaned_on_amazon',
+    'price_drift',
+    'quantity_drift',
+    'title_drift'
+)
+
+
+def normalize_title(title: str) -> str:
+    """Приводит название к виду для сравнения: нижний регистр, одиночные пробелы"""
+    return ' '.join(title.lower().split())
+
+
+def _title_hash(title: str) -> int:
+    normalized = normalize_title(title) if title else ''
+    if not normalized:
+        return EMPTY_TITLE_HASH
+    return hash(normalized) or 1
+
+
+def _parse_price(value) -> float:
+    try:
+        return float(value) if value not in (None, '') else float('nan')
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def _parse_quantity(value) -> Optional[int]:
+    """None - остаток неизвестен (отрицательный остаток Shopify - реальное значение)"""
+    try:
+        return int(float(value)) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+class ColumnarSnapshot:
+    """
+    Колоночный снимок каталога: по строке на SKU.
+
+    Пока снимок наполняется, значения копятся в компактных array.array,
+    после freeze() превращаются в numpy-массивы без копирования.
+    Известность остатка хранится отдельной маской quantity_known.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.skus: List[str] = []
+        self.titles: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.duplicates = 0
+        self._prices = array('d')
+        self._quantities = array('q')
+        self._quantity_known = array('B')
+        self._title_hashes = array('q')
+        self.prices = None
+        self.quantities = None
+        self.quantity_known = None
+        self.title_hashes = None
+
+    def __len__(self) -> int:
+        return len(self.skus)
+
+    def append(self, sku: str, price: float, quantity: Optional[int], title: str) -> None:
+        """Добавляет строку; повторный SKU не перезаписывает первую запись"""
+        if sku in self.index:
+            self.duplicates += 1
+            return
+        self.index[sku] = len(self.skus)
+        self.skus.append(sku)
+        self.titles.append(title)
+        self._prices.append(price)
+        self._quantities.append(quantity or 0)
+        self._quantity_known.append(quantity is not None)
+        self._title_hashes.append(_title_hash(title))
+
+    def quantity_at(self, row: int) -> Optional[int]:
+        """Остаток строки или None, если он неизвестен"""
+        if self.quantity_known is not None:
+            return int(self.quantities[row]) if self.quantity_known[row] else None
+        return self._quantities[row] if self._quantity_known[row] else None
+
+    def set_quantity(self, row: int, quantity: Optional[int]) -> None:
+        self._quantities[row] = quantity or 0
+        self._quantity_known[row] = quantity is not None
+
+    def freeze(self) -> 'ColumnarSnapshot':
+        """Фиксирует снимок и открывает numpy-представление колонок"""
+        self.prices = np.frombuffer(self._prices, dtype=np.float64)
+        self.quantities = np.frombuffer(self._quantities, dtype=np.int64)
+        self.quantity_known = np.frombuffer(self._quantity_known, dtype=np.bool_)
+        self.title_hashes = np.frombuffer(self._title_hashes, dtype=np.int64)
+        return self
+
+
+def iter_jsonl(path: str) -> Iterator[Dict]:
+    """Построчно читает JSONL, пропуская пустые строки"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def load_shopify_snapshot(products: Iterable[Dict]) -> ColumnarSnapshot:
+    """Разворачивает поток товаров Shopify в колонки по вариантам"""
+    snapshot = ColumnarSnapshot('shopify')
+    skipped = 0
+
+    for product in products:
+        product_title = product.get('title', '')
+        for variant in product.get('variants', []):
+            sku = (variant.get('sku') or '').strip()
+            if not sku:
+                skipped += 1
+                continue
+
+            variant_title = variant.get('title', 'Default Title')
+            title = product_title if variant_title in ('', 'Default Title') else f"{product_title} - {variant_title}"
+            snapshot.append(
+                sku,
+                _parse_price(variant.get('price')),
+                _parse_quantity(variant.get('inventory_quantity')),
+                title
+            )
+
+    if skipped:
+        log.warning('reconcile.variants_without_sku', skipped=skipped)
+    return snapshot.freeze()
+
+
+def load_amazon_snapshot(listing_rows: Iterable[Dict[str, str]],
+                         fba_summaries: Iterable[Dict] = ()) -> ColumnarSnapshot:
+    """
+    Собирает снимок Amazon из отчета листингов и FBA inventory summaries.
+
+    Для FBA-листингов отчет не содержит остатка - его берем из
+    fulfillableQuantity; SKU, которые есть только в FBA, добавляются отдельными строками.
+    """
+    snapshot = ColumnarSnapshot('amazon')
+
+    for row in listing_rows:
+        sku = (row.get('seller-sku') or '').strip()
+        if not sku:
+            continue
+        snapshot.append(
+            sku,
+            _parse_price(row.get('price')),
+            _parse_quantity(row.get('quantity')),
+            row.get('item-name') or ''
+        )
+
+    for summary in fba_summaries:
+        sku = (summary.get('sellerSku') or '').strip()
+        if not sku:
+            continue
+        details = summary.get('inventoryDetails') or {}
+        quantity = _parse_quantity(details.get('fulfillableQuantity', summary.get('totalQuantity')))
+
+        row = snapshot.index.get(sku)
+        if row is None:
+            snapshot.append(sku, float('nan'), quantity, summary.get('productName') or '')
+        elif snapshot.quantity_at(row) is None:
+            snapshot.set_quantity(row, quantity)
+
+    return snapshot.freeze()
+
+
+class CatalogReconciler:
+    """
+    Сверяет снимки Shopify и Amazon и раскладывает расхождения по категориям.
+
+    С price_engine цена Amazon сравнивается с ожидаемой ценой маркетплейса
+    (курс, наценка, налог, окончание), а не с сырой ценой Shopify.
+    """
+
+    def __init__(self, price_tolerance: float = 0.01, quantity_tolerance: int = 0,
+                 price_engine=None, marketplace: str = None):
+        self.price_tolerance = price_tolerance
+        self.quantity_tolerance = quantity_tolerance
+        self.price_engine = price_engine
+        self.marketplace = marketplace
+
+    def expected_prices(self, base_prices: np.ndarray) -> np.ndarray:
+        """Цены, которые должны стоять на маркетплейсе для цен Shopify"""
+        if self.price_engine is None:
+            return base_prices
+        marketplace_idx = np.full(len(base_prices), self.price_engine.index[self.marketplace])
+        return self.price_engine.price_pairs(base_prices, marketplace_idx)
+
+    def reconcile(self, shopify: ColumnarSnapshot, amazon: ColumnarSnapshot) -> Dict[str, List[Dict]]:
+        """Hash join по SKU + векторное сравнение колонок"""
+        amazon_index = amazon.index
+        amazon_rows = np.fromiter(
+            (amazon_index.get(sku, -1) for sku in shopify.skus),
+            dtype=np.int64,
+            count=len(shopify)
+        )
+
+        matched = amazon_rows >= 0
+        shopify_matched = np.flatnonzero(matched)
+        amazon_matched = amazon_rows[matched]
+
+        seen_on_amazon = np.zeros(len(amazon), dtype=bool)
+        seen_on_amazon[amazon_matched] = True
+
+        # Цена: сравниваем только там, где она известна с обеих сторон
+        expected_prices = self.expected_prices(shopify.prices[shopify_matched])
+        amz_prices = amazon.prices[amazon_matched]
+        price_known = ~(np.isnan(expected_prices) | np.isnan(amz_prices))
+        price_drift = price_known & (np.abs(expected_prices - amz_prices) > self.price_tolerance)
+        expected_by_row = dict(zip(shopify_matched[price_drift].tolist(), expected_prices[price_drift].tolist()))
+
+        # Остаток: в Amazon уходит max(0, inventory_quantity), так и сравниваем
+        shop_qty = shopify.quantities[shopify_matched]
+        amz_qty = amazon.quantities[amazon_matched]
+        qty_known = shopify.quantity_known[shopify_matched] & amazon.quantity_known[amazon_matched]
+        quantity_drift = qty_known & (np.abs(np.maximum(shop_qty, 0) - amz_qty) > self.quantity_tolerance)
+
+        shop_titles = shopify.title_hashes[shopify_matched]
+        amz_titles = amazon.title_hashes[amazon_matched]
+        title_drift = (shop_titles != EMPTY_TITLE_HASH) & (amz_titles != EMPTY_TITLE_HASH) & (shop_titles != amz_titles)
+
+        return {
+            'missing_on_amazon': [
+                {
+                    'sku': shopify.skus[i],
+                    'title': shopify.titles[i],
+                    'price': _json_float(shopify.prices[i]),
+                    'quantity': shopify.quantity_at(i)
+                }
+                for i in np.flatnonzero(~matched).tolist()
+            ],
+            'orphaned_on_amazon': [
+                {
+                    'sku': amazon.skus[i],
+                    'title': amazon.titles[i],
+                    'price': _json_float(amazon.prices[i]),
+                    'quantity': amazon.quantity_at(i)
+                }
+                for i in np.flatnonzero(~seen_on_amazon).tolist()
+            ],
+            'price_drift': [
+                {
+                    'sku': shopify.skus[s],
+                    'shopify_price': float(shopify.prices[s]),
+                    'expected_price': expected_by_row[s],
+                    'amazon_price': float(amazon.prices[a]),
+                    'delta': round(float(amazon.prices[a]) - expected_by_row[s], 4)
+                }
+                for s, a in self._pairs(shopify_matched, amazon_matched, price_drift)
+            ],
+            'quantity_drift': [
+                {
+                    'sku': shopify.skus[s],
+                    'shopify_quantity': int(shopify.quantities[s]),
+                    'amazon_quantity': int(amazon.quantities[a])
+                }
+                for s, a in self._pairs(shopify_matched, amazon_matched, quantity_drift)
+            ],
+            'title_drift': [
+                {
+                    'sku': shopify.skus[s],
+                    'shopify_title': shopify.titles[s],
+                    'amazon_title': amazon.titles[a]
+                }
+                for s, a in self._pairs(shopify_matched, amazon_matched, title_drift)
+            ]
+        }
+
+    @staticmethod
+    def _pairs(shopify_rows, amazon_rows, mask):
+        return zip(shopify_rows[mask].tolist(), amazon_rows[mask].tolist())
+
+
+def _json_float(value) -> Optional[float]:
+    return None if np.isnan(value) else float(value)
+
+
+def _load_fba_summaries(path: str) -> List[Dict]:
+    """FBA summaries: JSONL по одной записи или JSON-ответ API с payload.inventorySummaries"""
+    if path.endswith('.jsonl'):
+        return list(iter_jsonl(path))
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return data
+    return data.get('payload', data).get('inventorySummaries', [])
+
+
+def _iter_shopify_products(snapshot_path: Optional[str]) -> Iterator[Dict]:
+    if snapshot_path:
+        return iter_jsonl(snapshot_path)
+
+    return _iter_shopify_pages()
+
+
+def _iter_shopify_pages() -> Iterator[Dict]:
+    from test_integration import ShopifyClient
+    print("📡 Выгружаем варианты из Shopify постранично...")
+    client = ShopifyClient()
+    yield from client.iter_pages('/products.json?limit=250&fields=id,title,variants', 'products')
+    # iter_pages на ошибке страницы просто заканчивается: неполный каталог дал бы
+    # массовые ложные orphaned_on_amazon, поэтому сверка прерывается
+    if client.last_error:
+        raise RuntimeError(f"Выгрузка товаров Shopify прервана: {client.last_error}")
+
+
+def _iter_listing_rows(report_path: Optional[str], marketplace_id: str) -> Iterator[Dict[str, str]]:
+    from amazon_reports import AmazonReportFetcher, iter_flat_report_rows
+
+    if report_path:
+        with open(report_path, 'r', encoding='utf-8', errors='replace') as f:
+            yield from iter_flat_report_rows(f)
+        return
+
+    print("📡 Запрашиваем отчет GET_MERCHANT_LISTINGS_ALL_DATA у Amazon...")
+    text = AmazonReportFetcher().fetch_report('GET_MERCHANT_LISTINGS_ALL_DATA', [marketplace_id])
+    if text is None:
+        raise RuntimeError("Не удалось получить отчет листингов Amazon")
+    yield from iter_flat_report_rows(text.splitlines())
+
+
+def main():
+    """Ежедневная сверка Shopify ↔ Amazon"""
+    parser = argparse.ArgumentParser(description='Сверка каталога Shopify и Amazon по SKU')
+    parser.add_argument('--shopify-snapshot', help='JSONL с товарами Shopify (по умолчанию - выгрузка через API)')
+    parser.add_argument('--listings-report', help='TSV отчет GET_MERCHANT_LISTINGS_ALL_DATA (по умолчанию - запрос через Reports API)')
+    parser.add_argument('--fba-summaries', help='JSON/JSONL с FBA inventory summaries')
+    parser.add_argument('--fba-from-store', action='store_true',
+                        help='Взять FBA остатки из хранилища соответствий (см. fba_inventory_crawler.py)')
+    parser.add_argument('--marketplace-id', default='ATVPDKIKX0DER')
+    parser.add_argument('--price-tolerance', type=float, default=0.01,
+                        help='Допуск цены в валюте маркетплейса')
+    parser.add_argument('--quantity-tolerance', type=int, default=0)
+    parser.add_argument('--output', help='Файл результата (по умолчанию reconciliation_<timestamp>.json)')
+    args = parser.parse_args()
+
+    print("🔄 СВЕРКА КАТАЛОГА: Shopify ↔ Amazon")
+    print("=" * 60)
+
+    from get_product_schema import AmazonProductSchemaClient
+    from price_engine import PriceEngine
+
+    names_by_id = {marketplace_id: name for name, marketplace_id in AmazonProductSchemaClient().marketplaces.items()}
+    marketplace = names_by_id.get(args.marketplace_id)
+    if marketplace is None:
+        print(f"❌ Неизвестный маркетплейс: {args.marketplace_id}")
+        return 1
+    try:
+        price_engine = PriceEngine([marketplace])
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+    print(f"🌍 Маркетплейс: {marketplace} ({price_engine.currency(marketplace)})")
+
+    started = datetime.now()
+
+    try:
+        shopify = load_shopify_snapshot(_iter_shopify_products(args.shopify_snapshot))
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        print("💡 Отчет не записан - повторите сверку позже")
+        return 1
+    print(f"🛍️  Shopify: {len(shopify)} SKU (дубликатов: {shopify.duplicates})")
+
+    fba_summaries = []
+    if args.fba_summaries:
+        fba_summaries = _load_fba_summaries(args.fba_summaries)
+    elif args.fba_from_store:
+        from mapping_store import MappingStore
+        store = MappingStore()
+        fba_summaries = list(store.iter_fba_inventory(args.marketplace_id))
+        store.close()
+    try:
+        amazon = load_amazon_snapshot(_iter_listing_rows(args.listings_report, args.marketplace_id), fba_summaries)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        print("💡 Отчет не записан - повторите сверку позже")
+        return 1
+    print(f"📦 Amazon: {len(amazon)} SKU (дубликатов: {amazon.duplicates}, FBA записей: {len(fba_summaries)})")
+
+    reconciler = CatalogReconciler(args.price_tolerance, args.quantity_tolerance, price_engine, marketplace)
+    mismatches = reconciler.reconcile(shopify, amazon)
+
+    elapsed = (datetime.now() - started).total_seconds()
+
+    print(f"\n📊 РЕЗУЛЬТАТ СВЕРКИ ({elapsed:.2f} сек):")
+    print("-" * 40)
+    for category in MISMATCH_CATEGORIES:
+        print(f"   • {category}: {len(mismatches[category])}")
+
+    output = args.output or f"reconciliation_{started.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'generated_at': started.isoformat(),
+            'marketplace_id': args.marketplace_id,
+            'marketplace': marketplace,
+            'currency': price_engine.currency(marketplace),
+            'shopify_skus': len(shopify),
+            'amazon_skus': len(amazon),
+            'summary': {category: len(mismatches[category]) for category in MISMATCH_CATEGORIES},
+            'mismatches': mismatches
+        }, f, indent=2, ensure_ascii=False)
+
+    print(f"\n💾 Расхождения сохранены в: {output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Загрузка настроек (.env) один раз на процесс
+
+Раньше каждый модуль вызывал load_dotenv() при импорте и заново читал .env;
+теперь модули вызывают load_settings(), а повторные вызовы ничего не стоят.
+python-dotenv импортируется, только если файл настроек действительно есть -
+короткие cron-задачи не платят за импорт, когда все задано в окружении.
+
+Путь к файлу можно переопределить через SYNC_ENV_FILE (или sync --env-file).
+"""
+import os
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ENV_FILE = os.path.join(PROJECT_ROOT, '.env')
+
+_loaded = set()
+
+
+def load_settings(env_file: str = None) -> str:
+    """
+    Загружает переменные из .env в окружение (уже заданные не перезаписываются).
+
+    Возвращает путь к файлу настроек; один и тот же файл читается не больше одного раза.
+    """
+    path = os.path.abspath(env_file or os.getenv('SYNC_ENV_FILE') or DEFAULT_ENV_FILE)
+    if path in _loaded:
+        return path
+    _loaded.add(path)
+
+    if os.path.isfile(path):
+        from dotenv import load_dotenv
+        load_dotenv(path)
+    return path
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Списание остатков Shopify по заказам Amazon
+
+Позиции MFN-заказов Amazon (из хранилища, куда их пишет orders_ingester.py)
+копятся в течение короткого окна, суммируются по паре
+(inventory item, location) и применяются пачкой одной GraphQL-мутацией
+inventoryAdjustQuantities. Каждая позиция заказа списывается ровно один раз:
+ключ идемпотентности - AmazonOrderId:OrderItemId в журнале списаний.
+
+Пачка (ее ключ, позиции, изменения и остатки available до мутации)
+записывается в хранилище до вызова Shopify. Если ответа нет (таймаут, 5xx),
+пачка не пересобирается из новых позиций: на следующей итерации остатки
+сравниваются с записанными до мутации - совпадают с "до" - та же пачка
+отправляется повторно с тем же ключом, совпадают с "до + delta" - пачка уже
+применена. (Admin API не ищет inventoryAdjustmentGroup по
+referenceDocumentUri, поэтому проверка идет по остаткам.) Если остатки
+успели измениться иначе, пачка ждет решения оператора:
+--resolve-batch KEY --as applied|retry.
+"""
+import argparse
+import hashlib
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from mapping_store import MappingStore
+from settings import load_settings
+from structured_log import get_logger
+from test_integration import ShopifyClient
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('stock_adjuster')
+
+# Ограничение Shopify на число изменений в одной мутации
+MAX_CHANGES_PER_MUTATION = 250
+# Сколько SKU запрашивать одним productVariants(query: "sku:A OR sku:B ...")
+SKU_LOOKUP_BATCH = 50
+# Сколько inventory_item_ids передавать в один запрос inventory_levels.json (ограничение Shopify)
+LEVELS_LOOKUP_BATCH = 50
+
+VARIANTS_BY_SKU_QUERY = """
+query VariantsBySku($query: String!) {
+  productVariants(first: 250, query: $query) {
+    edges { node { id sku inventoryItem { id } } }
+  }
+}
+"""
+
+ADJUST_QUANTITIES_MUTATION = """
+mutation AdjustStock($input: InventoryAdjustQuantitiesInput!) {
+  inventoryAdjustQuantities(input: $input) {
+    inventoryAdjustmentGroup { id }
+    userErrors { field message }
+  }
+}
+"""
+
+
+def location_gid(location_id: str) -> str:
+    location_id = str(location_id)
+    return location_id if location_id.startswith('gid://') else f"gid://shopify/Location/{location_id}"
+
+
+def sku_search_term(sku: str) -> str:
+    """Условие sku:"..." для search syntax Shopify: обратный слеш и кавычки экранируются"""
+    escaped = sku.replace('\\', '\\\\').replace('"', '\\"')
+    return f'sku:"{escaped}"'
+
+
+def gid_id(gid: str) -> str:
+    """gid://shopify/InventoryItem/123 → 123"""
+    return str(gid).rsplit('/', 1)[-1]
+
+
+def level_key(inventory_item_id, location_id) -> str:
+    return f"{gid_id(inventory_item_id)}|{gid_id(location_id)}"
+
+
+def batch_key(line_keys: List[str]) -> str:
+    """Детерминированный ключ пачки: повтор той же пачки дает тот же ключ"""
+    return hashlib.sha1('\n'.join(sorted(line_keys)).encode('utf-8')).hexdigest()
+
+
+class ShopifyStockAdjuster:
+    """Агрегирует позиции заказов Amazon и списывает их со склада Shopify пачками"""
+
+    def __init__(self, store: MappingStore, location_id: str = None, shopify_client: ShopifyClient = None):
+        self.store = store
+        self.shopify = shopify_client or ShopifyClient()
+        self.location_id = location_id or os.getenv('SHOPIFY_LOCATION_ID')
+
+    def resolve_location(self) -> Optional[str]:
+        """Локация списания: из настроек или первая активная локация магазина"""
+        if self.location_id:
+            return location_gid(self.location_id)
+
+        response = self.shopify.make_api_request('/locations.json')
+        for location in (response or {}).get('locations', []):
+            if location.get('active', True):
+                self.location_id = str(location['id'])
+                return location_gid(self.location_id)
+        return None
+
+    def resolve_inventory_items(self, skus: List[str]) -> Dict[str, str]:
+        """SKU → inventory item GID: сначала кэш, недостающие - пачками через GraphQL"""
+        known = self.store.get_inventory_items(skus)
+        missing = [sku for sku in skus if sku not in known]
+
+        for start in range(0, len(missing), SKU_LOOKUP_BATCH):
+            chunk = missing[start:start + SKU_LOOKUP_BATCH]
+            query = ' OR '.join(sku_search_term(sku) for sku in chunk)
+            data = self.shopify.graphql(VARIANTS_BY_SKU_QUERY, {'query': query})
+            if data is None:
+                continue
+
+            found = []
+            wanted = set(chunk)
+            for edge in data['productVariants']['edges']:
+                node = edge['node']
+                if node.get('sku') in wanted and node.get('inventoryItem'):
+                    found.append({
+                        'sku': node['sku'],
+                        'variant_id': node['id'],
+                        'inventory_item_id': node['inventoryItem']['id']
+                    })
+            self.store.upsert_variants(found)
+            known.update({v['sku']: v['inventory_item_id'] for v in found})
+
+        return known
+
+    def read_levels(self, changes: List[Dict]) -> Optional[Dict[str, Optional[int]]]:
+        """Остатки available для изменений пачки: ключ "item|location" → количество (None - уровня нет)"""
+        levels = {level_key(change['inventoryItemId'], change['locationId']): None for change in changes}
+        item_ids = sorted({gid_id(change['inventoryItemId']) for change in changes})
+        location_ids = sorted({gid_id(change['locationId']) for change in changes})
+
+        for start in range(0, len(item_ids), LEVELS_LOOKUP_BATCH):
+            endpoint = (f"/inventory_levels.json?limit=250"
+                        f"&inventory_item_ids={','.join(item_ids[start:start + LEVELS_LOOKUP_BATCH])}"
+                        f"&location_ids={','.join(location_ids)}")
+            for level in self.shopify.iter_pages(endpoint, 'inventory_levels'):
+                key = level_key(level['inventory_item_id'], level['location_id'])
+                if key in levels:
+                    levels[key] = level.get('available')
+            if self.shopify.last_error:
+                return None
+        return levels
+
+    def send_batch(self, batch_key: str, changes: List[Dict]) -> str:
+        """Мутация пачки: 'applied', 'rejected' (userErrors - не применена) или 'unknown' (нет ответа)"""
+        self.store.count_stock_attempt(batch_key)
+        data = self.shopify.graphql(ADJUST_QUANTITIES_MUTATION, {
+            'input': {
+                'reason': 'correction',
+                'name': 'available',
+                'referenceDocumentUri': f"gid://shopify-amazon-integration/AmazonOrderBatch/{batch_key}",
+                'changes': [{key: change[key] for key in ('inventoryItemId', 'locationId', 'delta')}
+                            for change in changes]
+            }
+        })
+        if data is None:
+            log.error('stock.batch_unknown', batch=batch_key[:12], error=self.shopify.last_error)
+            return 'unknown'
+        result = data.get('inventoryAdjustQuantities') or {}
+        if result.get('userErrors'):
+            log.error('stock.batch_failed', batch=batch_key[:12], user_errors=result['userErrors'])
+            return 'rejected'
+        return 'applied'
+
+    def batch_state(self, batch: Dict) -> str:
+        """Применена ли пачка без ответа: 'applied', 'not_applied', 'ambiguous' или 'unknown' (остатки не прочитаны)"""
+        levels = self.read_levels(batch['changes'])
+        if levels is None:
+            return 'unknown'
+        current = [levels[level_key(change['inventoryItemId'], change['locationId'])] for change in batch['changes']]
+        before = [change['before'] for change in batch['changes']]
+        after = [(change['before'] or 0) + change['delta'] for change in batch['changes']]
+        if current == before:
+            return 'not_applied'
+        if current == after:
+            return 'applied'
+        return 'ambiguous'
+
+    def settle_batch(self, batch_key: str, outcome: str, lines: int, stats: Dict) -> None:
+        if outcome in ('applied', 'rejected'):
+            self.store.finish_stock_batch(batch_key, applied=outcome == 'applied')
+        if outcome == 'applied':
+            stats['applied'] += lines
+        else:
+            stats['failed'] += lines
+
+    def resume_batches(self, stats: Dict) -> None:
+        """Пачки прошлых итераций без ответа Shopify: проверить по остаткам и при необходимости повторить"""
+        for batch in self.store.get_stock_batches():
+            lines = len(batch['lines'])
+            state = self.batch_state(batch)
+            log.info('stock.batch_check', batch=batch['batch_key'][:12], state=state, attempts=batch['attempts'])
+            if state == 'applied':
+                self.settle_batch(batch['batch_key'], 'applied', lines, stats)
+            elif state == 'not_applied':
+                stats['mutations'] += 1
+                self.settle_batch(batch['batch_key'], self.send_batch(batch['batch_key'], batch['changes']),
+                                  lines, stats)
+            else:
+                if state == 'ambiguous':
+                    log.error('stock.batch_ambiguous', batch=batch['batch_key'],
+                              changes=batch['changes'], hint='--resolve-batch KEY --as applied|retry')
+                    stats['ambiguous'] += 1
+                stats['failed'] += lines
+
+    def resolve_batch(self, batch_key: str, applied: bool) -> bool:
+        """Решение оператора по пачке: applied - уже списана, иначе позиции снова ждут списания"""
+        if not any(batch['batch_key'] == batch_key for batch in self.store.get_stock_batches()):
+            return False
+        self.store.finish_stock_batch(batch_key, applied)
+        return True
+
+    def apply_pending(self) -> Dict:
+        """Одна итерация: довести незавершенные пачки, собрать новые позиции, свернуть и применить"""
+        stats = {'lines': 0, 'applied': 0, 'unmapped': 0, 'mutations': 0, 'failed': 0, 'ambiguous': 0}
+
+        self.resume_batches(stats)
+
+        lines = list(self.store.iter_pending_stock_lines())
+        stats['lines'] = len(lines)
+        if not lines:
+            return stats
+
+        location = self.resolve_location()
+        if not location:
+            log.error('stock.location_unresolved', lines=len(lines))
+            stats['failed'] = len(lines)
+            return stats
+
+        inventory_items = self.resolve_inventory_items(sorted({line['seller_sku'] for line in lines}))
+
+        # Сворачиваем позиции по (inventory item, location)
+        grouped = defaultdict(list)
+        for line in lines:
+            inventory_item_id = inventory_items.get(line['seller_sku'])
+            if not inventory_item_id:
+                stats['unmapped'] += 1
+                continue
+            line['inventory_item_id'] = inventory_item_id
+            line['location_id'] = location
+            grouped[(inventory_item_id, location)].append(line)
+
+        keys = list(grouped)
+        for start in range(0, len(keys), MAX_CHANGES_PER_MUTATION):
+            chunk = keys[start:start + MAX_CHANGES_PER_MUTATION]
+            chunk_lines = [line for key in chunk for line in grouped[key]]
+            key = batch_key([line['line_key'] for line in chunk_lines])
+
+            changes = [
+                {
+                    'inventoryItemId': inventory_item_id,
+                    'locationId': location_id,
+                    'delta': -sum(line['quantity'] for line in grouped[(inventory_item_id, location_id)])
+                }
+                for inventory_item_id, location_id in chunk
+            ]
+
+            # Остатки до мутации - по ним потом видно, применена ли пачка без ответа
+            levels = self.read_levels(changes)
+            if levels is None:
+                log.error('stock.levels_unavailable', batch=key[:12], lines=len(chunk_lines))
+                stats['failed'] += len(chunk_lines)
+                continue
+            for change in changes:
+                change['before'] = levels[level_key(change['inventoryItemId'], change['locationId'])]
+
+            # Пачка в хранилище до мутации: повтор пойдет ровно с этими позициями и этим ключом
+            self.store.begin_stock_batch(key, changes, chunk_lines)
+            stats['mutations'] += 1
+            self.settle_batch(key, self.send_batch(key, changes), len(chunk_lines), stats)
+
+        return stats
+
+    def run(self, window_seconds: float, once: bool = False) -> None:
+        """Цикл: раз в окно списывает все накопившиеся позиции"""
+        while True:
+            stats = self.apply_pending()
+            if stats['lines'] or stats['applied'] or stats['failed']:
+                print(f"📦 Позиций: {stats['lines']}, списано: {stats['applied']}, "
+                      f"без SKU в Shopify: {stats['unmapped']}, ошибок: {stats['failed']}, "
+                      f"мутаций: {stats['mutations']}")
+            if stats['ambiguous']:
+                print(f"⚠️  Пачек без ответа Shopify с изменившимися остатками: {stats['ambiguous']} - "
+                      f"проверьте и закройте: --resolve-batch KEY --as applied|retry")
+            if once:
+                return
+            time.sleep(window_seconds)
+
+
+def main():
+    """Списание остатков Shopify по заказам Amazon"""
+    parser = argparse.ArgumentParser(description='Списание остатков Shopify по заказам Amazon')
+    parser.add_argument('--window', type=float, default=60, help='Окно накопления позиций, сек')
+    parser.add_argument('--once', action='store_true', help='Одна итерация без цикла')
+    parser.add_argument('--location-id', help='Локация Shopify (по умолчанию SHOPIFY_LOCATION_ID или первая активная)')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    parser.add_argument('--resolve-batch', metavar='KEY', help='Закрыть пачку без ответа Shopify (ключ из лога)')
+    parser.add_argument('--as', dest='resolution', choices=('applied', 'retry'),
+                        help='applied - пачка уже списана в Shopify, retry - списать ее позиции заново')
+    args = parser.parse_args()
+    if args.resolve_batch and not args.resolution:
+        parser.error('--resolve-batch требует --as applied|retry')
+
+    print("🔄 AMAZON → SHOPIFY: списание остатков по заказам")
+    print("=" * 60)
+
+    store = MappingStore(args.store)
+    adjuster = ShopifyStockAdjuster(store, args.location_id)
+    if args.resolve_batch:
+        if adjuster.resolve_batch(args.resolve_batch, args.resolution == 'applied'):
+            print(f"✅ Пачка {args.resolve_batch[:12]} закрыта: {args.resolution}")
+        else:
+            print(f"❌ Незавершенной пачки {args.resolve_batch} нет")
+        store.close()
+        return
+    try:
+        adjuster.run(args.window, once=args.once)
+    except KeyboardInterrupt:
+        print("\n⏹️  Остановлено")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
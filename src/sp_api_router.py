@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Маршрутизация запросов SP-API по регионам
+
+Каждый маркетплейс заранее сопоставлен своему региональному хосту
+(NA / EU / FE, sandbox или production). Для каждого хоста - собственный
+requests.Session с пулом соединений и собственные token bucket'ы по операциям,
+поэтому медленный или упершийся в лимит регион не задерживает остальные.
+"""
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from rate_limiter import TokenBucket
+
+# Маркетплейс → регион SP-API
+MARKETPLACE_REGIONS = {
+    # Северная Америка
+    'ATVPDKIKX0DER': 'NA',   # США
+    'A2EUQ1WTGCTBG2': 'NA',  # Канада
+    'A1AM78C64UM0Y8': 'NA',  # Мексика
+    'A2Q3Y263D00KWC': 'NA',  # Бразилия
+    # Европа, Ближний Восток, Индия
+    'A1F83G8C2ARO7P': 'EU',  # Великобритания
+    'A1PA6795UKMFR9': 'EU',  # Германия
+    'A13V1IB3VIYZZH': 'EU',  # Франция
+    'APJ6JRA9NG5V4': 'EU',   # Италия
+    'A1RKKUPIHCS9HS': 'EU',  # Испания
+    'A1805IZSGTT6HS': 'EU',  # Нидерланды
+    'A2NODRKZP88ZB9': 'EU',  # Швеция
+    'A1C3SOZRARQ6R3': 'EU',  # Польша
+    'AMEN7PMS3EDWL': 'EU',   # Бельгия
+    'A33AVAJ2PDY3EV': 'EU',  # Турция
+    'A2VIGQ35RCS4UG': 'EU',  # ОАЭ
+    'A17E79C6D8DWNP': 'EU',  # Саудовская Аравия
+    'ARBP9OOSHTCHU': 'EU',   # Египет
+    'A21TJRUUN4KGV': 'EU',   # Индия
+    'AE08WJ6YKNBMC': 'EU',   # ЮАР
+    # Дальний Восток
+    'A39IBJ37TRP1C6': 'FE',  # Австралия
+    'A1VC38T7YXB528': 'FE',  # Япония
+    'A19VAU5U5O7RUS': 'FE',  # Сингапур
+}
+
+REGION_HOSTS = {
+    ('NA', False): 'https://sellingpartnerapi-na.amazon.com',
+    ('EU', False): 'https://sellingpartnerapi-eu.amazon.com',
+    ('FE', False): 'https://sellingpartnerapi-fe.amazon.com',
+    ('NA', True): 'https://sandbox.sellingpartnerapi-na.amazon.com',
+    ('EU', True): 'https://sandbox.sellingpartnerapi-eu.amazon.com',
+    ('FE', True): 'https://sandbox.sellingpartnerapi-fe.amazon.com',
+}
+
+# Предвычисленная таблица (маркетплейс, sandbox) → хост: одна операция словаря на запрос
+MARKETPLACE_ENDPOINTS = {
+    (marketplace_id, sandbox): REGION_HOSTS[(region, sandbox)]
+    for marketplace_id, region in MARKETPLACE_REGIONS.items()
+    for sandbox in (False, True)
+}
+
+# Неизвестные маркетплейсы исторически уходили в EU (см. get_region_endpoint)
+DEFAULT_REGION = 'EU'
+
+
+def region_for(marketplace_id: str) -> str:
+    return MARKETPLACE_REGIONS.get(marketplace_id, DEFAULT_REGION)
+
+
+def endpoint_for(marketplace_id: str, sandbox: bool = False) -> str:
+    """Региональный хост SP-API для маркетплейса (SP_API_ENDPOINT подменяет все хосты, например на stand_in_server)"""
+    override = os.getenv('SP_API_ENDPOINT')
+    if override:
+        return override.rstrip('/')
+    endpoint = MARKETPLACE_ENDPOINTS.get((marketplace_id, sandbox))
+    return endpoint or REGION_HOSTS[(DEFAULT_REGION, sandbox)]
+
+
+class SpApiRouter:
+    """Пулы соединений и состояние лимитов отдельно для каждого регионального хоста"""
+
+    def __init__(self, pool_maxsize: int = 16):
+        self.pool_maxsize = pool_maxsize
+        self._sessions: Dict[str, requests.Session] = {}
+        self._limiters: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def session(self, base_url: str) -> requests.Session:
+        """Session с собственным пулом соединений для хоста"""
+        session = self._sessions.get(base_url)
+        if session is not None:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[base_url] = session
+        return session
+
+    def limiter(self, base_url: str, operation: str, rate: float, burst: int = 1) -> TokenBucket:
+        """
+        Token bucket операции в пределах хоста (создается при первом обращении).
+
+        SP_API_RATE_SCALE умножает лимит - для прогонов против stand_in_server с --rate-scale.
+        """
+        key = (base_url, operation)
+        bucket = self._limiters.get(key)
+        if bucket is not None:
+            return bucket
+
+        with self._lock:
+            bucket = self._limiters.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate * float(os.getenv('SP_API_RATE_SCALE') or 1), burst)
+                self._limiters[key] = bucket
+        return bucket
+
+    def fan_out(self, marketplace_ids: Iterable[str], func: Callable[[str], object],
+                max_workers: int = None) -> List[Tuple[str, object, Exception]]:
+        """
+        Выполняет func(marketplace_id) для всех маркетплейсов параллельно.
+
+        Возвращает (marketplace_id, результат, исключение) по мере завершения.
+        """
+        marketplace_ids = list(marketplace_ids)
+        if not marketplace_ids:
+            return []
+
+        results = []
+        with ThreadPoolExecutor(max_workers=max_workers or len(marketplace_ids)) as executor:
+            # Каждому потоку - копия контекста вызывающего: спаны маркетплейсов остаются в его трассе
+            futures = {
+                executor.submit(contextvars.copy_context().run, func, marketplace_id): marketplace_id
+                for marketplace_id in marketplace_ids
+            }
+            for future in as_completed(futures):
+                marketplace_id = futures[future]
+                try:
+                    results.append((marketplace_id, future.result(), None))
+                except Exception as e:
+                    results.append((marketplace_id, None, e))
+        return results
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+_default_router = None
+_default_router_lock = threading.Lock()
+
+
+def get_router() -> SpApiRouter:
+    """Общий для процесса роутер: все клиенты делят одни и те же пулы и лимиты"""
+    global _default_router
+    if _default_router is None:
+        with _default_router_lock:
+            if _default_router is None:
+                _default_router = SpApiRouter()
+    return _default_router
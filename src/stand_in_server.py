@@ -0,0 +1,1090 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная замена SP-API, LWA и Shopify Admin API для нагрузочных прогонов
+
+Реализует эндпоинты, которыми пользуется проект: токен LWA, Sellers,
+Catalog Items, Product Type Definitions, Listings, Feeds (+ документы),
+Reports, FBA Inventory, Orders и Shopify products/orders/locations/
+inventory_levels/GraphQL. Данные - синтетический каталог, детерминированный по seed.
+
+Поведение настраивается:
+- задержка ответа по распределению (fixed / uniform / normal / lognormal),
+  отдельно для групп эндпоинтов (lwa, sp, shopify, documents)
+- лимиты по операциям SP-API (x-amzn-RateLimit-Limit) и leaky bucket Shopify
+  (X-Shopify-Shop-Api-Call-Limit) с ответом 429 при превышении
+- случайные 5xx и "зависания" (соединение закрывается без ответа)
+
+Клиенты переключаются переменными окружения:
+    SP_API_ENDPOINT=http://127.0.0.1:8800
+    AMAZON_TOKEN_URL=http://127.0.0.1:8800/auth/o2/token
+    SHOPIFY_BASE_URL=http://127.0.0.1:8800
+    SP_API_RATE_SCALE=<--rate-scale>  (лимиты клиентов в тон серверу)
+"""
+import argparse
+import base64
+import gzip
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit
+
+from rate_limiter import TokenBucket
+
+# Лимиты SP-API по операциям: (запросов/сек, burst)
+SP_API_RATES = {
+    'getMarketplaceParticipations': (0.016, 15),
+    'searchCatalogItems': (2, 2),
+    'getCatalogItem': (2, 2),
+    'searchDefinitionsProductTypes': (5, 10),
+    'getDefinitionsProductType': (5, 10),
+    'getListingsItem': (5, 10),
+    'putListingsItem': (5, 10),
+    'deleteListingsItem': (5, 10),
+    'createFeedDocument': (0.5, 15),
+    'createFeed': (0.0083, 15),
+    'getFeed': (2, 15),
+    'getFeedDocument': (0.0222, 10),
+    'createReport': (0.0167, 15),
+    'getReport': (2, 15),
+    'getReportDocument': (0.0167, 15),
+    'getInventorySummaries': (2, 2),
+    'getOrders': (0.0167, 20),
+    'getOrderItems': (0.5, 30),
+}
+
+# Shopify REST: ведро на 40 запросов, утекает 2 в секунду; GraphQL - упрощенно по запросам
+SHOPIFY_REST_RATE = (2, 40)
+SHOPIFY_GRAPHQL_RATE = (5, 100)
+
+MARKETPLACE_ID = 'ATVPDKIKX0DER'
+SELLER_ID = 'A1STANDINSELLER'
+WIPER_PRODUCT_TYPE = 'WINDSHIELD_WIPER_BLADE'
+
+# Сколько длится обработка фида/отчета (сек) до DONE
+DEFAULT_PROCESSING_SECONDS = 2.0
+
+CATALOG_PAGE_SIZE = 20
+FBA_PAGE_SIZE = 50
+ORDERS_PAGE_SIZE = 100
+SHOPIFY_MAX_LIMIT = 250
+
+
+class LatencyModel:
+    """
+    Распределение задержки по строке-описанию (миллисекунды):
+    none | fixed:50 | uniform:10,80 | normal:60,15 | lognormal:60,0.5 (медиана, sigma)
+    """
+
+    def __init__(self, spec: str = 'none'):
+        self.spec = spec
+        kind, _, args = spec.partition(':')
+        self.kind = kind
+        self.args = [float(x) for x in args.split(',')] if args else []
+        if kind not in ('none', 'fixed', 'uniform', 'normal', 'lognormal'):
+            raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        """Задержка в секундах"""
+        if self.kind == 'none':
+            return 0.0
+        if self.kind == 'fixed':
+            ms = self.args[0]
+        elif self.kind == 'uniform':
+            ms = rng.uniform(self.args[0], self.args[1])
+        elif self.kind == 'normal':
+            ms = rng.gauss(self.args[0], self.args[1])
+        else:
+            ms = self.args[0] * rng.lognormvariate(0, self.args[1])
+        return max(ms, 0.0) / 1000
+
+
+def _gs1_check_digit(body: str) -> str:
+    total = sum(int(d) * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(body)))
+    return str((10 - total % 10) % 10)
+
+
+def _iso(moment: datetime) -> str:
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _encode_token(offset: int, extra: str = '') -> str:
+    return base64.urlsafe_b64encode(f"{offset}:{extra}".encode()).decode().rstrip('=')
+
+
+def _decode_token(token: str) -> Tuple[int, str]:
+    padded = token + '=' * (-len(token) % 4)
+    offset, _, extra = base64.urlsafe_b64decode(padded.encode()).decode().partition(':')
+    return int(offset), extra
+
+
+PRODUCT_ID_BASE = 9160000000000
+VARIANT_ID_BASE = 47000000000000
+INVENTORY_ITEM_ID_BASE = 49000000000000
+IMAGE_ID_BASE = 50000000000000
+BLADE_LENGTHS = [350, 380, 400, 425, 450, 475, 500, 530, 550, 600, 650, 700]
+
+
+def synthetic_product(index: int, rng: random.Random, now: datetime, variants: int = 1, images: int = 1) -> Dict:
+    """
+    Товар Shopify по образцу Bosch Aerotwin из create_sku_in_amazon:
+    варианты по длине щетки, изображения, теги и HTML-описание со списком
+    """
+    model = f"A{100 + index}S"
+    lengths = sorted(rng.sample(BLADE_LENGTHS, min(variants, len(BLADE_LENGTHS))))
+    product_id = PRODUCT_ID_BASE + index
+    title = f"Bosch Aerotwin {model} Wiper Blade"
+    handle = f"bosch-aerotwin-{model.lower()}"
+
+    product_variants = []
+    for position, length in enumerate(lengths, 1):
+        number = index * len(BLADE_LENGTHS) + position - 1
+        ean = '40470' + f"{number:07d}"
+        product_variants.append({
+            'id': VARIANT_ID_BASE + number,
+            'product_id': product_id,
+            'title': f"{length}mm" if len(lengths) > 1 else 'Default Title',
+            'option1': f"{length}mm",
+            'position': position,
+            'sku': f"BSH-{model}{position:02d}",
+            'price': f"{rng.uniform(12, 60):.2f}",
+            'barcode': ean + _gs1_check_digit(ean),
+            'weight': rng.randint(150, 400),
+            'weight_unit': 'g',
+            'inventory_item_id': INVENTORY_ITEM_ID_BASE + number,
+            'inventory_quantity': 0,
+        })
+
+    lengths_text = ', '.join(f"{length} mm" for length in lengths)
+    return {
+        'id': product_id,
+        'title': title,
+        'vendor': 'Bosch',
+        'product_type': 'Wiper Blades',
+        'handle': handle,
+        'tags': 'wiper, bosch, aerotwin, automotive, flat blade',
+        'status': 'active',
+        'body_html': (
+            f"<p><strong>{title}</strong> &ndash; premium flat wiper blade for streak-free "
+            f"wiping in all weather conditions.</p>"
+            f"<ul><li>Length: {lengths_text}</li><li>Quick-Clip adapter for fast installation</li>"
+            f"<li>Power Protection Plus rubber with dual-layer coating</li>"
+            f"<li>Aerodynamic spoiler reduces wind noise</li></ul>"
+            f"<p>Replace wiper blades every <em>6&ndash;12 months</em> for best visibility.</p>"
+        ),
+        'created_at': _iso(now - timedelta(days=rng.randint(30, 900))),
+        'updated_at': _iso(now - timedelta(days=rng.randint(0, 29))),
+        'options': [{'name': 'Length', 'position': 1, 'values': [f"{length}mm" for length in lengths]}],
+        'variants': product_variants,
+        'images': [
+            {'id': IMAGE_ID_BASE + index * 10 + n, 'position': n + 1, 'src': f"/_images/{handle}-{n + 1}.jpg",
+             'alt': title, 'variant_ids': [product_variants[n]['id']] if n < len(product_variants) else []}
+            for n in range(images)
+        ],
+    }
+
+
+class StandInData:
+    """Синтетический каталог Bosch-подобных дворников, общий для Shopify и Amazon"""
+
+    def __init__(self, products: int = 200, orders: int = 100, seed: int = 42,
+                 asin_share: float = 0.7, fba_share: float = 0.3, variants: int = 1, images: int = 1):
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.lock = threading.Lock()
+
+        self.locations = [
+            {'id': 70000000001, 'name': 'Main warehouse', 'active': True},
+            {'id': 70000000002, 'name': 'Retail store', 'active': True},
+        ]
+
+        self.products: List[Dict] = []
+        self.catalog: List[Dict] = []          # элементы Catalog Items API
+        self.catalog_by_asin: Dict[str, Dict] = {}
+        self.catalog_by_gtin: Dict[str, Dict] = {}
+        self.catalog_words: Dict[str, set] = defaultdict(set)
+        self.fba_summaries: List[Dict] = []
+        self.inventory_levels: Dict[Tuple[int, int], int] = {}
+        self.variants_by_sku: Dict[str, Dict] = {}
+        self.listings: Dict[str, Dict] = {}
+
+        for i in range(products):
+            product = synthetic_product(i, rng, now, variants, images)
+            self.products.append(product)
+            model = product['handle'].rsplit('-', 1)[-1].upper()
+
+            for variant in product['variants']:
+                sku = variant['sku']
+                self.variants_by_sku[sku] = variant
+
+                total = 0
+                for location in self.locations:
+                    available = rng.randint(0, 40)
+                    self.inventory_levels[(variant['inventory_item_id'], location['id'])] = available
+                    total += available
+                variant['inventory_quantity'] = total
+
+                if rng.random() >= asin_share:
+                    continue
+
+                index = variant['id'] - VARIANT_ID_BASE
+                asin = f"B0{index:08d}"
+                length = variant['option1']
+                item = {
+                    'asin': asin,
+                    'identifiers': [{'marketplaceId': MARKETPLACE_ID,
+                                     'identifiers': [{'identifierType': 'EAN', 'identifier': variant['barcode']}]}],
+                    'productTypes': [{'marketplaceId': MARKETPLACE_ID, 'productType': WIPER_PRODUCT_TYPE}],
+                    'summaries': [{'marketplaceId': MARKETPLACE_ID, 'itemName': f"BOSCH {model} Aerotwin {length}",
+                                   'brand': 'BOSCH', 'manufacturer': 'Robert Bosch GmbH',
+                                   'partNumber': model, 'modelNumber': model}],
+                }
+                self.catalog.append(item)
+                self.catalog_by_asin[asin] = item
+                self.catalog_by_gtin[variant['barcode'].zfill(14)] = item
+                for word in re.findall(r'[a-z0-9]+', f"bosch {model} aerotwin {length} wiper blade".lower()):
+                    self.catalog_words[word].add(asin)
+
+                price = float(variant['price'])
+                self.listings[sku] = {'sku': sku, 'asin': asin, 'price': price,
+                                      'quantity': total, 'title': item['summaries'][0]['itemName']}
+
+                if rng.random() < fba_share:
+                    fulfillable = rng.randint(0, 120)
+                    self.fba_summaries.append({
+                        'asin': asin,
+                        'fnSku': f"X00{index:07d}",
+                        'sellerSku': sku,
+                        'condition': 'NewItem',
+                        'inventoryDetails': {'fulfillableQuantity': fulfillable},
+                        'lastUpdatedTime': _iso(now - timedelta(hours=rng.randint(0, 240))),
+                        'productName': product['title'],
+                        'totalQuantity': fulfillable + rng.randint(0, 10),
+                    })
+
+        self.orders: List[Dict] = []
+        self.order_items: Dict[str, List[Dict]] = {}
+        listed = [sku for sku in self.listings]
+        for i in range(orders if listed else 0):
+            purchased = now - timedelta(minutes=rng.randint(10, 60 * 24 * 14))
+            order_id = f"111-{rng.randint(1000000, 9999999)}-{i:07d}"
+            items = []
+            total = 0.0
+            for n in range(rng.choice([1, 1, 1, 2, 3])):
+                sku = rng.choice(listed)
+                quantity = rng.choice([1, 1, 2])
+                price = self.listings[sku]['price'] * quantity
+                total += price
+                items.append({
+                    'ASIN': self.listings[sku]['asin'],
+                    'SellerSKU': sku,
+                    'OrderItemId': f"{order_id.replace('-', '')}{n}",
+                    'Title': self.listings[sku]['title'],
+                    'QuantityOrdered': quantity,
+                    'QuantityShipped': 0,
+                    'ItemPrice': {'CurrencyCode': 'USD', 'Amount': f"{price:.2f}"},
+                })
+            self.orders.append({
+                'AmazonOrderId': order_id,
+                'PurchaseDate': _iso(purchased),
+                'LastUpdateDate': _iso(purchased + timedelta(minutes=rng.randint(0, 600))),
+                'OrderStatus': rng.choice(['Unshipped', 'Unshipped', 'Shipped', 'Pending', 'Canceled']),
+                'FulfillmentChannel': rng.choice(['MFN', 'MFN', 'AFN']),
+                'MarketplaceId': MARKETPLACE_ID,
+                'OrderTotal': {'CurrencyCode': 'USD', 'Amount': f"{total:.2f}"},
+            })
+            self.order_items[order_id] = items
+        self.orders.sort(key=lambda order: order['LastUpdateDate'])
+
+        self.product_by_id = {product['id']: product for product in self.products}
+        self.feeds: Dict[str, Dict] = {}
+        self.reports: Dict[str, Dict] = {}
+        self.documents: Dict[str, Dict] = {}
+        self.tokens: set = set()
+
+    def listings_report(self) -> str:
+        rows = ['seller-sku\tasin1\titem-name\tprice\tquantity\tstatus']
+        for listing in self.listings.values():
+            rows.append(f"{listing['sku']}\t{listing['asin']}\t{listing['title']}\t"
+                        f"{listing['price']:.2f}\t{listing['quantity']}\tActive")
+        return '\n'.join(rows) + '\n'
+
+
+class StandInConfig:
+    """Параметры поведения сервера"""
+
+    def __init__(self, latency: Dict[str, str] = None, error_rate: float = 0.0, timeout_rate: float = 0.0,
+                 timeout_seconds: float = 30.0, rate_scale: float = 1.0, throttle: bool = True,
+                 processing_seconds: float = DEFAULT_PROCESSING_SECONDS, seed: int = 42):
+        latency = latency or {}
+        default = latency.get('default', 'none')
+        self.latency = {group: LatencyModel(latency.get(group, default))
+                        for group in ('lwa', 'sp', 'shopify', 'documents', 'default')}
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.rate_scale = rate_scale
+        self.throttle = throttle
+        self.processing_seconds = processing_seconds
+        self.seed = seed
+
+
+class StandInState:
+    """Данные, лимиты и статистика одного экземпляра сервера"""
+
+    def __init__(self, data: StandInData, config: StandInConfig):
+        self.data = data
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.rng_lock = threading.Lock()
+        self.buckets: Dict[str, TokenBucket] = {}
+        for operation, (rate, burst) in SP_API_RATES.items():
+            self.buckets[operation] = TokenBucket(rate * config.rate_scale, burst)
+        self.buckets['shopifyRest'] = TokenBucket(SHOPIFY_REST_RATE[0] * config.rate_scale, SHOPIFY_REST_RATE[1])
+        self.buckets['shopifyGraphql'] = TokenBucket(SHOPIFY_GRAPHQL_RATE[0] * config.rate_scale,
+                                                     SHOPIFY_GRAPHQL_RATE[1])
+        self.stats_lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def random(self) -> float:
+        with self.rng_lock:
+            return self.rng.random()
+
+    def latency(self, group: str) -> float:
+        with self.rng_lock:
+            return self.config.latency.get(group, self.config.latency['default']).sample(self.rng)
+
+    def record(self, operation: str, outcome: str) -> None:
+        with self.stats_lock:
+            self.stats[operation][outcome] += 1
+
+    def snapshot(self) -> Dict:
+        with self.stats_lock:
+            return {operation: dict(outcomes) for operation, outcomes in self.stats.items()}
+
+
+# (метод, регулярное выражение пути, обработчик, операция для лимита, группа задержки)
+ROUTES = [
+    ('POST', r'/auth/o2/token', 'lwa_token', None, 'lwa'),
+    ('GET', r'/sellers/v1/marketplaceParticipations', 'sellers', 'getMarketplaceParticipations', 'sp'),
+    ('GET', r'/catalog/2022-04-01/items', 'catalog_search', 'searchCatalogItems', 'sp'),
+    ('GET', r'/catalog/2022-04-01/items/(?P<asin>[^/]+)', 'catalog_item', 'getCatalogItem', 'sp'),
+    ('GET', r'/definitions/2020-09-01/productTypes', 'definitions_search', 'searchDefinitionsProductTypes', 'sp'),
+    ('GET', r'/definitions/2020-09-01/productTypes/(?P<product_type>[^/]+)', 'definition',
+     'getDefinitionsProductType', 'sp'),
+    ('GET', r'/listings/2021-08-01/items/(?P<seller_id>[^/]+)/(?P<sku>[^/]+)', 'listing_get', 'getListingsItem', 'sp'),
+    ('PUT', r'/listings/2021-08-01/items/(?P<seller_id>[^/]+)/(?P<sku>[^/]+)', 'listing_put', 'putListingsItem', 'sp'),
+    ('PATCH', r'/listings/2021-08-01/items/(?P<seller_id>[^/]+)/(?P<sku>[^/]+)', 'listing_put', 'putListingsItem',
+     'sp'),
+    ('DELETE', r'/listings/2021-08-01/items/(?P<seller_id>[^/]+)/(?P<sku>[^/]+)', 'listing_delete',
+     'deleteListingsItem', 'sp'),
+    ('POST', r'/feeds/2021-06-30/documents', 'feed_document_create', 'createFeedDocument', 'sp'),
+    ('GET', r'/feeds/2021-06-30/documents/(?P<document_id>[^/]+)', 'document_get', 'getFeedDocument', 'sp'),
+    ('POST', r'/feeds/2021-06-30/feeds', 'feed_create', 'createFeed', 'sp'),
+    ('GET', r'/feeds/2021-06-30/feeds/(?P<feed_id>[^/]+)', 'feed_get', 'getFeed', 'sp'),
+    ('POST', r'/reports/2021-06-30/reports', 'report_create', 'createReport', 'sp'),
+    ('GET', r'/reports/2021-06-30/reports/(?P<report_id>[^/]+)', 'report_get', 'getReport', 'sp'),
+    ('GET', r'/reports/2021-06-30/documents/(?P<document_id>[^/]+)', 'document_get', 'getReportDocument', 'sp'),
+    ('GET', r'/fba/inventory/v1/summaries', 'fba_summaries', 'getInventorySummaries', 'sp'),
+    ('GET', r'/orders/v0/orders', 'orders', 'getOrders', 'sp'),
+    ('GET', r'/orders/v0/orders/(?P<order_id>[^/]+)/orderItems', 'order_items', 'getOrderItems', 'sp'),
+    ('PUT', r'/_uploads/(?P<document_id>[^/]+)', 'document_upload', None, 'documents'),
+    ('GET', r'/_documents/(?P<document_id>[^/]+)', 'document_download', None, 'documents'),
+    ('GET', r'/_images/(?P<name>[^/]+)', 'image', None, 'documents'),
+    ('GET', r'/_schemas/(?P<product_type>[^/]+)\.json', 'schema_document', None, 'documents'),
+    ('GET', r'/admin/api/[^/]+/products\.json', 'shopify_products', 'shopifyRest', 'shopify'),
+    ('GET', r'/admin/api/[^/]+/products/(?P<product_id>\d+)\.json', 'shopify_product', 'shopifyRest', 'shopify'),
+    ('GET', r'/admin/api/[^/]+/orders\.json', 'shopify_orders', 'shopifyRest', 'shopify'),
+    ('GET', r'/admin/api/[^/]+/locations\.json', 'shopify_locations', 'shopifyRest', 'shopify'),
+    ('GET', r'/admin/api/[^/]+/inventory_levels\.json', 'shopify_inventory_levels', 'shopifyRest', 'shopify'),
+    ('POST', r'/admin/api/[^/]+/graphql\.json', 'shopify_graphql', 'shopifyGraphql', 'shopify'),
+    ('GET', r'/_stats', 'stats', None, None),
+]
+COMPILED_ROUTES = [(method, re.compile(pattern + r'$'), handler, operation, group)
+                   for method, pattern, handler, operation, group in ROUTES]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Маршрутизация, задержки, лимиты и отказы; сами ответы - в методах handle_*"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'StandIn/1.0'
+    state: StandInState = None  # задается в подклассе сервером
+
+    def log_message(self, format, *args):
+        pass
+
+    # --- общий конвейер ---
+
+    def _dispatch(self, method: str) -> None:
+        parsed = urlsplit(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        self.body = self._read_body()
+
+        route = None
+        for route_method, pattern, handler, operation, group in COMPILED_ROUTES:
+            if route_method != method:
+                continue
+            match = pattern.match(parsed.path)
+            if match:
+                route = (handler, operation, group, match.groupdict())
+                break
+
+        if route is None:
+            self.state.record('unknown', '404')
+            self._send_json(404, {'errors': [{'code': 'NotFound', 'message': f"{method} {parsed.path}"}]})
+            return
+
+        handler, operation, group, params = route
+        name = operation or handler
+        state = self.state
+
+        if group is not None:
+            delay = state.latency(group)
+            if delay:
+                time.sleep(delay)
+
+            if state.config.timeout_rate and state.random() < state.config.timeout_rate:
+                # Висим и закрываем соединение без ответа
+                state.record(name, 'timeout')
+                time.sleep(state.config.timeout_seconds)
+                self.close_connection = True
+                return
+
+            if state.config.error_rate and state.random() < state.config.error_rate:
+                status = 503 if state.random() < 0.5 else 500
+                state.record(name, str(status))
+                self._send_json(status, {'errors': [{'code': 'InternalFailure',
+                                                     'message': 'Injected failure'}]})
+                return
+
+        extra_headers = {}
+        if operation is not None:
+            if operation.startswith('shopify'):
+                if self.headers.get('X-Shopify-Access-Token') is None:
+                    state.record(name, '401')
+                    self._send_json(401, {'errors': '[API] Invalid API key or access token'})
+                    return
+            elif self.headers.get('x-amz-access-token') not in state.data.tokens:
+                state.record(name, '403')
+                self._send_json(403, {'errors': [{'code': 'Unauthorized',
+                                                  'message': 'Access to requested resource is denied.'}]})
+                return
+
+            bucket = state.buckets[operation]
+            allowed = bucket.try_acquire() if state.config.throttle else True
+            if operation.startswith('shopify'):
+                used = max(0, round(bucket.burst - bucket.available()))
+                extra_headers['X-Shopify-Shop-Api-Call-Limit'] = f"{used}/{bucket.burst}"
+            else:
+                extra_headers['x-amzn-RateLimit-Limit'] = f"{bucket.rate:g}"
+            if not allowed:
+                state.record(name, '429')
+                retry_after = max(1, int(round(1 / bucket.rate))) if bucket.rate else 1
+                extra_headers['Retry-After'] = str(retry_after)
+                self._send_json(429, {'errors': [{'code': 'QuotaExceeded',
+                                                  'message': 'You exceeded your quota for the requested resource.'}]},
+                                extra_headers)
+                return
+
+        try:
+            result = getattr(self, f'handle_{handler}')(**params)
+        except Exception as e:
+            state.record(name, '500')
+            self._send_json(500, {'errors': [{'code': 'InternalFailure', 'message': str(e)}]})
+            return
+
+        status, payload = result[0], result[1]
+        headers = dict(extra_headers, **(result[2] if len(result) > 2 else {}))
+        state.record(name, str(status))
+        if isinstance(payload, (bytes, str)):
+            self._send_raw(status, payload, headers)
+        else:
+            self._send_json(status, payload, headers)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _json_body(self) -> Dict:
+        if not self.body:
+            return {}
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return {}
+
+    def _send_raw(self, status: int, payload, headers: Dict = None) -> None:
+        body = payload.encode('utf-8') if isinstance(payload, str) else payload
+        headers = dict(headers or {})
+        self.send_response(status)
+        self.send_header('Content-Type', headers.pop('Content-Type', 'application/octet-stream'))
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-amzn-RequestId', str(uuid.uuid4()))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload, headers: Dict = None) -> None:
+        self._send_raw(status, json.dumps(payload), dict(headers or {}, **{'Content-Type': 'application/json'}))
+
+    def _base_url(self) -> str:
+        host = self.headers.get('Host') or f"{self.server.server_address[0]}:{self.server.server_address[1]}"
+        return f"http://{host}"
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    # --- LWA и Sellers ---
+
+    def handle_lwa_token(self):
+        form = {key: values[-1] for key, values in parse_qs(self.body.decode('utf-8')).items()}
+        if form.get('grant_type') not in ('refresh_token', 'client_credentials') or not form.get('client_id'):
+            return 400, {'error': 'invalid_request', 'error_description': 'Missing client_id or grant_type'}
+        token = f"Atza|stand-in-{uuid.uuid4().hex}"
+        with self.state.data.lock:
+            self.state.data.tokens.add(token)
+        return 200, {'access_token': token, 'token_type': 'bearer', 'expires_in': 3600,
+                     'refresh_token': form.get('refresh_token', '')}
+
+    def handle_sellers(self):
+        return 200, {'payload': [{
+            'marketplace': {'id': MARKETPLACE_ID, 'name': 'Amazon.com', 'countryCode': 'US',
+                            'defaultCurrencyCode': 'USD', 'defaultLanguageCode': 'en_US',
+                            'domainName': 'www.amazon.com'},
+            'participation': {'isParticipating': True, 'hasSuspendedListings': False},
+        }]}
+
+    # --- Catalog Items ---
+
+    def handle_catalog_search(self):
+        data = self.state.data
+        page_size = min(int(self.query.get('pageSize') or 10), CATALOG_PAGE_SIZE)
+
+        if self.query.get('identifiers'):
+            items = []
+            for identifier in self.query['identifiers'].split(','):
+                value = identifier.strip()
+                item = data.catalog_by_gtin.get(value.zfill(14)) if value.isdigit() else None
+                if item and item not in items:
+                    items.append(item)
+            return 200, {'numberOfResults': len(items), 'items': items, 'pagination': {}, 'refinements': {}}
+
+        keywords = self.query.get('keywords')
+        if not keywords:
+            return 400, {'errors': [{'code': 'InvalidInput',
+                                     'message': 'Either keywords or identifiers must be provided'}]}
+
+        words = [w for w in re.findall(r'[a-z0-9]+', keywords.lower())]
+        matched = None
+        for word in words:
+            asins = data.catalog_words.get(word, set())
+            matched = set(asins) if matched is None else matched & asins
+        ordered = sorted(matched or ())
+
+        offset = _decode_token(self.query['pageToken'])[0] if self.query.get('pageToken') else 0
+        page = [data.catalog_by_asin[asin] for asin in ordered[offset:offset + page_size]]
+        pagination = {}
+        if offset + page_size < len(ordered):
+            pagination['nextToken'] = _encode_token(offset + page_size)
+        if offset:
+            pagination['previousToken'] = _encode_token(max(offset - page_size, 0))
+        return 200, {'numberOfResults': len(ordered), 'items': page, 'pagination': pagination, 'refinements': {}}
+
+    def handle_catalog_item(self, asin):
+        item = self.state.data.catalog_by_asin.get(asin)
+        if item is None:
+            return 404, {'errors': [{'code': 'NotFound', 'message': f"Requested item '{asin}' not found"}]}
+        return 200, item
+
+    # --- Product Type Definitions ---
+
+    def handle_definitions_search(self):
+        keywords = (self.query.get('keywords') or '').lower()
+        product_types = [
+            {'name': WIPER_PRODUCT_TYPE, 'displayName': 'Windshield Wiper Blade', 'marketplaceIds': [MARKETPLACE_ID]},
+            {'name': 'AUTO_PART', 'displayName': 'Auto Part', 'marketplaceIds': [MARKETPLACE_ID]},
+            {'name': 'AUTO_ACCESSORY', 'displayName': 'Auto Accessory', 'marketplaceIds': [MARKETPLACE_ID]},
+        ]
+        if keywords:
+            product_types = [
+                pt for pt in product_types
+                if any(word in pt['displayName'].lower() or word in pt['name'].lower()
+                       for word in keywords.split(','))
+            ] or product_types
+        return 200, {'productTypes': product_types, 'productTypeVersion': 'LATEST'}
+
+    def handle_definition(self, product_type):
+        return 200, {
+            'metaSchema': {'link': {'resource': 'https://schemas.amazon.com/selling-partners/definitions/product-types/meta-schema/v1', 'verb': 'GET'},
+                           'checksum': 'stand-in'},
+            'schema': {'link': {'resource': f"{self._base_url()}/_schemas/{product_type}.json", 'verb': 'GET'},
+                       'checksum': 'stand-in'},
+            'requirements': self.query.get('requirements', 'LISTING'),
+            'requirementsEnforced': 'ENFORCED',
+            'propertyGroups': {
+                'offer': {'title': 'Offer', 'propertyNames': ['purchasable_offer', 'fulfillment_availability']},
+                'product_identity': {'title': 'Product Identity',
+                                     'propertyNames': ['item_name', 'brand', 'externally_assigned_product_identifier']},
+                'images': {'title': 'Images', 'propertyNames': ['main_product_image_locator']},
+            },
+            'locale': self.query.get('locale', 'en_US'),
+            'marketplaceIds': [MARKETPLACE_ID],
+            'productType': product_type,
+            'displayName': product_type.replace('_', ' ').title(),
+            'productTypeVersion': {'version': 'stand-in', 'latest': True, 'releaseCandidate': False},
+        }
+
+    def handle_schema_document(self, product_type):
+        schema = {
+            '$schema': 'https://schemas.amazon.com/selling-partners/definitions/product-types/meta-schema/v1',
+            'type': 'object',
+            'required': ['item_name', 'brand', 'externally_assigned_product_identifier', 'purchasable_offer'],
+            'properties': {
+                name: {'type': 'array', 'items': {'type': 'object'}}
+                for name in ('item_name', 'brand', 'externally_assigned_product_identifier', 'purchasable_offer',
+                             'fulfillment_availability', 'main_product_image_locator', 'bullet_point',
+                             'product_description', 'part_number')
+            },
+        }
+        return 200, schema
+
+    # --- Listings ---
+
+    def handle_listing_get(self, seller_id, sku):
+        listing = self.state.data.listings.get(sku)
+        if listing is None:
+            return 404, {'errors': [{'code': 'NOT_FOUND', 'message': f"SKU '{sku}' not found"}]}
+        return 200, {
+            'sku': sku,
+            'summaries': [{'marketplaceId': MARKETPLACE_ID, 'asin': listing['asin'], 'productType': WIPER_PRODUCT_TYPE,
+                           'conditionType': 'new_new', 'status': ['BUYABLE', 'DISCOVERABLE'],
+                           'itemName': listing['title']}],
+            'attributes': listing.get('attributes', {}),
+            'issues': [],
+        }
+
+    def handle_listing_put(self, seller_id, sku):
+        body = self._json_body()
+        with self.state.data.lock:
+            listing = self.state.data.listings.setdefault(
+                sku, {'sku': sku, 'asin': None, 'price': 0.0, 'quantity': 0, 'title': ''}
+            )
+            listing.setdefault('attributes', {}).update(body.get('attributes') or {})
+        return 200, {'sku': sku, 'status': 'ACCEPTED', 'submissionId': uuid.uuid4().hex, 'issues': []}
+
+    def handle_listing_delete(self, seller_id, sku):
+        with self.state.data.lock:
+            self.state.data.listings.pop(sku, None)
+        return 200, {'sku': sku, 'status': 'ACCEPTED', 'submissionId': uuid.uuid4().hex, 'issues': []}
+
+    # --- Feeds, Reports и документы ---
+
+    def _new_document(self, content: bytes = b'', content_type: str = 'text/xml', compress: bool = False) -> str:
+        document_id = f"amzn1.tortuga.4.na.{uuid.uuid4().hex}"
+        with self.state.data.lock:
+            self.state.data.documents[document_id] = {
+                'content': gzip.compress(content) if compress else content,
+                'content_type': content_type,
+                'compressed': compress,
+            }
+        return document_id
+
+    def _processing_status(self, created: float) -> str:
+        elapsed = time.monotonic() - created
+        processing = self.state.config.processing_seconds
+        if elapsed < processing / 2:
+            return 'IN_QUEUE'
+        if elapsed < processing:
+            return 'IN_PROGRESS'
+        return 'DONE'
+
+    def handle_feed_document_create(self):
+        body = self._json_body()
+        document_id = self._new_document(content_type=body.get('contentType', 'text/xml'))
+        return 201, {'feedDocumentId': document_id, 'url': f"{self._base_url()}/_uploads/{document_id}"}
+
+    def handle_document_upload(self, document_id):
+        with self.state.data.lock:
+            document = self.state.data.documents.get(document_id)
+            if document is None:
+                return 404, '<Error><Code>NoSuchKey</Code></Error>', {'Content-Type': 'application/xml'}
+            document['content'] = self.body
+        return 200, b''
+
+    def handle_document_download(self, document_id):
+        document = self.state.data.documents.get(document_id)
+        if document is None:
+            return 404, '<Error><Code>NoSuchKey</Code></Error>', {'Content-Type': 'application/xml'}
+        return 200, document['content'], {'Content-Type': document['content_type']}
+
+    def handle_document_get(self, document_id):
+        document = self.state.data.documents.get(document_id)
+        if document is None:
+            return 404, {'errors': [{'code': 'NotFound', 'message': f"Document {document_id} not found"}]}
+        response = {'url': f"{self._base_url()}/_documents/{document_id}"}
+        response['reportDocumentId' if self.path.startswith('/reports') else 'feedDocumentId'] = document_id
+        if document['compressed']:
+            response['compressionAlgorithm'] = 'GZIP'
+        return 200, response
+
+    def handle_feed_create(self):
+        body = self._json_body()
+        document = self.state.data.documents.get(body.get('inputFeedDocumentId'))
+        if not body.get('feedType') or document is None:
+            return 400, {'errors': [{'code': 'InvalidInput', 'message': 'feedType and a valid inputFeedDocumentId are required'}]}
+        feed_id = str(50000000000 + len(self.state.data.feeds))
+        with self.state.data.lock:
+            self.state.data.feeds[feed_id] = {
+                'feedType': body['feedType'],
+                'marketplaceIds': body.get('marketplaceIds', []),
+                'inputFeedDocumentId': body['inputFeedDocumentId'],
+                'created': time.monotonic(),
+                'createdTime': _iso(datetime.now(timezone.utc)),
+            }
+        return 202, {'feedId': feed_id}
+
+    def handle_feed_get(self, feed_id):
+        data = self.state.data
+        feed = data.feeds.get(feed_id)
+        if feed is None:
+            return 404, {'errors': [{'code': 'NotFound', 'message': f"Feed {feed_id} not found"}]}
+
+        status = self._processing_status(feed['created'])
+        response = {'feedId': feed_id, 'feedType': feed['feedType'], 'marketplaceIds': feed['marketplaceIds'],
+                    'createdTime': feed['createdTime'], 'processingStatus': status}
+        if status == 'DONE':
+            if 'resultFeedDocumentId' not in feed:
+                uploaded = data.documents[feed['inputFeedDocumentId']]['content']
+                messages = uploaded.count(b'<Message>')
+                report = (
+                    '<?xml version="1.0" encoding="UTF-8"?>\n<AmazonEnvelope><Header><DocumentVersion>1.02'
+                    '</DocumentVersion><MerchantIdentifier>' + SELLER_ID + '</MerchantIdentifier></Header>'
+                    '<MessageType>ProcessingReport</MessageType><Message><MessageID>1</MessageID>'
+                    '<ProcessingReport><DocumentTransactionID>' + feed_id + '</DocumentTransactionID>'
+                    '<StatusCode>Complete</StatusCode><ProcessingSummary>'
+                    f'<MessagesProcessed>{messages}</MessagesProcessed>'
+                    f'<MessagesSuccessful>{messages}</MessagesSuccessful>'
+                    '<MessagesWithError>0</MessagesWithError><MessagesWithWarning>0</MessagesWithWarning>'
+                    '</ProcessingSummary></ProcessingReport></Message></AmazonEnvelope>'
+                )
+                feed.setdefault('resultFeedDocumentId', self._new_document(report.encode('utf-8')))
+            response['resultFeedDocumentId'] = feed['resultFeedDocumentId']
+        return 200, response
+
+    def handle_report_create(self):
+        body = self._json_body()
+        if not body.get('reportType'):
+            return 400, {'errors': [{'code': 'InvalidInput', 'message': 'reportType is required'}]}
+        report_id = str(60000000000 + len(self.state.data.reports))
+        with self.state.data.lock:
+            self.state.data.reports[report_id] = {
+                'reportType': body['reportType'],
+                'marketplaceIds': body.get('marketplaceIds', []),
+                'created': time.monotonic(),
+                'createdTime': _iso(datetime.now(timezone.utc)),
+            }
+        return 202, {'reportId': report_id}
+
+    def handle_report_get(self, report_id):
+        data = self.state.data
+        report = data.reports.get(report_id)
+        if report is None:
+            return 404, {'errors': [{'code': 'NotFound', 'message': f"Report {report_id} not found"}]}
+
+        status = self._processing_status(report['created'])
+        response = {'reportId': report_id, 'reportType': report['reportType'],
+                    'marketplaceIds': report['marketplaceIds'], 'createdTime': report['createdTime'],
+                    'processingStatus': status}
+        if status == 'DONE':
+            if 'reportDocumentId' not in report:
+                if report['reportType'] == 'GET_MERCHANT_LISTINGS_ALL_DATA':
+                    content = data.listings_report()
+                else:
+                    content = 'sku\n'
+                report['reportDocumentId'] = self._new_document(content.encode('utf-8'), 'text/tab-separated-values',
+                                                                compress=True)
+            response['reportDocumentId'] = report['reportDocumentId']
+        return 200, response
+
+    # --- FBA и Orders ---
+
+    def handle_fba_summaries(self):
+        summaries = self.state.data.fba_summaries
+        since = self.query.get('startDateTime')
+        if since:
+            summaries = [s for s in summaries if s['lastUpdatedTime'] >= since]
+
+        offset = _decode_token(self.query['nextToken'])[0] if self.query.get('nextToken') else 0
+        page = summaries[offset:offset + FBA_PAGE_SIZE]
+        if self.query.get('details') != 'true':
+            page = [{k: v for k, v in s.items() if k != 'inventoryDetails'} for s in page]
+        response = {'payload': {'granularity': {'granularityType': 'Marketplace',
+                                                'granularityId': self.query.get('granularityId', MARKETPLACE_ID)},
+                                'inventorySummaries': page}}
+        if offset + FBA_PAGE_SIZE < len(summaries):
+            response['pagination'] = {'nextToken': _encode_token(offset + FBA_PAGE_SIZE, since or '')}
+        return 200, response
+
+    def handle_orders(self):
+        if self.query.get('NextToken'):
+            offset, since = _decode_token(self.query['NextToken'])
+        else:
+            offset, since = 0, self.query.get('LastUpdatedAfter') or self.query.get('CreatedAfter')
+            if not since:
+                return 400, {'errors': [{'code': 'InvalidInput',
+                                         'message': 'One of CreatedAfter or LastUpdatedAfter must be specified'}]}
+
+        orders = [order for order in self.state.data.orders if order['LastUpdateDate'] > since]
+        page = orders[offset:offset + ORDERS_PAGE_SIZE]
+        payload = {'Orders': page, 'LastUpdatedBefore': _iso(datetime.now(timezone.utc) - timedelta(minutes=2))}
+        if offset + ORDERS_PAGE_SIZE < len(orders):
+            payload['NextToken'] = _encode_token(offset + ORDERS_PAGE_SIZE, since)
+        return 200, {'payload': payload}
+
+    def handle_order_items(self, order_id):
+        items = self.state.data.order_items.get(order_id)
+        if items is None:
+            return 404, {'errors': [{'code': 'InvalidInput', 'message': f"Invalid AmazonOrderId {order_id}"}]}
+        return 200, {'payload': {'AmazonOrderId': order_id, 'OrderItems': items}}
+
+    # --- Shopify ---
+
+    def _shopify_page(self, collection: List, key: str, transform=None, cursor_filters: str = ''):
+        """Страница коллекции; cursor_filters зашиваются в page_info, как фильтры в Shopify"""
+        limit = min(int(self.query.get('limit') or 50), SHOPIFY_MAX_LIMIT)
+        offset = _decode_token(self.query['page_info'])[0] if self.query.get('page_info') else 0
+        page = collection[offset:offset + limit]
+        if transform:
+            page = [transform(item) for item in page]
+
+        headers = {}
+        if offset + limit < len(collection):
+            base = f"{self._base_url()}{urlsplit(self.path).path}"
+            next_query = {'limit': limit, 'page_info': _encode_token(offset + limit, cursor_filters)}
+            if self.query.get('fields'):
+                next_query['fields'] = self.query['fields']
+            headers['Link'] = f'<{base}?{urlencode(next_query)}>; rel="next"'
+        return 200, {key: page}, headers
+
+    def _shopify_fields(self, item: Dict) -> Dict:
+        fields = self.query.get('fields')
+        if not fields:
+            return item
+        wanted = set(fields.split(','))
+        return {k: v for k, v in item.items() if k in wanted}
+
+    def _with_image_urls(self, product: Dict) -> Dict:
+        base = self._base_url()
+        product = dict(product)
+        product['images'] = [dict(image, src=base + image['src']) for image in product['images']]
+        return product
+
+    def handle_shopify_products(self):
+        return self._shopify_page(self.state.data.products, 'products',
+                                  lambda product: self._shopify_fields(self._with_image_urls(product)))
+
+    def handle_shopify_product(self, product_id):
+        product = self.state.data.product_by_id.get(int(product_id))
+        if product is None:
+            return 404, {'errors': 'Not Found'}
+        return 200, {'product': self._with_image_urls(product)}
+
+    def handle_shopify_orders(self):
+        return self._shopify_page([], 'orders')
+
+    def handle_shopify_locations(self):
+        return 200, {'locations': self.state.data.locations}
+
+    def handle_shopify_inventory_levels(self):
+        data = self.state.data
+        # Следующие страницы несут только page_info - фильтры первой страницы зашиты в него
+        filters = self.query
+        if self.query.get('page_info'):
+            filters = dict(parse_qsl(_decode_token(self.query['page_info'])[1]))
+        location_ids = {int(x) for x in filters.get('location_ids', '').split(',') if x}
+        item_ids = {int(x) for x in filters.get('inventory_item_ids', '').split(',') if x}
+        # Как Shopify: без фильтра выгрузка всех остатков магазина не разрешена
+        if not location_ids and not item_ids:
+            return 422, {'errors': 'inventory_item_ids or location_ids must be specified'}
+        levels = [
+            {'inventory_item_id': item_id, 'location_id': location_id, 'available': available}
+            for (item_id, location_id), available in data.inventory_levels.items()
+            if (not location_ids or location_id in location_ids) and (not item_ids or item_id in item_ids)
+        ]
+        cursor_filters = urlencode({key: filters[key] for key in ('location_ids', 'inventory_item_ids')
+                                    if filters.get(key)})
+        return self._shopify_page(levels, 'inventory_levels', cursor_filters=cursor_filters)
+
+    def handle_shopify_graphql(self):
+        body = self._json_body()
+        query = body.get('query') or ''
+        variables = body.get('variables') or {}
+        data = self.state.data
+        cost = {'requestedQueryCost': 10, 'actualQueryCost': 10,
+                'throttleStatus': {'maximumAvailable': 1000.0, 'currentlyAvailable': 990, 'restoreRate': 50.0}}
+
+        if 'productVariants' in query:
+            # Значения в кавычках, \" и \\ внутри - экранированные символы (как в search syntax Shopify)
+            skus = [re.sub(r'\\(.)', r'\1', value)
+                    for value in re.findall(r'sku:"((?:[^"\\]|\\.)+)"', variables.get('query', ''))]
+            edges = [
+                {'node': {'id': f"gid://shopify/ProductVariant/{data.variants_by_sku[sku]['id']}", 'sku': sku,
+                          'inventoryItem': {'id': f"gid://shopify/InventoryItem/{data.variants_by_sku[sku]['inventory_item_id']}"}}}
+                for sku in skus if sku in data.variants_by_sku
+            ]
+            return 200, {'data': {'productVariants': {'edges': edges}}, 'extensions': {'cost': cost}}
+
+        if 'inventoryAdjustQuantities' in query:
+            changes = (variables.get('input') or {}).get('changes') or []
+            with data.lock:
+                for change in changes:
+                    item_id = int(str(change.get('inventoryItemId', '')).rsplit('/', 1)[-1] or 0)
+                    location_id = int(str(change.get('locationId', '')).rsplit('/', 1)[-1] or 0)
+                    key = (item_id, location_id)
+                    data.inventory_levels[key] = data.inventory_levels.get(key, 0) + int(change.get('delta') or 0)
+            return 200, {'data': {'inventoryAdjustQuantities': {
+                'inventoryAdjustmentGroup': {'id': f"gid://shopify/InventoryAdjustmentGroup/{uuid.uuid4().int % 10 ** 12}"},
+                'userErrors': []}}, 'extensions': {'cost': cost}}
+
+        return 200, {'errors': [{'message': 'Query not supported by stand-in server'}]}
+
+    # --- служебное ---
+
+    _image_cache: Optional[bytes] = None
+
+    def handle_image(self, name):
+        if StandInHandler._image_cache is None:
+            from PIL import Image
+            buffer = io.BytesIO()
+            Image.new('RGB', (1000, 1000), (255, 255, 255)).save(buffer, 'JPEG', quality=80)
+            StandInHandler._image_cache = buffer.getvalue()
+        return 200, StandInHandler._image_cache, {'Content-Type': 'image/jpeg'}
+
+    def handle_stats(self):
+        return 200, self.state.snapshot()
+
+
+class StandInServer:
+    """Сервер в фоновом потоке: для бенчмарков и прогонов из кода"""
+
+    def __init__(self, data: StandInData = None, config: StandInConfig = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.state = StandInState(data or StandInData(), config or StandInConfig())
+        handler = type('BoundStandInHandler', (StandInHandler,), {'state': self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environment(self) -> Dict[str, str]:
+        """Переменные окружения, переключающие клиентов проекта на этот сервер"""
+        environment = {
+            'SP_API_ENDPOINT': self.base_url,
+            'AMAZON_TOKEN_URL': f"{self.base_url}/auth/o2/token",
+            'SHOPIFY_BASE_URL': self.base_url,
+        }
+        if self.state.config.rate_scale != 1:
+            environment['SP_API_RATE_SCALE'] = f"{self.state.config.rate_scale:g}"
+        return environment
+
+    def start(self) -> 'StandInServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _parse_latency(values: List[str]) -> Dict[str, str]:
+    latency = {}
+    for value in values or []:
+        group, sep, spec = value.partition('=')
+        if not sep:
+            group, spec = 'default', value
+        LatencyModel(spec)
+        latency[group] = spec
+    return latency
+
+
+def main():
+    """Запуск локального stand-in сервера"""
+    parser = argparse.ArgumentParser(description='Локальная замена SP-API и Shopify для нагрузочных прогонов')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--products', type=int, default=200, help='Товаров в синтетическом каталоге')
+    parser.add_argument('--orders', type=int, default=100, help='Заказов Amazon')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency', action='append',
+                        help='Задержка: [группа=]распределение, группы lwa/sp/shopify/documents, '
+                             'например sp=lognormal:120,0.6 (можно несколько раз)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 500/503')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='Доля запросов без ответа')
+    parser.add_argument('--timeout-seconds', type=float, default=30.0, help='Сколько "висеть" перед обрывом')
+    parser.add_argument('--rate-scale', type=float, default=1.0, help='Множитель лимитов частоты')
+    parser.add_argument('--no-throttle', action='store_true', help='Не ограничивать частоту (без 429)')
+    parser.add_argument('--processing-seconds', type=float, default=DEFAULT_PROCESSING_SECONDS,
+                        help='Время обработки фидов и отчетов')
+    args = parser.parse_args()
+
+    config = StandInConfig(
+        latency=_parse_latency(args.latency),
+        error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_seconds=args.timeout_seconds,
+        rate_scale=args.rate_scale,
+        throttle=not args.no_throttle,
+        processing_seconds=args.processing_seconds,
+        seed=args.seed,
+    )
+
+    print("🧪 STAND-IN SERVER: SP-API + Shopify")
+    print("=" * 60)
+    data = StandInData(args.products, args.orders, args.seed)
+    server = StandInServer(data, config, args.host, args.port)
+    print(f"📦 Товаров: {len(data.products)}, ASIN: {len(data.catalog)}, FBA: {len(data.fba_summaries)}, "
+          f"заказов: {len(data.orders)}")
+    print(f"🌐 Слушаем {server.base_url}")
+    print("\n🔧 Переменные окружения для клиентов:")
+    for key, value in server.environment().items():
+        print(f"   export {key}={value}")
+    print("   export AMAZON_CLIENT_ID=stand-in AMAZON_CLIENT_SECRET=stand-in AMAZON_REFRESH_TOKEN=stand-in")
+    print("   export SHOPIFY_ACCESS_TOKEN=stand-in")
+    print(f"\n📊 Статистика: {server.base_url}/_stats")
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 Остановлен")
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Структурированное логирование для клиентов API и этапов конвейера
+
+- уровни стандартного logging; по умолчанию WARNING - штатная работа молчит
+- событие - короткий идентификатор ('sp_api.response'), данные - поля
+- поля-функции вычисляются только если запись действительно пишется:
+  log.debug('sp_api.response', keys=lambda: list(payload)) ничего не стоит на INFO
+- вывод текстом (key=value) или JSON-строками (LOG_FORMAT=json)
+- секреты не попадают в лог: поля с именами токенов/ключей заменяются на ***,
+  а LWA-токены, Bearer-заголовки и токены Shopify вырезаются из любых строк
+
+Настройка через окружение: LOG_LEVEL=DEBUG|INFO|WARNING|ERROR, LOG_FORMAT=text|json
+(или configure_logging() из кода).
+"""
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, TextIO
+
+ROOT_LOGGER_NAME = 'sync'
+DEFAULT_LEVEL = 'WARNING'
+DEFAULT_FORMAT = 'text'
+
+REDACTED = '***'
+
+# Имена полей/заголовков, значения которых никогда не пишутся
+SECRET_FIELDS = {
+    'access_token', 'refresh_token', 'client_secret', 'client_id', 'token', 'password', 'api_key',
+    'authorization', 'x-amz-access-token', 'x-shopify-access-token', 'shopify_access_token',
+}
+
+# Секреты внутри произвольного текста (тела ответов, сообщения исключений)
+SECRET_PATTERNS = re.compile(
+    r'(?P<prefix>Atz[ar]\||Bearer\s+|shp(?:at|ca|pa|ss)_)[^\s"\'&,;}]+'
+    r'|(?P<key>(?:access_token|refresh_token|client_secret)["\']?\s*[:=]\s*["\']?)[^\s"\'&,;}]+'
+)
+
+_configure_lock = threading.Lock()
+_configured = False
+
+
+def redact_text(text: str) -> str:
+    """Вырезает токены из строки, оставляя их тип (Atza|***, Bearer ***)"""
+    return SECRET_PATTERNS.sub(lambda m: (m.group('prefix') or m.group('key')) + REDACTED, text)
+
+
+def redact(value: Any, key: str = None) -> Any:
+    """Значение поля без секретов (рекурсивно для словарей и списков)"""
+    if key is not None and key.lower() in SECRET_FIELDS:
+        return REDACTED if value else value
+    if isinstance(value, str):
+        return redact_text(value)
+    if isinstance(value, dict):
+        return {k: redact(v, str(k)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+def _resolve_fields(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Вычисляет ленивые поля и вычищает секреты - только для записей, которые пишутся"""
+    resolved = {}
+    for key, value in fields.items():
+        if callable(value):
+            try:
+                value = value()
+            except Exception as e:
+                value = f"<ошибка вычисления поля: {e}>"
+        resolved[key] = redact(value, key)
+    return resolved
+
+
+class TextFormatter(logging.Formatter):
+    """12:00:01.123 WARNING sp_api sp_api.error status=429 url=..."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = _resolve_fields(getattr(record, 'fields', {}))
+        moment = datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]
+        parts = [moment, record.levelname, record.name.split('.', 1)[-1], redact_text(record.getMessage())]
+        for key, value in fields.items():
+            text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+            if isinstance(value, str) and (not value or any(c.isspace() for c in value)):
+                text = json.dumps(value, ensure_ascii=False)
+            parts.append(f"{key}={text}")
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + redact_text(self.formatException(record.exc_info))
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: ts, level, logger, event и поля"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name.split('.', 1)[-1],
+            'event': redact_text(record.getMessage()),
+        }
+        entry.update(_resolve_fields(getattr(record, 'fields', {})))
+        if record.exc_info:
+            entry['exception'] = redact_text(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = None, fmt: str = None, stream: TextIO = None) -> None:
+    """
+    Настраивает вывод логов проекта (повторный вызов заменяет настройки).
+
+    level/fmt по умолчанию берутся из LOG_LEVEL/LOG_FORMAT, stream - stderr,
+    чтобы логи не смешивались с выводом команд.
+    """
+    global _configured
+    level = (level or os.getenv('LOG_LEVEL') or DEFAULT_LEVEL).upper()
+    fmt = (fmt or os.getenv('LOG_FORMAT') or DEFAULT_FORMAT).lower()
+    if fmt not in ('text', 'json'):
+        raise ValueError(f"Неизвестный формат логов: {fmt} (text или json)")
+
+    with _configure_lock:
+        root = logging.getLogger(ROOT_LOGGER_NAME)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        handler = logging.StreamHandler(stream or sys.stderr)
+        handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+        root.addHandler(handler)
+        root.setLevel(level)
+        root.propagate = False
+        _configured = True
+
+
+class StructuredLogger:
+    """Логгер с полями: log.info('feed.submitted', feed_id=..., bytes=...)"""
+
+    def __init__(self, name: str, context: Dict[str, Any] = None):
+        self.name = name
+        self._logger = logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+        self._context = context or {}
+
+    def bind(self, **fields) -> 'StructuredLogger':
+        """Дочерний логгер, добавляющий поля ко всем записям (marketplace_id, sku, ...)"""
+        return StructuredLogger(self.name, {**self._context, **fields})
+
+    def enabled(self, level: int) -> bool:
+        if not _configured:
+            configure_logging()
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level: int, event: str, exc_info=None, **fields) -> None:
+        if not self.enabled(level):
+            return
+        if self._context:
+            fields = {**self._context, **fields}
+        self._logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+    def debug(self, event: str, **fields) -> None:
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event: str, **fields) -> None:
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event: str, **fields) -> None:
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event: str, **fields) -> None:
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event: str, **fields) -> None:
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    """Логгер модуля; настройки применяются при первой записи, а не при импорте"""
+    return StructuredLogger(name)
+
@@ -0,0 +1,860 @@
+# -*- coding: utf-8 -*-
+"""
+Демон синхронизации Shopify → Amazon с полосами приоритета
+
+    python src/sync_daemon.py --marketplaces USA UK --poll-interval 300
+    python src/cli.py daemon --once          # один опрос Shopify и разбор всех очередей
+
+Вместо разовых скриптов - один долгоживущий процесс:
+- раз в poll-interval забирает из Shopify товары, измененные с прошлого опроса,
+  и сравнивает с последним подтвержденным Amazon состоянием листинга
+  (MappingStore.listing_snapshots); разница превращается в задания
+- задания раскладываются по полосам: price_quantity (цена и остаток),
+  new_listing (новые листинги), content (контент и изображения); повторное
+  изменение того же SKU до отправки заменяет задание, а не добавляет второе
+- планировщик выбирает полосу взвешенным round robin (6:3:1 - цены и остатки
+  уходят первыми, но контент не голодает); запас токенов createFeed частично
+  закреплен за приоритетными полосами, а пачка заполняется до максимума типа
+  фида, прежде чем партиция делится на несколько фидов
+- пачка - один фид, собранный из фидов билдеров ShopifyToAmazonCreator
+  (MessageID по порядку); до max-in-flight фидов ждут обработки параллельно
+- клиенты, токен LWA, пулы соединений, курсы валют и кэш изображений живут в
+  памяти между циклами - без стартовой цены разовых скриптов
+- разбор товаров Shopify и рендер Product feed больших пачек идут в пуле
+  процессов (transform_pool, --transform-workers)
+
+Новый листинг сначала создается, и только после подтверждения Amazon следом
+ставятся цена, остаток и изображения (иначе Price/Inventory feed отклоняется).
+
+Каждое задание и каждая пачка проходят через журнал (job_journal) до следующего
+шага, поэтому после падения или SIGTERM новый запуск продолжает с того же места:
+невыполненные задания снова в очереди, уже созданные фиды не отправляются
+повторно - демон дожидается их отчета по feed_id.
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import signal
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+from amazon_feeds import AmazonFeedSubmitter, FeedWaitCancelled, parse_processing_report
+from create_sku_in_amazon import ShopifyToAmazonCreator
+from get_product_schema import AmazonProductSchemaClient
+from image_pipeline import ImagePipeline, build_image_feed
+from job_journal import JobJournal, new_id
+from mapping_store import MappingStore, utc_now
+from metrics import record_daemon_jobs, stage_timer
+from price_engine import PriceEngine
+from settings import load_settings
+from sp_api_router import get_router
+from structured_log import get_logger
+from transform_pool import TransformPool, map_record
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('daemon')
+
+# Полосы в порядке приоритета и их веса во взвешенном round robin
+LANE_WEIGHTS = OrderedDict([('price_quantity', 6), ('new_listing', 3), ('content', 1)])
+
+# Тип задания → (полоса, feedType, максимум сообщений в одном фиде)
+JOB_KINDS = {
+    'price': ('price_quantity', 'POST_PRODUCT_PRICING_DATA', 10000),
+    'quantity': ('price_quantity', 'POST_INVENTORY_AVAILABILITY_DATA', 10000),
+    'listing': ('new_listing', 'POST_PRODUCT_DATA', 1000),
+    'content': ('content', 'POST_PRODUCT_DATA', 1000),
+    'image': ('content', 'POST_PRODUCT_IMAGE_DATA', 1000),
+}
+
+# Лимит createFeed: 0.0083 req/s (burst 15) - общий для всех типов фидов продавца
+CREATE_FEED_RATE = (0.0083, 15)
+
+# Токены createFeed, которые полоса держит за собой: полосы с меньшим весом их не тратят.
+# Пополнение - один токен в 2 минуты, поэтому без резерва цена и остаток нового
+# листинга ждали бы, пока контент выберет весь burst
+LANE_RESERVE = {'price_quantity': 2, 'new_listing': 1}
+
+DEFAULT_POLL_INTERVAL = 300
+DEFAULT_MAX_IN_FLIGHT = 4
+# Replay dead letters: небольшие пачки, после неудачной пачки пауза растет вдвое до потолка
+DEFAULT_REPLAY_BATCH = 20
+DEFAULT_REPLAY_BACKOFF = 30
+MAX_REPLAY_BACKOFF = 900
+# Повторы пачки, которую Amazon не принял целиком (сеть, 5xx, FATAL)
+MAX_ATTEMPTS = 3
+# Пауза главного цикла, когда отправлять нечего или нет токена createFeed
+TICK_SECONDS = 1.0
+# Сколько при остановке ждать HTTP-запросов, уже начатых потоками фидов (ожидание обработки прерывается сразу)
+SHUTDOWN_GRACE_SECONDS = 30
+
+WATERMARK_KEY = 'daemon:products_updated_at'
+
+
+class SyncJob:
+    """Одно изменение листинга: тип, маркетплейс, SKU и данные для билдера"""
+
+    __slots__ = ('job_id', 'kind', 'marketplace', 'sku', 'payload', 'attempts', 'enqueued_at')
+
+    def __init__(self, kind: str, marketplace: str, sku: str, payload: Dict, job_id: str = None, attempts: int = 0):
+        self.job_id = job_id or new_id()
+        self.kind = kind
+        self.marketplace = marketplace
+        self.sku = sku
+        self.payload = payload
+        self.attempts = attempts
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def lane(self) -> str:
+        return JOB_KINDS[self.kind][0]
+
+
+class Lane:
+    """Очередь полосы: партиции (тип, маркетплейс) → SKU → последняя версия задания"""
+
+    def __init__(self, name: str, weight: int):
+        self.name = name
+        self.weight = weight
+        self.current = 0
+        self.partitions: Dict[Tuple[str, str], OrderedDict] = OrderedDict()
+
+    def __len__(self) -> int:
+        return sum(len(jobs) for jobs in self.partitions.values())
+
+    def put(self, job: SyncJob) -> Optional[SyncJob]:
+        """Ставит задание; возвращает замененное им еще не отправленное задание того же SKU"""
+        jobs = self.partitions.setdefault((job.kind, job.marketplace), OrderedDict())
+        previous = jobs.get(job.sku)
+        if previous is not None:
+            # Место в очереди и счетчик попыток остаются от первого задания
+            job.enqueued_at, job.attempts = previous.enqueued_at, previous.attempts
+        jobs[job.sku] = job
+        return previous
+
+    def oldest_partition(self) -> Tuple[str, str]:
+        """Партиция, чье первое задание ждет дольше всех"""
+        return min(self.partitions, key=lambda key: next(iter(self.partitions[key].values())).enqueued_at)
+
+    def take(self, key: Tuple[str, str], size: int) -> List[SyncJob]:
+        jobs = self.partitions[key]
+        batch = [jobs.popitem(last=False)[1] for _ in range(min(size, len(jobs)))]
+        if not jobs:
+            del self.partitions[key]
+        return batch
+
+
+class QuotaScheduler:
+    """
+    Какая полоса отправляет следующий фид и сколько в нем сообщений.
+
+    Полоса - smooth weighted round robin по непустым полосам, которым хватает
+    токенов createFeed сверх резерва полос с большим весом (LANE_RESERVE).
+    Пачка - партиция целиком, но не больше максимума сообщений типа фида:
+    каждый фид стоит токен, поэтому партиция делится, только если не влезает в один.
+    """
+
+    def __init__(self, lanes: List[Lane], bucket):
+        self.lanes = lanes
+        self.bucket = bucket
+
+    def has_work(self) -> bool:
+        return any(lane.partitions for lane in self.lanes)
+
+    def reserved_above(self, lane: Lane) -> int:
+        """Токены, которые полоса оставляет полосам с большим весом (хотя бы один токен ей доступен)"""
+        reserve = sum(LANE_RESERVE.get(other.name, 0) for other in self.lanes if other.weight > lane.weight)
+        return min(reserve, max(0, int(self.bucket.burst) - 1))
+
+    def next_lane(self) -> Optional[Lane]:
+        """Полоса следующего фида; None - токенов нет ни у одной полосы с заданиями"""
+        available = self.bucket.available()
+        active = [lane for lane in self.lanes if lane.partitions and available >= 1 + self.reserved_above(lane)]
+        if not active:
+            return None
+        for lane in active:
+            lane.current += lane.weight
+        chosen = max(active, key=lambda lane: lane.current)
+        chosen.current -= sum(lane.weight for lane in active)
+        return chosen
+
+    def batch_size(self, lane: Lane, key: Tuple[str, str]) -> int:
+        return min(len(lane.partitions[key]), JOB_KINDS[key[0]][2])
+
+
+def product_key(product_id) -> str:
+    """Ключ dead letter для товара, у которого еще нет SKU (не получен из Shopify или не разобран)"""
+    return f"shopify:{product_id}"
+
+
+def merge_feed_messages(documents: List[str]) -> str:
+    """Одиночные фиды билдеров ShopifyToAmazonCreator → один фид, MessageID по порядку"""
+    envelope = None
+    for document in documents:
+        root = ET.fromstring(document)
+        if envelope is None:
+            envelope = root
+        else:
+            envelope.extend(root.findall('Message'))
+    for message_id, message in enumerate(envelope.findall('Message'), 1):
+        message.find('MessageID').text = str(message_id)
+    return '<?xml version="1.0" encoding="utf-8"?>\n' + ET.tostring(envelope, encoding='unicode')
+
+
+def content_hash(product_data: Dict) -> str:
+    """Хэш полей, из которых строится Product feed (цена, остаток и изображения - отдельно)"""
+    main_variant = product_data['variants'][0]
+    fields = [product_data['title'], product_data['vendor'], product_data['product_type'],
+              product_data['description'], product_data.get('bullet_points', []), product_data['tags'],
+              main_variant.get('barcode'), main_variant.get('weight'), len(product_data['variants'])]
+    return hashlib.sha1(json.dumps(fields, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def images_hash(product_data: Dict) -> str:
+    sources = sorted((image.get('position') or 0, image['src']) for image in product_data['images'])
+    return hashlib.sha1(json.dumps(sources).encode('utf-8')).hexdigest()
+
+
+class SyncDaemon:
+    """Опрос Shopify, очереди по полосам и отправка фидов под квоту createFeed"""
+
+    def __init__(self, marketplaces: List[str], store: MappingStore, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 feed_poll_interval: float = 30, journal: JobJournal = None, transform_workers: int = None):
+        self.marketplaces = marketplaces
+        self.store = store
+        self.journal = journal or JobJournal()
+        self.poll_interval = poll_interval
+        self.max_in_flight = max_in_flight
+
+        # Все, что дорого создавать, создается один раз на процесс
+        self.creator = ShopifyToAmazonCreator()
+        self.stop_event = threading.Event()
+        self.feeds = AmazonFeedSubmitter(self.creator.amazon_client, poll_interval=feed_poll_interval,
+                                         stop_event=self.stop_event)
+        self.price_engine = PriceEngine(marketplaces)
+        self.images = ImagePipeline(store)
+        self.transform = TransformPool(transform_workers)
+        self.marketplace_ids = AmazonProductSchemaClient().marketplaces
+
+        self.lanes = OrderedDict((name, Lane(name, weight)) for name, weight in LANE_WEIGHTS.items())
+        bucket = get_router().limiter(self.creator.amazon_client.sandbox_url, 'createFeed', *CREATE_FEED_RATE)
+        self.scheduler = QuotaScheduler(list(self.lanes.values()), bucket)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='feed')
+        self.in_flight: Dict = {}
+        self.sending: Dict[Tuple[str, str, str], Dict] = {}
+        self.stats = {'polls': 0, 'feeds': 0, 'sent': 0, 'rejected': 0, 'retried': 0, 'dropped': 0, 'resumed': 0,
+                      'unmapped': 0}
+
+    # --- задания ---
+
+    def enqueue(self, jobs: List[SyncJob], journaled: bool = False) -> None:
+        """Ставит задания в полосы; journaled - задания уже в журнале (восстановлены после перезапуска)"""
+        # То же изменение уже в отправленном фиде (опрос до его подтверждения) - второй раз не ставим
+        jobs = [job for job in jobs if self.sending.get((job.kind, job.marketplace, job.sku)) != job.payload]
+        replaced = []
+        for job in jobs:
+            previous = self.lanes[job.lane].put(job)
+            if previous is not None:
+                replaced.append(previous.job_id)
+            record_daemon_jobs(job.lane, job.kind, 'replaced' if previous is not None else 'queued')
+        if jobs and not journaled:
+            self.journal.record_queued(jobs, replaced)
+
+    def pending(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def idle(self) -> bool:
+        return not self.pending() and not self.in_flight
+
+    def changes(self, marketplace: str, product_data: Dict, snapshot: Optional[Dict]) -> List[SyncJob]:
+        """Задания на разницу между товаром и подтвержденным состоянием листинга"""
+        main_variant = product_data['variants'][0]
+        sku = main_variant['sku']
+
+        if not snapshot or not snapshot.get('listed'):
+            return [SyncJob('listing', marketplace, sku, {'product': product_data})]
+
+        jobs = []
+        if str(main_variant['price']) != snapshot.get('price'):
+            jobs.append(SyncJob('price', marketplace, sku, {'price': str(main_variant['price'])}))
+        if int(main_variant['inventory_quantity'] or 0) != snapshot.get('quantity'):
+            jobs.append(SyncJob('quantity', marketplace, sku,
+                                {'quantity': int(main_variant['inventory_quantity'] or 0)}))
+        if content_hash(product_data) != snapshot.get('content'):
+            jobs.append(SyncJob('content', marketplace, sku, {'product': product_data}))
+        if images_hash(product_data) != snapshot.get('images'):
+            jobs.append(SyncJob('image', marketplace, sku, {'images': product_data['images'],
+                                                             'hash': images_hash(product_data)}))
+        return jobs
+
+    def map_product(self, product: Dict, marketplace: str) -> Optional[Dict]:
+        """Товар Shopify → product_data; товар, который не разобрать, уходит в dead letters"""
+        data, error = map_record(product, marketplace)
+        if error is None:
+            return data
+        self.unmapped(product, marketplace, error)
+        return None
+
+    def unmapped(self, product: Dict, marketplace: str, error: str) -> None:
+        self.journal.record_dead_letter('fetch', marketplace, product_key(product.get('id')),
+                                        {'product_id': product.get('id')}, error)
+        self.stats['unmapped'] += 1
+        log.warning('daemon.product_unmapped', product_id=product.get('id'), marketplace=marketplace, error=error)
+
+    def poll_shopify(self) -> int:
+        """Товары, измененные с прошлого опроса → задания; возвращает число товаров"""
+        since = self.store.get_state(WATERMARK_KEY)
+        started = utc_now()
+        endpoint = '/products.json?limit=250' + (f'&updated_at_min={since}' if since else '')
+
+        with stage_timer('fetch'):
+            products = list(self.creator.shopify_client.iter_pages(endpoint, 'products'))
+            fetch_error = self.creator.shopify_client.last_error
+
+        with stage_timer('map'):
+            for marketplace in self.marketplaces:
+                mapped = []
+                for product, (data, error) in zip(products, self.transform.map_products(products, marketplace)):
+                    if error is None:
+                        mapped.append((product['id'], data))
+                    else:
+                        self.unmapped(product, marketplace, error)
+                snapshots = self.store.get_listing_snapshots(
+                    marketplace, [data['variants'][0]['sku'] for _product_id, data in mapped])
+                self.enqueue([job for _product_id, data in mapped
+                              for job in self.changes(marketplace, data, snapshots.get(data['variants'][0]['sku']))])
+                self.journal.resolve_dead_letters([('fetch', marketplace, product_key(product_id))
+                                                   for product_id, _data in mapped])
+
+        self.stats['polls'] += 1
+        if fetch_error:
+            # iter_pages на ошибке страницы просто заканчивается: отметку не сдвигаем,
+            # следующий опрос заберет те же товары заново (дубли заданий схлопнутся в полосах)
+            log.warning('daemon.poll_incomplete', products=len(products), since=since, error=fetch_error)
+            return len(products)
+
+        # Задания уже в журнале - отметку можно сдвигать, не дожидаясь их отправки
+        self.store.set_state(WATERMARK_KEY, started)
+        log.info('daemon.polled', products=len(products), since=since, pending=self.pending(),
+                 lanes=lambda: {name: len(lane) for name, lane in self.lanes.items()})
+        return len(products)
+
+    def resume(self) -> None:
+        """Продолжает работу прошлого запуска по журналу"""
+        recovered = self.journal.recover()
+        # Задания и фиды других маркетплейсов остаются в журнале до запуска с этими маркетплейсами:
+        # их цены и фиды этот процесс не построит и не разберет
+        skipped = {
+            'queued': [row for row in recovered['queued'] if row['marketplace'] not in self.marketplaces],
+            'created': [batch for batch in recovered['created'] if batch['marketplace'] not in self.marketplaces],
+        }
+        recovered = {
+            'queued': [row for row in recovered['queued'] if row['marketplace'] in self.marketplaces],
+            'created': [batch for batch in recovered['created'] if batch['marketplace'] in self.marketplaces],
+        }
+        if skipped['queued'] or skipped['created']:
+            log.warning('daemon.resume_skipped', queued=len(skipped['queued']), feeds=len(skipped['created']),
+                        marketplaces=lambda: sorted({item['marketplace'] for items in skipped.values()
+                                                     for item in items}))
+
+        self.enqueue([SyncJob(row['kind'], row['marketplace'], row['sku'], row['payload'], row['job_id'],
+                              row['attempts']) for row in recovered['queued']], journaled=True)
+
+        for batch in recovered['created']:
+            jobs = [SyncJob(row['kind'], row['marketplace'], row['sku'], row['payload'], row['job_id'],
+                            row['attempts']) for row in batch['jobs']]
+            future = self.executor.submit(self._resume, batch['feed_id'])
+            self.in_flight[future] = (batch['batch_id'], batch['kind'], batch['marketplace'], jobs, batch['context'])
+            self.sending.update(((job.kind, job.marketplace, job.sku), job.payload) for job in jobs)
+
+        self.stats['resumed'] = len(recovered['queued']) + sum(len(batch['jobs']) for batch in recovered['created'])
+        if self.stats['resumed']:
+            log.info('daemon.resumed', queued=len(recovered['queued']), feeds=len(recovered['created']),
+                     feed_ids=lambda: [batch['feed_id'] for batch in recovered['created']])
+
+    # --- фиды ---
+
+    def build_feed(self, kind: str, marketplace: str, jobs: List[SyncJob]) -> Tuple[Optional[str], Dict]:
+        """XML фида пачки и контекст для разбора отчета; None - отправлять нечего"""
+        context = {}
+        # Билдеры печатают ход работы для ручного запуска - в демоне это шум
+        with contextlib.redirect_stdout(io.StringIO()):
+            if kind == 'price':
+                currency = self.price_engine.currency(marketplace)
+                decimals = self.price_engine.decimals(marketplace)
+                documents = [self.creator.create_amazon_price_feed(
+                    job.sku, self.price_engine.price_one(float(job.payload['price']), marketplace), currency, decimals)
+                    for job in jobs]
+            elif kind == 'quantity':
+                documents = [self.creator.create_amazon_inventory_feed(job.sku, job.payload['quantity'])
+                             for job in jobs]
+            elif kind in ('listing', 'content'):
+                # Самая тяжелая по CPU пачка: фрагменты рендерятся в пуле, MessageID уже по порядку
+                return self.transform.render_listing_feed([job.payload['product'] for job in jobs]), context
+            else:
+                # Update и Delete - от состояния, подтвержденного на этом маркетплейсе
+                result = self.images.process({job.sku: job.payload['images'] for job in jobs}, marketplace)
+                changed = [image for image in result['images'] if not image['issues']]
+                # Для mark_sent после отчета (в том числе после перезапуска) хватает sku, слота и хэша
+                context['images'] = {
+                    'changed': [{key: image[key] for key in ('sku', 'slot', 'content_hash')} for image in changed],
+                    'removed': result['removed'],
+                }
+                if not changed and not result['removed']:
+                    return None, context
+                return build_image_feed(changed, result['removed']), context
+
+        return merge_feed_messages(documents), context
+
+    def _submit(self, batch_id: str, feed_type: str, marketplace: str, xml: str) -> Optional[Dict]:
+        report = self.feeds.submit(feed_type, [self.marketplace_ids[marketplace]], xml.encode('utf-8'),
+                                   on_progress=lambda stage, value: self.journal.record_progress(batch_id, stage, value))
+        return parse_processing_report(report) if report is not None else None
+
+    def _resume(self, feed_id: str) -> Optional[Dict]:
+        report = self.feeds.resume(feed_id)
+        return parse_processing_report(report) if report is not None else None
+
+    def dispatch(self) -> int:
+        """Отправляет пачки, пока есть задания, свободные слоты и токены createFeed"""
+        dispatched = 0
+        while len(self.in_flight) < self.max_in_flight and self.scheduler.has_work():
+            lane = self.scheduler.next_lane()
+            if lane is None or not self.scheduler.bucket.try_acquire():
+                break
+            key = lane.oldest_partition()
+            size = self.scheduler.batch_size(lane, key)
+            jobs = lane.take(key, size)
+            kind, marketplace = key
+
+            batch_id = new_id()
+            try:
+                with stage_timer('build'):
+                    xml, context = self.build_feed(kind, marketplace, jobs)
+            except Exception as e:
+                self.build_failed(batch_id, kind, marketplace, jobs, e)
+                continue
+            if xml is None:
+                self.complete(None, kind, marketplace, jobs, context, {'results': []})
+                continue
+
+            self.journal.record_built(batch_id, kind, marketplace, JOB_KINDS[kind][1], jobs, context)
+            future = self.executor.submit(self._submit, batch_id, JOB_KINDS[kind][1], marketplace, xml)
+            self.in_flight[future] = (batch_id, kind, marketplace, jobs, context)
+            self.sending.update(((kind, marketplace, job.sku), job.payload) for job in jobs)
+            self.stats['feeds'] += 1
+            dispatched += 1
+            log.info('daemon.dispatched', lane=lane.name, kind=kind, marketplace=marketplace, jobs=len(jobs),
+                     bytes=len(xml), lane_pending=len(lane), in_flight=len(self.in_flight))
+        return dispatched
+
+    def reap(self) -> None:
+        """Разбирает завершенные фиды"""
+        for future in [future for future in self.in_flight if future.done()]:
+            batch_id, kind, marketplace, jobs, context = self.in_flight.pop(future)
+            for job in jobs:
+                if self.sending.get((kind, marketplace, job.sku)) is job.payload:
+                    del self.sending[(kind, marketplace, job.sku)]
+            try:
+                report = future.result()
+            except (FeedWaitCancelled, CancelledError):
+                # Остановка: пачка остается в журнале как есть - созданный фид следующий запуск
+                # дождется по feed_id, несозданный recover() вернет в очередь
+                log.info('daemon.feed_left', batch_id=batch_id, kind=kind, marketplace=marketplace, jobs=len(jobs))
+                continue
+            except Exception as e:
+                log.exception('daemon.feed_crashed', kind=kind, marketplace=marketplace, error=repr(e))
+                report = None
+            if report is None:
+                self.retry(batch_id, kind, jobs)
+            else:
+                self.complete(batch_id, kind, marketplace, jobs, context, report)
+
+    def build_failed(self, batch_id: str, kind: str, marketplace: str, jobs: List[SyncJob],
+                     error: Exception) -> None:
+        """
+        Фид пачки не собрался. Ошибка билдера обычно в данных одного SKU: задания
+        собираются по одному, несобираемые уходят в dead letters, остальные - обратно
+        в очередь. Если по одному собираются все - это обычный повтор пачки.
+        """
+        log.exception('daemon.build_failed', kind=kind, marketplace=marketplace, jobs=len(jobs), error=repr(error))
+        if len(jobs) == 1:
+            broken = [(jobs[0], f"build failed: {error!r}")]
+        else:
+            broken = []
+            for job in jobs:
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        self.build_feed(kind, marketplace, [job])
+                except Exception as e:
+                    broken.append((job, f"build failed: {e!r}"))
+        if not broken:
+            self.retry(batch_id, kind, jobs)
+            return
+
+        broken_ids = {job.job_id for job, _error in broken}
+        requeued = [job for job in jobs if job.job_id not in broken_ids]
+        self.journal.record_failed(batch_id, requeued, broken, 'build failed')
+        self.enqueue(requeued, journaled=True)
+
+        self.stats['dropped'] += len(broken)
+        record_daemon_jobs(JOB_KINDS[kind][0], kind, 'dropped', len(broken))
+
+    def retry(self, batch_id: str, kind: str, jobs: List[SyncJob]) -> None:
+        lane = JOB_KINDS[kind][0]
+        retried = [job for job in jobs if job.attempts + 1 < MAX_ATTEMPTS]
+        dropped = [(job, 'attempts exhausted') for job in jobs if job.attempts + 1 >= MAX_ATTEMPTS]
+        for job in retried:
+            job.attempts += 1
+        self.journal.record_failed(batch_id, retried, dropped, 'feed not processed')
+        self.enqueue(retried, journaled=True)
+
+        self.stats['retried'] += len(retried)
+        self.stats['dropped'] += len(dropped)
+        record_daemon_jobs(lane, kind, 'retried', len(retried))
+        if dropped:
+            record_daemon_jobs(lane, kind, 'dropped', len(dropped))
+        log.warning('daemon.feed_failed', kind=kind, batch_id=batch_id, jobs=len(jobs), retried=len(retried),
+                    dropped=len(dropped))
+
+    def complete(self, batch_id: Optional[str], kind: str, marketplace: str, jobs: List[SyncJob], context: Dict,
+                 report: Dict) -> None:
+        """Фид обработан: подтвержденные задания → снимок листинга, ошибки сообщений → журнал и лог"""
+        errors = {}
+        for result in report['results']:
+            if result['code'] != 'Error':
+                continue
+            sku = result['sku']
+            # Отчет об обработке может не указать SKU - тогда сообщение находится по MessageID
+            if not sku and kind != 'image' and result['message_id']:
+                index = int(result['message_id']) - 1
+                sku = jobs[index].sku if 0 <= index < len(jobs) else None
+            if sku:
+                errors.setdefault(sku, f"{result['message_code']}: {result['description']}")
+
+        accepted = [job for job in jobs if job.sku not in errors]
+        rejected = [(job, errors[job.sku]) for job in jobs if job.sku in errors]
+
+        updates, follow_ups = {}, []
+        for job in accepted:
+            if kind == 'price':
+                updates[job.sku] = {'price': job.payload['price']}
+            elif kind == 'quantity':
+                updates[job.sku] = {'quantity': job.payload['quantity']}
+            elif kind == 'content':
+                updates[job.sku] = {'content': content_hash(job.payload['product'])}
+            elif kind == 'image':
+                updates[job.sku] = {'images': job.payload['hash']}
+            else:
+                product = job.payload['product']
+                updates[job.sku] = {'listed': True, 'content': content_hash(product)}
+                # Цена, остаток и изображения - только для уже созданного листинга
+                follow_ups += self.changes(marketplace, product, updates[job.sku])
+        if updates:
+            self.store.save_listing_snapshots(marketplace, updates)
+        if 'images' in context and accepted:
+            # Отклоненные SKU не отмечаются: их повтор должен снова отправить и Update, и Delete
+            self.images.mark_sent(context['images'], marketplace, {job.sku for job, _error in rejected})
+        self.journal.record_finished(batch_id, accepted, rejected)
+        self.enqueue(follow_ups)
+
+        lane = JOB_KINDS[kind][0]
+        self.stats['sent'] += len(accepted)
+        self.stats['rejected'] += len(rejected)
+        record_daemon_jobs(lane, kind, 'sent', len(accepted))
+        if rejected:
+            record_daemon_jobs(lane, kind, 'rejected', len(rejected))
+            log.warning('daemon.jobs_rejected', kind=kind, marketplace=marketplace,
+                        skus=lambda: sorted(job.sku for job, _error in rejected)[:20], count=len(rejected))
+        log.info('daemon.feed_done', kind=kind, marketplace=marketplace, accepted=len(accepted),
+                 rejected=len(rejected))
+
+    # --- повтор dead letters ---
+
+    def fetch_product(self, product_id) -> Tuple[Optional[Dict], Optional[str]]:
+        """Один товар из Shopify: (товар, None) или (None, ошибка)"""
+        response = self.creator.shopify_client.make_api_request(f"/products/{product_id}.json")
+        if not response or 'product' not in response:
+            return None, self.creator.shopify_client.last_error or 'товар не найден в Shopify'
+        return response['product'], None
+
+    def replay_jobs(self, letters: List[Dict]) -> List[SyncJob]:
+        """Dead letters → задания; для fetch товар заново забирается из Shopify"""
+        jobs, resolved = [], []
+        for letter in letters:
+            marketplace = letter['marketplace']
+            if letter['kind'] != 'fetch':
+                jobs.append(SyncJob(letter['kind'], marketplace, letter['sku'], letter['payload'],
+                                    attempts=letter['attempts']))
+                continue
+
+            product, error = self.fetch_product(letter['payload']['product_id'])
+            if product is None:
+                self.journal.record_dead_letter('fetch', marketplace, letter['sku'], letter['payload'], error)
+                continue
+            data = self.map_product(product, marketplace)
+            if data is None:
+                continue
+            resolved.append(('fetch', marketplace, letter['sku']))
+            sku = data['variants'][0]['sku']
+            jobs += self.changes(marketplace, data, self.store.get_listing_snapshots(marketplace, [sku]).get(sku))
+        self.journal.resolve_dead_letters(resolved)
+        return jobs
+
+    def send_batch(self, kind: str, marketplace: str, jobs: List[SyncJob]) -> bool:
+        """Синхронно отправляет одну пачку; False - фид не обработан или Amazon отклонил сообщения"""
+        self.scheduler.bucket.acquire()
+        batch_id = new_id()
+        try:
+            with stage_timer('build'):
+                xml, context = self.build_feed(kind, marketplace, jobs)
+        except Exception as e:
+            self.build_failed(batch_id, kind, marketplace, jobs, e)
+            return False
+        if xml is None:
+            self.complete(None, kind, marketplace, jobs, context, {'results': []})
+            return True
+
+        self.journal.record_built(batch_id, kind, marketplace, JOB_KINDS[kind][1], jobs, context)
+        self.stats['feeds'] += 1
+        try:
+            report = self._submit(batch_id, JOB_KINDS[kind][1], marketplace, xml)
+        except FeedWaitCancelled:
+            # Фид создан - его отчет заберет следующий запуск демона через recover()
+            log.info('daemon.feed_left', batch_id=batch_id, kind=kind, marketplace=marketplace, jobs=len(jobs))
+            return False
+        except Exception as e:
+            log.exception('daemon.feed_crashed', kind=kind, marketplace=marketplace, error=repr(e))
+            report = None
+
+        if report is None:
+            # Повтор уже был - второй раз в полосы не ставим, задания возвращаются в dead letters
+            self.journal.record_failed(batch_id, [], [(job, 'feed not processed') for job in jobs],
+                                       'feed not processed')
+            self.stats['dropped'] += len(jobs)
+            record_daemon_jobs(JOB_KINDS[kind][0], kind, 'dropped', len(jobs))
+            return False
+
+        rejected = self.stats['rejected']
+        self.complete(batch_id, kind, marketplace, jobs, context, report)
+        return self.stats['rejected'] == rejected
+
+    def replay(self, letters: List[Dict], batch_size: int = DEFAULT_REPLAY_BATCH,
+               backoff: float = DEFAULT_REPLAY_BACKOFF) -> Dict:
+        """
+        Повторно отправляет только dead letters: пачками по batch_size, после
+        неудачной пачки пауза backoff, 2 * backoff, ... до MAX_REPLAY_BACKOFF.
+
+        Задания новых листингов, подтвержденных при повторе (цена, остаток,
+        изображения), уходят обычным порядком через полосы.
+        """
+        self._handle_signals()
+        self.journal.start_run({'replay': len(letters), 'batch_size': batch_size})
+
+        jobs = self.replay_jobs(letters)
+        # Задания в журнале: если повтор прервется, их продолжит следующий запуск демона
+        self.journal.record_queued(jobs)
+
+        partitions = OrderedDict()
+        for job in jobs:
+            partitions.setdefault((job.kind, job.marketplace), []).append(job)
+
+        delay = 0.0
+        for (kind, marketplace), partition in partitions.items():
+            for start in range(0, len(partition), batch_size):
+                if delay and self.stop_event.wait(delay):
+                    break
+                if self.stop_event.is_set():
+                    break
+                batch = partition[start:start + batch_size]
+                if self.send_batch(kind, marketplace, batch):
+                    delay = 0.0
+                else:
+                    delay = min(max(delay * 2, backoff), MAX_REPLAY_BACKOFF)
+                    log.warning('daemon.replay_backoff', kind=kind, marketplace=marketplace, jobs=len(batch),
+                                delay=delay)
+
+        self.drain()
+        self.shutdown()
+        self.journal.finish_run(self.stats)
+        log.info('daemon.replayed', letters=len(letters), jobs=len(jobs), **self.stats)
+        return self.stats
+
+    # --- главный цикл ---
+
+    def stop(self, *_args) -> None:
+        self.stop_event.set()
+
+    def shutdown(self) -> None:
+        """
+        Освобождает потоки фидов и пул процессов.
+
+        После stop() ожидание обработки фидов уже прервано: созданные фиды остаются
+        в журнале и продолжаются следующим запуском, поэтому ждем только HTTP-запросы,
+        которые потоки успели начать, и не дольше SHUTDOWN_GRACE_SECONDS.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.in_flight:
+            wait(list(self.in_flight), timeout=SHUTDOWN_GRACE_SECONDS)
+        self.reap()
+        if self.in_flight:
+            log.warning('daemon.shutdown_timeout', in_flight=len(self.in_flight))
+        self.transform.close()
+
+    def _handle_signals(self) -> None:
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+    def drain(self) -> None:
+        """Разбирает очереди без опроса Shopify, пока есть задания или фиды в работе"""
+        while not self.stop_event.is_set() and not self.idle():
+            self.reap()
+            if self.dispatch():
+                continue
+            if self.in_flight:
+                wait(list(self.in_flight), timeout=TICK_SECONDS, return_when=FIRST_COMPLETED)
+            elif self.pending():
+                self.stop_event.wait(TICK_SECONDS)
+
+    def run(self, once: bool = False) -> Dict:
+        """Работает до SIGTERM/SIGINT; once - один опрос Shopify и разбор всех очередей"""
+        self._handle_signals()
+
+        self.journal.start_run({'marketplaces': self.marketplaces, 'once': once})
+        self.resume()
+
+        next_poll = 0.0
+        while not self.stop_event.is_set():
+            if time.monotonic() >= next_poll and not (once and self.stats['polls']):
+                try:
+                    self.poll_shopify()
+                except Exception as e:
+                    log.exception('daemon.poll_failed', error=repr(e))
+                next_poll = time.monotonic() + self.poll_interval
+
+            self.reap()
+            dispatched = self.dispatch()
+
+            if once and self.idle():
+                break
+            if dispatched:
+                continue
+            if self.in_flight:
+                # Просыпаемся сразу, как только какой-то фид обработан
+                wait(list(self.in_flight), timeout=TICK_SECONDS, return_when=FIRST_COMPLETED)
+            else:
+                self.stop_event.wait(TICK_SECONDS)
+
+        # Фиды в обработке и задания в очередях уже в журнале - их подхватит следующий запуск
+        self.shutdown()
+        self.journal.finish_run(self.stats)
+        log.info('daemon.stopped', pending=self.pending(), **self.stats)
+        return self.stats
+
+
+def main():
+    """Запуск демона синхронизации"""
+    parser = argparse.ArgumentParser(description='Демон синхронизации Shopify → Amazon с полосами приоритета')
+    parser.add_argument('--marketplaces', nargs='+', default=['USA'],
+                        help='Названия маркетплейсов (USA, UK, AUSTRALIA, ...), по умолчанию USA')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help='Пауза между опросами Shopify, сек')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+                        help='Сколько фидов одновременно ждут обработки')
+    parser.add_argument('--feed-poll-interval', type=float, default=30, help='Пауза между опросами статуса фида, сек')
+    parser.add_argument('--once', action='store_true', help='Один опрос Shopify, разбор очередей и выход')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    parser.add_argument('--journal', help='Путь к SQLite журналу заданий (SYNC_JOURNAL_PATH)')
+    parser.add_argument('--transform-workers', type=int,
+                        help='Процессов для разбора товаров и рендера фидов (TRANSFORM_WORKERS, по умолчанию ядер - 1)')
+    args = parser.parse_args()
+
+    print("🔁 SYNC DAEMON: Shopify → Amazon")
+    print("=" * 60)
+
+    names = [name.upper() for name in args.marketplaces]
+    unknown = [name for name in names if name not in AmazonProductSchemaClient().marketplaces]
+    if unknown:
+        print(f"❌ Неизвестные маркетплейсы: {unknown}")
+        return
+
+    store = MappingStore(args.store)
+    journal = JobJournal(args.journal)
+    daemon = SyncDaemon(names, store, args.poll_interval, args.max_in_flight,
+                        args.feed_poll_interval, journal, args.transform_workers)
+    print(f"📡 Маркетплейсы: {', '.join(names)}, опрос каждые {args.poll_interval:g} сек")
+    stats = daemon.run(once=args.once)
+
+    print("\n📊 ИТОГО:")
+    print("-" * 40)
+    print(f"   🔄 Опросов Shopify: {stats['polls']}, фидов: {stats['feeds']}")
+    print(f"   ✅ Отправлено: {stats['sent']}, ❌ отклонено Amazon: {stats['rejected']}")
+    print(f"   🔁 Повторов: {stats['retried']}, 🗑️  брошено: {stats['dropped']}")
+    if stats['resumed']:
+        print(f"   ⏯️  Продолжено заданий прошлого запуска: {stats['resumed']}")
+    dead_letters = journal.summary()['dead_letters']
+    if dead_letters:
+        print(f"   📮 Dead letters: {dead_letters} - повтор: python src/cli.py replay")
+    journal.close()
+    store.close()
+
+
+def replay_main():
+    """Повтор только заданий из dead letters"""
+    parser = argparse.ArgumentParser(description='Повторная отправка заданий из dead letters')
+    parser.add_argument('--marketplaces', nargs='+', help='Только эти маркетплейсы (USA, UK, ...)')
+    parser.add_argument('--kinds', nargs='+', choices=sorted(JOB_KINDS) + ['fetch'], help='Только эти типы заданий')
+    parser.add_argument('--skus', nargs='+', help='Только эти SKU')
+    parser.add_argument('--limit', type=int, help='Не больше N записей (самые старые первыми)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_REPLAY_BATCH, help='Сообщений в одном фиде')
+    parser.add_argument('--backoff', type=float, default=DEFAULT_REPLAY_BACKOFF,
+                        help='Пауза после неудачной пачки, сек (удваивается до %d)' % MAX_REPLAY_BACKOFF)
+    parser.add_argument('--feed-poll-interval', type=float, default=30, help='Пауза между опросами статуса фида, сек')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    parser.add_argument('--journal', help='Путь к SQLite журналу заданий (SYNC_JOURNAL_PATH)')
+    args = parser.parse_args()
+
+    print("📮 REPLAY: повтор dead letters")
+    print("=" * 60)
+
+    journal = JobJournal(args.journal)
+    letters = journal.dead_letters(args.kinds, [name.upper() for name in args.marketplaces or []],
+                                   args.skus, args.limit)
+    if not letters:
+        print("✅ Dead letters нет - повторять нечего")
+        journal.close()
+        return
+
+    keys = {(letter['kind'], letter['marketplace'], letter['sku']) for letter in letters}
+    names = sorted({letter['marketplace'] for letter in letters})
+    print(f"📋 Записей: {len(letters)}, маркетплейсы: {', '.join(names)}, пачки по {args.batch_size}")
+
+    store = MappingStore(args.store)
+    daemon = SyncDaemon(names, store, max_in_flight=1, feed_poll_interval=args.feed_poll_interval, journal=journal)
+    stats = daemon.replay(letters, args.batch_size, args.backoff)
+
+    remaining = [letter for letter in journal.dead_letters(args.kinds, names, args.skus)
+                 if (letter['kind'], letter['marketplace'], letter['sku']) in keys]
+    print("\n📊 ИТОГО:")
+    print("-" * 40)
+    print(f"   📦 Фидов: {stats['feeds']}, ✅ отправлено: {stats['sent']}")
+    print(f"   ✅ Исправлено: {len(keys) - len(remaining)} из {len(keys)}")
+    for letter in remaining[:20]:
+        print(f"   ❌ {letter['kind']}/{letter['marketplace']} {letter['sku']} "
+              f"(попыток {letter['attempts']}): {(letter['error'] or '')[:120]}")
+    journal.close()
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,39 @@
 # -*- coding: utf-8 -*-
 import os
+import time
 import requests
 import json
 import hashlib
 import hmac
 import base64
 from datetime import datetime
-from typing import Dict, Optional
-from dotenv import load_dotenv
+from typing import Dict, Iterator, Optional
+from settings import load_settings
 from urllib.parse import urlencode, quote
+from sp_api_router import endpoint_for, get_router
+from structured_log import configure_logging, get_logger
+from metrics import observe_http, observe_response, operation_name, record_retry, record_token_refresh
+from tracing import http_span
+from http_cassette import install_from_env
+from profiling import profile_main
 
 # Load environment variables
-load_dotenv()
+load_settings()
+
+# HTTP_CASSETTE: запросы клиентов пишутся в кассету или воспроизводятся из нее (http_cassette)
+install_from_env()
+
+sp_api_log = get_logger('sp_api')
+shopify_log = get_logger('shopify')
+
+# Токен LWA живет час; обновляем заранее, чтобы долгие процессы (демон) не ловили 403
+TOKEN_REFRESH_MARGIN = 60
+
+# Shopify: таймаут запроса и повторы страницы при 429/5xx/обрыве соединения
+SHOPIFY_TIMEOUT = 30
+SHOPIFY_PAGE_ATTEMPTS = 5
+# REST bucket Shopify утекает со скоростью 2 запроса/сек - у полного bucket ждем одну утечку
+SHOPIFY_LEAK_SECONDS = 0.5
 
 class AmazonSandboxClient:
     """Amazon Selling Partner API Sandbox Client with detailed logging"""
@@ -20,15 +42,15 @@ class AmazonSandboxClient:
         self.client_id = os.getenv('AMAZON_CLIENT_ID')
         self.client_secret = os.getenv('AMAZON_CLIENT_SECRET')
         self.refresh_token = os.getenv('AMAZON_REFRESH_TOKEN')
-        self.sandbox_url = "https://sandbox.sellingpartnerapi-na.amazon.com"
-        self.token_url = "https://api.amazon.com/auth/o2/token"
+        self.sandbox_url = endpoint_for('ATVPDKIKX0DER', sandbox=True)
+        self.token_url = os.getenv('AMAZON_TOKEN_URL', "https://api.amazon.com/auth/o2/token")
         self.access_token = None
+        self.token_expires_at = None
     
     def get_access_token(self) -> Optional[str]:
         """Get access token using refresh token"""
-        print("🔑 Запрашиваем access token у Amazon...")
-        print(f"   Client ID: {self.client_id[:20]}...")
-        print(f"   Refresh Token: {self.refresh_token[:30] if self.refresh_token else 'НЕ НАЙДЕН'}...")
+        sp_api_log.info('lwa.token.request', token_url=self.token_url, client_id=self.client_id,
+                        has_refresh_token=bool(self.refresh_token))
         
         try:
             token_data = {
@@ -38,42 +60,43 @@ class AmazonSandboxClient:
                 'client_secret': self.client_secret
             }
             
-            response = requests.post(self.token_url, data=token_data)
-            print(f"   Статус ответа: {response.status_code}")
+            started = time.perf_counter()
+            with http_span('lwa', 'POST', self.token_url) as token_span:
+                response = requests.post(self.token_url, data=token_data)
+                token_span.set(**{'http.status_code': response.status_code})
             
             if response.status_code != 200:
-                print(f"   ❌ Ошибка получения токена: {response.text}")
+                record_token_refresh('failed', time.perf_counter() - started)
+                sp_api_log.error('lwa.token.failed', status=response.status_code, body=lambda: response.text[:500])
                 return None
-                
-            response.raise_for_status()
             
             token_response = response.json()
             self.access_token = token_response['access_token']
+            self.token_expires_at = (time.monotonic() + int(token_response.get('expires_in') or 3600)
+                                     - TOKEN_REFRESH_MARGIN)
+            record_token_refresh('ok', time.perf_counter() - started)
             
-            expires_in = token_response.get('expires_in', 'неизвестно')
-            token_type = token_response.get('token_type', 'Bearer')
-            
-            print(f"   ✅ Токен получен успешно!")
-            print(f"   Тип токена: {token_type}")
-            print(f"   Время действия: {expires_in} секунд")
-            print(f"   Access token: {self.access_token[:50]}...")
+            sp_api_log.info('lwa.token.ok', token_type=token_response.get('token_type', 'Bearer'),
+                            expires_in=token_response.get('expires_in'))
             
             return self.access_token
             
         except requests.exceptions.RequestException as e:
-            print(f"   ❌ Ошибка сети при получении токена: {e}")
+            record_token_refresh('error', time.perf_counter() - started)
+            sp_api_log.error('lwa.token.network_error', error=str(e))
             return None
-        except KeyError as e:
-            print(f"   ❌ Отсутствует ключ в ответе: {e}")
-            print(f"   Полный ответ: {response.text if 'response' in locals() else 'Нет ответа'}")
+        except (KeyError, ValueError) as e:
+            record_token_refresh('error', time.perf_counter() - started)
+            sp_api_log.error('lwa.token.bad_response', error=repr(e), body=lambda: response.text[:500])
             return None
     
-    def make_api_request(self, endpoint: str, method: str = 'GET', data: Dict = None, params: Dict = None) -> Optional[Dict]:
-        """Make authenticated API request to Amazon with proper headers"""
-        if not self.access_token:
-            print("⚠️  Access token отсутствует, получаем новый...")
+    def make_api_request(self, endpoint: str, method: str = 'GET', data: Dict = None, params: Dict = None,
+                         base_url: str = None) -> Optional[Dict]:
+        """Make authenticated API request to Amazon with proper headers (base_url overrides the sandbox host)"""
+        if not self.access_token or (self.token_expires_at and time.monotonic() >= self.token_expires_at):
+            sp_api_log.debug('sp_api.token.missing')
             if not self.get_access_token():
-                print("❌ Не удалось получить access token")
+                sp_api_log.error('sp_api.token.unavailable', endpoint=endpoint)
                 return None
         
         headers = {
@@ -84,48 +107,52 @@ class AmazonSandboxClient:
             'User-Agent': 'shopify-amazon-integration/1.0'
         }
         
-        url = f"{self.sandbox_url}{endpoint}"
+        base_url = base_url or self.sandbox_url
+        url = f"{base_url}{endpoint}"
+        # У каждого регионального хоста свой пул соединений
+        session = get_router().session(base_url)
         
-        print(f"📡 Отправляем запрос к Amazon API:")
-        print(f"   URL: {url}")
-        print(f"   Метод: {method}")
-        print(f"   Заголовки: Authorization=Bearer ..., x-amz-access-token=...")
-        if params:
-            print(f"   Параметры: {params}")
+        sp_api_log.debug('sp_api.request', method=method, url=url, params=params)
         
+        started = time.perf_counter()
         try:
-            if method.upper() == 'GET':
-                response = requests.get(url, headers=headers, params=params)
-            elif method.upper() == 'POST':
-                response = requests.post(url, headers=headers, json=data, params=params)
-            else:
-                print(f"❌ Неподдерживаемый HTTP метод: {method}")
-                return None
-            
-            print(f"📨 Получен ответ:")
-            print(f"   Полный URL запроса: {response.url}")
-            print(f"   Статус ответа: {response.status_code}")
-            print(f"   Размер ответа: {len(response.content)} байт")
+            with http_span('sp_api', method, url, operation=operation_name(url)) as request_span:
+                if method.upper() == 'GET':
+                    response = session.get(url, headers=headers, params=params)
+                elif method.upper() == 'POST':
+                    response = session.post(url, headers=headers, json=data, params=params)
+                else:
+                    sp_api_log.error('sp_api.unsupported_method', method=method, url=url)
+                    return None
+                request_span.set(**{'http.status_code': response.status_code,
+                                    'request_id': response.headers.get('x-amzn-RequestId')})
+                if response.status_code >= 300:
+                    request_span.fail(f"HTTP {response.status_code}")
+            observe_response('sp_api', response, time.perf_counter() - started)
             
-            if response.status_code == 200:
-                print("   ✅ Запрос выполнен успешно!")
+            # createReport/createFeed отвечают 202 Accepted
+            if 200 <= response.status_code < 300:
                 try:
                     json_response = response.json()
-                    print(f"   Структура ответа: {list(json_response.keys()) if isinstance(json_response, dict) else 'Не JSON объект'}")
-                    return json_response
                 except json.JSONDecodeError:
-                    print("   ⚠️  Ответ не является валидным JSON")
-                    print(f"   Содержимое: {response.text[:200]}...")
+                    sp_api_log.warning('sp_api.invalid_json', method=method, url=response.url,
+                                       status=response.status_code, body=lambda: response.text[:200])
                     return None
-            else:
-                print(f"   ❌ API запрос завершился с ошибкой {response.status_code}")
-                print(f"   Ответ сервера: {response.text}")
-                return None
+                sp_api_log.debug('sp_api.response', method=method, url=response.url, status=response.status_code,
+                                 bytes=len(response.content),
+                                 elapsed_ms=lambda: round(response.elapsed.total_seconds() * 1000, 1),
+                                 keys=lambda: list(json_response) if isinstance(json_response, dict) else None)
+                return json_response
+            
+            sp_api_log.warning('sp_api.error', method=method, url=response.url, status=response.status_code,
+                               request_id=response.headers.get('x-amzn-RequestId'),
+                               body=lambda: response.text[:1000])
+            return None
             
         except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка при выполнении запроса: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                print(f"   Ответ сервера: {e.response.text}")
+            observe_http('sp_api', method, url, 'error', time.perf_counter() - started)
+            sp_api_log.error('sp_api.network_error', method=method, url=url, error=str(e),
+                             body=lambda: e.response.text[:1000] if e.response is not None else None)
             return None
     
     def test_marketplace_participation(self) -> bool:
@@ -302,10 +329,15 @@ class ShopifyClient:
         self.shop_domain = os.getenv('SHOPIFY_SHOP_DOMAIN')
         self.access_token = os.getenv('SHOPIFY_ACCESS_TOKEN')
         self.api_version = os.getenv('SHOPIFY_API_VERSION', '2023-10')
-        self.base_url = f"https://{self.shop_domain}.myshopify.com/admin/api/{self.api_version}"
+        # SHOPIFY_BASE_URL подменяет https://<shop>.myshopify.com (например, на stand_in_server)
+        shop_url = os.getenv('SHOPIFY_BASE_URL') or f"https://{self.shop_domain}.myshopify.com"
+        self.base_url = f"{shop_url.rstrip('/')}/admin/api/{self.api_version}"
+        # Причина последнего None из make_api_request / обрыва iter_pages (для dead letters)
+        self.last_error: Optional[str] = None
     
     def make_api_request(self, endpoint: str, method: str = 'GET', data: Dict = None) -> Optional[Dict]:
         """Make authenticated API request to Shopify"""
+        self.last_error = None
         headers = {
             'X-Shopify-Access-Token': self.access_token,
             'Content-Type': 'application/json'
@@ -313,26 +345,142 @@ class ShopifyClient:
         
         url = f"{self.base_url}{endpoint}"
         
+        started = time.perf_counter()
+        response = None
         try:
-            if method.upper() == 'GET':
-                response = requests.get(url, headers=headers)
-            elif method.upper() == 'POST':
-                response = requests.post(url, headers=headers, json=data)
-            elif method.upper() == 'PUT':
-                response = requests.put(url, headers=headers, json=data)
-            else:
-                print(f"Неподдерживаемый HTTP метод: {method}")
-                return None
+            with http_span('shopify', method, url, operation=operation_name(url)) as request_span:
+                if method.upper() == 'GET':
+                    response = requests.get(url, headers=headers, timeout=SHOPIFY_TIMEOUT)
+                elif method.upper() == 'POST':
+                    response = requests.post(url, headers=headers, json=data, timeout=SHOPIFY_TIMEOUT)
+                elif method.upper() == 'PUT':
+                    response = requests.put(url, headers=headers, json=data, timeout=SHOPIFY_TIMEOUT)
+                else:
+                    shopify_log.error('shopify.unsupported_method', method=method, url=url)
+                    self.last_error = f"unsupported method {method}"
+                    return None
+                request_span.set(**{'http.status_code': response.status_code})
+                if response.status_code >= 300:
+                    request_span.fail(f"HTTP {response.status_code}")
+            observe_response('shopify', response, time.perf_counter() - started)
             
             response.raise_for_status()
+            shopify_log.debug('shopify.response', method=method, url=url, status=response.status_code,
+                              bytes=len(response.content),
+                              call_limit=response.headers.get('X-Shopify-Shop-Api-Call-Limit'))
             return response.json()
             
         except requests.exceptions.RequestException as e:
-            print(f"Shopify API запрос завершился с ошибкой: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                print(f"Ответ сервера: {e.response.text}")
+            if response is None:
+                observe_http('shopify', method, url, 'error', time.perf_counter() - started)
+            shopify_log.error('shopify.request_failed', method=method, url=url, error=str(e),
+                              body=lambda: e.response.text[:1000] if e.response is not None else None)
+            self.last_error = str(e)
             return None
-    
+
+    def graphql(self, query: str, variables: Dict = None) -> Optional[Dict]:
+        """Выполняет запрос к Shopify Admin GraphQL API, возвращает data или None"""
+        response = self.make_api_request('/graphql.json', method='POST',
+                                          data={'query': query, 'variables': variables or {}})
+        if response is None:
+            return None
+
+        if response.get('errors'):
+            shopify_log.error('shopify.graphql_errors', errors=response['errors'])
+            return None
+
+        return response.get('data')
+
+    def iter_pages(self, endpoint: str, collection_key: str) -> Iterator[Dict]:
+        """
+        Постранично обходит коллекцию Shopify (cursor pagination через заголовок Link)
+        и отдает элементы по одному, не держа весь каталог в памяти
+        """
+        headers = {
+            'X-Shopify-Access-Token': self.access_token,
+            'Content-Type': 'application/json'
+        }
+
+        url = f"{self.base_url}{endpoint}"
+        # Обрыв на середине выглядит как конец коллекции - вызывающий проверяет last_error
+        self.last_error = None
+
+        while url:
+            response = self._get_page(url, headers)
+            if response is None:
+                return
+
+            try:
+                items = response.json().get(collection_key, [])
+            except ValueError as e:
+                shopify_log.error('shopify.page_invalid_json', url=url, error=str(e),
+                                  body=lambda: response.text[:1000])
+                self.last_error = f"invalid JSON: {e}"
+                return
+
+            for item in items:
+                yield item
+
+            # Следующая страница приходит в Link: <...page_info=...>; rel="next"
+            url = response.links.get('next', {}).get('url')
+
+    def _get_page(self, url: str, headers: Dict) -> Optional[requests.Response]:
+        """
+        GET страницы с повторами: 429 ждет Retry-After, 5xx и обрыв соединения -
+        экспоненциальную паузу. Почти полный bucket (X-Shopify-Shop-Api-Call-Limit)
+        притормаживает следующий запрос, чтобы не доводить до 429.
+        """
+        for attempt in range(1, SHOPIFY_PAGE_ATTEMPTS + 1):
+            started = time.perf_counter()
+            response = None
+            try:
+                with http_span('shopify', 'GET', url, operation=operation_name(url)) as request_span:
+                    response = requests.get(url, headers=headers, timeout=SHOPIFY_TIMEOUT)
+                    request_span.set(**{'http.status_code': response.status_code})
+                    if response.status_code >= 300:
+                        request_span.fail(f"HTTP {response.status_code}")
+                observe_response('shopify', response, time.perf_counter() - started)
+                retryable = response.status_code == 429 or response.status_code >= 500
+                if not retryable or attempt == SHOPIFY_PAGE_ATTEMPTS:
+                    response.raise_for_status()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if response is None:
+                    observe_http('shopify', 'GET', url, 'error', time.perf_counter() - started)
+                if attempt == SHOPIFY_PAGE_ATTEMPTS:
+                    shopify_log.error('shopify.page_failed', url=url, error=str(e), attempts=attempt)
+                    self.last_error = str(e)
+                    return None
+                error = str(e)
+            except requests.exceptions.RequestException as e:
+                if response is None:
+                    observe_http('shopify', 'GET', url, 'error', time.perf_counter() - started)
+                shopify_log.error('shopify.page_failed', url=url, error=str(e), attempts=attempt,
+                                  body=lambda: e.response.text[:1000] if e.response is not None else None)
+                self.last_error = str(e)
+                return None
+            else:
+                if not retryable:
+                    call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+                    shopify_log.debug('shopify.page', url=url, status=response.status_code,
+                                      bytes=len(response.content), call_limit=call_limit)
+                    if call_limit and '/' in call_limit:
+                        used, _, burst = call_limit.partition('/')
+                        if used.isdigit() and burst.isdigit() and int(used) >= int(burst) - 1:
+                            time.sleep(SHOPIFY_LEAK_SECONDS)
+                    return response
+                error = f"HTTP {response.status_code}"
+
+            delay = 2 ** (attempt - 1)
+            if response is not None and response.status_code == 429:
+                try:
+                    delay = float(response.headers.get('Retry-After', SHOPIFY_LEAK_SECONDS * 2))
+                except ValueError:
+                    pass
+            shopify_log.warning('shopify.page_retry', url=url, error=error, attempt=attempt, delay=delay)
+            record_retry('shopify', url)
+            time.sleep(delay)
+        return None
+
     def test_products_endpoint(self) -> bool:
         """Test the products endpoint with detailed logging"""
         print("🛍️  Тестируем Shopify Products API")
@@ -619,8 +767,12 @@ def test_amazon_sandbox():
     return success
 
 
+@profile_main
 def main():
     """Main function to run integration tests"""
+    # Диагностический прогон: подробности запросов видны, если LOG_LEVEL не задан явно
+    configure_logging(os.getenv('LOG_LEVEL') or 'DEBUG')
+    
     # Initialize the integration tester
     tester = IntegrationTester()
     
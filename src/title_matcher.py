@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Нечеткое сопоставление товаров Shopify без штрихкода с каталогом Amazon
+
+- по каждому товару строятся keyword-запросы к /catalog/2022-04-01/items
+  (производитель + артикулы, иначе производитель + значимые слова названия)
+- страницы результатов проходятся по pageToken, ASIN дедуплицируются
+- кандидаты раскладываются по блокам (бренд, нормализованный артикул),
+  и товар сравнивается только с кандидатами своих блоков, а не со всем каталогом
+- результат - ранжированный список совпадений для ручной проверки
+"""
+import argparse
+import json
+import re
+import time
+import unicodedata
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set
+
+from get_product_schema import AmazonProductSchemaClient
+from mapping_store import MappingStore
+from metrics import record_retry
+from settings import load_settings
+from sp_api_router import get_router
+from structured_log import get_logger
+
+# Загружаем .env из корневой директории проекта
+load_settings()
+
+log = get_logger('title_matcher')
+
+CATALOG_ITEMS_ENDPOINT = "/catalog/2022-04-01/items"
+
+# Тот же лимит searchCatalogItems, что и у поиска по штрихкодам (общий bucket роутера)
+SEARCH_CATALOG_ITEMS_RATE = (2, 2)
+PAGE_SIZE = 20
+MAX_ATTEMPTS = 3
+
+STOP_WORDS = {'the', 'and', 'for', 'with', 'of', 'in', 'to', 'by', 'pack', 'set', 'pcs', 'piece', 'x'}
+
+# Размеры вроде 600MM или 24IN - не артикулы
+DIMENSION_RE = re.compile(r'^\d+(MM|CM|M|IN|INCH|")$')
+CODE_RE = re.compile(r'[A-Z0-9]+(?:[-./][A-Z0-9]+)*')
+WORD_RE = re.compile(r'[a-z0-9]+')
+
+# Вес артикула, слов названия и бренда в итоговой оценке
+PART_WEIGHT = 0.55
+TITLE_WEIGHT = 0.30
+BRAND_WEIGHT = 0.15
+
+
+def _ascii_fold(text: str) -> str:
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+
+
+def normalize_brand(brand: Optional[str]) -> str:
+    """'Bosch Automotive' и 'BOSCH' → 'bosch'"""
+    words = WORD_RE.findall(_ascii_fold(brand or '').lower())
+    return words[0] if words else ''
+
+
+def title_tokens(title: Optional[str], brand: str = '') -> Set[str]:
+    """Значимые слова названия без стоп-слов и бренда"""
+    words = WORD_RE.findall(_ascii_fold(title or '').lower())
+    return {word for word in words if len(word) > 1 and word not in STOP_WORDS and word != brand}
+
+
+def part_number_tokens(*texts: Optional[str]) -> Set[str]:
+    """
+    Нормализованные артикулы: коды с цифрами без разделителей (A950-S → A950S).
+
+    Подряд идущие группы цифр склеиваются: '3 397 118 950' → '3397118950'.
+    """
+    parts = set()
+    for text in texts:
+        if not text:
+            continue
+        digit_run = []
+        for code in CODE_RE.findall(_ascii_fold(text).upper()):
+            normalized = re.sub(r'[-./]', '', code)
+            if normalized.isdigit():
+                digit_run.append(normalized)
+                if len(normalized) >= 5:
+                    parts.add(normalized)
+                continue
+
+            if len(digit_run) > 1 and len(''.join(digit_run)) >= 6:
+                parts.add(''.join(digit_run))
+            digit_run = []
+            if len(normalized) >= 3 and any(c.isdigit() for c in normalized) and not DIMENSION_RE.match(normalized):
+                parts.add(normalized)
+
+        if len(digit_run) > 1 and len(''.join(digit_run)) >= 6:
+            parts.add(''.join(digit_run))
+    return parts
+
+
+def candidate_from_item(item: Dict, marketplace_id: str) -> Optional[Dict]:
+    """Кандидат из элемента ответа Catalog Items (includedData=summaries)"""
+    summaries = item.get('summaries') or []
+    summary = next((s for s in summaries if s.get('marketplaceId') == marketplace_id), summaries[0] if summaries else {})
+    title = summary.get('itemName') or ''
+    if not item.get('asin') or not title:
+        return None
+
+    brand = normalize_brand(summary.get('brand') or summary.get('manufacturer'))
+    return {
+        'asin': item['asin'],
+        'title': title,
+        'brand': brand,
+        'tokens': title_tokens(title, brand),
+        'parts': part_number_tokens(title, summary.get('partNumber'), summary.get('modelNumber'))
+    }
+
+
+def product_features(product: Dict) -> Dict:
+    """Признаки товара Shopify для поиска и сравнения"""
+    brand = normalize_brand(product.get('vendor'))
+    skus = [v['sku'] for v in product.get('variants', []) if v.get('sku')]
+    return {
+        'product_id': product.get('id'),
+        'title': product.get('title') or '',
+        'vendor': product.get('vendor') or '',
+        'skus': skus,
+        'brand': brand,
+        'tokens': title_tokens(product.get('title'), brand),
+        # Артикул часто лежит в SKU варианта
+        'parts': part_number_tokens(product.get('title'), *skus)
+    }
+
+
+class SimilarityIndex:
+    """Кандидаты Amazon, разложенные по блокам (бренд, артикул) и (бренд, None)"""
+
+    def __init__(self):
+        self.candidates: Dict[str, Dict] = {}
+        self.blocks: Dict[tuple, Set[str]] = defaultdict(set)
+
+    def add(self, candidate: Dict) -> bool:
+        """Добавляет кандидата; False - ASIN уже был"""
+        if candidate['asin'] in self.candidates:
+            return False
+        self.candidates[candidate['asin']] = candidate
+        self.blocks[(candidate['brand'], None)].add(candidate['asin'])
+        for part in candidate['parts']:
+            self.blocks[(candidate['brand'], part)].add(candidate['asin'])
+            if candidate['brand']:
+                # Кандидаты без бренда тоже должны находиться по артикулу
+                self.blocks[('', part)].add(candidate['asin'])
+        return True
+
+    def block_for(self, features: Dict) -> Set[str]:
+        asins = set()
+        for part in features['parts']:
+            asins |= self.blocks.get((features['brand'], part), set())
+            asins |= self.blocks.get(('', part), set())
+        if not asins:
+            # Без общего артикула сравниваем только внутри бренда
+            asins = self.blocks.get((features['brand'], None), set())
+        return asins
+
+    @staticmethod
+    def score(features: Dict, candidate: Dict) -> Dict:
+        tokens, other_tokens = features['tokens'], candidate['tokens']
+        union = tokens | other_tokens
+        title_score = len(tokens & other_tokens) / len(union) if union else 0.0
+
+        if candidate['brand'] and features['brand']:
+            brand_score = 1.0 if candidate['brand'] == features['brand'] else 0.0
+        else:
+            brand_score = 0.5
+
+        common_parts = features['parts'] & candidate['parts']
+        if features['parts']:
+            # У товара бывает несколько артикулов (OEM, каталожный), у кандидата - один из них
+            part_score = 1.0 if common_parts else 0.0
+            total = PART_WEIGHT * part_score + TITLE_WEIGHT * title_score + BRAND_WEIGHT * brand_score
+        else:
+            total = (TITLE_WEIGHT * title_score + BRAND_WEIGHT * brand_score) / (TITLE_WEIGHT + BRAND_WEIGHT)
+
+        return {
+            'asin': candidate['asin'],
+            'title': candidate['title'],
+            'brand': candidate['brand'],
+            'score': round(total, 3),
+            'title_score': round(title_score, 3),
+            'common_part_numbers': sorted(common_parts)
+        }
+
+    def rank(self, features: Dict, top_n: int = 5, min_score: float = 0.3) -> List[Dict]:
+        scored = [self.score(features, self.candidates[asin]) for asin in self.block_for(features)]
+        scored = [entry for entry in scored if entry['score'] >= min_score]
+        scored.sort(key=lambda entry: (-entry['score'], entry['asin']))
+        return scored[:top_n]
+
+
+class TitleMatcher:
+    """Собирает кандидатов из Catalog Items API и ранжирует совпадения"""
+
+    def __init__(self, marketplace_id: str, schema_client: AmazonProductSchemaClient = None,
+                 max_pages: int = 2):
+        self.marketplace_id = marketplace_id
+        self.schema_client = schema_client or AmazonProductSchemaClient()
+        self.client = self.schema_client.base_client
+        self.base_url = self.schema_client.get_region_endpoint(marketplace_id)
+        self.bucket = get_router().limiter(self.base_url, 'searchCatalogItems', *SEARCH_CATALOG_ITEMS_RATE)
+        self.max_pages = max_pages
+        self.index = SimilarityIndex()
+        self._seen_queries: Set[tuple] = set()
+
+    @staticmethod
+    def build_queries(features: Dict) -> List[List[str]]:
+        """Наборы ключевых слов: сначала по артикулам, затем по словам названия"""
+        vendor = [features['vendor']] if features['vendor'] else []
+        queries = []
+        # Длинные артикулы специфичнее - ищем по ним в первую очередь
+        for part in sorted(features['parts'], key=len, reverse=True)[:2]:
+            queries.append(vendor + [part])
+        words = sorted(features['tokens'] - {p.lower() for p in features['parts']}, key=len, reverse=True)[:5]
+        if words:
+            queries.append(vendor + words)
+        return queries
+
+    def _request(self, params: Dict) -> Optional[Dict]:
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.bucket.acquire()
+            response = self.client.make_api_request(CATALOG_ITEMS_ENDPOINT, params=params, base_url=self.base_url)
+            if response is not None:
+                return response
+            log.warning('catalog.retry', operation='searchCatalogItems', attempt=attempt,
+                        keywords=params.get('keywords'))
+            if attempt < MAX_ATTEMPTS:
+                record_retry('sp_api', CATALOG_ITEMS_ENDPOINT)
+                self.bucket.drain()
+                time.sleep(2 ** attempt)
+        return None
+
+    def search(self, keywords: List[str]) -> Iterator[Dict]:
+        """Элементы каталога по ключевым словам с переходом по pageToken"""
+        params = {
+            'keywords': ','.join(keywords),
+            'marketplaceIds': self.marketplace_id,
+            'includedData': 'summaries',
+            'pageSize': PAGE_SIZE
+        }
+        for _ in range(self.max_pages):
+            response = self._request(params)
+            if response is None:
+                return
+            yield from response.get('items', [])
+
+            next_token = (response.get('pagination') or {}).get('nextToken')
+            if not next_token:
+                return
+            params = dict(params, pageToken=next_token)
+
+    def collect(self, features: Dict) -> int:
+        """Выполняет запросы товара и добавляет новых кандидатов в индекс"""
+        added = 0
+        for keywords in self.build_queries(features):
+            key = tuple(word.lower() for word in keywords)
+            # Одинаковые запросы у соседних товаров серии выполняем один раз
+            if key in self._seen_queries:
+                continue
+            self._seen_queries.add(key)
+            for item in self.search(keywords):
+                candidate = candidate_from_item(item, self.marketplace_id)
+                if candidate and self.index.add(candidate):
+                    added += 1
+        return added
+
+    def match(self, products: List[Dict], top_n: int = 5, min_score: float = 0.3) -> List[Dict]:
+        """
+        Ранжированный список совпадений для проверки.
+
+        Сначала собираются кандидаты по всем товарам, потом ранжирование:
+        кандидат, найденный запросом соседнего товара, тоже участвует.
+        """
+        if not self.client.access_token and not self.client.get_access_token():
+            raise RuntimeError("Не удалось получить access token")
+
+        all_features = [product_features(product) for product in products]
+        for features in all_features:
+            self.collect(features)
+
+        review = []
+        for features in all_features:
+            matches = self.index.rank(features, top_n, min_score)
+            review.append({
+                'product_id': features['product_id'],
+                'title': features['title'],
+                'vendor': features['vendor'],
+                'skus': features['skus'],
+                'part_numbers': sorted(features['parts']),
+                'best_score': matches[0]['score'] if matches else 0.0,
+                'matches': matches
+            })
+        review.sort(key=lambda entry: -entry['best_score'])
+        return review
+
+
+def main():
+    """Поиск ASIN по названиям для товаров без штрихкода"""
+    from reconcile_catalog import iter_jsonl
+
+    parser = argparse.ArgumentParser(description='Нечеткое сопоставление товаров Shopify с каталогом Amazon')
+    parser.add_argument('--shopify-snapshot', required=True, help='JSONL с товарами Shopify')
+    parser.add_argument('--marketplace', default='USA', help='Название маркетплейса (USA, UK, AUSTRALIA, ...)')
+    parser.add_argument('--max-pages', type=int, default=2, help='Страниц результатов на запрос')
+    parser.add_argument('--top', type=int, default=5, help='Кандидатов на товар в отчете')
+    parser.add_argument('--min-score', type=float, default=0.3, help='Минимальная оценка кандидата')
+    parser.add_argument('--accept-above', type=float,
+                        help='Записать в хранилище совпадения с оценкой не ниже порога (только товары с одним SKU)')
+    parser.add_argument('--store', help='Путь к SQLite хранилищу соответствий')
+    parser.add_argument('--output', help='Файл отчета (по умолчанию title_matches_<время>.json)')
+    args = parser.parse_args()
+
+    print("🔤 СОПОСТАВЛЕНИЕ ПО НАЗВАНИЯМ")
+    print("=" * 60)
+
+    schema_client = AmazonProductSchemaClient()
+    marketplace_id = schema_client.marketplaces.get(args.marketplace.upper())
+    if not marketplace_id:
+        print(f"❌ Неизвестный маркетплейс: {args.marketplace}")
+        return
+
+    store = MappingStore(args.store)
+    already_matched = store.matched_skus(marketplace_id)
+
+    # Товары, у которых ни один SKU еще не сопоставлен (в т.ч. по штрихкоду)
+    products = [
+        product for product in iter_jsonl(args.shopify_snapshot)
+        if not any(v.get('sku') in already_matched for v in product.get('variants', []))
+    ]
+    print(f"📦 Товаров без ASIN: {len(products)}")
+
+    started = datetime.now()
+    matcher = TitleMatcher(marketplace_id, schema_client, max_pages=args.max_pages)
+    review = matcher.match(products, top_n=args.top, min_score=args.min_score)
+    elapsed = (datetime.now() - started).total_seconds()
+
+    with_matches = sum(1 for entry in review if entry['matches'])
+    print(f"\n📊 ИТОГО ({elapsed:.1f} сек):")
+    print(f"   🔎 Запросов: {len(matcher._seen_queries)}, кандидатов: {len(matcher.index.candidates)}")
+    print(f"   ✅ Товаров с кандидатами: {with_matches} из {len(review)}")
+
+    if args.accept_above is not None:
+        accepted = [
+            {
+                'sku': entry['skus'][0],
+                'asin': entry['matches'][0]['asin'],
+                'product_type': None,
+                'matched_by': 'TITLE',
+                'matched_value': str(entry['best_score'])
+            }
+            for entry in review
+            if len(entry['skus']) == 1 and entry['matches'] and entry['best_score'] >= args.accept_above
+        ]
+        store.save_sku_asins(marketplace_id, accepted)
+        print(f"   💾 Принято автоматически: {len(accepted)}")
+    store.close()
+
+    output = args.output or f"title_matches_{started.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'generated_at': started.isoformat(),
+            'marketplace_id': marketplace_id,
+            'products': len(review),
+            'review': review
+        }, f, indent=2, ensure_ascii=False)
+
+    print(f"\n💾 Список на проверку сохранен в: {output}")
+
+
+if __name__ == "__main__":
+    main()
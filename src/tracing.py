@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Легковесная трассировка конвейера: спаны этапов и HTTP-запросов в локальный файл
+
+    with span('feed.submit', feed_type='POST_PRODUCT_DATA', marketplace_id=...):
+        ...
+        current_span().set(feed_id=feed_id)
+
+- родитель спана берется из contextvars, поэтому вложенность этапов и запросов
+  восстанавливается сама (SpApiRouter.fan_out передает контекст в потоки)
+- sku, marketplace_id и feed_id наследуются дочерними спанами: все запросы
+  одного SKU находятся фильтром по атрибуту, даже если SKU стал известен по ходу
+- без TRACE_FILE трассировка выключена и span() почти ничего не стоит
+
+Форматы файла (TRACE_FORMAT):
+- chrome (по умолчанию) - Trace Event Format, открывается в ui.perfetto.dev и chrome://tracing
+- otlp - OTLP/JSON, по одному ExportTraceServiceRequest на строку
+  (формат file exporter OpenTelemetry Collector; загружается в Jaeger/Tempo через collector)
+"""
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from structured_log import redact
+
+SERVICE_NAME = 'shopify-amazon-sync'
+
+# Атрибуты корреляции: переходят от родителя ко всем дочерним спанам
+CORRELATION_KEYS = ('sku', 'marketplace_id', 'feed_id')
+
+# Сколько завершенных спанов копится в памяти до записи в файл
+FLUSH_EVERY = 256
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """Один интервал работы: имя, атрибуты, родитель и длительность"""
+
+    __slots__ = ('name', 'kind', 'trace_id', 'span_id', 'parent_id', 'attributes',
+                 'start_ns', 'end_ns', 'status', 'error', 'thread_id')
+
+    def __init__(self, name: str, kind: str, parent: Optional['Span'], attributes: Dict[str, Any]):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        inherited = {key: parent.attributes[key] for key in CORRELATION_KEYS
+                     if parent and key in parent.attributes}
+        self.attributes = {**inherited, **attributes}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = 'ok'
+        self.error = None
+        self.thread_id = threading.get_ident()
+
+    def set(self, **attributes) -> 'Span':
+        self.attributes.update(attributes)
+        return self
+
+    def fail(self, error: str) -> 'Span':
+        self.status = 'error'
+        self.error = error
+        return self
+
+
+class _NoopSpan:
+    """Заглушка при выключенной трассировке: set()/fail() ничего не делают"""
+
+    attributes: Dict[str, Any] = {}
+
+    def set(self, **attributes) -> '_NoopSpan':
+        return self
+
+    def fail(self, error: str) -> '_NoopSpan':
+        return self
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _clean_attributes(attributes: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in redact(attributes).items() if value is not None}
+
+
+class ChromeTraceExporter:
+    """Trace Event Format (JSON Array): допускает незакрытый массив, поэтому пишется потоково"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pid = os.getpid()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('[\n')
+            f.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                                'args': {'name': SERVICE_NAME}}) + ',\n')
+
+    def export(self, spans: List[Span]) -> None:
+        lines = []
+        for item in spans:
+            args = _clean_attributes(item.attributes)
+            args.update(trace_id=item.trace_id, span_id=item.span_id)
+            if item.parent_id:
+                args['parent_id'] = item.parent_id
+            if item.error:
+                args['error'] = item.error
+            lines.append(json.dumps({
+                'name': item.name,
+                'cat': item.kind,
+                'ph': 'X',
+                'ts': item.start_ns / 1000,
+                'dur': (item.end_ns - item.start_ns) / 1000,
+                'pid': self.pid,
+                'tid': item.thread_id,
+                'args': args,
+            }, ensure_ascii=False, default=str) + ',\n')
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+
+
+class OtlpJsonExporter:
+    """OTLP/JSON: строка = ExportTraceServiceRequest с пачкой спанов"""
+
+    KINDS = {'internal': 1, 'client': 3}
+
+    def __init__(self, path: str):
+        self.path = path
+        open(self.path, 'w').close()
+
+    @staticmethod
+    def _value(value) -> Dict:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)}
+
+    def export(self, spans: List[Span]) -> None:
+        otlp_spans = []
+        for item in spans:
+            entry = {
+                'traceId': item.trace_id,
+                'spanId': item.span_id,
+                'name': item.name,
+                'kind': self.KINDS.get(item.kind, 1),
+                'startTimeUnixNano': str(item.start_ns),
+                'endTimeUnixNano': str(item.end_ns),
+                'attributes': [{'key': key, 'value': self._value(value)}
+                               for key, value in _clean_attributes(item.attributes).items()],
+                'status': {'code': 2, 'message': item.error or ''} if item.status == 'error' else {'code': 1},
+            }
+            if item.parent_id:
+                entry['parentSpanId'] = item.parent_id
+            otlp_spans.append(entry)
+        request = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+            'scopeSpans': [{'scope': {'name': 'sync'}, 'spans': otlp_spans}],
+        }]}
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(request, ensure_ascii=False, default=str) + '\n')
+
+
+EXPORTERS = {'chrome': ChromeTraceExporter, 'otlp': OtlpJsonExporter}
+
+_lock = threading.Lock()
+_exporter = None
+_pending: List[Span] = []
+_configured = False
+
+
+def configure_tracing(path: str = None, fmt: str = None) -> bool:
+    """
+    Включает запись спанов в файл (по умолчанию TRACE_FILE / TRACE_FORMAT).
+
+    Возвращает True, если трассировка включена. Повторный вызов дописывает
+    накопленное и начинает новый файл.
+    """
+    global _exporter, _configured
+    path = path or os.getenv('TRACE_FILE')
+    fmt = (fmt or os.getenv('TRACE_FORMAT') or 'chrome').lower()
+    if fmt not in EXPORTERS:
+        raise ValueError(f"Неизвестный формат трассировки: {fmt} ({' или '.join(EXPORTERS)})")
+
+    flush()
+    with _lock:
+        if path:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            if _exporter is None:
+                atexit.register(flush)
+            _exporter = EXPORTERS[fmt](path)
+        else:
+            _exporter = None
+        _configured = True
+    return _exporter is not None
+
+
+def enabled() -> bool:
+    if not _configured:
+        configure_tracing()
+    return _exporter is not None
+
+
+def flush() -> None:
+    """Записывает накопленные спаны"""
+    global _pending
+    with _lock:
+        spans, _pending = _pending, []
+        exporter = _exporter
+    if spans and exporter is not None:
+        exporter.export(spans)
+
+
+def _finish(item: Span) -> None:
+    item.end_ns = time.time_ns()
+    with _lock:
+        _pending.append(item)
+        full = len(_pending) >= FLUSH_EVERY
+    if full:
+        flush()
+
+
+def current_span():
+    """Открытый спан текущего контекста (или заглушка)"""
+    return _current_span.get() or NOOP_SPAN
+
+
+@contextmanager
+def span(name: str, kind: str = 'internal', **attributes):
+    """Спан вокруг блока; исключение помечает спан ошибкой и пробрасывается дальше"""
+    if not enabled():
+        yield NOOP_SPAN
+        return
+
+    item = Span(name, kind, _current_span.get(), attributes)
+    token = _current_span.set(item)
+    try:
+        yield item
+    except BaseException as e:
+        item.fail(repr(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        _finish(item)
+
+
+def http_span(service: str, method: str, url: str, **attributes):
+    """Спан HTTP-запроса: хост и путь без query (в query бывают подписи presigned URL)"""
+    parts = urlsplit(url)
+    return span(f"{service} {method.upper()}", kind='client', **{
+        'http.method': method.upper(),
+        'http.url': f"{parts.scheme}://{parts.netloc}{parts.path}",
+        **attributes,
+    })
+
+
+def traced(name: str):
+    """Декоратор: весь вызов функции - один спан"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Пул процессов для CPU-этапов: разбор товаров Shopify и рендер Product feed
+
+    pool = TransformPool()                            # TRANSFORM_WORKERS или число ядер - 1
+    results = pool.map_products(products, 'USA')      # [(product_data, None) | (None, причина)]
+    xml = pool.render_listing_feed([product_data, ...])
+    pool.close()
+
+Когда выгрузка из Shopify стала параллельной, узким местом остались
+shopify_product_data (HTML описания → текст и пункты) и create_amazon_listing_xml
+(ElementTree + minidom) на одном ядре. Пул делит записи на шарды и обрабатывает
+их в рабочих процессах:
+- шард уходит в процесс одним JSON-блоком (bytes), а не списком словарей:
+  pickle обходит каждый ключ и значение, bytes копируется целиком
+- рабочий процесс возвращает готовые фрагменты <Message> с MessageID,
+  проставленными по смещению шарда; родитель только склеивает строки в порядке
+  шардов, без повторного разбора XML (как в sync_daemon.merge_feed_messages)
+- небольшие пачки (меньше MIN_PARALLEL_RECORDS) и TRANSFORM_WORKERS=1
+  обрабатываются в текущем процессе - запуск пула и IPC дороже самой работы
+
+Процессы создаются через spawn: у демона к этому моменту уже есть потоки
+(фиды в работе, логирование), а fork с занятыми чужими блокировками может
+зависнуть. Трассировка, метрики, профиль и HTTP-кассета принадлежат родителю -
+рабочие процессы их не открывают.
+"""
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+# Меньше записей - обработка в текущем процессе
+MIN_PARALLEL_RECORDS = 200
+# Шардов на процесс: долгий последний шард не оставляет остальные процессы без дела
+SHARDS_PER_WORKER = 4
+
+# Переменные, по которым процесс открывает файлы и порты: в рабочих процессах не нужны
+PARENT_ONLY_ENV = ('TRACE_FILE', 'METRICS_FILE', 'METRICS_PORT', 'SYNC_PROFILE', 'HTTP_CASSETTE')
+
+FEED_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+ENVELOPE_END = '</AmazonEnvelope>'
+
+_creator = None
+
+
+def default_workers() -> int:
+    """TRANSFORM_WORKERS или все ядра, кроме одного (родитель занят HTTP и очередями)"""
+    value = os.getenv('TRANSFORM_WORKERS')
+    if value:
+        return max(1, int(value))
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def _init_worker() -> None:
+    for key in PARENT_ONLY_ENV:
+        os.environ.pop(key, None)
+
+
+def _get_creator():
+    """Один ShopifyToAmazonCreator на процесс (конструктор в сеть не ходит)"""
+    global _creator
+    if _creator is None:
+        from create_sku_in_amazon import ShopifyToAmazonCreator
+        _creator = ShopifyToAmazonCreator()
+    return _creator
+
+
+def map_record(product: Dict, marketplace: str) -> Tuple[Optional[Dict], Optional[str]]:
+    """Товар Shopify → (product_data, None) или (None, причина, по которой его не синхронизировать)"""
+    from create_sku_in_amazon import shopify_product_data
+    try:
+        data = shopify_product_data(product, marketplace)
+    except Exception as e:
+        return None, repr(e)
+    if not data['variants'] or not data['variants'][0]['sku']:
+        return None, 'у товара нет SKU'
+    return data, None
+
+
+def render_listing_messages(records: List[Dict], first_message_id: int) -> Tuple[str, str]:
+    """
+    Product feed для записей → (начало конверта до первого <Message>, фрагменты <Message>).
+
+    Фрагменты сериализуются вместе с хвостовым пробелом - склеенные подряд,
+    они дают тот же текст, что и merge_feed_messages.
+    """
+    creator = _get_creator()
+    head, fragments = None, []
+    # Билдер печатает ход работы для ручного запуска
+    with contextlib.redirect_stdout(io.StringIO()):
+        for offset, product_data in enumerate(records):
+            root = ET.fromstring(creator.create_amazon_listing_xml(product_data)[0])
+            message = root.find('Message')
+            message.find('MessageID').text = str(first_message_id + offset)
+            fragments.append(ET.tostring(message, encoding='unicode'))
+            if head is None:
+                root.remove(message)
+                head = ET.tostring(root, encoding='unicode')[:-len(ENVELOPE_END)]
+    return head, ''.join(fragments)
+
+
+def _map_shard(blob: bytes, marketplace: str) -> bytes:
+    products = json.loads(blob)
+    return json.dumps([map_record(product, marketplace) for product in products],
+                      ensure_ascii=False, default=str).encode('utf-8')
+
+
+def _render_shard(blob: bytes, first_message_id: int) -> Tuple[str, str]:
+    return render_listing_messages(json.loads(blob), first_message_id)
+
+
+class TransformPool:
+    """Пул процессов создается при первой большой пачке и живет до close()"""
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or default_workers()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def parallel(self, count: int) -> bool:
+        return self.workers > 1 and count >= MIN_PARALLEL_RECORDS
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_worker)
+        return self._executor
+
+    def _shards(self, records: List[Dict]) -> Tuple[List[int], List[bytes]]:
+        """Смещения шардов и их JSON-блоки"""
+        size = math.ceil(len(records) / (self.workers * SHARDS_PER_WORKER))
+        starts = list(range(0, len(records), size))
+        blobs = [json.dumps(records[start:start + size], ensure_ascii=False, default=str).encode('utf-8')
+                 for start in starts]
+        return starts, blobs
+
+    def map_products(self, products: List[Dict], marketplace: str) -> List[Tuple[Optional[Dict], Optional[str]]]:
+        """map_record для каждого товара, в порядке products"""
+        if not self.parallel(len(products)):
+            return [map_record(product, marketplace) for product in products]
+
+        _starts, blobs = self._shards(products)
+        results = self._pool().map(_map_shard, blobs, [marketplace] * len(blobs))
+        return [tuple(pair) for blob in results for pair in json.loads(blob)]
+
+    def render_listing_feed(self, records: List[Dict]) -> str:
+        """Один Product feed на все записи, MessageID по порядку с 1"""
+        if not self.parallel(len(records)):
+            shards = [render_listing_messages(records, 1)]
+        else:
+            starts, blobs = self._shards(records)
+            # map отдает результаты в порядке шардов - MessageID идут подряд
+            shards = list(self._pool().map(_render_shard, blobs, [start + 1 for start in starts]))
+
+        head = shards[0][0]
+        return FEED_DECLARATION + head + ''.join(fragments for _head, fragments in shards) + ENVELOPE_END
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None